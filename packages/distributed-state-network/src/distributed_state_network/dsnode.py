@@ -177,8 +177,19 @@ class DSNode:
                     if self.disconnect_cb is not None:
                         self.disconnect_cb()
 
-    def send_http_request(self, endpoint: Endpoint, msg_type: int, payload: bytes, retries: int = 0) -> bytes:
-        """Send HTTP request and wait for response"""
+    def send_http_request(
+            self,
+            endpoint: Endpoint,
+            msg_type: int,
+            payload: bytes,
+            retries: int = 0,
+            timeout: Optional[float] = None,
+            max_retries: int = 2
+        ) -> bytes:
+        """Send HTTP request and wait for response.
+
+        `timeout` replaces the one scaled to the transfer size, and a failed
+        request is tried again up to `max_retries` times."""
         try:
             # Prepend message type to payload
             data = bytes([msg_type]) + payload
@@ -190,7 +201,8 @@ class DSNode:
             url = f"http://{endpoint.address}:{endpoint.port}{path}"
             
             # Scale timeout to transfer size
-            timeout = max(HTTP_TIMEOUT, len(data) / MIN_TRANSFER_BYTES_PER_SEC)
+            if timeout is None:
+                timeout = max(HTTP_TIMEOUT, len(data) / MIN_TRANSFER_BYTES_PER_SEC)
 
             # Send HTTP POST request
             response = requests.post(
@@ -224,22 +236,29 @@ class DSNode:
             return response_data[1:]
             
         except requests.exceptions.Timeout:
-            if retries < 2:
+            if retries < max_retries:
                 time.sleep(0.5)
-                return self.send_http_request(endpoint, msg_type, payload, retries + 1)
+                return self.send_http_request(endpoint, msg_type, payload, retries + 1, timeout, max_retries)
             else:
                 raise Exception(f"HTTP request to {endpoint.to_string()} timed out")
         except requests.exceptions.RequestException:
-            if retries < 2:
+            if retries < max_retries:
                 time.sleep(0.5)
-                return self.send_http_request(endpoint, msg_type, payload, retries + 1)
+                return self.send_http_request(endpoint, msg_type, payload, retries + 1, timeout, max_retries)
             else:
                 raise Exception(f"HTTP request to {endpoint.to_string()} failed")
 
-    def send_request_to_node(self, node_id: str, msg_type: int, payload: bytes) -> bytes:
+    def send_request_to_node(
+            self,
+            node_id: str,
+            msg_type: int,
+            payload: bytes,
+            timeout: Optional[float] = None,
+            max_retries: int = 2
+        ) -> bytes:
         self.ensure_node_id_allowed(node_id)
         con = self.connection_from_node(node_id)
-        return self.send_http_request(con, msg_type, payload)
+        return self.send_http_request(con, msg_type, payload, timeout=timeout, max_retries=max_retries)
 
     def encrypt_data(self, data: bytes) -> bytes:
         key = self.get_aes_key()
@@ -474,9 +493,11 @@ class DSNode:
     def peers(self) -> List[str]:
         return list(self.node_states.keys())
 
-    def send_to_node(self, node_id: str, data: bytes) -> str:
+    def send_to_node(self, node_id: str, data: bytes, timeout: Optional[float] = None, retries: int = 2) -> str:
+        """Send `data` to `node_id`. Returns what the receive callback there
+        answered, "OK" if it answered nothing."""
         pkt = DataPacket.create(self.config.node_id, self.cred_manager.my_private(), data)
-        response = self.send_request_to_node(node_id, MSG_DATA, pkt.to_bytes())
+        response = self.send_request_to_node(node_id, MSG_DATA, pkt.to_bytes(), timeout, retries)
         try:
             return response.decode('utf-8')
         except Exception:
@@ -496,7 +517,9 @@ class DSNode:
         
         if self.receive_cb is not None:
             try:
-                self.receive_cb(pkt.node_id, pkt.data)
+                reply = self.receive_cb(pkt.node_id, pkt.data)
+                if isinstance(reply, bytes):
+                    return reply
             except Exception as e:
                 print(e)
 
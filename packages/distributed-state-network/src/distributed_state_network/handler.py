@@ -241,8 +241,8 @@ class DSNodeServer(StateNetworkNode):
     def update_data(self, key: str, value: str):
         self.node.update_data(key, value)
 
-    def send_to_node(self, node_id: str, data: bytes):
-        self.node.send_to_node(node_id, data)
+    def send_to_node(self, node_id: str, data: bytes, timeout: Optional[float] = None, retries: int = 2) -> str:
+        return self.node.send_to_node(node_id, data, timeout, retries)
 
     def is_shut_down(self) -> bool:
         return self.node.shutting_down
@@ -261,4 +261,4 @@ class DSNodeServer(StateNetworkNode):
 
     def receive_data(self, data: bytes):
         if self.node.receive_cb is not None:
-            self.node.receive_cb(self.config.node_id, data)
+            return self.node.receive_cb(self.config.node_id, data)
@@ -19,7 +19,7 @@ class StateNetworkNode(Protocol):
     def is_shut_down(self) -> bool:
         ...
 
-    def send_to_node(self, node_id: str, data: bytes):
+    def send_to_node(self, node_id: str, data: bytes, timeout: Optional[float] = None, retries: int = 2) -> str:
         ...
 
     def set_receive_cb(self, cb: Callable):
@@ -56,6 +56,15 @@ class TestStateData(DSNTestBase):
         self.assertEqual(len(received_data), 1)
         self.assertEqual(received_data[0], payload)
 
+    def test_send_to_node_returns_the_receivers_reply(self):
+        """A receive callback that returns bytes answers the sender with them"""
+        bootstrap = spawn_node("bootstrap", "127.0.0.1")
+        bootstrap.set_receive_cb(lambda _, data: b"BUSY")
+        connector = spawn_node("connector", None, [bootstrap.node.my_con().to_json()])
+
+        resp = connector.send_to_node("bootstrap", b"Hello", timeout=2, retries=0)
+        self.assertEqual(resp, "BUSY")
+
     def test_send_to_node_wrapper(self):
         """DSNodeServer.send_to_node wrapper should work"""
         bootstrap = spawn_node("bootstrap", "127.0.0.1")
@@ -0,0 +1,199 @@
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers.cache_utils import Cache
+
+from llm_layer_collector.state_obj import LLmComputationState
+
+
+def _left_pad(t: torch.Tensor, length: int, dim: int, value: float = 0) -> torch.Tensor:
+    """Pad `t` at the front of `dim` so it is `length` long."""
+    missing = length - t.shape[dim]
+    if missing == 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = missing
+    pad = torch.full(shape, value, dtype=t.dtype, device=t.device)
+    return torch.cat([pad, t], dim=dim)
+
+
+def _left_pad_cat(tensors: List[torch.Tensor], dim: int) -> torch.Tensor:
+    length = max(t.shape[dim] for t in tensors)
+    return torch.cat([_left_pad(t, length, dim) for t in tensors], dim=0)
+
+
+def _materialize_mask(mask: Optional[torch.Tensor], query_length: int, kv_length: int, device: torch.device) -> torch.Tensor:
+    """A row's mask as an explicit `[1, 1, query_length, kv_length]` tensor.
+
+    transformers returns None when the mask is pure causal and SDPA can skip it,
+    which for one sequence means "attend to everything up to yourself".
+    """
+    if mask is not None:
+        return mask
+    q = torch.arange(query_length, device=device).unsqueeze(1)
+    k = torch.arange(kv_length, device=device).unsqueeze(0)
+    return (k <= q + (kv_length - query_length)).view(1, 1, query_length, kv_length)
+
+
+def _pad_mask(mask: torch.Tensor, query_length: int, kv_length: int, dtype: Optional[torch.dtype]) -> torch.Tensor:
+    """Left-pad a row mask to `[1, 1, query_length, kv_length]`.
+
+    Padding keys are masked out. Padding queries only attend to the row's last
+    key: their output is thrown away, but a query that can see nothing turns
+    into NaN under softmax.
+
+    `dtype` is None for boolean (SDPA) masks; otherwise the additive float mask
+    eager attention expects, where a masked position holds the dtype's minimum.
+    """
+    if dtype is None:
+        keep, drop = True, False
+        mask = mask.bool()
+    else:
+        keep, drop = 0, torch.finfo(dtype).min
+        if mask.dtype == torch.bool:
+            mask = torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill(~mask, drop)
+        mask = mask.to(dtype)
+
+    mask = _left_pad(mask, kv_length, -1, drop)
+    missing = query_length - mask.shape[-2]
+    if missing == 0:
+        return mask
+    pad = torch.full((1, 1, missing, kv_length), drop, dtype=mask.dtype, device=mask.device)
+    pad[..., -1] = keep
+    return torch.cat([pad, mask], dim=-2)
+
+
+class BatchedComputationState:
+    """Several sequences' computation states stacked into one batch.
+
+    Every row keeps the masks, rotary embeddings and position ids its own
+    embedding node built for it, so nothing about a sequence changes by being
+    batched. Rows can be at different points in their conversation, which means
+    their key/value histories differ in length: keys are left-padded to the
+    longest row and the padding columns are masked out of each row's mask. Each
+    row still reads and writes its own cache through `BatchedCache`.
+
+    Rows can also carry different numbers of new tokens (prefill chunks of
+    different sizes, or prefill next to decode). Queries are left-padded the
+    same way; padding positions never reach a cache and `split` drops them.
+    """
+
+    rows: List[LLmComputationState]
+    state: LLmComputationState
+    # Longest row's query length; every row is padded to it
+    query_length: int
+    query_lengths: List[int]
+    # Per mask type, how many keys each row attends over
+    kv_lengths: Dict[str, List[int]]
+
+    def __init__(self, rows: List[LLmComputationState]):
+        if len(rows) == 0:
+            raise ValueError("cannot batch zero sequences")
+
+        self.rows = rows
+        self.query_lengths = [r.state.shape[1] for r in rows]
+        self.query_length = max(self.query_lengths)
+        device = rows[0].state.device
+
+        # Keys each row sees if its mask was skipped: everything so far plus itself
+        full_lengths = [int(r.cache_position[-1].item()) + 1 for r in rows]
+
+        causal_mask: Dict[str, Optional[torch.Tensor]] = {}
+        self.kv_lengths = {}
+        for key in rows[0].causal_mask:
+            masks = [r.causal_mask.get(key) for r in rows]
+            if key == "linear_attention":
+                # Linear attention layers run one row at a time (see compute_layer_batch)
+                causal_mask[key] = None
+                continue
+
+            masks = [
+                _materialize_mask(m, self.query_lengths[i], full_lengths[i], device)
+                .expand(-1, -1, self.query_lengths[i], -1)
+                for i, m in enumerate(masks)
+            ]
+            self.kv_lengths[key] = [m.shape[-1] for m in masks]
+            float_dtype = next((m.dtype for m in masks if m.dtype != torch.bool), None)
+            kv_length = max(self.kv_lengths[key])
+            causal_mask[key] = torch.cat(
+                [_pad_mask(m, self.query_length, kv_length, float_dtype) for m in masks], dim=0
+            )
+
+        position_embeddings: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        for key in rows[0].position_embeddings:
+            position_embeddings[key] = (
+                _left_pad_cat([r.position_embeddings[key][0] for r in rows], -2),
+                _left_pad_cat([r.position_embeddings[key][1] for r in rows], -2),
+            )
+
+        # Gemma4 KV sharing: keys and values produced upstream for each row
+        shared_kv_states: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        for key in rows[0].shared_kv_states:
+            shared_kv_states[key] = (
+                _left_pad_cat([r.shared_kv_states[key][0] for r in rows], -2),
+                _left_pad_cat([r.shared_kv_states[key][1] for r in rows], -2),
+            )
+
+        per_layer_inputs = None
+        if rows[0].per_layer_inputs is not None:
+            per_layer_inputs = _left_pad_cat([r.per_layer_inputs for r in rows], 1)  # type: ignore
+
+        self.state = LLmComputationState(
+            state=_left_pad_cat([r.state for r in rows], 1),
+            position_ids=_left_pad_cat([r.position_ids for r in rows], 1),
+            # Not read by the layers; each row's own positions are in position_ids
+            cache_position=rows[0].cache_position,
+            causal_mask=causal_mask,
+            position_embeddings=position_embeddings,
+            per_layer_inputs=per_layer_inputs,
+            shared_kv_states=shared_kv_states,
+        )
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def split(self, hidden_state: torch.Tensor) -> List[torch.Tensor]:
+        """One `[1, L, hidden]` tensor per row of a batched hidden state, without
+        the query padding."""
+        return [hidden_state[i:i + 1, -length:] for i, length in enumerate(self.query_lengths)]
+
+    def join(self, hidden_states: List[torch.Tensor]) -> torch.Tensor:
+        """The inverse of `split`: per-row hidden states back in the padded batch layout."""
+        return _left_pad_cat(hidden_states, 1)
+
+    def split_shared_kv_states(self) -> List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]]:
+        """Each row's shared keys/values with the batch padding removed."""
+        rows: List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]] = [{} for _ in self.rows]
+        for key, (k, v) in self.state.shared_kv_states.items():
+            lengths = self.kv_lengths.get(key)
+            for i in range(len(self.rows)):
+                length = k.shape[-2] if lengths is None else lengths[i]
+                rows[i][key] = (k[i:i + 1, :, -length:], v[i:i + 1, :, -length:])
+        return rows
+
+
+class BatchedCache:
+    """Presents one cache per batch row to attention as a single batched cache.
+
+    Attention hands `update` the new keys/values for every row at once. Each row
+    is written to its own cache, which returns that row's whole history; the
+    histories are left-padded to a common length to line up with the padded
+    masks built by `BatchedComputationState`. Query padding is cut off before
+    anything is written, so a row's cache only ever sees its own tokens.
+    """
+
+    def __init__(self, caches: List[Cache], query_lengths: Optional[List[int]] = None):
+        self.caches = caches
+        self.query_lengths = query_lengths
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int, *args, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:  # type: ignore
+        keys: List[torch.Tensor] = []
+        values: List[torch.Tensor] = []
+        for i, cache in enumerate(self.caches):
+            length = key_states.shape[-2] if self.query_lengths is None else self.query_lengths[i]
+            k, v = cache.update(
+                key_states[i:i + 1, :, -length:], value_states[i:i + 1, :, -length:], layer_idx, *args, **kwargs
+            )
+            keys.append(k)
+            values.append(v)
+        return _left_pad_cat(keys, -2), _left_pad_cat(values, -2)
@@ -1,5 +1,5 @@
 import torch
-from typing import Optional
+from typing import List, Optional, Union
 
 from transformers.cache_utils import DynamicCache
 from transformers.configuration_utils import PretrainedConfig
@@ -7,6 +7,7 @@ from transformers.configuration_utils import PretrainedConfig
 from llm_layer_collector.state_obj import LLmComputationState
 from llm_layer_collector.auto.auto_layer import AutoDecoderLayer
 from llm_layer_collector.auto.cache_view import PartialCacheMaskView
+from llm_layer_collector.auto.batch import BatchedCache, BatchedComputationState
 
 from llm_layer_collector.modeling.Phi3Model import Phi3Model
 from llm_layer_collector.modeling.Qwen3Model import Qwen3Model
@@ -29,39 +30,119 @@ class StaticAutoModel:
         cache: DynamicCache,
         per_layer_embedder: Optional[torch.nn.Module] = None,
         past_seen_tokens: Optional[int] = None,
+        kept_tokens: Optional[int] = None,
     ) -> LLmComputationState:
+        """`kept_tokens` is how many of the `past_seen_tokens` the cache still
+        holds, for caches that drop tokens (a rolling window). The new tokens
+        keep their positions; the masks cover only the kept tokens."""
         device = input_embedder.weight.device
 
-        input_seq = input_ids.clone()
-
         # Callers that only host part of the layer stack must pass the count
         # themselves - the local cache cannot report it (see PartialCacheMaskView).
         if past_seen_tokens is None:
             past_seen_tokens = cache.get_seq_length()
 
+        input_seq = StaticAutoModel._select_input(prompt_tokens, chunk_size, input_ids.clone(), past_seen_tokens)
+        hidden_state = input_embedder(input_seq.to(device))
+
+        per_layer_inputs = None
+        # Gemma4 Per-Layer Embeddings: computed once here on the node that owns the
+        # (very large) per-layer embedding table, then shipped read-only in JobData.
+        if per_layer_embedder is not None:
+            per_layer_inputs = per_layer_embedder(input_seq.to(device), hidden_state)
+
+        return StaticAutoModel._build_state(hidden_state, per_layer_inputs, config, cache, past_seen_tokens, kept_tokens)
+
+    @staticmethod
+    def compute_embedding_batch(
+        prompt_tokens: List[int],
+        chunk_size: Union[int, List[int]],
+        input_embedder: torch.nn.Embedding,
+        input_ids: List[torch.Tensor],
+        config: PretrainedConfig,
+        caches: List[DynamicCache],
+        past_seen_tokens: List[int],
+        per_layer_embedder: Optional[torch.nn.Module] = None,
+        kept_tokens: Optional[List[int]] = None,
+    ) -> List[LLmComputationState]:
+        """compute_embedding for several sequences with one embedding lookup.
+
+        Each sequence selects its own slice - a prefill chunk of any length or
+        its newest token - and the slices are embedded end to end as one row.
+        Masks and rotary embeddings are still built per sequence, so each state
+        is exactly what compute_embedding returns for it. `chunk_size` is shared
+        by every sequence or given per sequence, and so are `kept_tokens`.
+        """
+        device = input_embedder.weight.device
+        chunk_sizes = chunk_size if isinstance(chunk_size, list) else [chunk_size] * len(input_ids)
+        seqs = [
+            StaticAutoModel._select_input(prompt_tokens[i], chunk_sizes[i], ids.clone(), past_seen_tokens[i])
+            for i, ids in enumerate(input_ids)
+        ]
+        lengths = [s.shape[1] for s in seqs]
+
+        input_seq = torch.cat(seqs, dim=1).to(device)
+        hidden_state = input_embedder(input_seq)
+        per_layer_inputs = None
+        if per_layer_embedder is not None:
+            per_layer_inputs = per_layer_embedder(input_seq, hidden_state)
+
+        states: List[LLmComputationState] = []
+        start = 0
+        for i, length in enumerate(lengths):
+            end = start + length
+            states.append(StaticAutoModel._build_state(
+                hidden_state[:, start:end],
+                None if per_layer_inputs is None else per_layer_inputs[:, start:end],
+                config,
+                caches[i],
+                past_seen_tokens[i],
+                None if kept_tokens is None else kept_tokens[i]
+            ))
+            start = end
+        return states
+
+    @staticmethod
+    def _select_input(prompt_tokens: int, chunk_size: int, input_seq: torch.Tensor, past_seen_tokens: int) -> torch.Tensor:
+        """The slice of `input_seq` to embed next: a prefill chunk or the newest token."""
         remaining = prompt_tokens - past_seen_tokens
         if remaining > 0:
             take = min(chunk_size, remaining)
-            input_seq = input_seq[:, past_seen_tokens:past_seen_tokens + take]
-        else:
-            input_seq = input_seq[:, past_seen_tokens:past_seen_tokens + 1]
-        
-        hidden_state = input_embedder(input_seq.to(device))
+            return input_seq[:, past_seen_tokens:past_seen_tokens + take]
+        return input_seq[:, past_seen_tokens:past_seen_tokens + 1]
 
-        L = input_seq.size()[1]
+    @staticmethod
+    def _build_state(
+        hidden_state: torch.Tensor,
+        per_layer_inputs: Optional[torch.Tensor],
+        config: PretrainedConfig,
+        cache: DynamicCache,
+        past_seen_tokens: int,
+        kept_tokens: Optional[int] = None
+    ) -> LLmComputationState:
+        """Positions, masks and rotary embeddings for one embedded sequence.
+
+        `cache_position` indexes the cache, `position_ids` the sequence. They
+        only differ when the cache dropped tokens (`kept_tokens`)."""
+        device = hidden_state.device
+        L = hidden_state.size()[1]
+        if kept_tokens is None:
+            kept_tokens = past_seen_tokens
         
         cache_position = torch.arange(
-            past_seen_tokens, end=past_seen_tokens + L, device=device
+            kept_tokens, end=kept_tokens + L, device=device
         )
         
-        position_ids = cache_position.unsqueeze(0)
+        position_ids = torch.arange(
+            past_seen_tokens, end=past_seen_tokens + L, device=device
+        ).unsqueeze(0)
 
         mask_kwargs = { # pyright: ignore[reportUnknownVariableType]
             "config": config,
             "inputs_embeds": hidden_state.detach(),
             # Let transformers build the default causal/sliding masks.
             "attention_mask": None,
-            "past_key_values": PartialCacheMaskView(cache, past_seen_tokens),
+            "past_key_values": PartialCacheMaskView(cache, kept_tokens),
             "position_ids": position_ids
         }
 
@@ -70,14 +151,10 @@ class StaticAutoModel:
             cache_position=cache_position,
             position_ids=position_ids,
             causal_mask={ },
-            position_embeddings={ }
+            position_embeddings={ },
+            per_layer_inputs=per_layer_inputs
         )
 
-        # Gemma4 Per-Layer Embeddings: computed once here on the node that owns the
-        # (very large) per-layer embedding table, then shipped read-only in JobData.
-        if per_layer_embedder is not None:
-            state.per_layer_inputs = per_layer_embedder(input_seq.to(device), hidden_state)
-
         match config.model_type: # pyright: ignore[reportMatchNotExhaustive]
             case "qwen3":
                 Qwen3Model.compute_embedding(state, config, mask_kwargs)
@@ -145,6 +222,27 @@ class StaticAutoModel:
 
         return torch.tensor([])
 
+    @staticmethod
+    def compute_layer_batch(
+        layer: AutoDecoderLayer,
+        config: PretrainedConfig,
+        batch: BatchedComputationState,
+        caches: List[DynamicCache]
+    ) -> torch.Tensor:
+        """Run one layer over every row of `batch`, each row against its own cache."""
+        layer_types = getattr(config, "layer_types", None) or []
+        layer_idx: int = layer.cls.layer_idx # type: ignore
+        if layer_idx < len(layer_types) and layer_types[layer_idx] == "linear_attention":
+            # Recurrent state is per sequence and the gated delta rule has no
+            # notion of padding, so these layers take their rows one at a time.
+            outputs: List[torch.Tensor] = []
+            for row, row_state, cache in zip(batch.rows, batch.split(batch.state.state), caches, strict=True):
+                row.state = row_state
+                outputs.append(StaticAutoModel.compute_layer(layer, config, row, cache))
+            return batch.join(outputs)
+
+        return StaticAutoModel.compute_layer(layer, config, batch.state, BatchedCache(caches, batch.query_lengths)) # type: ignore
+
     @staticmethod
     def compute_head(
         head: torch.nn.Linear,
@@ -212,3 +310,77 @@ class StaticAutoModel:
             
             del logits
             return res
+
+    @staticmethod
+    def compute_head_batch(
+        head: torch.nn.Linear,
+        states: List[torch.Tensor],
+        device: str,
+        top_k: List[int],
+        top_p: List[float],
+        min_p: List[float],
+        temperature: List[float]
+    ) -> List[int]:
+        """compute_head for several sequences with one lm_head matmul.
+
+        Each row is sampled with its own parameters, applying the same filters in
+        the same order as compute_head: min_p, then top_p, then top_k.
+        """
+        with torch.inference_mode():
+            state_on_device = torch.cat([s.detach()[:, -1, :] for s in states], dim=0).to(device)
+            logits = torch.nn.functional.linear(
+                state_on_device,
+                head.weight,
+                head.bias
+            )
+            del state_on_device
+
+            res = logits.argmax(dim=-1)
+
+            # Rows with temperature 0 stay greedy
+            rows = torch.tensor([i for i, t in enumerate(temperature) if t != 0], dtype=torch.long, device=logits.device)
+            if rows.numel() > 0:
+                temps = StaticAutoModel._row_param(temperature, logits.dtype, rows)
+                row_min_p = StaticAutoModel._row_param(min_p, torch.float32, rows)
+                row_top_p = StaticAutoModel._row_param(top_p, torch.float32, rows)
+                row_top_k = StaticAutoModel._row_param(top_k, torch.long, rows)
+                neg_inf = torch.tensor(float('-inf'), dtype=logits.dtype, device=logits.device)
+
+                scaled_logits = logits[rows] / temps
+
+                if bool((row_min_p > 0).any()):
+                    probs = torch.nn.functional.softmax(scaled_logits, dim=-1)
+                    min_prob_threshold = row_min_p * probs.max(dim=-1, keepdim=True).values
+                    indices_to_remove = (probs < min_prob_threshold) & (row_min_p > 0)
+                    scaled_logits = scaled_logits.masked_fill(indices_to_remove, neg_inf)
+
+                if bool((row_top_p < 1.0).any()):
+                    sorted_logits, sorted_indices = torch.sort(scaled_logits, descending=True, dim=-1)
+                    cumulative_probs = torch.cumsum(torch.nn.functional.softmax(sorted_logits, dim=-1), dim=-1)
+                    sorted_indices_to_remove = cumulative_probs > row_top_p
+                    # Shift to keep at least one token
+                    sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
+                    sorted_indices_to_remove[:, 0] = False
+                    sorted_indices_to_remove &= row_top_p < 1.0
+                    indices_to_remove = torch.zeros_like(sorted_indices_to_remove).scatter(
+                        1, sorted_indices, sorted_indices_to_remove
+                    )
+                    scaled_logits = scaled_logits.masked_fill(indices_to_remove, neg_inf)
+
+                if bool((row_top_k > 0).any()):
+                    k = row_top_k.clamp(1, scaled_logits.size(-1))
+                    top_k_values, _ = torch.topk(scaled_logits, int(k.max().item()), dim=-1)
+                    threshold = top_k_values.gather(1, k - 1)
+                    indices_to_remove = (scaled_logits < threshold) & (row_top_k > 0)
+                    scaled_logits = scaled_logits.masked_fill(indices_to_remove, neg_inf)
+
+                probabilities = torch.nn.functional.softmax(scaled_logits, dim=-1)
+                res[rows] = torch.multinomial(probabilities, num_samples=1).squeeze(1)
+
+            del logits
+            return [int(t) for t in res.tolist()]
+
+    @staticmethod
+    def _row_param(values: List, dtype: torch.dtype, rows: torch.Tensor) -> torch.Tensor:
+        """A per-row sampling parameter as a column, for the rows being sampled."""
+        return torch.tensor(values, dtype=dtype, device=rows.device)[rows].unsqueeze(1)
@@ -13,6 +13,7 @@ Adding a model = adding one ``TinyModelSpec`` to ``specs.py``. Nothing here chan
     python -m unittest tests.llm_layer_collector.test_tiny_models -k ministral
 """
 
+import copy
 import tempfile
 import unittest
 
@@ -26,6 +27,7 @@ from llm_layer_collector.load_layer import (
     fuse_moe_expert_weights,
 )
 from llm_layer_collector.auto.auto_layer import AutoDecoderLayer
+from llm_layer_collector.auto.batch import BatchedComputationState
 
 from .specs import TinyModelSpec, TINY_MODEL_SPECS
 from .synthetic import build_tiny_checkpoint
@@ -283,6 +285,94 @@ class _SpecRunner:
                           "wrong cache position")
             self._assert_match(refs[i], ours, f"distributed decode {i}")
 
+    # ---- Phase 6: batched decode parity ----
+    def phase_batched_decode(self, emb, norm, layers):
+        """Decode steps for several conversations run as one batch.
+
+        The conversations differ in length - one past the sliding window - so the
+        batch has to pad each row's keys, and every row must come out exactly as it
+        does when decoded on its own against a copy of the same cache.
+        """
+        ple = self.collector.load_per_layer_embedder() if self.spec.ple else None
+        lengths = (SEQ_LEN * 3, SEQ_LEN - 3, 2)
+        seqs = [torch.randint(0, self.vocab, (1, n)) for n in lengths]
+        caches = [DynamicCache(config=self.config) for _ in seqs]
+        for ids, cache in zip(seqs, caches, strict=True):
+            _our_forward(self.collector, ids, cache, ids.shape[1], layers, emb, norm, ple)
+
+        for step in range(2):
+            seqs = [torch.cat([ids, torch.randint(0, self.vocab, (1, 1))], dim=1) for ids in seqs]
+            solo_caches = [copy.deepcopy(c) for c in caches]
+            solo = [
+                _our_forward(self.collector, ids, cache, ids.shape[1] - 1, layers, emb, norm, ple)[1]
+                for ids, cache in zip(seqs, solo_caches, strict=True)
+            ]
+
+            batch = BatchedComputationState([
+                StaticAutoModel.compute_embedding(
+                    ids.shape[1] - 1, 1, emb, ids, self.config, cache,
+                    per_layer_embedder=ple, past_seen_tokens=ids.shape[1] - 1,
+                )
+                for ids, cache in zip(seqs, caches, strict=True)
+            ])
+            for lyr in layers:
+                batch.state.state = StaticAutoModel.compute_layer_batch(lyr, self.config, batch, caches)
+
+            for i, row in enumerate(batch.split(norm(batch.state.state))):
+                self._assert_match(solo[i], row, f"batched decode {step} row {i}")
+
+    def phase_batched_prefill(self, emb, norm, layers):
+        """Prefill chunks from several conversations run as one ragged batch.
+
+        The prompts differ in length, so the chunks in a batch do too and rows
+        drop out as their prompts finish. The first batch also carries one
+        conversation's decode step. Every row must end where a solo forward over
+        the same tokens ends.
+        """
+        ple = self.collector.load_per_layer_embedder() if self.spec.ple else None
+        lengths = [SEQ_LEN * 3, SEQ_LEN - 3, 2]
+        seqs = [torch.randint(0, self.vocab, (1, n)) for n in lengths]
+        solo = [
+            _our_forward(self.collector, ids, DynamicCache(config=self.config), ids.shape[1], layers, emb, norm, ple)[1]
+            for ids in seqs
+        ]
+
+        decode_ids = torch.randint(0, self.vocab, (1, SEQ_LEN + 1))
+        decode_cache = DynamicCache(config=self.config)
+        _our_forward(self.collector, decode_ids[:, :-1], decode_cache, SEQ_LEN, layers, emb, norm, ple)
+        decode_solo = _our_forward(
+            self.collector, decode_ids, copy.deepcopy(decode_cache), SEQ_LEN, layers, emb, norm, ple)[1]
+
+        caches = [DynamicCache(config=self.config) for _ in seqs]
+        done = [0 for _ in seqs]
+        step = 0
+        while any(d < n for d, n in zip(done, lengths, strict=True)):
+            rows = [i for i, n in enumerate(lengths) if done[i] < n]
+            prompt_tokens = [lengths[i] for i in rows]
+            input_ids = [seqs[i] for i in rows]
+            row_caches = [caches[i] for i in rows]
+            past = [done[i] for i in rows]
+            if step == 0:
+                prompt_tokens.append(SEQ_LEN)
+                input_ids.append(decode_ids)
+                row_caches.append(decode_cache)
+                past.append(SEQ_LEN)
+
+            batch = BatchedComputationState(StaticAutoModel.compute_embedding_batch(
+                prompt_tokens, CHUNK, emb, input_ids, self.config, row_caches, past, per_layer_embedder=ple,
+            ))
+            for lyr in layers:
+                batch.state.state = StaticAutoModel.compute_layer_batch(lyr, self.config, batch, row_caches)
+            outputs = batch.split(norm(batch.state.state))
+
+            for i, out in zip(rows, outputs, strict=False):
+                done[i] += out.shape[1]
+                if done[i] == lengths[i]:
+                    self._assert_match(solo[i], out, f"batched prefill row {i}")
+            if step == 0:
+                self._assert_match(decode_solo, outputs[-1], "decode step in a prefill batch")
+            step += 1
+
     # ---- shared assertions ----
     def _assert_match(self, ref: torch.Tensor, ours: torch.Tensor, label: str):
         ref_f = ref[:, -1, :].float()
@@ -349,6 +439,9 @@ def _run_spec(test: unittest.TestCase, spec: TinyModelSpec):
         runner.phase_chunked(emb, norm, layers, ref_single)
         runner.phase_decode(emb, norm, layers)
         runner.phase_distributed(emb, norm, layers)
+        with torch.no_grad():
+            runner.phase_batched_decode(emb, norm, layers)
+            runner.phase_batched_prefill(emb, norm, layers)
 
 
 class TestTinyModels(unittest.TestCase):
@@ -369,6 +369,54 @@ class TestComputeHeadSampling(unittest.TestCase):
         self.assertEqual(a, b)
 
 
+class TestComputeHeadBatchSampling(unittest.TestCase):
+    def _head_and_states(self, rows):
+        # Identity head: every row's logits are [0, 1, 2, 3]; argmax is token 3.
+        head = torch.nn.Linear(4, 4, bias=False)
+        head.weight = torch.nn.Parameter(torch.eye(4))
+        return head, [torch.tensor([[[9.0, 9.0, 9.0, 9.0], [0.0, 1.0, 2.0, 3.0]]]) for _ in range(rows)]
+
+    def _sample(self, rows, **params):
+        head, states = self._head_and_states(rows)
+        return StaticAutoModel.compute_head_batch(head, states, "cpu", **params)
+
+    def test_each_row_uses_its_own_parameters(self):
+        # Row 0 greedy, row 1 top_k=1, row 2 tiny top_p, row 3 strict min_p:
+        # all of them can only pick token 3.
+        torch.manual_seed(0)
+        self.assertEqual(self._sample(
+            4,
+            temperature=[0, 1, 1, 1],
+            top_k=[0, 1, 0, 0],
+            top_p=[1, 1, 1e-6, 1],
+            min_p=[0, 0, 0, 0.9],
+        ), [3, 3, 3, 3])
+
+    def test_top_k_only_filters_its_own_row(self):
+        seen = set()
+        torch.manual_seed(0)
+        for _ in range(50):
+            tokens = self._sample(2, temperature=[1, 1], top_k=[1, 0], top_p=[1, 1], min_p=[0, 0])
+            self.assertEqual(tokens[0], 3)
+            seen.add(tokens[1])
+        self.assertGreater(len(seen), 1)
+
+    def test_top_k_of_two_keeps_the_two_best(self):
+        torch.manual_seed(0)
+        for _ in range(50):
+            tokens = self._sample(2, temperature=[1, 1], top_k=[2, 1], top_p=[1, 1], min_p=[0, 0])
+            self.assertIn(tokens[0], (2, 3))
+            self.assertEqual(tokens[1], 3)
+
+    def test_matches_compute_head_when_greedy(self):
+        head = torch.nn.Linear(8, 16)
+        states = [torch.randn(1, 3, 8) for _ in range(3)]
+        expected = [StaticAutoModel.compute_head(head, s, "cpu", temperature=0) for s in states]
+        self.assertEqual(
+            StaticAutoModel.compute_head_batch(head, states, "cpu", [0] * 3, [1.0] * 3, [0.0] * 3, [0.0] * 3),
+            expected)
+
+
 # --------------------------------------------------------------------------- #
 # static_auto_model.compute_embedding chunk-slicing math
 # --------------------------------------------------------------------------- #
@@ -422,6 +470,39 @@ class TestComputeEmbeddingChunking(unittest.TestCase):
         self.assertEqual(tuple(state.state.shape[:2]), (1, 1))
         self.assertEqual(state.cache_position[0].item(), 8)
 
+    def test_batch_matches_one_at_a_time(self):
+        caches = [DynamicCache(), DynamicCache()]
+        self._advance(caches[0], 8)
+        self._advance(caches[1], 3)
+        ids = [torch.randint(0, 128, (1, 9)), torch.randint(0, 128, (1, 4))]
+        states = StaticAutoModel.compute_embedding_batch(
+            [8, 3], 3, self.embedder, ids, self.config, caches, [8, 3])
+        for i, state in enumerate(states):
+            solo = StaticAutoModel.compute_embedding(
+                [8, 3][i], 3, self.embedder, ids[i], self.config, caches[i])
+            self.assertTrue(torch.equal(state.state, solo.state))
+            self.assertTrue(torch.equal(state.position_ids, solo.position_ids))
+
+    def test_batch_embeds_slices_of_different_lengths(self):
+        caches = [DynamicCache(), DynamicCache(), DynamicCache()]
+        self._advance(caches[2], 8)
+        ids = [torch.randint(0, 128, (1, 8)), torch.randint(0, 128, (1, 3)), torch.randint(0, 128, (1, 9))]
+        states = StaticAutoModel.compute_embedding_batch(
+            [8, 3, 8], 5, self.embedder, ids, self.config, caches, [0, 2, 8])
+        self.assertEqual([s.state.shape[1] for s in states], [5, 1, 1])
+        for i, state in enumerate(states):
+            solo = StaticAutoModel.compute_embedding(
+                [8, 3, 8][i], 5, self.embedder, ids[i], self.config, caches[i],
+                past_seen_tokens=[0, 2, 8][i])
+            self.assertTrue(torch.equal(state.state, solo.state))
+            self.assertTrue(torch.equal(state.cache_position, solo.cache_position))
+
+    def test_batch_takes_a_chunk_size_per_sequence(self):
+        caches = [DynamicCache(), DynamicCache()]
+        ids = [torch.randint(0, 128, (1, 8)), torch.randint(0, 128, (1, 8))]
+        states = StaticAutoModel.compute_embedding_batch(
+            [8, 8], [2, 6], self.embedder, ids, self.config, caches, [0, 0])
+        self.assertEqual([s.state.shape[1] for s in states], [2, 6])
 
 if __name__ == "__main__":
     unittest.main()
@@ -14,8 +14,33 @@ logger = logging.getLogger(__name__)
 
 DEFAULT_NUM_LOCAL_LAYERS = 1
 DEFAULT_END_MODEL_DEVICE = "cpu"
+# Keep the KV cache in the dtype the layers compute in ("int8" or "fp8" quantize it)
+DEFAULT_KV_CACHE_DTYPE = "auto"
+# Layer models join any pipe ("prefill" or "decode" split the work of a job)
+DEFAULT_PIPE_ROLE = "both"
+# Keep every token in the KV cache of an end model's jobs. A window above 0
+# keeps the first sink tokens and the last window tokens instead.
+DEFAULT_KV_SINK_TOKENS = 16
+DEFAULT_KV_WINDOW_TOKENS = 0
 DEFAULT_MAX_NODE_JOBS = 10
 DEFAULT_MAX_API_JOBS = 5
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_ROUND_TOKEN_BUDGET = 256
+DEFAULT_MAX_PREFILL_SHARE = 0.5
+DEFAULT_SEGMENT_PROCESSES = False
+DEFAULT_MIN_PREFILL_CHUNK = 32
+DEFAULT_MAX_PREFILL_CHUNK = 512
+# 0 lets each device use 90% of its memory
+DEFAULT_MAX_DEVICE_MEMORY = 0
+# 0 keeps every job's KV cache in RAM
+DEFAULT_MAX_KV_MEMORY = 0
+# Spill the caches that were used longest ago first ("largest" spills the biggest)
+DEFAULT_KV_SPILL_POLICY = "lru"
+# 0 keeps no KV cache of earlier prompts
+DEFAULT_PREFIX_CACHE_MEMORY = 0
+# 0 keeps no KV cache of finished conversations
+DEFAULT_SESSION_KV_MEMORY = 0
+DEFAULT_SESSION_KV_TTL = 600
 
 def _deprecated_env_num_local_layers() -> Optional[int]:
     raw = os.environ.get("LP_NUM_LOCAL_LAYERS")
@@ -71,22 +96,38 @@ class EndModelConfig:
     # The PyTorch device used for both the local layers and the embed/head
     # modules of this end model.
     device: str = DEFAULT_END_MODEL_DEVICE
+    # Dtype of the KV cache of the local layers
+    kv_cache_dtype: str = DEFAULT_KV_CACHE_DTYPE
+    # Bounded KV cache of the model's jobs: tokens kept at the start and
+    # the window of latest tokens after them. A window of 0 keeps all.
+    kv_sink_tokens: int = DEFAULT_KV_SINK_TOKENS
+    kv_window_tokens: int = DEFAULT_KV_WINDOW_TOKENS
 
     def _has_only_defaults(self) -> bool:
         return (
             self.num_local_layers == DEFAULT_NUM_LOCAL_LAYERS
             and self.device == DEFAULT_END_MODEL_DEVICE
+            and self.kv_cache_dtype == DEFAULT_KV_CACHE_DTYPE
+            and self.kv_sink_tokens == DEFAULT_KV_SINK_TOKENS
+            and self.kv_window_tokens == DEFAULT_KV_WINDOW_TOKENS
         )
 
     def to_config(self) -> Union[str, Dict[str, Any]]:
         # Preserve the simple string form when no extra options are set.
         if self._has_only_defaults():
             return self.model_id
-        return {
+        data: Dict[str, Any] = {
             "model_id": self.model_id,
             "num_local_layers": self.num_local_layers,
             "device": self.device,
         }
+        if self.kv_cache_dtype != DEFAULT_KV_CACHE_DTYPE:
+            data["kv_cache_dtype"] = self.kv_cache_dtype
+        if self.kv_sink_tokens != DEFAULT_KV_SINK_TOKENS:
+            data["kv_sink_tokens"] = self.kv_sink_tokens
+        if self.kv_window_tokens != DEFAULT_KV_WINDOW_TOKENS:
+            data["kv_window_tokens"] = self.kv_window_tokens
+        return data
 
     @staticmethod
     def from_config(data: Union[str, Dict[str, Any]]) -> "EndModelConfig":
@@ -101,6 +142,9 @@ class EndModelConfig:
             model_id=data.get("model_id", ""),
             num_local_layers=data.get("num_local_layers", default),
             device=data.get("device", DEFAULT_END_MODEL_DEVICE),
+            kv_cache_dtype=data.get("kv_cache_dtype", DEFAULT_KV_CACHE_DTYPE),
+            kv_sink_tokens=data.get("kv_sink_tokens", DEFAULT_KV_SINK_TOKENS),
+            kv_window_tokens=data.get("kv_window_tokens", DEFAULT_KV_WINDOW_TOKENS),
         )
 
 def _serialize_end_models(
@@ -119,6 +163,9 @@ def _serialize_end_models(
             "model_id": m.model_id,
             "num_local_layers": m.num_local_layers,
             "device": m.device,
+            "kv_cache_dtype": m.kv_cache_dtype,
+            "kv_sink_tokens": m.kv_sink_tokens,
+            "kv_window_tokens": m.kv_window_tokens,
         }
         for m in end_models
     ]
@@ -129,13 +176,18 @@ class ModelToLoad:
     device: torch.device
     memory: float
     data_type: int
+    kv_cache_dtype: str = DEFAULT_KV_CACHE_DTYPE
+    # Pipes the layers join: "both", "prefill" or "decode"
+    role: str = DEFAULT_PIPE_ROLE
 
     def to_dict(self):
         return {
             "model_id": self.model_id,
             "device": str(self.device),
             "memory": self.memory,
-            "data_type": self.data_type
+            "data_type": self.data_type,
+            "kv_cache_dtype": self.kv_cache_dtype,
+            "role": self.role
         }
 
     @staticmethod
@@ -144,7 +196,9 @@ class ModelToLoad:
             model_id=data.get("model_id", ""),
             device=torch.device(data.get("device", "cpu")),
             memory=data.get("memory", 0),
-            data_type=data.get("data_type", 8 if is_8_bit_mode() else 16)
+            data_type=data.get("data_type", 8 if is_8_bit_mode() else 16),
+            kv_cache_dtype=data.get("kv_cache_dtype", DEFAULT_KV_CACHE_DTYPE),
+            role=data.get("role", DEFAULT_PIPE_ROLE)
         )
 
 class LpConfig:
@@ -154,6 +208,24 @@ class LpConfig:
     end_models: List[EndModelConfig]
     max_node_jobs: int
     max_api_jobs: int
+    max_batch_size: int
+    round_token_budget: int
+    max_prefill_share: float
+    # Share of the queues of this node each origin node gets, relative to
+    # the others (1 when not listed)
+    flow_weights: Dict[str, float]
+    # Share of this node's share of its queues each API key gets, relative
+    # to the others (1 when not listed)
+    api_key_weights: Dict[str, float]
+    segment_processes: bool
+    min_prefill_chunk: int
+    max_prefill_chunk: int
+    max_device_memory: float
+    max_kv_memory: float
+    kv_spill_policy: str
+    prefix_cache_memory: float
+    session_kv_memory: float
+    session_kv_ttl: float
 
     network_config: DSNodeConfig
 
@@ -166,6 +238,20 @@ class LpConfig:
         self.end_models = []
         self.max_node_jobs = _default_max_node_jobs()
         self.max_api_jobs = _default_max_api_jobs()
+        self.max_batch_size = DEFAULT_MAX_BATCH_SIZE
+        self.round_token_budget = DEFAULT_ROUND_TOKEN_BUDGET
+        self.max_prefill_share = DEFAULT_MAX_PREFILL_SHARE
+        self.flow_weights = { }
+        self.api_key_weights = { }
+        self.segment_processes = DEFAULT_SEGMENT_PROCESSES
+        self.min_prefill_chunk = DEFAULT_MIN_PREFILL_CHUNK
+        self.max_prefill_chunk = DEFAULT_MAX_PREFILL_CHUNK
+        self.max_device_memory = DEFAULT_MAX_DEVICE_MEMORY
+        self.max_kv_memory = DEFAULT_MAX_KV_MEMORY
+        self.kv_spill_policy = DEFAULT_KV_SPILL_POLICY
+        self.prefix_cache_memory = DEFAULT_PREFIX_CACHE_MEMORY
+        self.session_kv_memory = DEFAULT_SESSION_KV_MEMORY
+        self.session_kv_ttl = DEFAULT_SESSION_KV_TTL
         self._file_path = None
         self.network_config = DSNodeConfig.from_dict({ })
 
@@ -179,6 +265,20 @@ class LpConfig:
             "end_models": _serialize_end_models(self.end_models),
             "max_node_jobs": self.max_node_jobs,
             "max_api_jobs": self.max_api_jobs,
+            "max_batch_size": self.max_batch_size,
+            "round_token_budget": self.round_token_budget,
+            "max_prefill_share": self.max_prefill_share,
+            "flow_weights": self.flow_weights,
+            "api_key_weights": self.api_key_weights,
+            "segment_processes": self.segment_processes,
+            "min_prefill_chunk": self.min_prefill_chunk,
+            "max_prefill_chunk": self.max_prefill_chunk,
+            "max_device_memory": self.max_device_memory,
+            "max_kv_memory": self.max_kv_memory,
+            "kv_spill_policy": self.kv_spill_policy,
+            "prefix_cache_memory": self.prefix_cache_memory,
+            "session_kv_memory": self.session_kv_memory,
+            "session_kv_ttl": self.session_kv_ttl,
             "node_id": self.network_config.node_id,
             "peer_port": self.network_config.port,
             "network_ip": self.network_config.network_ip,
@@ -204,6 +304,17 @@ class LpConfig:
             f"Job Port: {self.job_port if self.job_port is not None else 'Disabled'}",
             f"Max Node Jobs: {self.max_node_jobs}",
             f"Max API Jobs: {self.max_api_jobs}",
+            f"Max Batch Size: {self.max_batch_size}",
+            f"Round Token Budget: {self.round_token_budget}",
+            f"Max Prefill Share: {self.max_prefill_share}",
+            f"Flow Weights: {', '.join(f'{node}={weight}' for node, weight in self.flow_weights.items()) or 'Equal'}",
+            f"API Key Weights: {', '.join(f'{key}={weight}' for key, weight in self.api_key_weights.items()) or 'Equal'}",
+            f"Segment Processes: {self.segment_processes}",
+            f"Prefill Chunk: {self.min_prefill_chunk}-{self.max_prefill_chunk} tokens",
+            f"Max Device Memory: {f'{self.max_device_memory} GB' if self.max_device_memory > 0 else 'Auto'}",
+            f"Max KV Memory: {f'{self.max_kv_memory} GB, spill {self.kv_spill_policy}' if self.max_kv_memory > 0 else 'No spill'}",
+            f"Prefix Cache Memory: {f'{self.prefix_cache_memory} GB' if self.prefix_cache_memory > 0 else 'Off'}",
+            f"Session KV Memory: {f'{self.session_kv_memory} GB for {self.session_kv_ttl}s' if self.session_kv_memory > 0 else 'Off'}",
         ]
 
         lines.append("API Keys:")
@@ -221,6 +332,8 @@ class LpConfig:
                     f"Model ID: {model.model_id}",
                     f"Max Memory: {model.memory}",
                     f"Device: {model.device}",
+                    f"KV Cache: {model.kv_cache_dtype}",
+                    f"Role: {model.role}",
                     ""
                 ])
         else:
@@ -230,7 +343,8 @@ class LpConfig:
         lines.append("End Models:")
         if len(self.end_models) > 0:
             for model in self.end_models:
-                lines.append(f"- {model.model_id} (local layers: {model.num_local_layers}, device: {model.device})")
+                window = "all tokens" if model.kv_window_tokens <= 0 else f"{model.kv_sink_tokens} sink + {model.kv_window_tokens} window tokens"
+                lines.append(f"- {model.model_id} (local layers: {model.num_local_layers}, device: {model.device}, kv cache: {model.kv_cache_dtype}, {window})")
         else:
             lines.append("- None")
         
@@ -254,6 +368,20 @@ class LpConfig:
         cfg.end_models = [EndModelConfig.from_config(o) for o in data.get("end_models", [])]
         cfg.max_node_jobs = data.get("max_node_jobs", cfg.max_node_jobs)
         cfg.max_api_jobs = data.get("max_api_jobs", cfg.max_api_jobs)
+        cfg.max_batch_size = data.get("max_batch_size", cfg.max_batch_size)
+        cfg.round_token_budget = data.get("round_token_budget", cfg.round_token_budget)
+        cfg.max_prefill_share = data.get("max_prefill_share", cfg.max_prefill_share)
+        cfg.flow_weights = data.get("flow_weights", cfg.flow_weights)
+        cfg.api_key_weights = data.get("api_key_weights", cfg.api_key_weights)
+        cfg.segment_processes = data.get("segment_processes", cfg.segment_processes)
+        cfg.min_prefill_chunk = data.get("min_prefill_chunk", cfg.min_prefill_chunk)
+        cfg.max_prefill_chunk = data.get("max_prefill_chunk", cfg.max_prefill_chunk)
+        cfg.max_device_memory = data.get("max_device_memory", cfg.max_device_memory)
+        cfg.max_kv_memory = data.get("max_kv_memory", cfg.max_kv_memory)
+        cfg.kv_spill_policy = data.get("kv_spill_policy", cfg.kv_spill_policy)
+        cfg.prefix_cache_memory = data.get("prefix_cache_memory", cfg.prefix_cache_memory)
+        cfg.session_kv_memory = data.get("session_kv_memory", cfg.session_kv_memory)
+        cfg.session_kv_ttl = data.get("session_kv_ttl", cfg.session_kv_ttl)
         cfg.network_config = DSNodeConfig.from_dict({
             "credential_dir": str(get_app_dir() / "credentials"),
             "logging_dir": str(get_app_dir() / "logs"),
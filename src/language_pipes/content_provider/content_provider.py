@@ -7,13 +7,22 @@ from typing import Callable, List, Optional, Dict
 
 from language_pipes.request_for_model.rfm import RequestForModelHandler
 from language_pipes.jobs.job_factory import JobFactory
+from language_pipes.jobs.job_credit import CREDIT_PROTOCOL
+from language_pipes.jobs.job_migration import MIGRATE_PROTOCOL
 from language_pipes.jobs.job_receiver import CANCEL_PROTOCOL, JobReceiver
+from language_pipes.jobs.prefix_match import PREFIX_PROTOCOL, SESSION_PROTOCOL
 from language_pipes.jobs.job_tracker import JobTracker
+from language_pipes.jobs.memory_governor import MemoryGovernor
 from language_pipes.util.byte_helper import ByteHelper
 from language_pipes.util.utils import is_port_available
 from language_pipes.pipes.pipe_manager import PipeManager
 from language_pipes.pipes.router_pipes import RouterPipes
 from language_pipes.modeling.model_manager import ModelManager
+from language_pipes.modeling.kv_pool import KV_POOL
+from language_pipes.modeling.kv_spill import GB, KVSpill
+from language_pipes.modeling.kv_prefix import PREFIX_KV_CACHE
+from language_pipes.modeling.kv_session import SESSION_KV_CACHE
+from language_pipes.util.config import get_app_dir
 from language_pipes.content_provider.job_provider import JobProvider
 from distributed_state_network.handler import DSNodeServer
 from language_pipes.content_provider.pipe_provider import PipeProvider
@@ -32,6 +41,7 @@ class ContentProvider:
     job_tracker: Optional[JobTracker]
     job_factory: Optional[JobFactory]
     job_receiver: Optional[JobReceiver]
+    kv_spill: Optional[KVSpill]
 
     model_manager: ModelManager
     model_provider: ModelProvider
@@ -49,6 +59,7 @@ class ContentProvider:
         self.job_tracker = None
         self.job_factory = None
         self.job_receiver = None
+        self.kv_spill = None
         self.model_manager = ModelManager()
         self.config_file = config_file
         self.create_alert = create_alert
@@ -112,22 +123,56 @@ class ContentProvider:
         if router is not None:
             self.router_pipes = RouterPipes(router)
             self.pipe_manager = PipeManager(self.model_manager, self.router_pipes)
-            self.job_tracker = JobTracker()
-            self.job_factory = JobFactory(self.job_tracker, self.pipe_manager, self.job_provider.get_max_api_jobs)
+            memory_governor = MemoryGovernor(
+                self.model_manager.weights_per_device,
+                lambda: self.job_receiver.buffered_bytes() if self.job_receiver is not None else 0,
+                self.job_provider.get_max_device_memory
+            )
+            self.job_tracker = JobTracker(
+                on_remove=memory_governor.release,
+                on_complete=lambda job: self.job_receiver.finish_job(job) if self.job_receiver is not None else None
+            )
+            self.job_factory = JobFactory(
+                self.job_tracker,
+                self.pipe_manager,
+                self.job_provider.get_max_api_jobs,
+                lambda job: self.job_receiver.prefixes.match_prefix(job) if self.job_receiver is not None else None
+            )
             self.job_receiver = JobReceiver(
                 job_factory=self.job_factory,
                 job_tracker=self.job_tracker,
                 model_manager=self.model_manager,
                 pipe_manager=self.pipe_manager,
                 is_shutdown=self.router_pipes.router.is_shut_down,
-                get_max_node_jobs=self.job_provider.get_max_node_jobs
+                get_max_node_jobs=self.job_provider.get_max_node_jobs,
+                get_max_batch_size=self.job_provider.get_max_batch_size,
+                get_round_token_budget=self.job_provider.get_round_token_budget,
+                get_max_prefill_share=self.job_provider.get_max_prefill_share,
+                get_min_prefill_chunk=self.job_provider.get_min_prefill_chunk,
+                get_max_prefill_chunk=self.job_provider.get_max_prefill_chunk,
+                memory_governor=memory_governor,
+                get_flow_weights=self.job_provider.get_flow_weights,
+                get_api_key_weights=self.job_provider.get_api_key_weights
             )
             self.model_manager.set_job_hooks(
                 self.job_receiver.cancel_pipe_jobs,
-                self.job_receiver.cancel_model_jobs
+                self.job_receiver.cancel_model_jobs,
+                self.job_receiver.migration.move_segment_jobs
+            )
+            if self.kv_spill is not None:
+                self.kv_spill.stop()
+            self.kv_spill = KVSpill(
+                KV_POOL,
+                get_app_dir() / "kv_spill",
+                self.job_provider.get_max_kv_memory,
+                self.job_provider.get_kv_spill_policy
             )
+            PREFIX_KV_CACHE.get_max_bytes = lambda: int(self.job_provider.get_prefix_cache_memory() * GB)
+            SESSION_KV_CACHE.get_max_bytes = lambda: int(self.job_provider.get_session_kv_memory() * GB)
+            SESSION_KV_CACHE.get_ttl = self.job_provider.get_session_kv_ttl
 
             self.router_pipes.router.set_receive_cb(self._receive_data)
+            self.router_pipes.router.set_disconnect_cb(self.job_receiver.check_lost_passes)
             self.request_for_model = RequestForModelHandler(
                 router.node_id(),
                 router.peers,
@@ -139,6 +184,9 @@ class ContentProvider:
             self.router_pipes = None
             self.pipe_manager = None
             self.model_manager.clear_job_hooks()
+            if self.kv_spill is not None:
+                self.kv_spill.stop()
+                self.kv_spill = None
 
     def request_model(self, model_id: str, token: Optional[str] = None):
         if self.request_for_model is None:
@@ -147,15 +195,25 @@ class ContentProvider:
         self.request_for_model.request_state.reset()
         self.request_for_model.request_model(model_id, token)
 
-    def _receive_data(self, node_id: str, data: bytes):
+    def _receive_data(self, node_id: str, data: bytes) -> Optional[bytes]:
+        """Hand a packet to whatever handles its protocol. The job receiver's
+        answers go back to the sender."""
         bts = ByteHelper(data)
         protocol = bts.read_int() # Protocol number
         if protocol == 0 and self.job_receiver is not None:
-            self.job_receiver.receive_data(node_id, bts.read_bytes())
+            return self.job_receiver.receive_data(node_id, bts.read_bytes())
         if protocol == 1:
             self.request_for_model.receive_data(node_id, data)
         if protocol == CANCEL_PROTOCOL and self.job_receiver is not None:
             self.job_receiver.receive_cancel(node_id, bts.read_bytes())
+        if protocol == CREDIT_PROTOCOL and self.job_receiver is not None:
+            return self.job_receiver.credit.receive_credit(node_id, bts.read_bytes())
+        if protocol == PREFIX_PROTOCOL and self.job_receiver is not None:
+            return self.job_receiver.prefixes.receive_prefix(node_id, bts.read_bytes())
+        if protocol == SESSION_PROTOCOL and self.job_receiver is not None:
+            return self.job_receiver.prefixes.receive_session(node_id, bts.read_bytes())
+        if protocol == MIGRATE_PROTOCOL and self.job_receiver is not None:
+            return self.job_receiver.migration.receive_migrate(node_id, bts.read_bytes())
 
     def stop_network(self):
         if self.router is None:
@@ -167,7 +225,10 @@ class ContentProvider:
         if self.job_tracker is not None:
             self.job_tracker.shutdown = True
         if self.job_receiver is not None:
-            self.job_receiver.shutdown = True
+            self.job_receiver.stop()
+        if self.kv_spill is not None:
+            self.kv_spill.stop()
+            self.kv_spill = None
 
     @staticmethod
     def get_total_system_ram() -> float:
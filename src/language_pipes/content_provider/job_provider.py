@@ -3,16 +3,20 @@ from pathlib import Path
 from threading import Thread
 from time import time
 from dataclasses import dataclass
-from typing import Callable, List, Optional
+from typing import Callable, Dict, List, Optional
 
 import torch
 
 from language_pipes.config import LpConfig
 from language_pipes.jobs.job_factory import JobFactory
 from language_pipes.jobs.job_progress import JobProgress
+from language_pipes.jobs.job_queue import QueueStats
 from language_pipes.jobs.job_receiver import JobReceiver
 from language_pipes.jobs.job_tracker import JobTracker
 from language_pipes.jobs.timing_stats import TimingStats
+from language_pipes.modeling.kv_pool import KV_POOL, PoolStats
+from language_pipes.modeling.kv_prefix import PREFIX_KV_CACHE, PrefixStats
+from language_pipes.modeling.kv_session import SESSION_KV_CACHE, SessionStats
 from language_pipes.modeling.model_manager import ModelManager
 from language_pipes.oai_server import OAIHttpServer
 from language_pipes.pipes.pipe_manager import PipeManager
@@ -92,6 +96,123 @@ class JobProvider:
         cfg.max_api_jobs = value
         cfg.save()
 
+    def get_max_batch_size(self) -> int:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.max_batch_size
+
+    def set_max_batch_size(self, value: int):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.max_batch_size = value
+        cfg.save()
+
+    def get_round_token_budget(self) -> int:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.round_token_budget
+
+    def set_round_token_budget(self, value: int):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.round_token_budget = value
+        cfg.save()
+
+    def get_max_prefill_share(self) -> float:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.max_prefill_share
+
+    def set_max_prefill_share(self, value: float):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.max_prefill_share = value
+        cfg.save()
+
+    def get_flow_weights(self) -> Dict[str, float]:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.flow_weights
+
+    def set_flow_weights(self, value: Dict[str, float]):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.flow_weights = value
+        cfg.save()
+
+    def get_api_key_weights(self) -> Dict[str, float]:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.api_key_weights
+
+    def set_api_key_weights(self, value: Dict[str, float]):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.api_key_weights = value
+        cfg.save()
+
+    def get_min_prefill_chunk(self) -> int:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.min_prefill_chunk
+
+    def set_min_prefill_chunk(self, value: int):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.min_prefill_chunk = value
+        cfg.save()
+
+    def get_max_prefill_chunk(self) -> int:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.max_prefill_chunk
+
+    def set_max_prefill_chunk(self, value: int):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.max_prefill_chunk = value
+        cfg.save()
+
+    def get_max_device_memory(self) -> float:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.max_device_memory
+
+    def set_max_device_memory(self, value: float):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.max_device_memory = value
+        cfg.save()
+
+    def get_max_kv_memory(self) -> float:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.max_kv_memory
+
+    def set_max_kv_memory(self, value: float):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.max_kv_memory = value
+        cfg.save()
+
+    def get_kv_spill_policy(self) -> str:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.kv_spill_policy
+
+    def set_kv_spill_policy(self, value: str):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.kv_spill_policy = value
+        cfg.save()
+
+    def get_prefix_cache_memory(self) -> float:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.prefix_cache_memory
+
+    def set_prefix_cache_memory(self, value: float):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.prefix_cache_memory = value
+        cfg.save()
+
+    def get_session_kv_memory(self) -> float:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.session_kv_memory
+
+    def set_session_kv_memory(self, value: float):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.session_kv_memory = value
+        cfg.save()
+
+    def get_session_kv_ttl(self) -> float:
+        cfg = LpConfig.from_file(self.config_file)
+        return cfg.session_kv_ttl
+
+    def set_session_kv_ttl(self, value: float):
+        cfg = LpConfig.from_file(self.config_file)
+        cfg.session_kv_ttl = value
+        cfg.save()
+
     def get_api_keys(self) -> List[str]:
         cfg = LpConfig.from_file(self.config_file)
         return cfg.api_keys
@@ -154,27 +275,44 @@ class JobProvider:
     def oai_server_running(self) -> bool:
         return self.oai_server is not None
     
+    def get_queue_stats(self) -> Optional[QueueStats]:
+        job_receiver = self.get_job_receiver()
+        if job_receiver is None:
+            return None
+        return job_receiver.queue_stats()
+
+    def get_kv_pool_stats(self) -> PoolStats:
+        """Blocks of the node's KV pool and how many jobs hold."""
+        return KV_POOL.stats()
+
+    def get_prefix_cache_stats(self) -> PrefixStats:
+        """Blocks the node keeps of earlier prompts and how often jobs find them."""
+        return PREFIX_KV_CACHE.stats()
+
+    def get_session_kv_stats(self) -> SessionStats:
+        """Conversations whose KV cache the node keeps and the jobs that went on from them."""
+        return SESSION_KV_CACHE.stats()
+
     def get_active_jobs(self) -> List[MetaJob]:
         job_tracker = self.get_job_tracker()
         if job_tracker is None:
             return []
         
         meta_jobs = []
-        for key in job_tracker.jobs_pending:
-            for job in job_tracker.jobs_pending[key]:
-                # Nodes without the end model can only report what the origin sent
-                progress = job.display_progress()
-                meta_jobs.append(MetaJob(
-                    job_id=job.job_id,
-                    pipe_id=job.pipe_id,
-                    model_id=job.model_id,
-                    current_token=progress.current_token,
-                    origin_node_id=job.origin_node_id,
-                    prompt_processed=(progress.prefill_tokens / progress.prompt_tokens) if progress.prefilling and progress.prompt_tokens > 0 else 1,
-                    last_update=time() - job.last_update,
-                    ram=job.get_job_ram(),
-                    timing_stats=job.timing_stats,
-                    progress=progress
-               ))
+        for job in job_tracker.get_jobs():
+            # Nodes without the end model can only report what the origin sent
+            progress = job.display_progress()
+            meta_jobs.append(MetaJob(
+                job_id=job.job_id,
+                pipe_id=job.pipe_id,
+                model_id=job.model_id,
+                current_token=progress.current_token,
+                origin_node_id=job.origin_node_id,
+                prompt_processed=(progress.prefill_tokens / progress.prompt_tokens) if progress.prefilling and progress.prompt_tokens > 0 else 1,
+                last_update=time() - job.last_update,
+                ram=job.get_job_ram(),
+                timing_stats=job.timing_stats,
+                progress=progress
+            ))
         
         return meta_jobs
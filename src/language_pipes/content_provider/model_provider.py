@@ -242,7 +242,10 @@ class ModelProvider:
                 max_memory=model.memory,
                 device=model.device,
                 first_layer=0,
-                data_type=model.data_type
+                data_type=model.data_type,
+                own_process=LpConfig.from_file(self.config_file).segment_processes,
+                kv_cache_dtype=model.kv_cache_dtype,
+                role=model.role
             )
 
         Thread(target=host_layer_model, args=()).start()
@@ -262,7 +265,10 @@ class ModelProvider:
                 max_memory=new_model.memory,
                 device=new_model.device,
                 first_layer=0,
-                data_type=new_model.data_type
+                data_type=new_model.data_type,
+                own_process=LpConfig.from_file(self.config_file).segment_processes,
+                kv_cache_dtype=new_model.kv_cache_dtype,
+                role=new_model.role
             )
 
         Thread(target=restart_model, args=()).start()
@@ -270,7 +276,9 @@ class ModelProvider:
     def load_end_model(self, model_id: str):
         config = self._get_end_model_config(model_id)
         def host_end_model():
-            self.get_model_manager().load_end_model(model_id, config.device, config.num_local_layers)
+            self.get_model_manager().load_end_model(
+                model_id, config.device, config.num_local_layers, config.kv_cache_dtype, config.kv_sink_tokens, config.kv_window_tokens
+            )
 
         Thread(target=host_end_model, args=()).start()
 
@@ -279,7 +287,9 @@ class ModelProvider:
         def restart_end_model():
             mm = self.get_model_manager()
             mm.shutdown_end_model(model_id)
-            mm.load_end_model(model_id, config.device, config.num_local_layers)
+            mm.load_end_model(
+                model_id, config.device, config.num_local_layers, config.kv_cache_dtype, config.kv_sink_tokens, config.kv_window_tokens
+            )
 
         Thread(target=restart_end_model, args=()).start()
 
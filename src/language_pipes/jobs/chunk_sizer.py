@@ -0,0 +1,113 @@
+from time import time
+from collections import deque
+from threading import Lock
+from typing import Callable, Deque, List, Optional, Tuple
+
+from language_pipes.config import DEFAULT_MAX_PREFILL_CHUNK, DEFAULT_MIN_PREFILL_CHUNK
+from language_pipes.jobs.completed_pass import CompletedPass
+
+# Recent passes the estimate is built from
+SAMPLE_WINDOW = 64
+# Largest share of a prefill pass the fixed per-pass cost may take up before
+# chunks are made bigger
+OVERHEAD_SHARE = 0.2
+
+class PassSample:
+    """How long one pass around the pipe took, split into the time spent
+    computing (summed over every node it visited) and everything else: link
+    latency, transfer time and time spent waiting in queues."""
+    tokens: int
+    compute_ms: float
+    overhead_ms: float
+
+    def __init__(self, tokens: int, compute_ms: float, overhead_ms: float):
+        self.tokens = tokens
+        self.compute_ms = compute_ms
+        self.overhead_ms = overhead_ms
+
+    @staticmethod
+    def from_pass(completed: CompletedPass, end_time: float) -> Optional['PassSample']:
+        """Sample for a pass the origin closed at `end_time`. None without timings."""
+        if len(completed.times) == 0 or completed.token_count <= 0:
+            return None
+        compute_ms = 0.0
+        for entry in completed.times:
+            compute_ms += max(0.0, entry.send_time - entry.receive_time) * 1000.0
+        # Start and end are both read on the origin's clock, so other nodes'
+        # clock skew never enters the total
+        total_ms = (end_time - min(t.receive_time for t in completed.times)) * 1000.0
+        return PassSample(completed.token_count, compute_ms, max(0.0, total_ms - compute_ms))
+
+def _fit(xs: List[float], ys: List[float]) -> Optional[Tuple[float, float]]:
+    """Least squares line (intercept, slope) through the points. None if every x is the same."""
+    n = len(xs)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        return None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys, strict=True)) / var_x
+    return (mean_y - slope * mean_x, slope)
+
+class ChunkSizer:
+    """Picks the prefill chunk size for jobs on one pipe from the fixed and
+    per-token cost of its recent passes."""
+    samples: Deque[PassSample]
+
+    def __init__(
+            self,
+            get_min_chunk: Callable[[], int] = lambda: DEFAULT_MIN_PREFILL_CHUNK,
+            get_max_chunk: Callable[[], int] = lambda: DEFAULT_MAX_PREFILL_CHUNK
+    ):
+        self.get_min_chunk = get_min_chunk
+        self.get_max_chunk = get_max_chunk
+        self.samples = deque(maxlen=SAMPLE_WINDOW)
+        self.lock = Lock()
+
+    def record(self, completed: Optional[CompletedPass], end_time: Optional[float] = None):
+        """Add a pass the origin just closed."""
+        if completed is None:
+            return
+        sample = PassSample.from_pass(completed, time() if end_time is None else end_time)
+        if sample is None:
+            return
+        with self.lock:
+            self.samples.append(sample)
+
+    def estimate(self) -> Optional[Tuple[float, float]]:
+        """(fixed ms per pass, ms per token), or None before the first pass."""
+        with self.lock:
+            samples = list(self.samples)
+        if len(samples) == 0:
+            return None
+
+        tokens = [float(s.tokens) for s in samples]
+        compute = [s.compute_ms for s in samples]
+        overhead = [s.overhead_ms for s in samples]
+
+        # With only one pass size to go on, compute is taken to scale with the
+        # tokens and the overhead to be the same for any pass
+        compute_fit = _fit(tokens, compute)
+        if compute_fit is None or compute_fit[1] <= 0:
+            compute_fit = (0.0, sum(compute) / sum(tokens))
+        overhead_fit = _fit(tokens, overhead)
+        if overhead_fit is None or overhead_fit[1] < 0:
+            overhead_fit = (sum(overhead) / len(overhead), 0.0)
+
+        fixed_ms = max(0.0, compute_fit[0]) + max(0.0, overhead_fit[0])
+        return (fixed_ms, compute_fit[1] + overhead_fit[1])
+
+    def chunk_size(self) -> int:
+        """Tokens per prefill chunk for the next chunk sent into this pipe."""
+        low = max(1, self.get_min_chunk())
+        high = max(low, self.get_max_chunk())
+        estimate = self.estimate()
+        if estimate is None:
+            return low
+
+        fixed_ms, per_token_ms = estimate
+        if per_token_ms <= 0:
+            return high
+        # fixed / (fixed + size * per_token) <= OVERHEAD_SHARE
+        size = fixed_ms * (1 - OVERHEAD_SHARE) / (OVERHEAD_SHARE * per_token_ms)
+        return round(min(high, max(low, size)))
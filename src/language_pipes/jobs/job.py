@@ -1,17 +1,18 @@
 from time import time
 from uuid import uuid4
-from typing import Iterable, List, Optional
+from typing import Dict, Iterable, List, Optional
 
 import torch
 from promise import Promise
 from typing import Callable
 from transformers import PretrainedConfig
-from transformers.cache_utils import DynamicCache
 
 from language_pipes.jobs.job_data import JobData
 from language_pipes.jobs.job_progress import JobProgress
 from language_pipes.jobs.network_job import NetworkJob
 from language_pipes.jobs.timing_stats import TimingStats
+from language_pipes.modeling.kv_pool import PagedCache, window_kept
+from language_pipes.modeling.kv_session import SESSION_KV_CACHE
 
 from language_pipes.util.chat import ChatMessage
 from language_pipes.util.chunk_state import ChunkState
@@ -34,6 +35,10 @@ class Job:
     status: JobStatus
     current_token: int = 0
     current_layer: int = 0
+    # The pass being processed, numbered by the origin, and the passes the
+    # origin has numbered so far
+    pass_id: int = 0
+    passes_sent: int = 0
     data: Optional[JobData]
     messages: List[ChatMessage]
     result: Optional[str]
@@ -43,6 +48,38 @@ class Job:
     cancel_reason: Optional[str]
     # Origin's progress report, kept only on the nodes that can't derive it
     reported_progress: Optional[JobProgress]
+    # Origin only: hashes of the prompt's blocks and the tokens at its start
+    # every node of the pipe has the KV cache of (see PrefixKVCache)
+    prefix_hashes: List[bytes]
+    prefix_tokens: int
+    # Session the job's KV cache is kept under once it finishes, and the
+    # session it goes on from (see SessionKVCache)
+    session_id: Optional[str]
+    resume_session_id: Optional[str]
+    # Tokens of the cache to keep, on the nodes that do not have the ids
+    session_tokens: Optional[int]
+    session_kept: bool
+    # Bounded KV cache of the job's model: tokens kept at the start and the
+    # window after them (see window_kept). A window of 0 keeps every token.
+    kv_sink_tokens: int
+    kv_window_tokens: int
+    # Segments of the pipe the job's KV cache moved off, by first layer, and
+    # the segment it runs on instead. Set by the origin, carried by every pass.
+    segment_moves: Dict[int, str]
+    # Replay that rebuilds the KV cache of layers replay_start up to
+    # replay_end from every token of the job, after they failed over to
+    # other segments; all 0 when there is none. Set by the origin, carried by
+    # every pass of the replay. Layers before replay_start run it on
+    # replay_cache, kept for the replay numbered replay_cache_id, so their
+    # own cache stays as it is.
+    replay_id: int
+    replay_start: int
+    replay_end: int
+    replay_cache: Optional[PagedCache]
+    replay_cache_id: int
+    # Origin only: whether the job looked for a decode pipe to hand the KV
+    # cache of its prefill segments to (see JobMigration.park_job)
+    handoff_checked: bool
     
     # API params
     top_k: int
@@ -53,7 +90,8 @@ class Job:
     max_completion_tokens: int
 
     # Classes
-    cache: DynamicCache
+    config: PretrainedConfig
+    cache: PagedCache
     chunking: ChunkState
 
     # Functions
@@ -97,6 +135,21 @@ class Job:
         self.stale = False
         self.cancel_reason = None
         self.reported_progress = None
+        self.prefix_hashes = []
+        self.prefix_tokens = 0
+        self.session_id = None
+        self.resume_session_id = None
+        self.session_tokens = None
+        self.session_kept = False
+        self.kv_sink_tokens = 0
+        self.kv_window_tokens = 0
+        self.segment_moves = { }
+        self.replay_id = 0
+        self.replay_start = 0
+        self.replay_end = 0
+        self.replay_cache = None
+        self.replay_cache_id = 0
+        self.handoff_checked = False
         self.messages = messages
 
         self.temperature = temperature
@@ -107,8 +160,11 @@ class Job:
         self.max_completion_tokens = max_completion_tokens
         
         self.current_layer = 0
+        self.pass_id = 0
+        self.passes_sent = 0
 
-        self.cache = DynamicCache(config=config)
+        self.config = config
+        self.cache = PagedCache(config)
         self.chunking = ChunkState(self.job_id)
         self.resolve = resolve
         self.update = update
@@ -123,8 +179,21 @@ class Job:
     def pass_complete(self):
         pass
 
-    def init_chunking(self):
-        self.chunking.init(self.prompt_tokens)
+    def init_chunking(self, chunk_size: Optional[int] = None):
+        self.chunking.init(self.prompt_tokens, chunk_size, self.prefix_tokens)
+        self.timing_stats.prefill_chunk_size = self.chunking.chunk_size
+
+    def advance_chunk(self, chunk_size: Optional[int] = None):
+        """Move on to the next prefill chunk, re-sized to `chunk_size` if given."""
+        self.chunking.advance(chunk_size)
+        self.timing_stats.prefill_chunk_size = self.chunking.chunk_size
+
+    def number_pass(self):
+        """Give the pass the origin is about to send into the pipe its number.
+        Every hop of the pass carries it, so a copy can be told apart."""
+        self.passes_sent += 1
+        self.pass_id = self.passes_sent
+        self.chunking.number(self.pass_id)
 
     def past_seen_tokens(self) -> int:
         """Tokens already consumed by the cache, tracked here rather than read back
@@ -136,13 +205,72 @@ class Job:
         as 0 forever - Qwen3.5 opens with three `linear_attention` layers, so the
         default single local layer never advances it.
         """
-        if self.current_token == 0:
+        if self.current_token == 0 or self.replaying():
             # Still prefilling: chunks that have already finished.
             return self.chunking.get_tokens_processed()
 
         # Decoding: every token but the one about to be embedded.
         return len(self.input_ids) - 1
 
+    def embed_tokens(self) -> int:
+        """Tokens the passes that prefill are cut from: the prompt, or every
+        token of the job while a replay rebuilds its KV cache."""
+        if self.replaying():
+            return len(self.input_ids)
+        return self.prompt_tokens
+
+    def replaying(self) -> bool:
+        return self.replay_end > 0
+
+    def start_replay(self, start_layer: int, end_layer: int, chunk_size: Optional[int] = None):
+        """Get a decoding job ready to rebuild the KV cache of layers
+        `start_layer` up to `end_layer` from every token it has, in prefill
+        chunks. The first chunk is the next pass the origin sends."""
+        self.replay_id = self.passes_sent + 1
+        self.replay_start = start_layer
+        self.replay_end = end_layer
+        self.chunking.init(len(self.input_ids), chunk_size)
+        self.compute_step = ComputeStep.EMBED
+        self.current_layer = 0
+        self.data = None
+
+    def end_replay(self):
+        """The last chunk of the replay is back: the job decodes again."""
+        self.replay_id = 0
+        self.replay_start = 0
+        self.replay_end = 0
+        self.chunking.disable()
+        self.compute_step = ComputeStep.EMBED
+
+    def layer_cache(self) -> PagedCache:
+        """The cache the pass being processed runs its layers from
+        `current_layer` on with. A replay runs the layers before the ones it
+        rebuilds on a cache of its own, dropped once the replay is over."""
+        if not self.replaying() or self.current_layer >= self.replay_start:
+            return self.cache
+        if self.replay_cache is None or self.replay_cache_id != self.replay_id:
+            self.drop_replay_cache()
+            self.replay_cache = PagedCache(self.config)
+            self.replay_cache_id = self.replay_id
+        return self.replay_cache
+
+    def drop_replay_cache(self):
+        if self.replay_cache is not None:
+            self.replay_cache.release()
+            self.replay_cache = None
+
+    def cached_tokens(self) -> int:
+        """Tokens of `past_seen_tokens` the KV cache still holds on every
+        node before the next pass; fewer once a bounded cache drops some."""
+        return window_kept(self.past_seen_tokens(), self.kv_sink_tokens, self.kv_window_tokens)
+
+    def kv_bound_tokens(self) -> int:
+        """Most tokens a bounded KV cache keeps between passes, 0 when the
+        cache is not bounded."""
+        if self.kv_window_tokens <= 0:
+            return 0
+        return self.kv_sink_tokens + self.kv_window_tokens
+
     def set_layer(self, state: torch.Tensor, layer: int, num_hidden_layers: int, shared_kv_states: Optional[dict] = None):
         if self.compute_step != ComputeStep.LAYER:
             raise Exception('Invalid step for layer')
@@ -153,8 +281,11 @@ class Job:
         # Gemma4 cross-node KV sharing: persist the mutated dict so it serializes onward.
         if shared_kv_states is not None:
             self.data.shared_kv_states = shared_kv_states
-        if self.current_layer == num_hidden_layers:
-            self.compute_step = ComputeStep.EMBED if self.chunking.has_more() else ComputeStep.HEAD
+        if self.current_layer == num_hidden_layers or (self.replaying() and self.current_layer >= self.replay_end):
+            # Back to the origin, which tells a finished prefill chunk from
+            # the pass that needs the head (see JobProcessor). A replay pass
+            # goes back once the layers it rebuilds are done.
+            self.compute_step = ComputeStep.HEAD
             self.current_layer = 0
 
     def set_norm(self, state: torch.Tensor):
@@ -207,14 +338,17 @@ class Job:
         if network_job.origin_node_id != self.origin_node_id:
             return False
 
-        if network_job.compute_step == ComputeStep.HEAD and self.chunking.has_more():
-            self.compute_step = ComputeStep.EMBED
-            self.current_layer = 0
-        else:
-            self.compute_step = network_job.compute_step
-            self.current_layer = network_job.current_layer
-            
+        self.compute_step = network_job.compute_step
+        self.current_layer = network_job.current_layer
+        self.pass_id = network_job.pass_id
         self.data = network_job.data
+        if node_id != self.origin_node_id:
+            self.segment_moves = dict(network_job.segment_moves)
+            self.replay_id = network_job.replay_id
+            self.replay_start = network_job.replay_start
+            self.replay_end = network_job.replay_end
+            if not self.replaying():
+                self.drop_replay_cache()
         self.timing_stats.receive_network_job(network_job.times, network_job.completed)
         # Origin keeps its own live state; a peer too old to report leaves the
         # last good reading in place
@@ -230,7 +364,9 @@ class Job:
             current_token=self.current_token,
             prompt_tokens=self.prompt_tokens,
             prefilling=self.chunking.is_active(),
-            prefill_tokens=self.chunking.get_tokens_processed()
+            prefill_tokens=self.chunking.get_tokens_done(),
+            max_completion_tokens=self.max_completion_tokens,
+            kv_bound_tokens=self.kv_bound_tokens()
         )
 
     def display_progress(self) -> JobProgress:
@@ -238,9 +374,9 @@ class Job:
 
         Nodes hosting only layers never advance the token counter or the chunk
         state, so they show what the origin last told them. Their own
-        `current_token`/`chunking` are deliberately left alone: `set_layer` reads
-        `chunking.has_more()` to decide whether a finished layer pass goes back to
-        the origin, and a mirrored chunk state would misroute it.
+        `current_token`/`chunking` are deliberately left alone: the processor
+        reads them to decide what a pass that reaches this node does next, and a
+        mirrored copy would have a node that is not the origin act like one.
         """
         if self.reported_progress is not None:
             return self.reported_progress
@@ -254,26 +390,66 @@ class Job:
             return self.update(self)
         return True
 
-    def to_network_job(self) -> NetworkJob:
-        data_hash = self.data.hash_state() if self.data is not None else b''
-        return NetworkJob(
+    def to_network_job(self, hash_data: bool = True) -> NetworkJob:
+        """The packet for the job's current pass. Without `hash_data` the data is
+        left for NetworkJob.hash_data to serialize and hash later."""
+        network_job = NetworkJob(
             job_id=self.job_id, 
             pipe_id=self.pipe_id, 
             origin_node_id=self.origin_node_id, 
             current_layer=self.current_layer, 
             data=self.data, 
-            data_hash=data_hash, 
+            data_hash=b'', 
             compute_step=self.compute_step,
             times=list(self.timing_stats.current_times),
             completed=self.timing_stats.completed_pass,
-            progress=self.get_progress()
+            progress=self.get_progress(),
+            pass_id=self.pass_id,
+            segment_moves=dict(self.segment_moves),
+            replay_id=self.replay_id,
+            replay_start=self.replay_start,
+            replay_end=self.replay_end
         )
+        if hash_data:
+            network_job.hash_data()
+        return network_job
 
     def set_last_update(self):
         self.last_update = time()
 
+    def keep_waiting(self):
+        """A job that waits on purpose (for memory, room in its pipe or a
+        move) is not idle: keep the tracker from expiring it."""
+        self.set_last_update()
+
+    def kept_tokens(self) -> int:
+        """Tokens every node of the pipe has the KV cache of once the job is
+        done: the prompt and every generated token but the last. 0 when the
+        prompt was not done yet."""
+        if self.current_token == 0:
+            return 0
+        return len(self.input_ids) - 1
+
+    def keep_session(self):
+        """Keep the KV cache of a job that finished under its session, if it
+        has one, instead of releasing it."""
+        if self.session_id is None or self.session_kept or self.kv_window_tokens > 0:
+            # A bounded cache no longer holds the whole conversation
+            return
+        tokens = self.session_tokens if self.session_tokens is not None else self.kept_tokens()
+        self.session_kept = SESSION_KV_CACHE.keep(self.session_id, self.pipe_id, self.cache, tokens, self.input_ids[:tokens])
+
+    def release_cache(self):
+        """Hand the job's KV blocks back to the node's pool, unless a session
+        took them over."""
+        self.drop_replay_cache()
+        if self.session_kept:
+            return
+        self.cache.release()
+
     def get_job_ram(self) -> float:
-        total_bytes = 0
+        # Blocks of full attention layers, from the node's KV pool
+        total_bytes = self.cache.held_bytes()
         tensors = []
         # Newer transformers: cache.layers is a list of layer objects with keys/values
         if hasattr(self.cache, "layers"):
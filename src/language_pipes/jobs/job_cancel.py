@@ -1,33 +1,66 @@
+from typing import Optional
+
 from language_pipes.util.byte_helper import ByteHelper
 
 class JobCancel:
-    """Tells the node that owns a job to stop waiting on it.
-
-    Sent when the pipe a job is running on can no longer carry it - a model was
-    unloaded, or the segment for the next layer left the network. Without it the
-    origin sits on the job until the stale timeout fires.
-    """
+    """Tells a node to stop working on a job, or that the job finished or lost a
+    layer on its pipe."""
     job_id: str
     pipe_id: str
     reason: str
+    finished: bool
+    session_id: str
+    session_tokens: int
+    # The layer the pass could not go on to, None for a plain cancel
+    lost_layer: Optional[int]
+    pass_id: int
 
-    def __init__(self, job_id: str, pipe_id: str, reason: str):
+    def __init__(
+            self,
+            job_id: str,
+            pipe_id: str,
+            reason: str,
+            finished: bool = False,
+            session_id: str = "",
+            session_tokens: int = 0,
+            lost_layer: Optional[int] = None,
+            pass_id: int = 0
+    ):
         self.job_id = job_id
         self.pipe_id = pipe_id
         self.reason = reason
+        self.finished = finished
+        self.session_id = session_id
+        self.session_tokens = session_tokens
+        self.lost_layer = lost_layer
+        self.pass_id = pass_id
 
     def to_bytes(self) -> bytes:
         bts = ByteHelper()
         bts.write_string(self.job_id)
         bts.write_string(self.pipe_id)
         bts.write_string(self.reason)
+        bts.write_int(1 if self.finished else 0)
+        bts.write_string(self.session_id)
+        bts.write_int(self.session_tokens)
+        bts.write_int(0 if self.lost_layer is None else 1)
+        bts.write_int(self.lost_layer or 0)
+        bts.write_int(self.pass_id)
         return bts.get_bytes()
 
     @staticmethod
     def from_bytes(data: bytes) -> 'JobCancel':
         bts = ByteHelper(data)
-        return JobCancel(
+        cancel = JobCancel(
             job_id=bts.read_string(),
             pipe_id=bts.read_string(),
-            reason=bts.read_string()
+            reason=bts.read_string(),
+            finished=bts.read_int() == 1,
+            session_id=bts.read_string(),
+            session_tokens=bts.read_int()
         )
+        lost = bts.read_int() == 1
+        lost_layer = bts.read_int()
+        cancel.lost_layer = lost_layer if lost else None
+        cancel.pass_id = bts.read_int()
+        return cancel
@@ -0,0 +1,72 @@
+from threading import Lock
+from typing import Callable, Optional, Set
+
+from language_pipes.jobs.job_sender import JobSender
+from language_pipes.jobs.network_job import HopReply
+from language_pipes.pipes.pipe_manager import PipeManager
+from language_pipes.util.byte_helper import ByteHelper
+
+CREDIT_PROTOCOL = 3
+
+class CreditExchange:
+    """Tells other nodes how many more packets this node has room for from them,
+    and takes the credit they give this node in turn."""
+    sender: JobSender
+    pipe_manager: PipeManager
+    # Packets this node has room for from a node. Call with `lock` held.
+    credit: Callable[[str], int]
+
+    def __init__(self, lock: Lock, credit: Callable[[str], int], sender: JobSender, pipe_manager: PipeManager):
+        self.lock = lock
+        self.credit = credit
+        self.sender = sender
+        self.pipe_manager = pipe_manager
+        # Nodes that were given no credit and wait to hear there is room again
+        self.starved: Set[str] = set()
+
+    def starve(self, node_id: str):
+        """Tell `node_id` once it has credit again. Call with `lock` held."""
+        self.starved.add(node_id)
+
+    def grant(self, node_id: str) -> int:
+        """The credit `node_id` gets now; a node given none is told once it has some."""
+        with self.lock:
+            credit = self.credit(node_id)
+            if credit == 0:
+                self.starve(node_id)
+        return credit
+
+    def return_credit(self):
+        """Tell the nodes that ran out of credit here that there is room again."""
+        with self.lock:
+            if len(self.starved) == 0:
+                return
+            ready = [node_id for node_id in self.starved if self.credit(node_id) > 0]
+            self.starved.difference_update(ready)
+        for node_id in ready:
+            self.sender.send_control(node_id, lambda node_id=node_id: self.exchange(node_id))
+
+    def exchange(self, node_id: str) -> Optional[int]:
+        """Send `node_id` the credit it has here. Returns the credit it gives
+        this node in turn, None from a node that does not say."""
+        payload = ByteHelper()
+        payload.write_int(self.grant(node_id))
+        bts = ByteHelper()
+        bts.write_int(CREDIT_PROTOCOL)
+        bts.write_bytes(payload.get_bytes())
+        data = bts.get_bytes()
+        router = self.pipe_manager.router_pipes.router
+        reply = router.receive_data(data) if node_id == router.node_id() else router.send_to_node(node_id, data)
+        credit = HopReply.from_reply(reply).credit
+        self.sender.set_credit(node_id, credit)
+        return credit
+
+    def receive_credit(self, node_id: str, data: bytes) -> bytes:
+        """Take the credit another node gives this one, and answer with the
+        credit it has here."""
+        try:
+            credit = ByteHelper(data).read_int()
+        except Exception:
+            return HopReply(True).to_bytes()
+        self.sender.set_credit(node_id, credit)
+        return HopReply(True, self.grant(node_id)).to_bytes()
@@ -2,7 +2,7 @@ from dataclasses import dataclass, field
 
 import torch
 import hashlib
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from language_pipes.util.byte_helper import ByteHelper
 from llm_layer_collector.state_obj import LLmComputationState
 
@@ -49,9 +49,32 @@ class JobData:
     # Gemma4 cross-node KV sharing: per-layer-type (k, v) dict mutated as it flows.
     # Empty for other models.
     shared_kv_states: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = field(default_factory=dict)
+    # Prefill passes only: the hashes of the prompt's blocks (see block_hashes)
+    # and the tokens at its start every node loads from its PrefixKVCache
+    prefix_hashes: List[bytes] = field(default_factory=list)
+    prefix_tokens: int = 0
+    # Bounded KV cache of the job (see window_kept): the tokens kept at the
+    # start and the window after them. A window of 0 keeps every token.
+    kv_sink_tokens: int = 0
+    kv_window_tokens: int = 0
+
+    def nbytes(self) -> int:
+        """Bytes the tensors of this pass take up in memory."""
+        tensors = [self.state, self.position_ids, self.cache_position]
+        tensors.extend(t for t in self.causal_mask.values() if t is not None)
+        for pair in list(self.position_embeddings.values()) + list(self.shared_kv_states.values()):
+            tensors.extend(pair)
+        if self.per_layer_inputs is not None:
+            tensors.append(self.per_layer_inputs)
+        return sum(t.numel() * t.element_size() for t in tensors)
 
     def hash_state(self):
-        return hashlib.sha256(self.to_bytes()).digest()
+        return JobData.hash_bytes(self.to_bytes())
+
+    @staticmethod
+    def hash_bytes(data: bytes) -> bytes:
+        """The hash of already serialized job data (see to_bytes)."""
+        return hashlib.sha256(data).digest()
 
     def to_bytes(self) -> bytes:
         state_bytes = tensor_to_bytes(self.state)
@@ -82,6 +105,14 @@ class JobData:
             bts.write_bytes(tensor_to_bytes(self.shared_kv_states[key][0]))
             bts.write_bytes(tensor_to_bytes(self.shared_kv_states[key][1]))
 
+        bts.write_int(self.prefix_tokens)
+        bts.write_int(len(self.prefix_hashes))
+        for block_hash in self.prefix_hashes:
+            bts.write_bytes(block_hash)
+
+        bts.write_int(self.kv_sink_tokens)
+        bts.write_int(self.kv_window_tokens)
+
         return bts.get_bytes()
 
     @staticmethod
@@ -115,6 +146,11 @@ class JobData:
             shared_kv_states[key] = (k, v)
             current_key += 1
 
+        prefix_tokens = bts.read_int()
+        prefix_hashes = [bts.read_bytes() for _ in range(bts.read_int())]
+        kv_sink_tokens = bts.read_int()
+        kv_window_tokens = bts.read_int()
+
         job_data = JobData(
             state = state,
             position_ids = position_ids,
@@ -122,15 +158,18 @@ class JobData:
             causal_mask = causal_mask,
             position_embeddings = position_embeddings,
             per_layer_inputs = per_layer_inputs,
-            shared_kv_states = shared_kv_states
+            shared_kv_states = shared_kv_states,
+            prefix_hashes = prefix_hashes,
+            prefix_tokens = prefix_tokens,
+            kv_sink_tokens = kv_sink_tokens,
+            kv_window_tokens = kv_window_tokens
         )
 
         return job_data
 
     @staticmethod
     def validate_state(data: bytes, state_hash: bytes) -> bool:
-        current_hash = hashlib.sha256(data).digest()
-        return current_hash == state_hash
+        return JobData.hash_bytes(data) == state_hash
 
 def _cast_float(t: torch.Tensor, dtype: Optional[torch.dtype]) -> torch.Tensor:
     if dtype is not None and t.is_floating_point():
@@ -6,22 +6,26 @@ from typing import List, Optional, Callable
 from language_pipes.jobs.job import Job
 from language_pipes.util.chat import ChatMessage
 from language_pipes.jobs.job_tracker import JobTracker
+from language_pipes.modeling.kv_session import session_key
 from language_pipes.pipes.pipe_manager import PipeManager
 
 class JobFactory:
     job_tracker: JobTracker
     pipe_manager: PipeManager
     get_max_api_jobs: Callable[[], int]
+    match_prefix: Optional[Callable[[Job], None]]
 
     def __init__(
         self,
         job_tracker: JobTracker,
         pipe_manager: PipeManager,
-        get_max_api_jobs: Callable[[], int]
+        get_max_api_jobs: Callable[[], int],
+        match_prefix: Optional[Callable[[Job], None]] = None
     ):
         self.job_tracker = job_tracker
         self.pipe_manager = pipe_manager
         self.get_max_api_jobs = get_max_api_jobs
+        self.match_prefix = match_prefix
         self.logger = logging.getLogger(__name__)
 
     def start_job(
@@ -37,8 +41,15 @@ class JobFactory:
         presence_penalty: float = 0.0,
         start: Optional[Callable] = None,
         update: Optional[Callable] = None,
-        resolve: Optional[Promise] = None
+        resolve: Optional[Promise] = None,
+        session_id: Optional[str] = None,
+        resume_session_id: Optional[str] = None
     ) -> Optional[Job]:
+        """Start a job for a chat request. A job with a `session_id` has its
+        KV cache kept under that session once it finishes, and a job with a
+        `resume_session_id` goes on from the cache of that session, if every
+        node of its pipe still has it (see SessionKVCache). Session ids are
+        the caller's and only reach sessions of the same API key."""
         end_model = self.pipe_manager.model_manager.get_end_model(model_id)
         if end_model is None:
             if resolve is not None:
@@ -51,7 +62,7 @@ class JobFactory:
                 resolve('NO_PIPE') # pyright: ignore[reportCallIssue]
             return
 
-        if api_key in self.job_tracker.jobs_pending and len(self.job_tracker.jobs_pending[api_key]) > self.get_max_api_jobs():
+        if self.job_tracker.count_jobs(api_key) > self.get_max_api_jobs():
             if resolve is not None:
                 resolve('MAX_JOBS') # pyright: ignore[reportCallIssue]
             return
@@ -74,16 +85,35 @@ class JobFactory:
             update=update,
             complete=self.job_tracker.complete_job
         )
+        job.kv_sink_tokens = end_model.kv_sink_tokens
+        job.kv_window_tokens = end_model.kv_window_tokens
+        if session_id is not None:
+            job.session_id = session_key(api_key, session_id)
+        if resume_session_id is not None:
+            job.resume_session_id = session_key(api_key, resume_session_id)
+
+        # On the thread that took the request: a long prompt would otherwise
+        # hold up every job on the end model's worker while it is tokenized
+        try:
+            end_model.tokenize_prompt(job)
+        except Exception as e:
+            # The worker tries again and cancels the job if it fails there too
+            self.logger.warning(f"Could not tokenize prompt of job {job.job_id[:4]}: {e}")
+
+        if self.match_prefix is not None and job.prompt_tokens > 0:
+            try:
+                self.match_prefix(job)
+            except Exception as e:
+                # The whole prompt is computed instead
+                self.logger.warning(f"Could not look up the cached prompt of job {job.job_id[:4]}: {e}")
+                job.prefix_tokens = 0
 
         self.logger.info(f"Job {job.job_id[:4]} started")
 
         # Register (and open the response stream) before handing the job to the
         # pipe: the first hop can be this same node, and a job that finishes or
         # gets canceled before it is tracked would never reach the caller.
-        if api_key not in self.job_tracker.jobs_pending:
-            self.job_tracker.jobs_pending[api_key] = [ ]
-
-        self.job_tracker.jobs_pending[api_key].append(job)
+        self.job_tracker.track_job(api_key, job)
 
         if start is not None:
             start(job)
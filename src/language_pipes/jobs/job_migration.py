@@ -0,0 +1,505 @@
+import logging
+from time import time
+from contextlib import suppress
+from dataclasses import dataclass, field
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Set
+
+from language_pipes.jobs.job import Job
+from language_pipes.jobs.job_progress import JobProgress
+from language_pipes.jobs.job_tracker import NETWORK_KEY, JobTracker
+from language_pipes.jobs.memory_governor import Admission, MemoryGovernor, device_key, kv_cache_bytes
+from language_pipes.modeling.llm_model import LlmModel
+from language_pipes.modeling.meta_model import MetaModel, ROLE_PREFILL
+from language_pipes.modeling.model_manager import ModelManager
+from language_pipes.modeling.kv_migrate import MigrationStaging, block_parts, cache_lengths, full_blocks, state_parts
+from language_pipes.pipes.meta_pipe import MetaPipe
+from language_pipes.pipes.pipe_manager import PipeManager
+from language_pipes.util.byte_helper import ByteHelper
+
+MIGRATE_PROTOCOL = 6
+# Seconds a node has to answer a message of a KV cache move, and that a job
+# has to reach a point it can move at
+MIGRATE_TIMEOUT = 30
+# Messages of a KV cache move (see move_segment_jobs)
+MIGRATE_PART = 1
+MIGRATE_COMMIT = 2
+MIGRATE_ABORT = 3
+MIGRATE_PAUSE = 4
+MIGRATE_FINISH = 5
+MIGRATE_HANDOFF = 6
+# How far a move off a segment here has got
+MOVE_WAITING = "waiting"
+MOVE_FINISHING = "finishing"
+MOVE_DONE = "done"
+MOVE_FAILED = "failed"
+
+@dataclass
+class SegmentMove:
+    """The KV cache of a job on a local segment, on its way to a segment of
+    another pipe that holds the same layers."""
+    job: Job
+    segment: LlmModel
+    target: MetaModel
+    # Blocks of each paged layer sent while the job was still running
+    sent: Dict[int, int] = field(default_factory=dict)
+    state: str = MOVE_WAITING
+    lock: Lock = field(default_factory=Lock)
+    done: Event = field(default_factory=Event)
+
+@dataclass
+class PausedMove:
+    """A move a job starting here is held for at its next pass: the node
+    sending the cache, and the segment taking the layers from `start_layer`."""
+    node_id: str
+    start_layer: int
+    process_id: str
+
+class JobMigration:
+    """Moves the KV cache of jobs between segments of different pipes that hold
+    the same layers, over MIGRATE_PROTOCOL."""
+    job_tracker: JobTracker
+    pipe_manager: PipeManager
+    model_manager: ModelManager
+    memory_governor: Optional[MemoryGovernor]
+    resume_job: Callable[[Job], None]
+    get_max_prefill_chunk: Callable[[], int]
+
+    def __init__(
+            self,
+            job_tracker: JobTracker,
+            pipe_manager: PipeManager,
+            model_manager: ModelManager,
+            job_locks: List[Lock],
+            resume_job: Callable[[Job], None],
+            get_max_prefill_chunk: Callable[[], int],
+            memory_governor: Optional[MemoryGovernor] = None
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.job_tracker = job_tracker
+        self.pipe_manager = pipe_manager
+        self.model_manager = model_manager
+        self.job_locks = job_locks
+        self.resume_job = resume_job
+        self.get_max_prefill_chunk = get_max_prefill_chunk
+        self.memory_governor = memory_governor
+        # Moves of jobs' KV caches off segments here and onto segments here
+        self.moves_out: Dict[str, SegmentMove] = { }
+        self.moves_in: Dict[str, MigrationStaging] = { }
+        # Jobs starting here to hold at their next pass for a move
+        self.paused_moves: Dict[str, PausedMove] = { }
+        # Jobs the last move_segment_jobs moved off every segment it was given
+        self.moved_jobs: Set[str] = set()
+        self.moves_lock = Lock()
+
+    def _node_id(self) -> str:
+        return self.pipe_manager.router_pipes.router.node_id()
+
+    def _job_lock(self, job_id: str) -> Lock:
+        return self.job_locks[hash(job_id) % len(self.job_locks)]
+
+    def forget(self, job_id: str):
+        """Drop a move a job that ended here was to be held for."""
+        with self.moves_lock:
+            self.paused_moves.pop(job_id, None)
+
+    def take_moved_jobs(self) -> Set[str]:
+        """The jobs the last move_segment_jobs moved off every segment it was
+        given, which are then forgotten."""
+        with self.moves_lock:
+            moved, self.moved_jobs = self.moved_jobs, set()
+        return moved
+
+    def _segment_jobs(self, segment: LlmModel) -> List[Job]:
+        """The jobs whose KV cache of the segment's layers is here."""
+        jobs: List[Job] = []
+        for job in self.job_tracker.jobs_for_model(segment.model_id):
+            if job.cancel_reason is not None:
+                continue
+            pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+            model = pipe.get_layer(segment.start_layer) if pipe is not None else None
+            if model is not None and model.process_id == segment.process_id:
+                jobs.append(job)
+        return jobs
+
+    def move_segment_jobs(self, segments: List[LlmModel]):
+        """Move the KV cache of the jobs running on `segments`, which are about to be
+        unloaded, to segments of other pipes that hold the same layers."""
+        node_id = self._node_id()
+        leaving = {segment.process_id for segment in segments}
+        moves: List[SegmentMove] = []
+        for segment in segments:
+            if segment.virtual or segment.segment_process is not None:
+                continue
+            targets = [
+                model for model in self.pipe_manager.router_pipes.replicas(segment.to_meta())
+                if model.process_id not in leaving
+            ]
+            if len(targets) == 0:
+                continue
+            for i, job in enumerate(self._segment_jobs(segment)):
+                moves.append(SegmentMove(job, segment, targets[i % len(targets)]))
+
+        threads = [Thread(target=self._move_job, args=(move,), name=f"kv-move-{move.job.job_id[:4]}") for move in moves]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        moved: Dict[str, List[SegmentMove]] = { }
+        for move in moves:
+            if move.state == MOVE_DONE:
+                moved.setdefault(move.job.job_id, []).append(move)
+        moved_jobs: Set[str] = set()
+        for job_moves in moved.values():
+            job = job_moves[0].job
+            pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+            if pipe is None:
+                continue
+            local = [segment for segment in pipe.segments if not segment.virtual]
+            if any(segment.process_id in leaving for segment in local):
+                # It still needs a segment that could not move
+                continue
+            moved_jobs.add(job.job_id)
+            if job.origin_node_id == node_id or len(local) > 0:
+                for move in job_moves:
+                    job.cache.release_layers(range(move.segment.start_layer, move.segment.end_layer + 1))
+            else:
+                self.job_tracker.remove_job(job.job_id)
+        with self.moves_lock:
+            self.moved_jobs = moved_jobs
+
+    def _move_job(self, move: SegmentMove):
+        """Send a job's cache of a local segment to `move.target` until the
+        job's origin holds it, and wait for the move to finish (see
+        _finish_segment_move)."""
+        job, segment, target = move.job, move.segment, move.target
+        layers = range(segment.start_layer, segment.end_layer + 1)
+        with self.moves_lock:
+            self.moves_out[job.job_id] = move
+        try:
+            if job.data is None or job.data.kv_window_tokens == 0:
+                # A bounded cache drops blocks as it goes; it is sent whole at the end
+                move.sent = full_blocks(job.cache, layers)
+                for part in block_parts(job.cache, layers, { }, move.sent):
+                    self._migrate(target.node_id, MIGRATE_PART, job.job_id, part)
+            pause = ByteHelper()
+            pause.write_int(segment.start_layer)
+            pause.write_string(target.process_id)
+            self._migrate(job.origin_node_id, MIGRATE_PAUSE, job.job_id, pause.get_bytes())
+            finished = move.done.wait(MIGRATE_TIMEOUT)
+            with move.lock:
+                if not finished and move.state == MOVE_WAITING:
+                    move.state = MOVE_FAILED
+                    move.done.set()
+            move.done.wait()
+        except Exception as e:
+            self.logger.warning(f"Could not move the KV cache of job {job.job_id[:4]} to {target.node_id}: {e}")
+            with move.lock:
+                move.state = MOVE_FAILED
+        finally:
+            with self.moves_lock:
+                self.moves_out.pop(job.job_id, None)
+        if move.state == MOVE_DONE:
+            self.logger.info(
+                f"Job {job.job_id[:4]} moved layers {segment.start_layer}-{segment.end_layer} to {target.node_id}"
+            )
+            return
+        # The other node drops what it staged, or does after a while anyway
+        with suppress(Exception):
+            self._migrate(target.node_id, MIGRATE_ABORT, job.job_id)
+
+    def _finish_segment_move(self, job_id: str) -> bool:
+        """Send the rest of a held job's cache and hand the job over, under
+        the job's lock. Asked by the job's origin once it holds the job."""
+        with self.moves_lock:
+            move = self.moves_out.get(job_id)
+        if move is None:
+            return False
+        with move.lock:
+            if move.state != MOVE_WAITING:
+                return False
+            move.state = MOVE_FINISHING
+
+        done = False
+        try:
+            with self._job_lock(job_id):
+                self._send_segment(move.job, move.segment, move.target, move.sent)
+            done = True
+        except Exception as e:
+            self.logger.warning(f"Could not finish moving the KV cache of job {job_id[:4]}: {e}")
+        finally:
+            with move.lock:
+                move.state = MOVE_DONE if done else MOVE_FAILED
+            move.done.set()
+        return done
+
+    def _send_segment(self, job: Job, segment: LlmModel, target: MetaModel, sent: Dict[int, int]):
+        """Send a job's cache of a local segment to `target`, past the
+        blocks of each layer in `sent`, and hand the segment's layers of the
+        job over to it. Called under the job's lock; raises unless `target`
+        took the job on."""
+        job_id = job.job_id
+        layers = range(segment.start_layer, segment.end_layer + 1)
+        for part in block_parts(job.cache, layers, sent):
+            self._migrate(target.node_id, MIGRATE_PART, job_id, part)
+        for part in state_parts(job.cache, layers):
+            self._migrate(target.node_id, MIGRATE_PART, job_id, part)
+
+        segment_moves = dict(job.segment_moves)
+        segment_moves[segment.start_layer] = target.process_id
+        commit = ByteHelper()
+        commit.write_string(job.pipe_id)
+        commit.write_string(job.origin_node_id)
+        commit.write_string(job.model_id)
+        commit.write_string(target.process_id)
+        commit.write_int(len(segment_moves))
+        for start_layer, process_id in segment_moves.items():
+            commit.write_int(start_layer)
+            commit.write_string(process_id)
+        commit.write_bytes(job.display_progress().to_bytes())
+        lengths = cache_lengths(job.cache, layers)
+        commit.write_int(len(lengths))
+        for layer_idx, tokens in lengths.items():
+            commit.write_int(layer_idx)
+            commit.write_int(tokens)
+        self._migrate(target.node_id, MIGRATE_COMMIT, job_id, commit.get_bytes())
+        job.segment_moves = segment_moves
+
+    def park_job(self, job: Job) -> bool:
+        """Hold a job starting here that a segment asked to move, or whose
+        prompt a prefill pipe just computed, and have the move or the hand-off
+        to a decode pipe done on another thread. False when there is none."""
+        with self.moves_lock:
+            move = self.paused_moves.pop(job.job_id, None)
+        if move is not None:
+            job.keep_waiting()
+            Thread(target=self._finish_move, args=(job, move), name=f"kv-move-{job.job_id[:4]}").start()
+            return True
+        targets = self._handoff_targets(job)
+        if len(targets) == 0:
+            return False
+        job.keep_waiting()
+        Thread(target=self._hand_off_job, args=(job, targets), name=f"kv-handoff-{job.job_id[:4]}").start()
+        return True
+
+    def _handoff_targets(self, job: Job) -> Dict[int, MetaModel]:
+        """Segments of decode pipes to hand the job's cache of its prefill
+        segments to, by the first layer of each (see
+        RouterPipes.handoff_targets). Looked up once, at the job's first
+        decode pass."""
+        if job.handoff_checked:
+            return { }
+        job.handoff_checked = True
+        pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+        if pipe is None or not any(segment.role == ROLE_PREFILL for segment in pipe.segments):
+            return { }
+        end_model = self.model_manager.get_end_model(job.model_id)
+        start_layer = len(end_model.layers) if end_model is not None else 0
+        meta_pipe = MetaPipe(job.pipe_id, job.model_id, [segment.to_meta() for segment in pipe.segments])
+        return self.pipe_manager.router_pipes.handoff_targets(meta_pipe, start_layer)
+
+    def _hand_off_job(self, job: Job, targets: Dict[int, MetaModel]):
+        """Ask the node of each prefill segment of a held job to hand its
+        cache to the segment of a decode pipe in `targets`, then send the job
+        on. A segment the hand-off fails for keeps the job's layers, so the
+        job decodes on it instead."""
+        for start_layer, target in sorted(targets.items()):
+            pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+            segment = pipe.get_layer(start_layer) if pipe is not None else None
+            if segment is None:
+                continue
+            body = ByteHelper()
+            body.write_int(start_layer)
+            body.write_string(target.process_id)
+            try:
+                self._migrate(segment.node_id, MIGRATE_HANDOFF, job.job_id, body.get_bytes())
+                job.segment_moves[start_layer] = target.process_id
+                self.logger.info(f"Job {job.job_id[:4]} decodes layers {target.start_layer}-{target.end_layer} on {target.node_id}")
+            except Exception as e:
+                self.logger.warning(f"Job {job.job_id[:4]} decodes layers {segment.start_layer}-{segment.end_layer} on its prefill pipe: {e}")
+        self.resume_job(job)
+
+    def _hand_off(self, job_id: str, body: bytes) -> bool:
+        """Hand a held job's cache of a local prefill segment to a segment
+        of a decode pipe, as the job's origin asked."""
+        job = self.job_tracker.get_job(job_id)
+        if job is None or job.cancel_reason is not None:
+            return False
+        handoff = ByteHelper(body)
+        start_layer = handoff.read_int()
+        target = self.pipe_manager.router_pipes.get_model(handoff.read_string())
+        if target is None or not target.loaded:
+            return False
+        with self._job_lock(job_id):
+            pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+            segment = pipe.get_layer(start_layer) if pipe is not None else None
+            if segment is None or segment.start_layer != start_layer or segment.virtual or segment.segment_process is not None:
+                return False
+            try:
+                self._send_segment(job, segment, target, { })
+            except Exception:
+                with suppress(Exception):
+                    self._migrate(target.node_id, MIGRATE_ABORT, job_id)
+                raise
+            job.cache.release_layers(range(segment.start_layer, segment.end_layer + 1))
+            pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+            local = [s for s in pipe.segments if not s.virtual] if pipe is not None else []
+            if job.origin_node_id != self._node_id() and len(local) == 0:
+                self.job_tracker.remove_job(job_id)
+        return True
+
+    def _finish_move(self, job: Job, move: PausedMove):
+        """Ask the node sending a held job's cache to finish the move, then
+        send the job on, on the segment that took its layers or, if the move
+        failed, on the one it was on."""
+        try:
+            self._migrate(move.node_id, MIGRATE_FINISH, job.job_id)
+            job.segment_moves[move.start_layer] = move.process_id
+        except Exception as e:
+            self.logger.warning(f"KV cache of job {job.job_id[:4]} did not move: {e}")
+        self.resume_job(job)
+
+    def _pause_for_move(self, node_id: str, job_id: str, body: bytes) -> bool:
+        """Hold a job starting here at its next pass for a move from `node_id`."""
+        job = self.job_tracker.get_job(job_id)
+        if job is None or job.origin_node_id != self._node_id():
+            return False
+        pause = ByteHelper(body)
+        start_layer = pause.read_int()
+        process_id = pause.read_string()
+        with self.moves_lock:
+            if job_id in self.paused_moves:
+                return False
+            self.paused_moves[job_id] = PausedMove(node_id, start_layer, process_id)
+        return True
+
+    def _stage_part(self, job_id: str, body: bytes) -> bool:
+        now = time()
+        with self.moves_lock:
+            # Moves whose sender went away
+            for stale in [j for j, s in self.moves_in.items() if now - s.created > 2 * MIGRATE_TIMEOUT]:
+                del self.moves_in[stale]
+            staging = self.moves_in.get(job_id)
+            if staging is None:
+                staging = MigrationStaging()
+                self.moves_in[job_id] = staging
+        staging.add(body)
+        return True
+
+    def _admit_move(self, job: Job, segment: LlmModel, progress: Optional[JobProgress]) -> bool:
+        """Reserve memory for the cache of a job moving onto `segment`. A job
+        that does not fit now is not taken."""
+        if self.memory_governor is None or progress is None or progress.prompt_tokens == 0:
+            return True
+        layers = range(segment.start_layer, segment.end_layer + 1)
+        tokens = progress.kv_tokens(self.get_max_prefill_chunk())
+        size = kv_cache_bytes(segment.collector.config, layers, tokens, kv_dtype=segment.kv_cache_dtype)
+        result = self.memory_governor.admit(job.job_id, {device_key(segment.device): size})
+        return result.admission == Admission.ADMIT
+
+    def _commit_move(self, node_id: str, job_id: str, body: bytes) -> bool:
+        """Take on a job whose cache of a segment's layers came from `node_id`."""
+        commit = ByteHelper(body)
+        pipe_id = commit.read_string()
+        origin_node_id = commit.read_string()
+        model_id = commit.read_string()
+        process_id = commit.read_string()
+        segment_moves: Dict[int, str] = { }
+        for _ in range(commit.read_int()):
+            start_layer = commit.read_int()
+            segment_moves[start_layer] = commit.read_string()
+        progress_bytes = commit.read_bytes()
+        progress = JobProgress.from_bytes(progress_bytes) if progress_bytes != b'' else None
+        lengths: Dict[int, int] = { }
+        for _ in range(commit.read_int()):
+            layer_idx = commit.read_int()
+            lengths[layer_idx] = commit.read_int()
+
+        with self.moves_lock:
+            staging = self.moves_in.pop(job_id, None)
+        segment = next((m for m in self.model_manager.layer_models if m.process_id == process_id), None)
+        if staging is None or segment is None or segment.virtual or segment.segment_process is not None:
+            return False
+
+        job = self.job_tracker.get_job(job_id)
+        added = job is None
+        if job is None:
+            if self.job_tracker.is_completed(job_id):
+                return False
+            job = Job(
+                origin_node_id=origin_node_id,
+                messages=[],
+                pipe_id=pipe_id,
+                model_id=model_id,
+                config=segment.collector.config
+            )
+            job.job_id = job_id
+            if not self._admit_move(job, segment, progress):
+                return False
+        elif job.pipe_id != pipe_id:
+            return False
+
+        try:
+            staging.install(job.cache, lengths, segment.device)
+        except Exception:
+            if added:
+                job.release_cache()
+                if self.memory_governor is not None:
+                    self.memory_governor.release(job_id)
+            raise
+        job.segment_moves = segment_moves
+        if progress is not None and origin_node_id != self._node_id():
+            job.reported_progress = progress
+        if added:
+            self.job_tracker.track_job(NETWORK_KEY, job)
+        self.logger.info(f"Job {job_id[:4]} moved its layers {segment.start_layer}-{segment.end_layer} here from {node_id}")
+        return True
+
+    def _migrate(self, node_id: str, kind: int, job_id: str, body: bytes = b''):
+        """Send a message of a move to `node_id`. Raises unless it was done."""
+        payload = ByteHelper()
+        payload.write_int(kind)
+        payload.write_string(job_id)
+        payload.write_bytes(body)
+        bts = ByteHelper()
+        bts.write_int(MIGRATE_PROTOCOL)
+        bts.write_bytes(payload.get_bytes())
+        data = bts.get_bytes()
+        router = self.pipe_manager.router_pipes.router
+        if node_id == router.node_id():
+            reply = router.receive_data(data)
+        else:
+            reply = router.send_to_node(node_id, data, timeout=MIGRATE_TIMEOUT, retries=0)
+        if reply is None or ByteHelper(reply).read_int() != 1:
+            raise Exception(f"node {node_id} did not take part {kind} of the move")
+
+    def receive_migrate(self, node_id: str, data: bytes) -> bytes:
+        """Handle a message of a move of a job's KV cache from `node_id` (see
+        move_segment_jobs). Answers 1 once it was done, 0 otherwise."""
+        try:
+            message = ByteHelper(data)
+            kind = message.read_int()
+            job_id = message.read_string()
+            body = message.read_bytes()
+            done = False
+            if kind == MIGRATE_PART:
+                done = self._stage_part(job_id, body)
+            elif kind == MIGRATE_COMMIT:
+                done = self._commit_move(node_id, job_id, body)
+            elif kind == MIGRATE_ABORT:
+                with self.moves_lock:
+                    self.moves_in.pop(job_id, None)
+                done = True
+            elif kind == MIGRATE_PAUSE:
+                done = self._pause_for_move(node_id, job_id, body)
+            elif kind == MIGRATE_FINISH:
+                done = self._finish_segment_move(job_id)
+            elif kind == MIGRATE_HANDOFF:
+                done = self._hand_off(job_id, body)
+        except Exception as e:
+            self.logger.warning(f"Bad KV cache move from {node_id}: {e}")
+            done = False
+        bts = ByteHelper()
+        bts.write_int(1 if done else 0)
+        return bts.get_bytes()
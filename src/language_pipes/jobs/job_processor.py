@@ -1,9 +1,11 @@
 import logging
-from typing import Callable, Optional
+from typing import Callable, Dict, Hashable, List, Optional
 from enum import Enum, auto
 from dataclasses import dataclass
 
 from language_pipes.jobs.job import Job
+from language_pipes.jobs.chunk_sizer import ChunkSizer
+from language_pipes.jobs.completed_pass import CompletedPass
 from language_pipes.pipes.pipe import Pipe
 from language_pipes.modeling.end_model import EndModel
 from language_pipes.util.enums import ComputeStep, JobStatus
@@ -25,9 +27,28 @@ class JobContext:
     # Called when the job cannot go any further (a segment it needs left the
     # network). Cancels the job here and tells the origin node to stop waiting.
     on_fail: Optional[Callable[[Job, str], None]] = None
+    # Hands the finished pass to the send stage (see JobSender). Without it
+    # the pass is encoded and sent on the calling thread.
+    send_job: Optional[Callable[[Pipe, Job, str], None]] = None
+    # Picks prefill chunk sizes for jobs starting here and learns from every
+    # pass they finish. Without it prompts are split into CHUNK_SIZE chunks.
+    chunk_sizer: Optional[ChunkSizer] = None
+    # Reserves memory for a job starting here once its prompt is tokenized.
+    # False when the job has to wait for memory or was turned away; the hook
+    # parks or cancels it. Without it every job is let in.
+    admit_job: Optional[Callable[[Job], bool]] = None
+    # Holds a decoding job starting here between two passes while one of its
+    # segments moves its KV cache to another node. True when the job was
+    # held; the hook sends it on once the move is over.
+    park_job: Optional[Callable[[Job], bool]] = None
+    # Called instead of on_fail when no node hosts the job's current layer.
+    # The job may go on on segments of other pipes that hold the layers
+    # (see JobReceiver.fail_over).
+    on_lost_layer: Optional[Callable[[Job, str], None]] = None
 
 def should_prefill_chunk(job: Job) -> bool:
-    return job.current_token == 0 and job.chunking.has_more()
+    """A prefill chunk came back to the origin and is not the prompt's last."""
+    return job.current_token == 0 and not job.chunking.next_return_is_final()
 
 def get_next_state(ctx: JobContext) -> JobState:
     cs = ctx.job.compute_step
@@ -35,7 +56,7 @@ def get_next_state(ctx: JobContext) -> JobState:
         if ctx.job.origin_node_id != ctx.node_id:
             return JobState.SEND
         
-        if should_prefill_chunk(ctx.job) or cs == ComputeStep.EMBED or cs == ComputeStep.TOKENIZE:
+        if should_prefill_chunk(ctx.job) or ctx.job.replaying() or cs == ComputeStep.EMBED or cs == ComputeStep.TOKENIZE:
             return JobState.EMBED  
         else:
             return JobState.HEAD
@@ -59,51 +80,101 @@ class JobProcessor:
     
     Transitions that end because a piece of the pipe is gone (no node hosts a
     layer, or the local end model was unloaded) cancel the job on the way to
-    DONE rather than dropping it silently - see _fail.
+    DONE rather than dropping it silently - see _fail. A layer no node hosts
+    goes to on_lost_layer first, which can fail the job over instead.
 
     VALIDATING -> DONE (missing job, or HEAD step off-origin/without end model,
                         or no node hosts the current layer)
     VALIDATING -> SEND (EMBED/TOKENIZE step off-origin, or current layer is virtual)
-    VALIDATING -> HEAD (HEAD step on origin and prefill finished)
-    VALIDATING -> EMBED (EMBED/TOKENIZE step on origin, or more prefill chunks)
+    VALIDATING -> HEAD (HEAD step on origin and the last prefill chunk is back)
+    VALIDATING -> EMBED (EMBED/TOKENIZE step on origin, or an earlier prefill
+                         chunk or a replay chunk is back)
     VALIDATING -> PROCESS_LAYERS (current layer is local)
 
-    HEAD -> DONE (missing end model, more prefill chunks, job complete,
-                  or failed to send update)
+    HEAD -> DONE (missing end model, more prefill chunks to come back, job
+                  complete, or failed to send update)
     HEAD -> EMBED (more tokens to generate)
     # HEAD only runs on the origin node, which holds the end model, so it never
     # transitions to SEND or PROCESS_LAYERS.
 
-    EMBED -> DONE (missing end model, failed to send update, or no node hosts
-                   the next layer)
+    EMBED -> DONE (missing end model, failed to send update, no node hosts the
+                   next layer, a prefill chunk came back and no new one
+                   can be sent yet, a new job is not let in yet, or the
+                   job is held while its KV cache moves)
     EMBED -> SEND (next layer is virtual/remote)
     EMBED -> PROCESS_LAYERS (next layer is local)
+    EMBED -> HEAD (the last replay chunk is back with the end of the pipe
+                   rebuilt)
 
     PROCESS_LAYERS -> DONE (no node hosts the current layer)
     PROCESS_LAYERS -> SEND (next layer set is not local, or all layers done off-origin)
     PROCESS_LAYERS -> PROCESS_LAYERS (next layer set is local)
-    PROCESS_LAYERS -> HEAD (all layers done on origin and prefill finished)
-    PROCESS_LAYERS -> EMBED (all layers done on origin with more prefill chunks)
+    PROCESS_LAYERS -> HEAD (all layers done on origin and the last prefill
+                            chunk is back)
+    PROCESS_LAYERS -> EMBED (all layers done on origin for an earlier prefill
+                             chunk)
 
     SEND -> DONE (handoff complete, or no node hosts the next layer)
+    SEND -> EMBED (origin sent a prefill chunk and the next one may follow it)
     """
     
     state: JobState
     ctx: JobContext
+    # Length of the final prefill chunk while its HEAD pass is running
+    _prefill_chunk_tokens: Optional[int]
+    # Whether that chunk had the pipe to itself
+    _prefill_chunk_alone: bool
     
     def __init__(self, ctx: JobContext):
         self.state = JobState.VALIDATING
         self.ctx = ctx
+        self._prefill_chunk_tokens = None
+        self._prefill_chunk_alone = True
         self.logger = logging.getLogger(__name__)
     
     def run(self):
         while self.state != JobState.DONE:
-            # A cancel (model unloaded here or upstream) can land mid-run; stop
-            # at the state boundary instead of computing against freed tensors.
-            if self.ctx.job.cancel_reason is not None:
-                self.state = JobState.DONE
-                return
-            self.state = self._transition()
+            self.step()
+
+    def step(self):
+        """Execute the current state and move to the next one."""
+        # A cancel (model unloaded here or upstream) can land mid-run; stop
+        # at the state boundary instead of computing against freed tensors.
+        if self.ctx.job.cancel_reason is not None:
+            self.state = JobState.DONE
+            return
+        self.state = self._transition()
+
+    def batch_key(self) -> Optional[Hashable]:
+        """Processors with the same key can run their next state as one batch.
+        None means the next state has to run on its own."""
+        job = self.ctx.job
+        end_model = self.ctx.end_model
+        if job.cancel_reason is not None:
+            return None
+
+        match self.state:
+            case JobState.HEAD:
+                if end_model is None:
+                    return None
+                return ("head", id(end_model))
+            case JobState.EMBED:
+                if end_model is None or self._redoes_lost_chunk() or job.replaying():
+                    return None
+                prefill = job.compute_step == ComputeStep.TOKENIZE or job.chunking.is_active()
+                return ("embed", id(end_model), prefill)
+            case JobState.PROCESS_LAYERS:
+                if job.data is None:
+                    return None
+                prefill = job.data.state.shape[1] != 1
+                if self._runs_end_model_layers():
+                    return ("end_layers", id(end_model), prefill)
+                model = self.ctx.pipe.get_layer(job.current_layer, False)
+                if model is None or model.virtual:
+                    return None
+                return ("layers", id(model), job.current_layer, prefill)
+
+        return None
 
     def _fail(self, reason: str) -> JobState:
         """End the job because the pipe can no longer carry it."""
@@ -112,11 +183,20 @@ class JobProcessor:
             self.ctx.on_fail(self.ctx.job, reason)
         return JobState.DONE
 
+    def _lose_layer(self) -> JobState:
+        """No node hosts the job's current layer."""
+        reason = f"no node hosts layer {self.ctx.job.current_layer}"
+        if self.ctx.on_lost_layer is None:
+            return self._fail(reason)
+        self.logger.info(f"Job {self.ctx.job.job_id[:4]} lost its pipe: {reason}")
+        self.ctx.on_lost_layer(self.ctx.job, reason)
+        return JobState.DONE
+
     def _next_state(self) -> JobState:
         """get_next_state, treating a missing layer host as a failure."""
         state = get_next_state(self.ctx)
         if state == JobState.DONE:
-            return self._fail(f"no node hosts layer {self.ctx.job.current_layer}")
+            return self._lose_layer()
         return state
 
     def _transition(self) -> JobState:
@@ -162,30 +242,51 @@ class JobProcessor:
         if end_model is None:
             return self._fail("end model unloaded")
 
+        if not self._begin_head():
+            return JobState.DONE
+
+        end_model.compute_norm(job)
+        end_model.compute_head(job)
+        return self._finish_head()
+
+    def _begin_head(self) -> bool:
+        """Get the job ready for norm/head. False when there is nothing to compute yet."""
+        job = self.ctx.job
+
         # Log prefill completion when transitioning from prefill to decode
-        is_prefill = job.current_token == 0
-        prefill_chunk_tokens = 0
-        if is_prefill:
-            if job.chunking.has_more():
-                return JobState.DONE
+        self._prefill_chunk_tokens = None
+        if job.current_token == 0:
+            if not job.chunking.next_return_is_final():
+                return False
 
             # Capture the final chunk's length before disable() clears chunk state
-            prefill_chunk_tokens = job.chunking.get_chunk_length()
+            if job.chunking.is_active():
+                self._prefill_chunk_tokens = job.chunking.finish_chunk()
+                self._prefill_chunk_alone = job.chunking.finished_alone()
+            else:
+                self._prefill_chunk_tokens = job.chunking.get_chunk_length()
             job.chunking.disable()
 
         job.compute_step = ComputeStep.NORM
         job.current_layer = 0
 
         job.timing_stats.add_head_time(self.ctx.node_id)
-        end_model.compute_norm(job)
-        end_model.compute_head(job)
+        return True
+
+    def _finish_head(self) -> JobState:
+        """Record the sampled token and either finish the job or go on to embed it."""
+        job = self.ctx.job
+        end_model = self.ctx.end_model
+        assert end_model is not None
+
         job.timing_stats.set_send_time()
         # The pass that produces the first token is still prefill work, so it
         # belongs to the prefill stats rather than the decode averages
-        if is_prefill:
-            job.timing_stats.finalize_prefill_chunk(prefill_chunk_tokens)
+        if self._prefill_chunk_tokens is not None:
+            completed = job.timing_stats.finalize_prefill_chunk(self._prefill_chunk_tokens)
+            self._record_pass(completed, self._prefill_chunk_alone)
         else:
-            job.timing_stats.finalize_token()
+            self._record_pass(job.timing_stats.finalize_token())
 
         # Job completed
         if job.status == JobStatus.COMPLETED:
@@ -213,41 +314,164 @@ class JobProcessor:
         if end_model is None:
             return self._fail("end model unloaded")
 
-        if job.prompt_tokens == 0:
+        if self._redoes_lost_chunk() and not self._restart_prefill():
+            return self._fail("prefill chunk lost in the pipe")
+
+        if job.replaying() and job.compute_step == ComputeStep.HEAD and not self._next_replay_chunk():
+            return self._end_replay()
+
+        if not self._begin_embed():
+            return JobState.DONE
+
+        end_model.compute_embed(job)
+        return self._finish_embed()
+
+    def _begin_embed(self) -> bool:
+        """Tokenize or advance the prefill chunk as needed. False when the client
+        is gone, a new job does not have the memory to start yet, or the job
+        is held while its KV cache moves."""
+        job = self.ctx.job
+        end_model = self.ctx.end_model
+        assert end_model is not None
+
+        if job.compute_step == ComputeStep.TOKENIZE:
+            # The job factory usually tokenized the prompt already
             end_model.tokenize(job)
-            job.init_chunking()
-        elif job.chunking.is_active():
-            chunk_tokens = job.chunking.get_chunk_length()
-            job.chunking.advance()
-            job.timing_stats.finalize_prefill_chunk(chunk_tokens)
+            job.init_chunking(self._chunk_size())
+            if self.ctx.admit_job is not None and not self.ctx.admit_job(job):
+                return False
+        elif job.compute_step == ComputeStep.HEAD:
+            # A prefill chunk came back, and more are still out or to be sent
+            chunk_tokens = job.chunking.finish_chunk()
+            completed = job.timing_stats.finalize_prefill_chunk(chunk_tokens)
+            self._record_pass(completed, job.chunking.finished_alone())
             job.delta = ""
             if not job.send_update():
                 job.stale = True
                 job.status = JobStatus.COMPLETED
                 end_model.set_result(job)
                 job.complete()
-                return JobState.DONE
+                return False
+            if not self._may_send_chunk():
+                return False
+            self._next_chunk()
+        elif job.compute_step == ComputeStep.LAYER:
+            # The last chunk just left; the next one follows it into the pipe
+            job.timing_stats.start_pass()
+            self._next_chunk()
+        elif job.current_token > 0 and not job.replaying() and self.ctx.park_job is not None and self.ctx.park_job(job):
+            # The only pass of a decoding job is here, so no node is using its cache
+            return False
         
+        job.number_pass()
+        job.set_last_update()
+        job.timing_stats.add_embed_time(self.ctx.node_id)
+        return True
+
+    def _next_replay_chunk(self) -> bool:
+        """A replay chunk came back. Get the next one ready; False when it was
+        the last."""
+        job = self.ctx.job
+        job.chunking.finish_chunk()
+        if not job.chunking.has_more():
+            return False
+        self._next_chunk()
+        return True
+
+    def _end_replay(self) -> JobState:
+        """The last replay chunk is back with the newest token's hidden state
+        after the rebuilt layers. Embed the token as a decode pass for its
+        positions and masks, and send it on from there with that state."""
+        job = self.ctx.job
+        end_model = self.ctx.end_model
+        assert end_model is not None and job.data is not None
+        state = job.data.state[:, -1:]
+        shared_kv_states = job.data.shared_kv_states
+        layer = job.replay_end
+        self.logger.info(f"Job {job.job_id[:4]} rebuilt the KV cache up to layer {layer}")
+
+        job.end_replay()
+        job.number_pass()
         job.set_last_update()
         job.timing_stats.add_embed_time(self.ctx.node_id)
         end_model.compute_embed(job)
-        job.timing_stats.set_send_time()
+        job.set_layer(state, layer, job.config.num_hidden_layers, shared_kv_states)
+        return self._finish_embed()
+
+    def _redoes_lost_chunk(self) -> bool:
+        """Whether a pass was sent back to be redone while other prefill chunks
+        are still out."""
+        job = self.ctx.job
+        return job.compute_step == ComputeStep.EMBED and job.chunking.in_flight() > 1
+
+    def _restart_prefill(self) -> bool:
+        """Send the prompt again from the chunk that was lost. The chunks sent
+        after it ran without its KV: they are dropped when they come back,
+        and the chunk sent again drops their KV on every segment (see
+        _rewind in compute.py). False when the lost chunk is not known."""
+        job = self.ctx.job
+        chunk = job.chunking.chunk_of(job.pass_id)
+        if chunk is None:
+            return False
+        self.logger.info(f"Job {job.job_id[:4]} sends its prompt again from chunk {chunk}")
+        job.chunking.restart(chunk)
+        return True
+
+    def _chunk_size(self) -> Optional[int]:
+        if self.ctx.chunk_sizer is None:
+            return None
+        return self.ctx.chunk_sizer.chunk_size()
+
+    def _record_pass(self, completed: Optional[CompletedPass], alone: bool = True):
+        # A chunk that shared the pipe waited behind the chunks ahead of it,
+        # which says nothing about the cost of a pass
+        if self.ctx.chunk_sizer is not None and alone:
+            self.ctx.chunk_sizer.record(completed)
+
+    def _max_chunks_in_flight(self) -> int:
+        """One chunk per node on the pipe keeps every node busy; more would only queue."""
+        return max(1, len({segment.node_id for segment in self.ctx.pipe.segments}))
+
+    def _may_send_chunk(self) -> bool:
+        chunking = self.ctx.job.chunking
+        return chunking.has_more() and chunking.in_flight() < self._max_chunks_in_flight()
+
+    def _next_chunk(self):
+        """Get the job ready to embed its next prefill chunk. The rest of the
+        prompt is re-planned with what the last passes taught the sizer."""
+        job = self.ctx.job
+        job.advance_chunk(self._chunk_size())
+        job.compute_step = ComputeStep.EMBED
+        job.current_layer = 0
 
+    def _sends_next_chunk(self) -> bool:
+        """Whether the origin follows the prefill chunk it just sent with the next one."""
+        job = self.ctx.job
+        if job.origin_node_id != self.ctx.node_id or self.ctx.end_model is None:
+            return False
+        return job.current_token == 0 and job.compute_step == ComputeStep.LAYER and self._may_send_chunk()
+
+    def _finish_embed(self) -> JobState:
+        self.ctx.job.timing_stats.set_send_time()
         return self._next_state()
 
+    def _runs_end_model_layers(self) -> bool:
+        return self.ctx.job.current_layer == 0 and self.ctx.end_model is not None and len(self.ctx.end_model.layers) > 0
+
     def _state_process_layers(self) -> JobState:
         """Process job through local layers."""
         pipe = self.ctx.pipe
         job = self.ctx.job
 
-        if job.current_layer == 0 and self.ctx.end_model is not None and len(self.ctx.end_model.layers) > 0:
+        if self._runs_end_model_layers():
+            assert self.ctx.end_model is not None
             job.timing_stats.add_layer_time(self.ctx.node_id, 0, len(self.ctx.end_model.layers))
             self.ctx.end_model.compute_layers(job)
             job.timing_stats.set_send_time()
 
         model = pipe.get_layer(job.current_layer, False)
         if model is None:
-            return self._fail(f"no node hosts layer {job.current_layer}")
+            return self._lose_layer()
 
         if model.virtual:
             return JobState.SEND
@@ -263,14 +487,122 @@ class JobProcessor:
         """Send job to next destination."""
         job = self.ctx.job
         pipe = self.ctx.pipe
-        network_job = job.to_network_job()
 
         if job.compute_step == ComputeStep.HEAD:
-            pipe.send_job(network_job, network_job.origin_node_id)
+            node_id = job.origin_node_id
         else:
-            next_model = pipe.get_layer(network_job.current_layer, False)
+            next_model = pipe.get_layer(job.current_layer, False)
             if next_model is None:
-                return self._fail(f"no node hosts layer {network_job.current_layer}")
-            pipe.send_job(network_job, next_model.node_id)
-        
+                return self._lose_layer()
+            node_id = next_model.node_id
+
+        if self.ctx.send_job is not None:
+            self.ctx.send_job(pipe, job, node_id)
+        else:
+            pipe.send_job(job.to_network_job(), node_id)
+
+        if self._sends_next_chunk():
+            return JobState.EMBED
         return JobState.DONE
+
+
+def _head_batch(processors: List[JobProcessor]):
+    """HEAD for processors sharing an end model: one norm and one lm_head matmul."""
+    end_model = processors[0].ctx.end_model
+    assert end_model is not None
+    ready: List[JobProcessor] = []
+    for p in processors:
+        if p._begin_head():
+            ready.append(p)
+        else:
+            p.state = JobState.DONE
+
+    if len(ready) > 0:
+        jobs = [p.ctx.job for p in ready]
+        end_model.compute_norm_batch(jobs)
+        end_model.compute_head_batch(jobs)
+    for p in ready:
+        p.state = p._finish_head()
+
+def _embed_batch(processors: List[JobProcessor]):
+    """EMBED for processors sharing an end model, with one embedding lookup."""
+    end_model = processors[0].ctx.end_model
+    assert end_model is not None
+    ready: List[JobProcessor] = []
+    for p in processors:
+        if p._begin_embed():
+            ready.append(p)
+        else:
+            p.state = JobState.DONE
+
+    if len(ready) > 0:
+        end_model.compute_embed_batch([p.ctx.job for p in ready])
+    for p in ready:
+        p.state = p._finish_embed()
+
+def _end_layers_batch(processors: List[JobProcessor]):
+    """The end model's local layers for several jobs, as one forward."""
+    end_model = processors[0].ctx.end_model
+    assert end_model is not None
+    for p in processors:
+        p.ctx.job.timing_stats.add_layer_time(p.ctx.node_id, 0, len(end_model.layers))
+    end_model.compute_layers_batch([p.ctx.job for p in processors])
+    for p in processors:
+        p.ctx.job.timing_stats.set_send_time()
+        p.state = p._next_state()
+
+def _process_layers_batch(processors: List[JobProcessor]):
+    """PROCESS_LAYERS through a local segment for several jobs, as one forward."""
+    first = processors[0]
+    model = first.ctx.pipe.get_layer(first.ctx.job.current_layer, False)
+    assert model is not None
+    jobs = [p.ctx.job for p in processors]
+
+    for p in processors:
+        p.ctx.job.timing_stats.add_layer_time(p.ctx.node_id, p.ctx.job.current_layer, model.end_layer)
+    model.process_jobs(jobs)
+    for p in processors:
+        p.ctx.job.timing_stats.set_send_time()
+        p.ctx.job.set_last_update()
+        p.state = p._next_state()
+
+_BATCH_STEPS: Dict[str, Callable[[List[JobProcessor]], None]] = {
+    "head": _head_batch,
+    "embed": _embed_batch,
+    "end_layers": _end_layers_batch,
+    "layers": _process_layers_batch,
+}
+
+def run_batch(processors: List[JobProcessor]):
+    """Run several processors to DONE, batching the states that can share a forward."""
+    logger = logging.getLogger(__name__)
+    pending = list(processors)
+    while len(pending) > 0:
+        groups: Dict[Hashable, List[JobProcessor]] = { }
+        singles: List[JobProcessor] = []
+        for p in pending:
+            key = p.batch_key()
+            if key is None:
+                singles.append(p)
+            else:
+                groups.setdefault(key, []).append(p)
+
+        for key, group in groups.items():
+            if len(group) == 1:
+                singles.extend(group)
+                continue
+            try:
+                _BATCH_STEPS[key[0]](group)
+            except Exception as e:
+                logger.exception(f"Batched job processing failed: {e}")
+                for p in group:
+                    p.state = JobState.DONE
+
+        for p in singles:
+            try:
+                p.step()
+            except Exception as e:
+                logger.exception(f"Job processing failed: {e}")
+                p.state = JobState.DONE
+
+        pending = [p for p in pending if p.state != JobState.DONE]
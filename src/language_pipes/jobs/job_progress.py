@@ -1,4 +1,13 @@
 from language_pipes.util.byte_helper import ByteHelper
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS
+
+def kv_tokens(total_tokens: int, kv_bound_tokens: int, max_prefill_chunk: int) -> int:
+    """Most tokens a job of `total_tokens` keeps in its KV cache during a
+    pass: all of them, or the bound, up to a block more, and the tokens of
+    the largest chunk the pass adds."""
+    if kv_bound_tokens <= 0:
+        return total_tokens
+    return min(total_tokens, kv_bound_tokens + BLOCK_TOKENS + max_prefill_chunk)
 
 class JobProgress:
     """How far along a job is: the decode token being generated, or how much of
@@ -18,18 +27,32 @@ class JobProgress:
     prefilling: bool
     # Prompt tokens already prefilled; only meaningful while prefilling
     prefill_tokens: int
+    # Most tokens the job may generate, so every node can size its KV cache.
+    # 0 from peers that predate it.
+    max_completion_tokens: int
+    # Most tokens the job's KV cache keeps, 0 when it keeps every token
+    # (see window_kept). 0 from peers that predate it.
+    kv_bound_tokens: int
 
     def __init__(
         self,
         current_token: int,
         prompt_tokens: int,
         prefilling: bool,
-        prefill_tokens: int
+        prefill_tokens: int,
+        max_completion_tokens: int = 0,
+        kv_bound_tokens: int = 0
     ):
         self.current_token = current_token
         self.prompt_tokens = prompt_tokens
         self.prefilling = prefilling
         self.prefill_tokens = prefill_tokens
+        self.max_completion_tokens = max_completion_tokens
+        self.kv_bound_tokens = kv_bound_tokens
+
+    def kv_tokens(self, max_prefill_chunk: int) -> int:
+        """Most tokens the job's KV cache holds during a pass on any node."""
+        return kv_tokens(self.prompt_tokens + self.max_completion_tokens, self.kv_bound_tokens, max_prefill_chunk)
 
     def to_bytes(self) -> bytes:
         bts = ByteHelper()
@@ -37,6 +60,8 @@ class JobProgress:
         bts.write_int(self.prompt_tokens)
         bts.write_int(1 if self.prefilling else 0)
         bts.write_int(self.prefill_tokens)
+        bts.write_int(self.max_completion_tokens)
+        bts.write_int(self.kv_bound_tokens)
         return bts.get_bytes()
 
     @staticmethod
@@ -46,5 +71,7 @@ class JobProgress:
             current_token=bts.read_int(),
             prompt_tokens=bts.read_int(),
             prefilling=bts.read_int() == 1,
-            prefill_tokens=bts.read_int()
+            prefill_tokens=bts.read_int(),
+            max_completion_tokens=bts.read_int(),
+            kv_bound_tokens=bts.read_int()
         )
@@ -0,0 +1,372 @@
+import hashlib
+import threading
+from time import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Collection, Deque, Dict, Hashable, List, Optional, Tuple
+
+from language_pipes.config import DEFAULT_MAX_PREFILL_SHARE, DEFAULT_ROUND_TOKEN_BUDGET
+from language_pipes.jobs.network_job import NetworkJob
+
+# Tokens a flow of weight 1 may spend per turn before the next flow is served
+QUANTUM_TOKENS = 32
+# Recent queue waits kept for the stats
+WAIT_SAMPLES = 256
+
+# A job can have several packets out at once (pipelined prefill chunks), so
+# packets are told apart by their data as well
+PacketKey = Tuple[str, bytes]
+
+def packet_key(network_job: NetworkJob) -> PacketKey:
+    return (network_job.job_id, network_job.data_hash)
+
+def api_key_flow(node_id: str, api_key: str) -> str:
+    """The flow of the jobs `api_key` starts on `node_id`. Only a hash of the
+    key shows in the stats."""
+    return f"{node_id}/{hashlib.blake2b(api_key.encode(), digest_size=4).hexdigest()}"
+
+@dataclass
+class QueuedJob:
+    network_job: NetworkJob
+    sender: str
+    flow: str
+    cost: int
+    # Bytes the packet's tensors hold while it waits
+    size: int
+    batch_class: Optional[Hashable]
+    enqueued_at: float
+
+    @property
+    def prefill(self) -> bool:
+        return self.cost > 1
+
+    @property
+    def key(self) -> PacketKey:
+        return packet_key(self.network_job)
+
+@dataclass
+class QueueStats:
+    depth: int
+    prefill: int = 0
+    decode: int = 0
+    # Queued packets per flow (see JobQueue)
+    flows: Dict[str, int] = field(default_factory=dict)
+    # Seconds, over the last WAIT_SAMPLES packets taken from the queue
+    samples: int = 0
+    avg_wait: float = 0
+    p99_wait: float = 0
+    max_wait: float = 0
+    # Seconds the oldest queued packet has been waiting
+    oldest_wait: float = 0
+    # Queues these numbers cover (one per segment worker)
+    queues: int = 1
+
+def combine_stats(stats: List[QueueStats]) -> QueueStats:
+    """One view over several queues. The p99 is the worst of the queues' p99s."""
+    flows: Dict[str, int] = { }
+    for s in stats:
+        for flow, depth in s.flows.items():
+            flows[flow] = flows.get(flow, 0) + depth
+    samples = sum(s.samples for s in stats)
+    return QueueStats(
+        depth=sum(s.depth for s in stats),
+        prefill=sum(s.prefill for s in stats),
+        decode=sum(s.decode for s in stats),
+        flows=flows,
+        samples=samples,
+        avg_wait=sum(s.avg_wait * s.samples for s in stats) / samples if samples > 0 else 0,
+        p99_wait=max((s.p99_wait for s in stats), default=0),
+        max_wait=max((s.max_wait for s in stats), default=0),
+        oldest_wait=max((s.oldest_wait for s in stats), default=0),
+        queues=len(stats)
+    )
+
+def job_cost(network_job: NetworkJob) -> int:
+    """Tokens of work a packet stands for: one for a decode step, the chunk
+    length for a prefill chunk."""
+    if network_job.data is None:
+        return 1
+    return max(1, network_job.data.state.shape[1])
+
+def job_size(network_job: NetworkJob) -> int:
+    """Bytes of memory a queued packet holds."""
+    if network_job.data is None:
+        return 0
+    return network_job.data.nbytes()
+
+class FairLane:
+    """Weighted deficit round robin over flows for one kind of packet."""
+    def __init__(self, weight: Callable[[str], float] = lambda flow: 1.0):
+        self.weight = weight
+        self.flows: Dict[str, OrderedDict[PacketKey, QueuedJob]] = { }
+        # Flows with queued packets in service order, and their deficit in tokens
+        self.active: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, entry: QueuedJob):
+        self.flows.setdefault(entry.flow, OrderedDict())[entry.key] = entry
+        if entry.flow not in self.active:
+            self.active[entry.flow] = 0
+        self.size += 1
+
+    def next(self) -> QueuedJob:
+        """The packet to serve next, already charged to its flow."""
+        while True:
+            flow, deficit = next(iter(self.active.items()))
+            entry = next(iter(self.flows[flow].values()))
+            if deficit >= entry.cost:
+                self.active[flow] = deficit - entry.cost
+                return entry
+            # Out of tokens this turn: top up and let the next flow go
+            self.active[flow] = deficit + max(1, round(QUANTUM_TOKENS * self.weight(flow)))
+            self.active.move_to_end(flow)
+
+    def charge(self, entry: QueuedJob):
+        self.active[entry.flow] -= entry.cost
+
+    def refund(self, entry: QueuedJob):
+        self.active[entry.flow] += entry.cost
+
+    def remove(self, entry: QueuedJob):
+        flow = self.flows[entry.flow]
+        del flow[entry.key]
+        self.size -= 1
+        if len(flow) == 0:
+            # An idle flow does not bank tokens for later
+            del self.flows[entry.flow]
+            del self.active[entry.flow]
+
+class JobQueue:
+    """Packets waiting to be processed on this node, in a prefill and a decode
+    lane shared fairly across flows."""
+    classify: Callable[[NetworkJob], Optional[Hashable]]
+    get_round_token_budget: Callable[[], int]
+    get_max_prefill_share: Callable[[], float]
+    get_flow_weights: Callable[[], Dict[str, float]]
+
+    def __init__(
+            self,
+            classify: Callable[[NetworkJob], Optional[Hashable]],
+            get_round_token_budget: Callable[[], int] = lambda: DEFAULT_ROUND_TOKEN_BUDGET,
+            get_max_prefill_share: Callable[[], float] = lambda: DEFAULT_MAX_PREFILL_SHARE,
+            get_flow_weights: Callable[[], Dict[str, float]] = lambda: { }
+    ):
+        self.classify = classify
+        self.get_round_token_budget = get_round_token_budget
+        self.get_max_prefill_share = get_max_prefill_share
+        self.get_flow_weights = get_flow_weights
+        self.flow_weights: Dict[str, float] = { }
+        self.cond = threading.Condition()
+        self.closed = False
+        self.entries: Dict[PacketKey, QueuedJob] = { }
+        # Each job's packets in arrival order
+        self.jobs: Dict[str, OrderedDict[PacketKey, QueuedJob]] = { }
+        self.prefill = FairLane(self._flow_weight)
+        self.decode = FairLane(self._flow_weight)
+        self.classes: Dict[Hashable, OrderedDict[PacketKey, QueuedJob]] = { }
+        self.sender_depth: Dict[str, int] = { }
+        self.queued_bytes = 0
+        self.waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+        # Current scheduling round
+        self.round_budget = 0
+        self.prefill_share = 0.0
+        self.round_prefill = 0
+        self.round_decode = 0
+        self._start_round()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: PacketKey) -> bool:
+        return key in self.entries
+
+    def depth(self, sender: str) -> int:
+        return self.sender_depth.get(sender, 0)
+
+    def buffered_bytes(self) -> int:
+        """Bytes held by the packets waiting here."""
+        return self.queued_bytes
+
+    def job_ids(self) -> List[str]:
+        with self.cond:
+            return list(self.jobs)
+
+    def put(self, sender: str, network_job: NetworkJob, max_sender_jobs: int, flow: Optional[str] = None) -> bool:
+        """Queue a packet from `sender` in `flow`, by default the node that
+        started the job. False if the same packet is already waiting."""
+        with self.cond:
+            if packet_key(network_job) in self.entries:
+                return False
+            if self.depth(sender) > max_sender_jobs:
+                raise Exception("Maximum number of jobs for node reached")
+
+            entry = QueuedJob(
+                network_job=network_job,
+                sender=sender,
+                flow=flow if flow is not None else network_job.origin_node_id,
+                cost=job_cost(network_job),
+                size=job_size(network_job),
+                batch_class=self.classify(network_job),
+                enqueued_at=time()
+            )
+            self.entries[entry.key] = entry
+            self.jobs.setdefault(network_job.job_id, OrderedDict())[entry.key] = entry
+            self._lane(entry).add(entry)
+            if entry.batch_class is not None:
+                self.classes.setdefault(entry.batch_class, OrderedDict())[entry.key] = entry
+            self.sender_depth[sender] = self.depth(sender) + 1
+            self.queued_bytes += entry.size
+            self.cond.notify()
+        return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[NetworkJob]:
+        """The next packet to run. Waits up to `timeout` seconds for one; None on
+        timeout or once the queue is closed."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.entries) > 0 or self.closed, timeout):
+                return None
+            if self.closed:
+                return None
+
+            if self.round_prefill + self.round_decode >= self.round_budget:
+                self._start_round()
+            lane = self.prefill if self._prefill_turn() else self.decode
+            entry = lane.next()
+            oldest = self._oldest(entry)
+            if oldest is not entry:
+                # An earlier packet of the same job goes first; the turn is
+                # charged for that one instead
+                lane.refund(entry)
+                self._lane(oldest).charge(oldest)
+                entry = oldest
+            self._remove(entry)
+            self._spend(entry)
+            return entry.network_job
+
+    def take(self, batch_class: Hashable, limit: int, exclude: Collection[str] = ()) -> List[NetworkJob]:
+        """Up to `limit` queued packets of `batch_class`, oldest first, at most one
+        per job and none for the jobs in `exclude`, charged like any other packet."""
+        taken: List[NetworkJob] = []
+        job_ids = set(exclude)
+        with self.cond:
+            for entry in list(self.classes.get(batch_class, { }).values()):
+                if len(taken) >= limit:
+                    break
+                # A job's later packet waits for its earlier ones
+                if entry.network_job.job_id in job_ids or self._oldest(entry) is not entry:
+                    continue
+                if entry.prefill and not self._prefill_allowed(entry.cost):
+                    break
+                job_ids.add(entry.network_job.job_id)
+                self._lane(entry).charge(entry)
+                self._remove(entry)
+                self._spend(entry)
+                taken.append(entry.network_job)
+        return taken
+
+    def remove(self, job_id: str) -> bool:
+        """Drop the packets queued for `job_id`, if there are any."""
+        with self.cond:
+            queued = self.jobs.get(job_id)
+            if queued is None:
+                return False
+            for entry in list(queued.values()):
+                self._remove(entry, taken=False)
+        return True
+
+    def close(self):
+        """Wake every waiting `get` and make it return None."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self) -> QueueStats:
+        with self.cond:
+            waits = sorted(self.waits)
+            now = time()
+            flows: Dict[str, int] = { }
+            for lane in (self.prefill, self.decode):
+                for flow, queued in lane.flows.items():
+                    flows[flow] = flows.get(flow, 0) + len(queued)
+            return QueueStats(
+                depth=len(self.entries),
+                prefill=len(self.prefill),
+                decode=len(self.decode),
+                flows=flows,
+                samples=len(waits),
+                avg_wait=sum(waits) / len(waits) if len(waits) > 0 else 0,
+                p99_wait=waits[int(0.99 * (len(waits) - 1))] if len(waits) > 0 else 0,
+                max_wait=waits[-1] if len(waits) > 0 else 0,
+                oldest_wait=max((now - e.enqueued_at for e in self.entries.values()), default=0)
+            )
+
+    def _oldest(self, entry: QueuedJob) -> QueuedJob:
+        """The first packet still queued for `entry`'s job."""
+        return next(iter(self.jobs[entry.network_job.job_id].values()))
+
+    def _lane(self, entry: QueuedJob) -> FairLane:
+        return self.prefill if entry.prefill else self.decode
+
+    def _start_round(self):
+        self.round_budget = max(1, self.get_round_token_budget())
+        self.prefill_share = min(1.0, max(0.0, self.get_max_prefill_share()))
+        self.round_prefill = 0
+        self.round_decode = 0
+        self.flow_weights = self.get_flow_weights()
+
+    def _flow_weight(self, flow: str) -> float:
+        weight = self.flow_weights.get(flow)
+        if weight is None:
+            weight = self.flow_weights.get(flow.rsplit("/", 1)[0], 1.0)
+        return max(0.0, weight)
+
+    def _prefill_allowed(self, cost: int) -> bool:
+        """Whether `cost` more prefill tokens fit this round while decode steps wait."""
+        if len(self.decode) == 0:
+            return True
+        return self.round_prefill + cost <= self.prefill_share * self.round_budget
+
+    def _prefill_turn(self) -> bool:
+        if len(self.prefill) == 0:
+            return False
+        if len(self.decode) == 0:
+            return True
+        # Under the cap, and not ahead of decode in the capped proportion.
+        # Any chunk may start a round so that a chunk larger than the cap still
+        # gets through.
+        if self.round_prefill > 0 and self.round_prefill >= self.prefill_share * self.round_budget:
+            return False
+        return self.round_prefill * (1 - self.prefill_share) <= self.round_decode * self.prefill_share
+
+    def _spend(self, entry: QueuedJob):
+        if entry.prefill:
+            self.round_prefill += entry.cost
+        else:
+            self.round_decode += entry.cost
+
+    def _remove(self, entry: QueuedJob, taken: bool = True):
+        key = entry.key
+        del self.entries[key]
+        job = self.jobs[entry.network_job.job_id]
+        del job[key]
+        if len(job) == 0:
+            del self.jobs[entry.network_job.job_id]
+        self._lane(entry).remove(entry)
+
+        if entry.batch_class is not None:
+            queued = self.classes[entry.batch_class]
+            del queued[key]
+            if len(queued) == 0:
+                del self.classes[entry.batch_class]
+
+        self.queued_bytes -= entry.size
+        self.sender_depth[entry.sender] -= 1
+        if self.sender_depth[entry.sender] == 0:
+            del self.sender_depth[entry.sender]
+
+        if taken:
+            self.waits.append(time() - entry.enqueued_at)
@@ -1,32 +1,75 @@
+import sys
 import logging
-import random
-import threading
-from time import sleep
-from threading import Thread
-from typing import Callable, Dict, Optional, List
+from time import time
+from contextlib import ExitStack
+from dataclasses import dataclass
+from threading import Lock, Thread, Timer
+from typing import Callable, Dict, Hashable, Optional, List
 
 from language_pipes.pipes.pipe_manager import PipeManager
 
+from language_pipes.config import DEFAULT_MAX_PREFILL_CHUNK, DEFAULT_MIN_PREFILL_CHUNK
 from language_pipes.jobs.job import ComputeStep, Job
+from language_pipes.jobs.chunk_sizer import ChunkSizer
 from language_pipes.jobs.job_cancel import JobCancel
+from language_pipes.jobs.job_credit import CreditExchange
 from language_pipes.jobs.job_factory import JobFactory
-from language_pipes.jobs.job_tracker import JobTracker
-from language_pipes.jobs.network_job import NetworkJob
+from language_pipes.jobs.job_migration import JobMigration
+from language_pipes.jobs.job_queue import JobQueue, QueueStats, api_key_flow, combine_stats, packet_key
+from language_pipes.jobs.job_sender import JobSender
+from language_pipes.jobs.prefix_match import PrefixMatcher
+from language_pipes.jobs.job_tracker import CompletedJobs, JobTracker
+from language_pipes.jobs.memory_governor import Admission, MemoryGovernor, device_key, kv_cache_bytes
+from language_pipes.jobs.network_job import HopReply, NetworkJob
 from language_pipes.modeling.model_manager import ModelManager
-from language_pipes.jobs.job_processor import JobProcessor, JobContext
+from language_pipes.modeling.end_model import EndModel
+from language_pipes.pipes.pipe import Pipe
+from language_pipes.jobs.job_processor import JobProcessor, JobContext, run_batch
 from language_pipes.util.byte_helper import ByteHelper
 
 CANCEL_PROTOCOL = 2
+# Seconds between shutdown checks while the queue is empty
+IDLE_WAIT = 0.5
+# Seconds a worker waits with nothing queued before its thread exits
+WORKER_IDLE_TIMEOUT = 60
+# Worker for packets that only pass through this node (no local segment runs them)
+FORWARD_WORKER = ("forward",)
+# Locks a job's packets are processed under, shared out by job id
+JOB_LOCK_STRIPES = 64
+# Seconds a packet that arrived is remembered, so a copy sent again is dropped.
+# Well past the time a sender keeps trying.
+SEEN_HOP_TIME = 60
+MAX_SEEN_HOPS = 100_000
+# Seconds the pass of a decoding job starting here has to come back after a
+# node left the network before the job fails over (see check_lost_passes)
+STALLED_PASS_TIME = 10
+
+@dataclass
+class JobWorker:
+    """A runner thread and the queue of packets for the segment it owns."""
+    key: Hashable
+    queue: JobQueue
+    thread: Optional[Thread] = None
 
 class JobReceiver:
+    """Takes job packets off the network and runs them, one worker thread per
+    segment hosted here."""
     job_factory: JobFactory
-    job_queue: Dict[str, List[NetworkJob]]
-    queue_lock: threading.Lock
+    workers: Dict[Hashable, JobWorker]
+    chunk_sizers: Dict[str, ChunkSizer]
     pipe_manager: PipeManager
     model_manager: ModelManager
+    memory_governor: Optional[MemoryGovernor]
     shutdown: bool
     is_shutdown: Callable[[], bool]
     get_max_node_jobs: Callable[[], int]
+    get_max_batch_size: Callable[[], int]
+    get_round_token_budget: Callable[[], int]
+    get_max_prefill_share: Callable[[], float]
+    get_min_prefill_chunk: Callable[[], int]
+    get_max_prefill_chunk: Callable[[], int]
+    get_flow_weights: Callable[[], Dict[str, float]]
+    get_api_key_weights: Callable[[], Dict[str, float]]
 
     def __init__(
             self,
@@ -35,10 +78,16 @@ class JobReceiver:
             pipe_manager: PipeManager,
             model_manager: ModelManager,
             is_shutdown: Callable[[], bool],
-            get_max_node_jobs: Callable[[], int]
+            get_max_node_jobs: Callable[[], int],
+            get_max_batch_size: Callable[[], int],
+            get_round_token_budget: Callable[[], int],
+            get_max_prefill_share: Callable[[], float],
+            get_min_prefill_chunk: Callable[[], int] = lambda: DEFAULT_MIN_PREFILL_CHUNK,
+            get_max_prefill_chunk: Callable[[], int] = lambda: DEFAULT_MAX_PREFILL_CHUNK,
+            memory_governor: Optional[MemoryGovernor] = None,
+            get_flow_weights: Callable[[], Dict[str, float]] = lambda: { },
+            get_api_key_weights: Callable[[], Dict[str, float]] = lambda: { }
     ):
-        self.job_queue = { }
-        self.queue_lock = threading.Lock()
         self.logger = logging.getLogger(__name__)
         self.job_tracker = job_tracker
         self.job_factory = job_factory
@@ -46,87 +95,389 @@ class JobReceiver:
         self.pipe_manager = pipe_manager
         self.is_shutdown = is_shutdown
         self.get_max_node_jobs = get_max_node_jobs
+        self.get_max_batch_size = get_max_batch_size
+        self.get_round_token_budget = get_round_token_budget
+        self.get_max_prefill_share = get_max_prefill_share
+        self.get_min_prefill_chunk = get_min_prefill_chunk
+        self.get_max_prefill_chunk = get_max_prefill_chunk
+        self.get_flow_weights = get_flow_weights
+        self.get_api_key_weights = get_api_key_weights
+        self.memory_governor = memory_governor
         self.shutdown = False
-        
-        Thread(target=self._job_runner_loop, args=()).start()
+        self.workers = { }
+        self.workers_lock = Lock()
+        self.sender = JobSender(is_shutdown, self._hop_lost, lambda node_id: self.credit.exchange(node_id), self._credit_returned)
+        # Shares workers_lock, which the credit is counted under
+        self.credit = CreditExchange(self.workers_lock, self._credit, self.sender, pipe_manager)
+        self.prefixes = PrefixMatcher(pipe_manager, model_manager)
+        # Jobs starting here that wait for room in their pipe, oldest first
+        self.held_jobs: List[Job] = []
+        self.held_lock = Lock()
+        # Hops of every pass that arrived here (see NetworkJob.hop_key)
+        self.seen_hops = CompletedJobs(SEEN_HOP_TIME, MAX_SEEN_HOPS)
+        self.chunk_sizers = { }
+        self.chunk_sizers_lock = Lock()
+        self.job_locks = [Lock() for _ in range(JOB_LOCK_STRIPES)]
+        self.migration = JobMigration(
+            job_tracker,
+            pipe_manager,
+            model_manager,
+            self.job_locks,
+            lambda job: self._resume_job(job),
+            get_max_prefill_chunk,
+            memory_governor
+        )
 
-    def _wait_for_job(self) -> Optional[NetworkJob]:
-        """Wait for a job from the queue. Returns None if shutting down."""
+    def _wait_for_job(self, worker: JobWorker) -> Optional[NetworkJob]:
+        """Wait for a job from the worker's queue. Returns None if shutting down
+        or once the worker has been idle long enough to retire."""
+        idle_since = time()
         while True:
             if self.is_shutdown() or self.shutdown:
                 return None
-            if len(self.job_queue.keys()) > 0:
-                with self.queue_lock:
-                    node_id = random.choice(list(self.job_queue.keys()))
-                    node_jobs = self.job_queue[node_id]
-                    idx = random.randrange(len(node_jobs))
-                    network_job = self.job_queue[node_id].pop(idx)
-                    if len(self.job_queue[node_id]) == 0:
-                        del self.job_queue[node_id]
+            network_job = worker.queue.get(IDLE_WAIT)
+            if network_job is not None:
+                self.credit.return_credit()
                 return network_job
-            sleep(0.01)
+            if time() - idle_since > WORKER_IDLE_TIMEOUT and self._retire_worker(worker):
+                return None
+
+    def _retire_worker(self, worker: JobWorker) -> bool:
+        """Forget an idle worker so its thread can exit. False if work arrived meanwhile."""
+        with self.workers_lock:
+            if len(worker.queue) > 0:
+                return False
+            if self.workers.get(worker.key) is worker:
+                del self.workers[worker.key]
+            return True
+
+    def _get_worker(self, key: Hashable) -> JobWorker:
+        """The worker for `key`, started if there is none. Call with workers_lock held."""
+        worker = self.workers.get(key)
+        if worker is None:
+            worker = JobWorker(key, JobQueue(self._batch_class, self.get_round_token_budget, self.get_max_prefill_share, self._flow_weights))
+            self.workers[key] = worker
+            self._start_worker(worker)
+        return worker
+
+    def _start_worker(self, worker: JobWorker):
+        worker.thread = Thread(target=self._job_runner_loop, args=(worker,), name=f"job-worker-{worker.key}")
+        worker.thread.start()
+
+    def _worker_key(self, network_job: NetworkJob) -> Hashable:
+        """Which hosted segment runs the next step of a packet: the end model, the
+        local segment holding its current layer, or the forwarding worker."""
+        pipe = self.pipe_manager.get_job_pipe(network_job.pipe_id, network_job.segment_moves)
+        if pipe is None:
+            return FORWARD_WORKER
+
+        if network_job.compute_step != ComputeStep.LAYER:
+            return ("end", pipe.model_id)
+
+        if network_job.current_layer == 0:
+            end_model = self.model_manager.get_end_model(pipe.model_id)
+            if end_model is not None and len(end_model.layers) > 0:
+                return ("end", pipe.model_id)
+
+        model = pipe.get_layer(network_job.current_layer, False)
+        if model is None or model.virtual:
+            return FORWARD_WORKER
+        return ("layers", pipe.pipe_id, model.start_layer)
+
+    def queue_stats(self) -> QueueStats:
+        with self.workers_lock:
+            workers = list(self.workers.values())
+        return combine_stats([w.queue.stats() for w in workers])
+
+    def buffered_bytes(self) -> int:
+        """Bytes held by the packets queued on every worker."""
+        with self.workers_lock:
+            workers = list(self.workers.values())
+        return sum(w.queue.buffered_bytes() for w in workers)
+
+    def queued_job_ids(self) -> List[str]:
+        with self.workers_lock:
+            workers = list(self.workers.values())
+        return [job_id for w in workers for job_id in w.queue.job_ids()]
+
+    def stop(self):
+        self.shutdown = True
+        self.sender.stop()
+        with self.workers_lock:
+            for worker in self.workers.values():
+                worker.queue.close()
+
+    @staticmethod
+    def _batch_class(network_job: NetworkJob) -> Optional[Hashable]:
+        """Packets with the same class are worth processing together: layer steps on
+        the same layer of a pipe, prefill or decode, and jobs back for their head."""
+        if network_job.compute_step == ComputeStep.HEAD:
+            return ("head",)
+        if network_job.compute_step == ComputeStep.LAYER and network_job.data is not None:
+            prefill = network_job.data.state.shape[1] != 1
+            return ("layer", network_job.pipe_id, network_job.current_layer, prefill)
+        return None
+
+    def _take_batch(self, worker: JobWorker, network_job: NetworkJob) -> List[NetworkJob]:
+        """Pull packets from the worker's queue that can be processed together
+        with `network_job`, up to the configured batch size."""
+        batch = [network_job]
+        batch_class = self._batch_class(network_job)
+        if batch_class is None:
+            return batch
+        batch.extend(worker.queue.take(batch_class, self.get_max_batch_size() - 1, exclude=(network_job.job_id,)))
+        return batch
+
+    def _job_locks(self, batch: List[NetworkJob]) -> List[Lock]:
+        """The locks for the jobs in `batch`, in the one order every worker takes them in."""
+        stripes = sorted({hash(j.job_id) % JOB_LOCK_STRIPES for j in batch})
+        return [self.job_locks[i] for i in stripes]
+
+    def _make_processor(self, network_job: NetworkJob) -> Optional[JobProcessor]:
+        """Resolve the local job for a packet and build the processor that runs it."""
+        job = self.job_tracker.get_job(network_job.job_id)
+        if job is None:
+            # A job that already finished or was canceled must not be
+            # resurrected by a packet that was still in flight.
+            if self.job_tracker.is_completed(network_job.job_id):
+                return None
+            pipe = self.pipe_manager.get_job_pipe(network_job.pipe_id, network_job.segment_moves)
+            assert pipe is not None
+            job = self.job_tracker.add_job(
+                network_job,
+                self.model_manager.get_config(pipe.model_id),
+                pipe.model_id
+            )
+            assert job is not None
+            if not self._admit_network_job(job, pipe, network_job):
+                return None
+
+        node_id = self.pipe_manager.router_pipes.router.node_id()
+
+        if self._gave_up_on(job, network_job, node_id):
+            return None
+
+        # Validate network job
+        if not job.receive_network_job(network_job, node_id):
+            return None
+
+        pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+        if pipe is None:
+            return None
+
+        end_model = self.model_manager.get_end_model(pipe.model_id)
+        origin = job.origin_node_id == node_id
+
+        return JobProcessor(JobContext(
+            node_id=node_id,
+            pipe=pipe,
+            end_model=end_model,
+            job=job,
+            on_fail=self.cancel_job,
+            send_job=self.sender.send,
+            chunk_sizer=self._chunk_sizer(pipe.pipe_id) if origin else None,
+            admit_job=self._admit_job,
+            park_job=self.migration.park_job if origin else None,
+            on_lost_layer=lambda job, reason: self._lose_layer(job, job.current_layer, reason)
+        ))
+
+    @staticmethod
+    def _gave_up_on(job: Job, network_job: NetworkJob, node_id: str) -> bool:
+        """Whether a pass coming back to its origin is one the job gave up on:
+        a decode pass it failed over from, or a prefill chunk sent before a
+        lost chunk ahead of it was sent again. The job sent a new pass since."""
+        if job.origin_node_id != node_id:
+            return False
+        if network_job.pass_id in job.chunking.stale_passes:
+            return True
+        return (
+            network_job.compute_step == ComputeStep.HEAD
+            and job.current_token > 0
+            and network_job.pass_id != job.passes_sent
+        )
+
+    def _kv_needs(self, pipe: Pipe, end_model: Optional[EndModel], tokens: int) -> Dict[str, int]:
+        """Bytes of KV cache per device a job of `tokens` tokens takes on this
+        node: the end model's layers on the origin and the local segments of its pipe."""
+        needs: Dict[str, int] = { }
+        if end_model is not None and len(end_model.layers) > 0:
+            size = kv_cache_bytes(
+                end_model.collector.config, range(len(end_model.layers)), tokens, kv_dtype=end_model.kv_cache_dtype
+            )
+            needs[device_key(end_model.device)] = size
+        for segment in pipe.segments:
+            if segment.virtual:
+                continue
+            layers = range(segment.start_layer, segment.end_layer + 1)
+            size = kv_cache_bytes(segment.collector.config, layers, tokens, kv_dtype=segment.kv_cache_dtype)
+            needs[device_key(segment.device)] = needs.get(device_key(segment.device), 0) + size
+        return needs
+
+    def _admit_job(self, job: Job) -> bool:
+        """Let a job starting here in, park it until there is memory and room
+        in its pipe, or turn it away."""
+        pipe = self.pipe_manager.get_pipe_by_pipe_id(job.pipe_id)
+        if pipe is None:
+            return True
+        if self.memory_governor is not None and not self._admit_memory(job, pipe):
+            return False
+        if self._pipe_full(pipe):
+            self._hold_job(job)
+            return False
+        return True
+
+    def _admit_memory(self, job: Job, pipe: Pipe) -> bool:
+        assert self.memory_governor is not None
+        end_model = self.model_manager.get_end_model(job.model_id)
+        needs = self._kv_needs(pipe, end_model, job.get_progress().kv_tokens(self.get_max_prefill_chunk()))
+        result = self.memory_governor.admit(job.job_id, needs)
+        if result.admission == Admission.ADMIT:
+            return True
+        if result.admission == Admission.REJECT:
+            self.cancel_job(job, result.reason or "not enough memory")
+            return False
+
+        self.logger.info(f"Job {job.job_id[:4]} {result.reason}")
+        job.keep_waiting()
+        self.memory_governor.wait(
+            job.job_id,
+            needs,
+            lambda: self._resume_after_memory(job),
+            lambda reason: self.cancel_job(job, reason)
+        )
+        return False
+
+    def _resume_after_memory(self, job: Job):
+        pipe = self.pipe_manager.get_pipe_by_pipe_id(job.pipe_id)
+        if pipe is not None and self._pipe_full(pipe):
+            self._hold_job(job)
+            return
+        self._resume_job(job)
+
+    def _pipe_full(self, pipe: Pipe) -> bool:
+        """Whether a node on the pipe has no room left for passes from this node."""
+        node_id = self._node_id()
+        return any(
+            self.sender.credit(segment.node_id) == 0
+            for segment in pipe.segments if segment.node_id != node_id
+        )
+
+    def _hold_job(self, job: Job):
+        """Keep a job starting here until its pipe has room for it."""
+        self.logger.info(f"Job {job.job_id[:4]} waiting for room in pipe {job.pipe_id[:4]}")
+        job.keep_waiting()
+        with self.held_lock:
+            self.held_jobs.append(job)
+        # The room may have come back meanwhile
+        self._credit_returned()
+
+    def _credit_returned(self, node_id: Optional[str] = None):
+        """Send held jobs into their pipes, oldest first, while the pipes have room."""
+        ready: List[Job] = []
+        with self.held_lock:
+            for job in list(self.held_jobs):
+                if self.job_tracker.get_job(job.job_id) is not job:
+                    # Canceled or expired while it waited
+                    self.held_jobs.remove(job)
+                    continue
+                pipe = self.pipe_manager.get_pipe_by_pipe_id(job.pipe_id)
+                if pipe is not None and self._pipe_full(pipe):
+                    continue
+                self.held_jobs.remove(job)
+                ready.append(job)
+        for job in ready:
+            self._resume_job(job)
+
+    def _resume_job(self, job: Job):
+        """Send a job that waited for memory or room back into its pipe."""
+        pipe = self.pipe_manager.get_pipe_by_pipe_id(job.pipe_id)
+        if pipe is None:
+            self.cancel_job(job, "pipe went away while the job waited")
+            return
+        job.set_last_update()
+        try:
+            # Through this node's own queue, which has room for it whatever
+            # the other nodes sent
+            self._enqueue(self._node_id(), job.to_network_job(), limited=False)
+        except Exception as e:
+            self.logger.exception(f"Could not resume job {job.job_id[:4]}: {e}")
+            self.cancel_job(job, "could not send job to pipe")
+
+    def _admit_network_job(self, job: Job, pipe: Pipe, network_job: NetworkJob) -> bool:
+        """Reserve memory for a job another node started, from the size its
+        origin reports. A job that does not fit is canceled; other nodes hold
+        the rest of its pipe, so there is nowhere here for it to wait."""
+        progress = network_job.progress
+        if self.memory_governor is None or progress is None or progress.prompt_tokens == 0:
+            return True
+        needs = self._kv_needs(pipe, None, progress.kv_tokens(self.get_max_prefill_chunk()))
+        result = self.memory_governor.admit(job.job_id, needs)
+        if result.admission == Admission.ADMIT:
+            return True
+        reason = result.reason
+        if result.admission == Admission.WAIT:
+            reason = "not enough memory: other jobs are using it"
+        self.cancel_job(job, f"{reason} (node {self._node_id()})")
+        return False
 
-    def _job_runner_loop(self):
-        """Main job processing loop using FSM."""
+    def _chunk_sizer(self, pipe_id: str) -> ChunkSizer:
+        with self.chunk_sizers_lock:
+            sizer = self.chunk_sizers.get(pipe_id)
+            if sizer is None:
+                sizer = ChunkSizer(self.get_min_prefill_chunk, self.get_max_prefill_chunk)
+                self.chunk_sizers[pipe_id] = sizer
+            return sizer
+
+    def _job_runner_loop(self, worker: JobWorker):
+        """Job processing loop of one worker, using the FSM.
+
+        A job keeps going on the worker that picked it up until it leaves the
+        node, even if its pass runs through more than one local segment.
+        """
         try:
             while True:
-                network_job = self._wait_for_job()
+                network_job = self._wait_for_job(worker)
                 if network_job is None:
                     return
-                
-                job = self.job_tracker.get_job(network_job.job_id)
-                if job is None:
-                    # A job that already finished or was canceled must not be
-                    # resurrected by a packet that was still in flight.
-                    if network_job.job_id in self.job_tracker.jobs_completed:
-                        continue
-                    pipe = self.pipe_manager.get_pipe_by_pipe_id(network_job.pipe_id)
-                    assert pipe is not None
-                    job = self.job_tracker.add_job(
-                        network_job,
-                        self.model_manager.get_config(pipe.model_id),
-                        pipe.model_id
-                    )
-                    assert job is not None
-
-                node_id = self.pipe_manager.router_pipes.router.node_id()
-
-                # Validate network job
-                if not job.receive_network_job(network_job, node_id):
-                    continue
-
-                pipe = self.pipe_manager.get_pipe_by_pipe_id(network_job.pipe_id)
-                if pipe is None:
-                    continue
 
-                end_model = self.model_manager.get_end_model(pipe.model_id)
-                
-                fsm = JobProcessor(JobContext(
-                    node_id=node_id,
-                    pipe=pipe,
-                    end_model=end_model,
-                    job=job,
-                    on_fail=self.cancel_job
-                ))
-
-                try:
-                    fsm.run()
-                except Exception as e:
-                    self.logger.exception(f"Job processing failed: {e}")
+                batch = self._take_batch(worker, network_job)
+                with ExitStack() as locks:
+                    for lock in self._job_locks(batch):
+                        locks.enter_context(lock)
+                    self._run_batch(batch)
         except Exception as e:
             self.logger.exception(f"Job runner loop failed: {e}")
-            Thread(target=self._job_runner_loop, args=()).start()
+            self._start_worker(worker)
+
+    def _run_batch(self, batch: List[NetworkJob]):
+        processors: List[JobProcessor] = []
+        for j in batch:
+            try:
+                fsm = self._make_processor(j)
+            except Exception as e:
+                self.logger.exception(f"Job processing failed: {e}")
+                continue
+            if fsm is not None:
+                processors.append(fsm)
+
+        if len(processors) == 1:
+            try:
+                processors[0].run()
+            except Exception as e:
+                self.logger.exception(f"Job processing failed: {e}")
+        elif len(processors) > 1:
+            run_batch(processors)
 
     def _node_id(self) -> str:
         return self.pipe_manager.router_pipes.router.node_id()
 
     def _drop_queued(self, job_id: str):
         """Discard packets for a job that is no longer running."""
-        with self.queue_lock:
-            for node_id in list(self.job_queue.keys()):
-                self.job_queue[node_id] = [j for j in self.job_queue[node_id] if j.job_id != job_id]
-                if len(self.job_queue[node_id]) == 0:
-                    del self.job_queue[node_id]
+        with self.workers_lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.queue.remove(job_id)
+        self.credit.return_credit()
 
     def _send_cancel(self, node_id: str, cancel: JobCancel):
         bts = ByteHelper()
@@ -159,8 +510,11 @@ class JobReceiver:
             self.cancel_job(job, reason)
 
     def cancel_pipe_jobs(self, pipe_ids: List[str], reason: str):
-        """Cancel every job running on the given pipes (a segment went away)."""
-        self.cancel_jobs(self.job_tracker.jobs_for_pipes(pipe_ids), reason)
+        """Cancel every job running on the given pipes (a segment went away),
+        but the jobs JobMigration.move_segment_jobs just moved off it."""
+        moved = self.migration.take_moved_jobs()
+        jobs = [job for job in self.job_tracker.jobs_for_pipes(pipe_ids) if job.job_id not in moved]
+        self.cancel_jobs(jobs, reason)
 
     def cancel_model_jobs(self, model_id: str, reason: str):
         """Cancel jobs this node started for a model whose end model is gone.
@@ -170,8 +524,136 @@ class JobReceiver:
         """
         self.cancel_jobs(self.job_tracker.jobs_for_model(model_id, self._node_id()), reason)
 
+    def _hop_lost(self, job: Job, node_id: str, reason: str):
+        """A pass could not be sent on. A pass on its way to the next layer
+        fails over (see _lose_layer); a job whose origin is out of reach
+        cannot finish."""
+        reason = f"could not reach node {node_id}: {reason}"
+        if job.compute_step == ComputeStep.HEAD:
+            self.cancel_job(job, reason)
+        elif job.origin_node_id == self._node_id():
+            self._lose_pass(job, job.current_layer, job.pass_id, reason)
+        else:
+            self._lose_layer(job, job.current_layer, reason)
+
+    def _lose_layer(self, job: Job, layer: int, reason: str):
+        """The pass of a job cannot go on to `layer`. The origin fails the job
+        over, or cancels it if it cannot; any other node asks the origin to.
+        On the origin, call with the job's lock held."""
+        if job.origin_node_id != self._node_id():
+            lost = JobCancel(job.job_id, job.pipe_id, reason, lost_layer=layer, pass_id=job.pass_id)
+            self._send_cancel(job.origin_node_id, lost)
+            return
+        if not self.fail_over(job, layer):
+            self.cancel_job(job, reason)
+
+    def _lose_pass(self, job: Job, layer: int, pass_id: int, reason: str):
+        """_lose_layer for the pass `pass_id` of a job starting here, from
+        outside its processing. A pass the job already gave up on is let go."""
+        with self.job_locks[hash(job.job_id) % JOB_LOCK_STRIPES]:
+            if pass_id != job.passes_sent or job.cancel_reason is not None:
+                return
+            self._lose_layer(job, layer, reason)
+
+    def fail_over(self, job: Job, layer: int) -> bool:
+        """Send a decoding job starting here on through segments of other pipes
+        that hold the layers its pass could not reach at `layer`, replaying its
+        tokens to rebuild their KV cache. False when the job cannot fail over."""
+        end_model = self.model_manager.get_end_model(job.model_id)
+        if end_model is None or job.cancel_reason is not None or job.current_token == 0:
+            return False
+        if job.kv_window_tokens > 0 or job.replaying():
+            return False
+        pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+        if pipe is None:
+            return False
+
+        lost = pipe.get_layer(layer)
+        if lost is not None:
+            start, end, lost_node_id = lost.start_layer, lost.end_layer, lost.node_id
+        else:
+            num_layers = job.config.num_hidden_layers
+            start, end, lost_node_id = layer, layer, None
+            while end + 1 < num_layers and pipe.get_layer(end + 1) is None:
+                end += 1
+        segments = self.pipe_manager.router_pipes.cover(job.model_id, job.pipe_id, start, end, lost_node_id)
+        if len(segments) == 0:
+            return False
+
+        job.segment_moves = {s: p for s, p in job.segment_moves.items() if s < start or s > end}
+        for segment in segments:
+            job.segment_moves[segment.start_layer] = segment.process_id
+        job.start_replay(start, end + 1, self._chunk_sizer(job.pipe_id).chunk_size())
+        self.logger.info(
+            f"Job {job.job_id[:4]} failed over layers {start}-{end} to "
+            f"{', '.join(s.node_id for s in segments)}, replaying {len(job.input_ids)} tokens"
+        )
+        self._resume_job(job)
+        return True
+
+    def check_lost_passes(self):
+        """A node left the network. Its send lanes are retired. The passes it
+        held are lost with it and no node says so: the decoding jobs starting
+        here whose pass has not come back STALLED_PASS_TIME from now, and
+        whose pipe lost a layer, fail over then."""
+        node_id = self._node_id()
+        router = self.pipe_manager.router_pipes.router
+        self.sender.retire_lanes([node_id, *router.peers()])
+        waiting = {
+            job.job_id: job.passes_sent for job in self.job_tracker.get_jobs()
+            if job.origin_node_id == node_id and job.current_token > 0
+        }
+        if len(waiting) == 0:
+            return
+        timer = Timer(STALLED_PASS_TIME, self._fail_over_stalled, args=(waiting,))
+        timer.daemon = True
+        timer.start()
+
+    def _fail_over_stalled(self, waiting: Dict[str, int]):
+        for job_id, pass_id in waiting.items():
+            job = self.job_tracker.get_job(job_id)
+            if job is None:
+                continue
+            layer = self._missing_layer(job)
+            if layer is not None:
+                self._lose_pass(job, layer, pass_id, f"no node hosts layer {layer}")
+
+    def _missing_layer(self, job: Job) -> Optional[int]:
+        """The first layer of a job's pipe that no node hosts."""
+        end_model = self.model_manager.get_end_model(job.model_id)
+        pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+        if end_model is None or pipe is None:
+            return None
+        for layer in range(len(end_model.layers), job.config.num_hidden_layers):
+            if pipe.get_layer(layer) is None:
+                return layer
+        return None
+
+    def finish_job(self, job: Job):
+        """Tell the other nodes on a job's pipe that the job ended here, so
+        they free its KV cache and queued packets now. Only the origin knows
+        when a job ends; every other node would hold on until it expires."""
+        node_id = self._node_id()
+        if job.origin_node_id != node_id:
+            return
+        self.migration.forget(job.job_id)
+        pipe = self.pipe_manager.get_job_pipe(job.pipe_id, job.segment_moves)
+        if pipe is None:
+            return
+        cancel = JobCancel(
+            job.job_id,
+            job.pipe_id,
+            job.cancel_reason or "completed",
+            finished=job.cancel_reason is None,
+            session_id=job.session_id if job.session_kept and job.session_id is not None else "",
+            session_tokens=job.kept_tokens() if job.session_kept else 0
+        )
+        for peer in sorted({segment.node_id for segment in pipe.segments} - {node_id}):
+            self.sender.send_notice(peer, lambda peer=peer: self._send_cancel(peer, cancel))
+
     def receive_cancel(self, node_id: str, data: bytes):
-        """Handle a cancel sent by another node holding part of our job."""
+        """Handle a cancel sent by another node holding part of our job, or
+        the origin telling us one of its jobs ended."""
         try:
             cancel = JobCancel.from_bytes(data)
         except Exception:
@@ -179,6 +661,23 @@ class JobReceiver:
         job = self.job_tracker.get_job(cancel.job_id)
         if job is None or job.pipe_id != cancel.pipe_id:
             self._drop_queued(cancel.job_id)
+            if job is None and node_id != self._node_id():
+                # Packets of the job may still be on their way here
+                self.job_tracker.mark_completed(cancel.job_id)
+            return
+        if node_id == job.origin_node_id and node_id != self._node_id():
+            # The origin ended the job and has told everyone; nothing to send back
+            self._drop_queued(job.job_id)
+            if cancel.finished:
+                if cancel.session_id != "":
+                    job.session_id = cancel.session_id
+                    job.session_tokens = cancel.session_tokens
+                self.job_tracker.complete_job(job)
+            else:
+                self.job_tracker.cancel_job(job, cancel.reason)
+            return
+        if cancel.lost_layer is not None and job.origin_node_id == self._node_id():
+            self._lose_pass(job, cancel.lost_layer, cancel.pass_id, cancel.reason)
             return
         self.cancel_job(job, cancel.reason)
 
@@ -193,25 +692,74 @@ class JobReceiver:
             return
         pipe.send_job(network_job, network_job.origin_node_id)
 
-    def receive_data(self, node_id: str, data: bytes):
-        """Receive and validate incoming job data."""
+    def _credit(self, node_id: str) -> int:
+        """Packets this node has room for from `node_id`. Call with workers_lock held."""
+        queued = sum(w.queue.depth(node_id) for w in self.workers.values())
+        return max(0, self.get_max_node_jobs() + 1 - queued)
+
+    def _flow(self, job: NetworkJob) -> str:
+        """The queue flow of a packet: its origin node, or its API key for a
+        job started here."""
+        node_id = self._node_id()
+        if job.origin_node_id == node_id:
+            api_key = self.job_tracker.job_key(job.job_id)
+            if api_key is not None:
+                return api_key_flow(node_id, api_key)
+        return job.origin_node_id
+
+    def _flow_weights(self) -> Dict[str, float]:
+        """Weights of the queues' flows: origin nodes from `flow_weights`,
+        and the API keys of this node from `api_key_weights` on top of
+        this node's weight."""
+        weights = dict(self.get_flow_weights())
+        node_id = self._node_id()
+        node_weight = weights.get(node_id, 1.0)
+        for api_key, weight in self.get_api_key_weights().items():
+            weights[api_key_flow(node_id, api_key)] = node_weight * weight
+        return weights
+
+    def _enqueue(self, node_id: str, job: NetworkJob, limited: bool = True) -> HopReply:
+        """Queue a packet from `node_id` on the worker that runs it."""
+        key = self._worker_key(job)
+        hop_key = job.hop_key()
+        flow = self._flow(job)
+        with self.workers_lock:
+            # The sender did not hear back in time and sent it again
+            if hop_key is not None and hop_key in self.seen_hops:
+                return HopReply(True, self._credit(node_id))
+            # Duplicate packets that are already waiting are ignored
+            if any(packet_key(job) in w.queue for w in self.workers.values()):
+                return HopReply(True, self._credit(node_id))
+            worker = self._get_worker(key)
+            # The per-node limit covers what the node has queued on every worker
+            queued_elsewhere = sum(w.queue.depth(node_id) for w in self.workers.values() if w is not worker)
+            max_jobs = self.get_max_node_jobs() - queued_elsewhere if limited else sys.maxsize
+            try:
+                worker.queue.put(node_id, job, max_jobs, flow)
+            except Exception as e:
+                self.logger.warning(f"Job {job.job_id[:4]} from {node_id} turned away: {e}")
+                self.credit.starve(node_id)
+                return HopReply(False, 0)
+            if hop_key is not None:
+                self.seen_hops.add(hop_key)
+            credit = self._credit(node_id)
+            if credit == 0:
+                self.credit.starve(node_id)
+        return HopReply(True, credit)
+
+    def receive_data(self, node_id: str, data: bytes) -> bytes:
+        """Receive and validate incoming job data.
+
+        Answers the sender BUSY when the node has no room for the packet, so
+        it holds it until told there is room, and ACCEPTED otherwise, with
+        the credit it has left. A copy of a packet that already arrived is
+        accepted and dropped.
+        """
         try:
             job, valid = NetworkJob.from_bytes(data)
         except Exception:
-            return
+            return HopReply(True).to_bytes()
         if not valid:
             self.restart_token(job)
-            return
-        
-        # Ignore duplicate jobs
-        if node_id in self.job_queue:
-            for j in self.job_queue[node_id]:
-                if j.job_id == job.job_id:
-                    return
-
-        with self.queue_lock:
-            if node_id not in self.job_queue:
-                self.job_queue[node_id] = [ ]
-            if len(self.job_queue[node_id]) > self.get_max_node_jobs():
-                raise Exception("Maximum number of jobs for node reached")
-            self.job_queue[node_id].insert(0, job)
+            return HopReply(True).to_bytes()
+        return self._enqueue(node_id, job).to_bytes()
@@ -0,0 +1,273 @@
+import queue
+import logging
+from contextlib import suppress
+from time import sleep, time
+from threading import Condition, Lock, Thread
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, Iterable, Optional, Union
+
+from language_pipes.jobs.job import Job
+from language_pipes.jobs.network_job import NetworkJob
+from language_pipes.pipes.pipe import Pipe
+
+# Passes that may wait on one destination before the worker handing over the
+# next one blocks
+SEND_QUEUE_SIZE = 4
+# Seconds between shutdown checks while a lane is empty or full
+IDLE_WAIT = 0.5
+# Seconds a lane waits with nothing to send before its thread exits
+LANE_IDLE_TIMEOUT = 60
+# Times a pass is sent before the job is given up on
+HOP_ATTEMPTS = 5
+# Seconds before a pass is sent again, doubled for every try after that
+RETRY_WAIT = 0.1
+# A hop may take this many times as long as the ones before it were
+# expected to before it is sent again
+HOP_DEADLINE_FACTOR = 4
+# Shortest deadline of a hop, in seconds
+MIN_HOP_DEADLINE = 1.0
+# Transfer rate assumed for a node no hop has been timed to yet
+DEFAULT_BYTES_PER_SEC = 1024 * 1024
+# Passes smaller than this take as long as the round trip, whatever their size
+MIN_TIMED_BYTES = 64 * 1024
+# Weight of the newest hop in a node's measured rate
+RATE_SMOOTHING = 0.2
+# Seconds a lane waits for a node with no credit left to give some back
+# before it asks
+CREDIT_WAIT = 0.5
+# Seconds a pass waits for credit before it is sent anyway, and then counts
+# as turned away
+MAX_CREDIT_WAIT = 30.0
+
+@dataclass
+class PendingSend:
+    pipe: Pipe
+    job: Job
+    network_job: NetworkJob
+    node_id: str
+
+@dataclass
+class PendingNotice:
+    # Sends a notice or control message (see JobReceiver.finish_job)
+    send: Callable[[], None]
+    node_id: str
+
+@dataclass
+class SendLane:
+    """The passes waiting for one destination, sent in order by one thread."""
+    passes: queue.Queue
+    node_id: str
+    # Workers that took the lane and have not handed their pass over yet
+    putting: int = 0
+    thread: Optional[Thread] = None
+
+class HopTimer:
+    """How fast passes reach one node, which sets how long the next may take."""
+    seconds_per_byte: Optional[float]
+
+    def __init__(self):
+        self.seconds_per_byte = None
+
+    def record(self, size: int, seconds: float):
+        if size < MIN_TIMED_BYTES:
+            return
+        rate = seconds / size
+        if self.seconds_per_byte is None:
+            self.seconds_per_byte = rate
+        else:
+            self.seconds_per_byte += RATE_SMOOTHING * (rate - self.seconds_per_byte)
+
+    def deadline(self, size: int) -> float:
+        """Seconds a pass of `size` bytes may take to be taken in."""
+        if self.seconds_per_byte is None:
+            return max(MIN_HOP_DEADLINE, size / DEFAULT_BYTES_PER_SEC)
+        return max(MIN_HOP_DEADLINE, HOP_DEADLINE_FACTOR * size * self.seconds_per_byte)
+
+class JobSender:
+    """Encodes finished passes and sends them on, one lane per destination node,
+    so the workers never wait on the network."""
+    lanes: Dict[Hashable, SendLane]
+    timers: Dict[str, HopTimer]
+    # None for a node that has not said
+    credits: Dict[str, Optional[int]]
+
+    def __init__(
+            self,
+            is_shutdown: Callable[[], bool],
+            on_lost: Callable[[Job, str, str], None] = lambda job, node_id, reason: None,
+            ask_credit: Callable[[str], Optional[int]] = lambda node_id: None,
+            on_credit: Callable[[str], None] = lambda node_id: None
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.is_shutdown = is_shutdown
+        self.on_lost = on_lost
+        self.ask_credit = ask_credit
+        self.on_credit = on_credit
+        self.lanes = { }
+        self.timers = { }
+        self.credits = { }
+        self.lock = Lock()
+        self.credit_cond = Condition()
+        self.shutdown = False
+
+    def send(self, pipe: Pipe, job: Job, node_id: str):
+        """Queue `job`'s current pass for `node_id`. Blocks while that node's lane is full."""
+        self._put(PendingSend(pipe, job, job.to_network_job(hash_data=False), node_id), node_id)
+
+    def send_notice(self, node_id: str, send: Callable[[], None]):
+        """Queue a notice for `node_id` behind its passes; `send` puts it on the wire."""
+        self._put(PendingNotice(send, node_id), node_id)
+
+    def send_control(self, node_id: str, send: Callable[[], None]):
+        """Queue a control message for `node_id` that does not wait for its
+        passes. Dropped rather than blocking when the control lane is full."""
+        self._put(PendingNotice(send, node_id), ("control", node_id), block=False)
+
+    def credit(self, node_id: str) -> Optional[int]:
+        """Packets `node_id` last said it has room for from this node."""
+        with self.credit_cond:
+            return self.credits.get(node_id)
+
+    def set_credit(self, node_id: str, credit: Optional[int]):
+        """Record the credit `node_id` gave this node."""
+        with self.credit_cond:
+            returned = self.credits.get(node_id) == 0 and credit != 0
+            self.credits[node_id] = credit
+            self.credit_cond.notify_all()
+        if returned:
+            Thread(target=self.on_credit, args=(node_id, ), daemon=True).start()
+
+    def _put(self, pending: Union[PendingSend, PendingNotice], key: Hashable, block: bool = True):
+        with self.lock:
+            lane = self.lanes.get(key)
+            if lane is None:
+                lane = SendLane(queue.Queue(maxsize=SEND_QUEUE_SIZE), pending.node_id)
+                self.lanes[key] = lane
+                self.timers.setdefault(pending.node_id, HopTimer())
+                lane.thread = Thread(target=self._send_loop, args=(key, lane), name=f"job-sender-{key}", daemon=True)
+                lane.thread.start()
+            # Keeps the lane's thread from exiting before the pass is in
+            lane.putting += 1
+
+        try:
+            if not block:
+                # The node is asked again if the message is dropped
+                with suppress(queue.Full):
+                    lane.passes.put_nowait(pending)
+                return
+
+            while not self._stopped():
+                try:
+                    lane.passes.put(pending, timeout=IDLE_WAIT)
+                    return
+                except queue.Full:
+                    continue
+        finally:
+            with self.lock:
+                lane.putting -= 1
+
+    def retire_lanes(self, connected: Iterable[str]):
+        """End the lanes of nodes that are not in `connected`, once what was
+        handed over for them has been tried."""
+        connected = set(connected)
+        with self.lock:
+            for key in [key for key, lane in self.lanes.items() if lane.node_id not in connected]:
+                del self.lanes[key]
+
+    def stop(self):
+        self.shutdown = True
+        with self.credit_cond:
+            self.credit_cond.notify_all()
+
+    def _stopped(self) -> bool:
+        return self.shutdown or self.is_shutdown()
+
+    def _retire_lane(self, key: Hashable, lane: SendLane, idle: bool) -> bool:
+        """Whether the lane's thread can exit: it has nothing left to send,
+        no worker is handing it a pass, and it was retired or sat idle."""
+        with self.lock:
+            if not lane.passes.empty() or lane.putting > 0:
+                return False
+            if self.lanes.get(key) is not lane:
+                return True
+            if idle:
+                del self.lanes[key]
+            return idle
+
+    def _send_loop(self, key: Hashable, lane: SendLane):
+        idle_since = time()
+        while not self._stopped():
+            try:
+                pending: Union[PendingSend, PendingNotice] = lane.passes.get(timeout=IDLE_WAIT)
+            except queue.Empty:
+                if self._retire_lane(key, lane, time() - idle_since > LANE_IDLE_TIMEOUT):
+                    return
+                continue
+            idle_since = time()
+
+            if isinstance(pending, PendingNotice):
+                try:
+                    pending.send()
+                except Exception as e:
+                    self.logger.exception(f"Could not send notice to {pending.node_id}: {e}")
+                continue
+
+            try:
+                self._send_pass(pending)
+            except Exception as e:
+                self.logger.exception(f"Could not send job {pending.job.job_id[:4]} to {pending.node_id}: {e}")
+
+    def _wait_for_credit(self, pending: PendingSend, until: float) -> bool:
+        """Hold a pass until its node has room for it or `until` has passed.
+        False if the job was canceled or the sender stopped meanwhile."""
+        node_id = pending.node_id
+        while True:
+            # Canceled while waiting to go out
+            if pending.job.cancel_reason is not None or self._stopped():
+                return False
+            if time() >= until:
+                return True
+            with self.credit_cond:
+                if self.credits.get(node_id) != 0:
+                    return True
+                self.credit_cond.wait(CREDIT_WAIT)
+                if self.credits.get(node_id) != 0:
+                    continue
+            # The node's word that it has room again may have been lost
+            try:
+                self.set_credit(node_id, self.ask_credit(node_id))
+            except Exception as e:
+                self.logger.warning(f"Could not ask {node_id} for credit: {e}")
+
+    def _send_pass(self, pending: PendingSend):
+        job = pending.job
+        node_id = pending.node_id
+        timer = self.timers[node_id]
+        pending.network_job.hash_data()
+        size = len(pending.network_job.data_bytes or b'')
+        reason = ""
+        attempts = 0
+        until = time() + MAX_CREDIT_WAIT
+        while attempts < HOP_ATTEMPTS:
+            if not self._wait_for_credit(pending, until):
+                return
+            start = time()
+            try:
+                reply = pending.pipe.send_job(pending.network_job, node_id, timer.deadline(size))
+                self.set_credit(node_id, reply.credit)
+                if reply.accepted:
+                    timer.record(size, time() - start)
+                    return
+                if reply.credit is not None and time() < until:
+                    # Full, and it will say when it has room: not a failure
+                    continue
+                reason = "node is too busy"
+            except Exception as e:
+                reason = str(e)
+            attempts += 1
+            if attempts < HOP_ATTEMPTS:
+                sleep(RETRY_WAIT * 2 ** (attempts - 1))
+
+        self.logger.warning(f"Could not send job {job.job_id[:4]} to {node_id}: {reason}")
+        # The handler may hand this lane more work, so it cannot run on it
+        Thread(target=self.on_lost, args=(job, node_id, reason), daemon=True).start()
@@ -1,11 +1,13 @@
 import gc
+import heapq
 import ctypes
 import logging
 import torch
 from time import time
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
 from time import sleep
-from threading import Thread
+from threading import Lock, Thread
 
 from transformers import PretrainedConfig
 
@@ -15,6 +17,12 @@ from language_pipes.util.enums import JobStatus
 
 CHECK_JOB_INTERVAL = 10
 EXPIRED_JOB_TIME = 60  # Unified timeout for both prefill and decode phases
+# How long a finished job's id is remembered. Packets of the job that are still
+# in flight must not bring it back, and none outlives EXPIRED_JOB_TIME by much.
+COMPLETED_JOB_TIME = 600
+MAX_COMPLETED_JOBS = 100_000
+# Key the jobs forwarded by other nodes are tracked under
+NETWORK_KEY = 'network'
 
 try:
     _libc = ctypes.CDLL("libc.so.6")
@@ -24,14 +32,68 @@ try:
 except:  # noqa: E722
     _malloc_trim = None
 
+class CompletedJobs:
+    """Ids of finished jobs, each kept for COMPLETED_JOB_TIME seconds and at
+    most MAX_COMPLETED_JOBS of them, so the set does not grow with uptime."""
+    finished: OrderedDict[str, float]
+
+    def __init__(self, ttl: float = COMPLETED_JOB_TIME, max_size: int = MAX_COMPLETED_JOBS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.finished = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.finished)
+
+    def __contains__(self, job_id: str) -> bool:
+        finished_at = self.finished.get(job_id)
+        return finished_at is not None and time() - finished_at <= self.ttl
+
+    def add(self, job_id: str, now: Optional[float] = None):
+        now = time() if now is None else now
+        self.finished[job_id] = now
+        self.finished.move_to_end(job_id)
+        self.prune(now)
+
+    def prune(self, now: Optional[float] = None):
+        """Forget the ids that are past their time, oldest first."""
+        now = time() if now is None else now
+        while len(self.finished) > 0:
+            job_id, finished_at = next(iter(self.finished.items()))
+            if len(self.finished) <= self.max_size and now - finished_at <= self.ttl:
+                return
+            del self.finished[job_id]
+
 class JobTracker:
-    jobs_completed: List[str]
-    jobs_pending: Dict[str, List[Job]]
+    """The jobs this node takes part in, indexed by id, API key, pipe and model."""
+    jobs: Dict[str, Job]
+    # The API key, pipe and model each job is indexed under
+    index_keys: Dict[str, Tuple[str, str, str]]
+    jobs_by_key: Dict[str, Dict[str, Job]]
+    jobs_by_pipe: Dict[str, Dict[str, Job]]
+    jobs_by_model: Dict[str, Dict[str, Job]]
+    jobs_completed: CompletedJobs
+    deadlines: List[Tuple[float, str]]
     shutdown: bool
 
-    def __init__(self):
-        self.jobs_completed = []
-        self.jobs_pending = { }
+    def __init__(
+            self,
+            on_remove: Callable[[str], None] = lambda job_id: None,
+            on_complete: Callable[[Job], None] = lambda job: None
+    ):
+        self.on_remove = on_remove
+        self.on_complete = on_complete
+        # Jobs were removed since memory was last trimmed
+        self.removed = False
+        self.last_trim = 0.0
+        self.jobs = { }
+        self.index_keys = { }
+        self.jobs_by_key = { }
+        self.jobs_by_pipe = { }
+        self.jobs_by_model = { }
+        self.jobs_completed = CompletedJobs()
+        self.deadlines = []
+        self.lock = Lock()
         self.shutdown = False
         self.logger = logging.getLogger(__name__)
         Thread(target=self.check_stale_jobs, args=( )).start()
@@ -40,66 +102,128 @@ class JobTracker:
         while True:
             if self.shutdown:
                 return
-            for key in self.jobs_pending.keys():
-                remove_jobs = []
-                for j in self.jobs_pending[key]:
-                    if j.stale:
-                        remove_jobs.append(j.job_id)
-                        continue
-                    stale_time = time() - j.last_update
-                    # Unified timeout - prefill chunks regularly update last_update,
-                    # so both prefill and decode phases use the same timeout
-                    if stale_time > EXPIRED_JOB_TIME:
-                        remove_jobs.append(j.job_id)
-
-                for job_id in remove_jobs:
-                    self.jobs_pending[key] = [j for j in self.jobs_pending[key] if j.job_id != job_id]
-
-                if len(remove_jobs) > 0:        
-                    gc.collect()
-                    torch.cuda.empty_cache()
-                    if _malloc_trim is not None:
-                        _malloc_trim(0)
-
-            sleep(CHECK_JOB_INTERVAL)
+            self.expire_jobs()
+            if self.removed and time() - self.last_trim >= CHECK_JOB_INTERVAL:
+                self.removed = False
+                self.last_trim = time()
+                gc.collect()
+                torch.cuda.empty_cache()
+                if _malloc_trim is not None:
+                    _malloc_trim(0)
+
+            sleep(min(CHECK_JOB_INTERVAL, max(0.0, self.next_deadline() - time())))
+
+    def expire_jobs(self, now: Optional[float] = None) -> List[str]:
+        """Drop the jobs whose deadline has passed or that were marked stale. Returns their ids."""
+        now = time() if now is None else now
+        expired: List[Job] = []
+        with self.lock:
+            while len(self.deadlines) > 0 and self.deadlines[0][0] <= now:
+                _, job_id = heapq.heappop(self.deadlines)
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                # Unified timeout - prefill chunks regularly update last_update,
+                # so both prefill and decode phases use the same timeout
+                deadline = job.last_update + EXPIRED_JOB_TIME
+                if job.stale or deadline <= now:
+                    self._remove(job_id)
+                    expired.append(job)
+                else:
+                    heapq.heappush(self.deadlines, (deadline, job_id))
+            self.jobs_completed.prune(now)
+        for job in expired:
+            self._release(job)
+        return [job.job_id for job in expired]
+
+    def next_deadline(self) -> float:
+        """When the next job could expire; CHECK_JOB_INTERVAL from now without jobs."""
+        with self.lock:
+            if len(self.deadlines) == 0:
+                return time() + CHECK_JOB_INTERVAL
+            return self.deadlines[0][0]
+
+    def track_job(self, key: str, job: Job) -> bool:
+        """Start tracking `job` under `key`. False if a job with its id is tracked already."""
+        with self.lock:
+            if job.job_id in self.jobs:
+                return False
+            self.jobs[job.job_id] = job
+            self.index_keys[job.job_id] = (key, job.pipe_id, job.model_id)
+            self.jobs_by_key.setdefault(key, { })[job.job_id] = job
+            self.jobs_by_pipe.setdefault(job.pipe_id, { })[job.job_id] = job
+            self.jobs_by_model.setdefault(job.model_id, { })[job.job_id] = job
+            heapq.heappush(self.deadlines, (job.last_update + EXPIRED_JOB_TIME, job.job_id))
+        return True
+
+    def job_key(self, job_id: str) -> Optional[str]:
+        """The key `job_id` is tracked under."""
+        with self.lock:
+            keys = self.index_keys.get(job_id)
+            return keys[0] if keys is not None else None
+
+    def count_jobs(self, key: str) -> int:
+        """Jobs tracked under `key`."""
+        with self.lock:
+            return len(self.jobs_by_key.get(key, { }))
+
+    def is_completed(self, job_id: str) -> bool:
+        with self.lock:
+            return job_id in self.jobs_completed
 
     def get_job(self, job_id: str) -> Optional[Job]:
-        for key in self.jobs_pending.keys():
-            for j in self.jobs_pending[key]:
-                if j.job_id == job_id:
-                    return j
-        return None
+        with self.lock:
+            return self.jobs.get(job_id)
 
     def get_jobs(self) -> List[Job]:
-        jobs = []
-        for key in list(self.jobs_pending.keys()):
-            jobs.extend(self.jobs_pending[key])
-        return jobs
+        with self.lock:
+            return list(self.jobs.values())
+
+    def jobs_for_key(self, key: str) -> List[Job]:
+        with self.lock:
+            return list(self.jobs_by_key.get(key, { }).values())
 
     def jobs_for_pipes(self, pipe_ids: List[str]) -> List[Job]:
-        return [j for j in self.get_jobs() if j.pipe_id in pipe_ids]
+        jobs: List[Job] = []
+        with self.lock:
+            for pipe_id in pipe_ids:
+                jobs.extend(self.jobs_by_pipe.get(pipe_id, { }).values())
+        return jobs
 
     def jobs_for_model(self, model_id: str, origin_node_id: Optional[str] = None) -> List[Job]:
-        return [
-            j for j in self.get_jobs()
-            if j.model_id == model_id and (origin_node_id is None or j.origin_node_id == origin_node_id)
-        ]
+        with self.lock:
+            return [
+                j for j in self.jobs_by_model.get(model_id, { }).values()
+                if origin_node_id is None or j.origin_node_id == origin_node_id
+            ]
 
     def remove_job(self, job_id: str):
-        for key in list(self.jobs_pending.keys()):
-            self.jobs_pending[key] = [j for j in self.jobs_pending[key] if j.job_id != job_id]
+        with self.lock:
+            job = self.jobs.get(job_id)
+            removed = self._remove(job_id)
+        if removed and job is not None:
+            self._release(job)
+
+    def mark_completed(self, job_id: str):
+        """Remember `job_id` as finished, so its packets still in flight are dropped."""
+        with self.lock:
+            self.jobs_completed.add(job_id)
 
     def complete_job(self, job: Job):
         job_id = job.job_id
-        if job_id in self.jobs_completed:
-            return
-
-        self.jobs_completed.append(job_id)
+        with self.lock:
+            if job_id in self.jobs_completed:
+                return
+            self.jobs_completed.add(job_id)
 
         if job.resolve is not None:
             job.resolve(job) # pyright: ignore[reportCallIssue]
 
+        if job.cancel_reason is None:
+            # A canceled job's cache may be missing passes
+            job.keep_session()
         self.remove_job(job_id)
+        self.on_complete(job)
 
     def cancel_job(self, job: Job, reason: str):
         """Stop a job now instead of leaving it to time out.
@@ -108,7 +232,7 @@ class JobTracker:
         completes it so an API caller waiting on the promise gets an error back
         rather than a hung request.
         """
-        if job.job_id in self.jobs_completed:
+        if self.is_completed(job.job_id):
             return
 
         job.stale = True
@@ -149,8 +273,25 @@ class JobTracker:
         # flight is one pass wide, not the prompt. The UI reads the origin's own
         # count out of Job.display_progress() instead.
         job.last_update = time()
-        if 'network' not in self.jobs_pending:
-            self.jobs_pending['network'] = []
-        
-        self.jobs_pending['network'].append(job)
+        if not self.track_job(NETWORK_KEY, job):
+            return None
         return job
+
+    def _release(self, job: Job):
+        """Free what a job that stopped being tracked holds, outside the lock:
+        freeing the KV cache waits for a forward writing to it to finish."""
+        job.release_cache()
+        self.on_remove(job.job_id)
+
+    def _remove(self, job_id: str) -> bool:
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return False
+        keys = self.index_keys.pop(job_id)
+        for index, index_key in zip((self.jobs_by_key, self.jobs_by_pipe, self.jobs_by_model), keys, strict=True):
+            jobs = index[index_key]
+            del jobs[job_id]
+            if len(jobs) == 0:
+                del index[index_key]
+        self.removed = True
+        return True
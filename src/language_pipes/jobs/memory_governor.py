@@ -0,0 +1,213 @@
+from dataclasses import dataclass
+from enum import Enum
+from threading import Lock, Timer
+from typing import Callable, Dict, Iterable, List, Optional
+
+import psutil
+import torch
+from transformers import PretrainedConfig
+
+from language_pipes.config import DEFAULT_MAX_DEVICE_MEMORY
+from language_pipes.modeling.kv_pool import KV_AUTO, token_bytes, whole_blocks
+
+# Share of a device's memory the node may use when no limit is configured
+MEMORY_HEADROOM = 0.9
+# Seconds a job may wait for memory before it is turned away. Below the
+# tracker's EXPIRED_JOB_TIME, so the caller hears why instead of timing out.
+ADMISSION_TIMEOUT = 30
+# Device the queued packets are held on
+BUFFER_DEVICE = "cpu"
+
+GB = 1024**3
+
+def device_key(device: torch.device | str) -> str:
+    """The name a device's memory is accounted under: `cuda` and `cuda:0` are one device."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return f"cuda:{0 if device.index is None else device.index}"
+    return device.type
+
+def device_memory(device: str) -> int:
+    """Bytes of memory `device` has."""
+    if device.startswith("cuda"):
+        return torch.cuda.get_device_properties(torch.device(device)).total_memory
+    return psutil.virtual_memory().total
+
+def kv_cache_bytes(
+        config: PretrainedConfig,
+        layers: Iterable[int],
+        tokens: int,
+        dtype_bytes: int = 2,
+        kv_dtype: str = KV_AUTO
+) -> int:
+    """Bytes the KV cache of `layers` takes up once it holds `tokens` tokens,
+    with the copy a forward makes of one paged layer."""
+    config = config.get_text_config()
+    heads = getattr(config, "num_attention_heads", 1)
+    kv_heads = getattr(config, "num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+    layer_types = getattr(config, "layer_types", None)
+    window = getattr(config, "sliding_window", None)
+
+    per_token = token_bytes(kv_heads, head_dim, kv_dtype, dtype_bytes)
+    paged_tokens = whole_blocks(tokens)
+    total = 0
+    paged = False
+    for layer in layers:
+        layer_type = layer_types[layer] if layer_types is not None and layer < len(layer_types) else "full_attention"
+        if layer_type == "linear_attention":
+            continue
+        if layer_type == "sliding_attention" and window is not None:
+            total += per_token * min(tokens, window)
+        else:
+            total += per_token * paged_tokens
+            paged = True
+    if paged:
+        total += token_bytes(kv_heads, head_dim, KV_AUTO, dtype_bytes) * paged_tokens
+    return total
+
+class Admission(Enum):
+    ADMIT = 0
+    WAIT = 1
+    REJECT = 2
+
+@dataclass
+class AdmissionResult:
+    admission: Admission
+    # Why the job has to wait or was turned away
+    reason: Optional[str] = None
+
+@dataclass
+class WaitingJob:
+    job_id: str
+    needs: Dict[str, int]
+    resume: Callable[[], None]
+    reject: Callable[[str], None]
+
+@dataclass
+class DeviceMemory:
+    device: str
+    limit: int
+    weights: int
+    kv: int
+    buffers: int
+
+    def free(self) -> int:
+        return self.limit - self.weights - self.kv - self.buffers
+
+class MemoryGovernor:
+    """Keeps the memory a node commits on each device under its limit."""
+    reserved: Dict[str, Dict[str, int]]
+    waiting: List[WaitingJob]
+
+    def __init__(
+            self,
+            get_weights: Callable[[], Dict[str, int]],
+            get_buffered: Callable[[], int] = lambda: 0,
+            get_max_device_memory: Callable[[], float] = lambda: DEFAULT_MAX_DEVICE_MEMORY,
+            get_device_memory: Callable[[str], int] = device_memory
+    ):
+        self.get_weights = get_weights
+        self.get_buffered = get_buffered
+        self.get_max_device_memory = get_max_device_memory
+        self.get_device_memory = get_device_memory
+        self.reserved = { }
+        self.waiting = []
+        self.lock = Lock()
+
+    def admit(self, job_id: str, needs: Dict[str, int]) -> AdmissionResult:
+        """Reserve `needs` (bytes of KV cache per device) for `job_id` if it fits now."""
+        with self.lock:
+            if job_id in self.reserved:
+                return AdmissionResult(Admission.ADMIT)
+            result = self._admit(job_id, needs, dry_run=len(self.waiting) > 0)
+            if result.admission == Admission.ADMIT and len(self.waiting) > 0:
+                # Jobs already waiting go first
+                return AdmissionResult(Admission.WAIT, f"waiting behind {len(self.waiting)} other jobs")
+            return result
+
+    def wait(self, job_id: str, needs: Dict[str, int], resume: Callable[[], None], reject: Callable[[str], None]):
+        """Wait for memory. `resume` runs once the job is admitted, `reject` if
+        it runs out of time first."""
+        with self.lock:
+            self.waiting.append(WaitingJob(job_id, needs, resume, reject))
+        timer = Timer(ADMISSION_TIMEOUT, self._timeout, (job_id, ))
+        timer.daemon = True
+        timer.start()
+        # Memory may have come free before the job was queued
+        self._admit_waiting()
+
+    def release(self, job_id: str):
+        """Give back what `job_id` reserved, and let waiting jobs in."""
+        with self.lock:
+            self.reserved.pop(job_id, None)
+            self.waiting = [w for w in self.waiting if w.job_id != job_id]
+        self._admit_waiting()
+
+    def devices(self) -> List[DeviceMemory]:
+        with self.lock:
+            return [self._device(d) for d in sorted(self._device_names())]
+
+    def _admit(self, job_id: str, needs: Dict[str, int], dry_run: bool = False) -> AdmissionResult:
+        waiting = False
+        for device, size in needs.items():
+            memory = self._device(device)
+            # Without the jobs that could finish, what would the job have?
+            if size > memory.free() + memory.kv:
+                return AdmissionResult(Admission.REJECT, (
+                    f"not enough memory: job needs {size / GB:.2f} GB of KV cache on {device}, "
+                    f"which has {max(0, memory.free() + memory.kv) / GB:.2f} GB for jobs"
+                ))
+            if size > memory.free():
+                waiting = True
+        if waiting:
+            return AdmissionResult(Admission.WAIT, f"waiting for memory held by {len(self.reserved)} other jobs")
+        if not dry_run:
+            self.reserved[job_id] = dict(needs)
+        return AdmissionResult(Admission.ADMIT)
+
+    def _admit_waiting(self):
+        """Let in the waiting jobs that fit, oldest first. A job that does not
+        fit yet holds up the ones behind it, so large jobs are not starved."""
+        resumed: List[WaitingJob] = []
+        rejected: List[tuple[WaitingJob, str]] = []
+        with self.lock:
+            while len(self.waiting) > 0:
+                first = self.waiting[0]
+                result = self._admit(first.job_id, first.needs)
+                if result.admission == Admission.WAIT:
+                    break
+                self.waiting.pop(0)
+                if result.admission == Admission.ADMIT:
+                    resumed.append(first)
+                else:
+                    # Weights were loaded since the job started waiting
+                    rejected.append((first, result.reason or ""))
+        for w in resumed:
+            w.resume()
+        for w, reason in rejected:
+            w.reject(reason)
+
+    def _timeout(self, job_id: str):
+        with self.lock:
+            timed_out = [w for w in self.waiting if w.job_id == job_id]
+            self.waiting = [w for w in self.waiting if w.job_id != job_id]
+        for w in timed_out:
+            w.reject(f"not enough memory: waited {ADMISSION_TIMEOUT} seconds for other jobs to finish")
+
+    def _device_names(self) -> set[str]:
+        names = set(self.get_weights())
+        for needs in self.reserved.values():
+            names.update(needs)
+        return names
+
+    def _device(self, device: str) -> DeviceMemory:
+        max_memory = self.get_max_device_memory()
+        limit = max_memory * GB if max_memory > 0 else self.get_device_memory(device) * MEMORY_HEADROOM
+        return DeviceMemory(
+            device=device,
+            limit=int(limit),
+            weights=self.get_weights().get(device, 0),
+            kv=sum(needs.get(device, 0) for needs in self.reserved.values()),
+            buffers=self.get_buffered() if device == BUFFER_DEVICE else 0
+        )
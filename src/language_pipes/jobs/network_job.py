@@ -1,3 +1,6 @@
+from dataclasses import dataclass
+from typing import Dict, Optional
+
 from language_pipes.util.byte_helper import ByteHelper
 from language_pipes.util.enums import ComputeStep
 from language_pipes.jobs.job_data import JobData
@@ -5,6 +8,34 @@ from language_pipes.jobs.job_time import JobTime
 from language_pipes.jobs.completed_pass import CompletedPass
 from language_pipes.jobs.job_progress import JobProgress
 
+# What a node answers a job packet with (see JobReceiver.receive_data). Older
+# nodes answer ACCEPTED to everything.
+ACCEPTED = "OK"
+BUSY = "BUSY"
+
+@dataclass
+class HopReply:
+    """A node's answer to a job packet."""
+    accepted: bool
+    # Packets the node has room for from the sender; None from a node that
+    # does not say
+    credit: Optional[int] = None
+
+    def to_bytes(self) -> bytes:
+        status = ACCEPTED if self.accepted else BUSY
+        if self.credit is None:
+            return status.encode()
+        return f"{status} {self.credit}".encode()
+
+    @staticmethod
+    def from_reply(reply: bytes | str | None) -> "HopReply":
+        if isinstance(reply, bytes):
+            reply = reply.decode("utf-8", errors="replace")
+        parts = (reply or ACCEPTED).split()
+        accepted = len(parts) == 0 or parts[0] != BUSY
+        credit = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+        return HopReply(accepted, credit)
+
 class NetworkJob:
     job_id: str
     pipe_id: str
@@ -17,6 +48,20 @@ class NetworkJob:
     completed: CompletedPass | None
     progress: JobProgress | None
     prefill_chunk_size: int
+    # Number of the pass on the origin, 0 from a peer that does not number them
+    pass_id: int
+    # Segments of the pipe the job's KV cache moved off, by first layer, and
+    # the segment it runs on instead (see JobMigration.move_segment_jobs)
+    segment_moves: Dict[int, str]
+    # A replay pass rebuilds the KV cache of layers replay_start up to
+    # replay_end after they failed over; replay_id numbers the replay's first
+    # pass. All 0 on any other pass (see JobReceiver.fail_over).
+    replay_id: int
+    replay_start: int
+    replay_end: int
+    # data already serialized, when whoever built the packet had to serialize
+    # it for the hash anyway
+    data_bytes: bytes | None
 
     def __init__(
         self,
@@ -29,7 +74,13 @@ class NetworkJob:
         compute_step: ComputeStep,
         times: list[JobTime],
         completed: CompletedPass | None = None,
-        progress: JobProgress | None = None
+        progress: JobProgress | None = None,
+        data_bytes: bytes | None = None,
+        pass_id: int = 0,
+        segment_moves: Dict[int, str] | None = None,
+        replay_id: int = 0,
+        replay_start: int = 0,
+        replay_end: int = 0
     ):
         self.job_id = job_id
         self.pipe_id = pipe_id
@@ -41,6 +92,26 @@ class NetworkJob:
         self.times = times
         self.completed = completed
         self.progress = progress
+        self.data_bytes = data_bytes
+        self.pass_id = pass_id
+        self.segment_moves = segment_moves if segment_moves is not None else { }
+        self.replay_id = replay_id
+        self.replay_start = replay_start
+        self.replay_end = replay_end
+
+    def hop_key(self) -> str | None:
+        """Names this hop of the job: a packet sent again with the same key is
+        a copy of one already received. None when the pass is not numbered."""
+        if self.pass_id == 0:
+            return None
+        return f"{self.job_id}:{self.pass_id}:{self.compute_step.value}:{self.current_layer}"
+
+    def hash_data(self):
+        """Serialize the data and hash it. The same bytes go into the packet."""
+        if self.data is None or self.data_bytes is not None:
+            return
+        self.data_bytes = self.data.to_bytes()
+        self.data_hash = JobData.hash_bytes(self.data_bytes)
 
     def to_bytes(self):
         bts = ByteHelper()
@@ -49,7 +120,10 @@ class NetworkJob:
         bts.write_string(self.origin_node_id)
         bts.write_int(self.current_layer)
         bts.write_int(self.compute_step.value)
-        bts.write_bytes(self.data.to_bytes() if self.data is not None else b'')
+        if self.data is None:
+            bts.write_bytes(b'')
+        else:
+            bts.write_bytes(self.data_bytes if self.data_bytes is not None else self.data.to_bytes())
         bts.write_bytes(self.data_hash)
 
         bts.write_int(len(self.times))
@@ -58,6 +132,14 @@ class NetworkJob:
 
         bts.write_bytes(self.completed.to_bytes() if self.completed is not None else b'')
         bts.write_bytes(self.progress.to_bytes() if self.progress is not None else b'')
+        bts.write_int(self.pass_id)
+        bts.write_int(len(self.segment_moves))
+        for start_layer, process_id in self.segment_moves.items():
+            bts.write_int(start_layer)
+            bts.write_string(process_id)
+        bts.write_int(self.replay_id)
+        bts.write_int(self.replay_start)
+        bts.write_int(self.replay_end)
 
         return bts.get_bytes()
 
@@ -88,6 +170,14 @@ class NetworkJob:
 
         progress_bytes = bts.read_bytes()
         progress = JobProgress.from_bytes(progress_bytes) if progress_bytes != b'' else None
+        pass_id = bts.read_int()
+        segment_moves = { }
+        for _ in range(bts.read_int()):
+            start_layer = bts.read_int()
+            segment_moves[start_layer] = bts.read_string()
+        replay_id = bts.read_int()
+        replay_start = bts.read_int()
+        replay_end = bts.read_int()
 
         return NetworkJob(
             job_id=job_id,
@@ -99,5 +189,10 @@ class NetworkJob:
             compute_step=step,
             times=times,
             completed=completed,
-            progress=progress
+            progress=progress,
+            pass_id=pass_id,
+            segment_moves=segment_moves,
+            replay_id=replay_id,
+            replay_start=replay_start,
+            replay_end=replay_end
         ), valid
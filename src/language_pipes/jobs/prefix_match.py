@@ -0,0 +1,169 @@
+import logging
+from typing import List, Optional
+
+from language_pipes.jobs.job import Job
+from language_pipes.modeling.end_model import EndModel
+from language_pipes.modeling.model_manager import ModelManager
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS
+from language_pipes.modeling.kv_prefix import PREFIX_KV_CACHE, PrefixLayer, block_hashes, prefix_reusable
+from language_pipes.modeling.kv_session import SESSION_KV_CACHE, common_prefix
+from language_pipes.pipes.pipe import Pipe
+from language_pipes.pipes.pipe_manager import PipeManager
+from language_pipes.util.byte_helper import ByteHelper
+
+PREFIX_PROTOCOL = 4
+SESSION_PROTOCOL = 5
+# Seconds a node has to say how much of a prompt's prefix or session it has
+PREFIX_QUERY_TIMEOUT = 5
+
+class PrefixMatcher:
+    """Finds the KV cache at the start of a prompt that every node of its pipe
+    already has, so the job starting here skips those tokens."""
+    pipe_manager: PipeManager
+    model_manager: ModelManager
+
+    def __init__(self, pipe_manager: PipeManager, model_manager: ModelManager):
+        self.logger = logging.getLogger(__name__)
+        self.pipe_manager = pipe_manager
+        self.model_manager = model_manager
+
+    def _node_id(self) -> str:
+        return self.pipe_manager.router_pipes.router.node_id()
+
+    def _prefix_layers(self, pipe: Pipe, end_model: Optional[EndModel]) -> Optional[List[PrefixLayer]]:
+        """The layers of the pipe this node keeps prompt blocks of. None when
+        one of them cannot take a prefix from the cache."""
+        layers: List[PrefixLayer] = []
+        if end_model is not None:
+            layers.extend(end_model.prefix_layers())
+        for segment in pipe.segments:
+            if segment.virtual:
+                continue
+            if segment.segment_process is not None:
+                return None
+            layers.extend(segment.prefix_layers())
+        return layers
+
+    def _reserve_prefix(self, job_id: str, pipe_id: str, hashes: List[bytes], end_model: Optional[EndModel]) -> int:
+        """Set aside the blocks of the prompt this node has for all of its
+        layers of the pipe. Returns the number of blocks."""
+        pipe = self.pipe_manager.get_pipe_by_pipe_id(pipe_id)
+        if pipe is None:
+            return 0
+        layers = self._prefix_layers(pipe, end_model)
+        if layers is None:
+            return 0
+        return PREFIX_KV_CACHE.reserve(job_id, pipe_id, layers, hashes)
+
+    def _query(self, node_id: str, protocol: int, payload: ByteHelper, job: Job) -> int:
+        """Ask `node_id` how much of the job's prompt it has, in blocks or
+        tokens by protocol. A node that does not answer has none."""
+        bts = ByteHelper()
+        bts.write_int(protocol)
+        bts.write_bytes(payload.get_bytes())
+        router = self.pipe_manager.router_pipes.router
+        try:
+            reply = router.send_to_node(node_id, bts.get_bytes(), timeout=PREFIX_QUERY_TIMEOUT, retries=0)
+            return ByteHelper(reply).read_int()
+        except Exception as e:
+            self.logger.warning(f"Could not ask {node_id} for the cached prompt of job {job.job_id[:4]}: {e}")
+            return 0
+
+    def _query_prefix(self, node_id: str, job: Job) -> int:
+        """Ask `node_id` how many of the job's prompt blocks it has."""
+        payload = ByteHelper()
+        payload.write_string(job.job_id)
+        payload.write_string(job.pipe_id)
+        payload.write_int(len(job.prefix_hashes))
+        for block_hash in job.prefix_hashes:
+            payload.write_bytes(block_hash)
+        return self._query(node_id, PREFIX_PROTOCOL, payload, job)
+
+    def _query_session(self, node_id: str, job: Job, tokens: int) -> int:
+        """Ask `node_id` how many of the first `tokens` tokens of the job's
+        session it has."""
+        assert job.resume_session_id is not None
+        payload = ByteHelper()
+        payload.write_string(job.job_id)
+        payload.write_string(job.resume_session_id)
+        payload.write_string(job.pipe_id)
+        payload.write_int(tokens)
+        return self._query(node_id, SESSION_PROTOCOL, payload, job)
+
+    def _peers(self, pipe: Pipe) -> List[str]:
+        node_id = self._node_id()
+        return sorted({segment.node_id for segment in pipe.segments if segment.node_id != node_id})
+
+    def _match_session(self, job: Job, pipe: Pipe) -> int:
+        """Set the job's session aside on every node of the pipe. Returns the
+        tokens at the start of the prompt they all have, 0 if one has none."""
+        if job.resume_session_id is None or not SESSION_KV_CACHE.enabled():
+            return 0
+        ids = SESSION_KV_CACHE.ids(job.resume_session_id)
+        if ids is None:
+            return 0
+        tokens = min(common_prefix(ids, job.input_ids), job.prompt_tokens - 1)
+        tokens = SESSION_KV_CACHE.reserve(job.job_id, job.resume_session_id, job.pipe_id, tokens)
+        for peer in self._peers(pipe):
+            if tokens == 0:
+                break
+            tokens = min(tokens, self._query_session(peer, job, tokens))
+        return tokens
+
+    def _match_blocks(self, job: Job, pipe: Pipe, end_model: EndModel) -> int:
+        """Set the prompt's blocks aside on every node of the pipe. Returns
+        the blocks at the start of the prompt they all have."""
+        blocks = self._reserve_prefix(job.job_id, job.pipe_id, job.prefix_hashes, end_model)
+        for peer in self._peers(pipe):
+            if blocks == 0:
+                break
+            blocks = min(blocks, self._query_prefix(peer, job))
+        return blocks
+
+    def match_prefix(self, job: Job):
+        """Find how much of a tokenized prompt starting here every node of its pipe
+        has kept, from its session or the prefix cache, and have the job start after it."""
+        if job.prompt_tokens == 0 or job.kv_window_tokens > 0:
+            return
+        pipe = self.pipe_manager.get_pipe_by_pipe_id(job.pipe_id)
+        end_model = self.model_manager.get_end_model(job.model_id)
+        if pipe is None or end_model is None:
+            return
+        if PREFIX_KV_CACHE.enabled() and prefix_reusable(end_model.collector.config):
+            job.prefix_hashes = block_hashes(job.input_ids, job.prompt_tokens - 1)
+
+        job.prefix_tokens = self._match_session(job, pipe)
+        if job.prefix_tokens == 0 and len(job.prefix_hashes) > 0:
+            job.prefix_tokens = self._match_blocks(job, pipe, end_model) * BLOCK_TOKENS
+        if job.prefix_tokens > 0:
+            self.logger.info(f"Job {job.job_id[:4]} reuses the KV cache of {job.prefix_tokens} prompt tokens")
+
+    def receive_session(self, node_id: str, data: bytes) -> bytes:
+        """Answer an origin's match_prefix with the tokens of the session set aside."""
+        bts = ByteHelper()
+        try:
+            query = ByteHelper(data)
+            job_id = query.read_string()
+            session_id = query.read_string()
+            pipe_id = query.read_string()
+            tokens = SESSION_KV_CACHE.reserve(job_id, session_id, pipe_id, query.read_int())
+        except Exception as e:
+            self.logger.warning(f"Bad session query from {node_id}: {e}")
+            tokens = 0
+        bts.write_int(tokens)
+        return bts.get_bytes()
+
+    def receive_prefix(self, node_id: str, data: bytes) -> bytes:
+        """Answer an origin's match_prefix with the number of blocks set aside."""
+        bts = ByteHelper()
+        try:
+            query = ByteHelper(data)
+            job_id = query.read_string()
+            pipe_id = query.read_string()
+            hashes = [query.read_bytes() for _ in range(query.read_int())]
+            blocks = self._reserve_prefix(job_id, pipe_id, hashes, None)
+        except Exception as e:
+            self.logger.warning(f"Bad prefix query from {node_id}: {e}")
+            blocks = 0
+        bts.write_int(blocks)
+        return bts.get_bytes()
@@ -92,6 +92,9 @@ class TimingStats:
     completed_pass: Optional[CompletedPass]
     # Index of that pass; passes at or below it have already been recorded.
     pass_index: int
+    # Tokens per prefill chunk the origin last chose for this job (0 while the
+    # prompt is not chunked, and on nodes that never chunk it)
+    prefill_chunk_size: int
 
     def __init__(self, job_id: str):
         self.output_times = TimingData(job_id)
@@ -99,6 +102,12 @@ class TimingStats:
         self.current_times = []
         self.completed_pass = None
         self.pass_index = -1
+        self.prefill_chunk_size = 0
+
+    def start_pass(self) -> None:
+        """Begin a new pass while the last one is still out in the pipe. Its
+        timings went out with its packet and come back with it."""
+        self.current_times = []
 
     def add_timing(self, time: JobTime) -> None:
         self.current_times.append(time)
@@ -136,18 +145,19 @@ class TimingStats:
         times = self.prefill_times if completed.is_prefill else self.output_times
         times.add_times(completed.times, completed.token_count)
 
-    def finalize_token(self) -> None:
-        self._finalize(self.output_times, 1, is_prefill=False)
+    def finalize_token(self) -> Optional[CompletedPass]:
+        return self._finalize(self.output_times, 1, is_prefill=False)
 
-    def finalize_prefill_chunk(self, token_count: int) -> None:
-        self._finalize(self.prefill_times, token_count, is_prefill=True)
+    def finalize_prefill_chunk(self, token_count: int) -> Optional[CompletedPass]:
+        return self._finalize(self.prefill_times, token_count, is_prefill=True)
 
-    def _finalize(self, times: TimingData, token_count: int, is_prefill: bool) -> None:
+    def _finalize(self, times: TimingData, token_count: int, is_prefill: bool) -> Optional[CompletedPass]:
+        """Close the current pass. Returns it, or None if it had no timings."""
         pass_times = self.current_times
         self.current_times = []
         times.add_times(pass_times, token_count)
         if len(pass_times) == 0:
-            return
+            return None
         self.pass_index += 1
         self.completed_pass = CompletedPass(
             index=self.pass_index,
@@ -155,3 +165,4 @@ class TimingStats:
             is_prefill=is_prefill,
             times=pass_times
         )
+        return self.completed_pass
@@ -1,22 +1,93 @@
 import warnings
 
 import torch
-from typing import List
+from typing import Dict, List, Tuple
 from transformers import PretrainedConfig
 from transformers.cache_utils import DynamicCache
 
+from language_pipes.jobs.job import Job
 from language_pipes.jobs.job_data import JobData
 from llm_layer_collector.auto.auto_layer import AutoDecoderLayer
+from llm_layer_collector.auto.batch import BatchedComputationState
 from language_pipes.jobs.job_data import jobDataToComputationState, detachCompState
 from llm_layer_collector.auto.static_auto_model import StaticAutoModel
+from language_pipes.modeling.kv_pool import KV_AUTO, PagedCache, PagedLayer
+from language_pipes.modeling.kv_prefix import PREFIX_KV_CACHE, PrefixLayer
+from language_pipes.modeling.kv_session import SESSION_KV_CACHE
 
-def compute_layers(start_layer: int, job_data: JobData, device: torch.device, config: PretrainedConfig, layers: List[AutoDecoderLayer], cache: DynamicCache):
+def _set_kv_dtype(cache: DynamicCache, layers: List[AutoDecoderLayer], kv_cache_dtype: str):
+    if isinstance(cache, PagedCache):
+        cache.set_kv_dtype([lyr.cls.layer_idx for lyr in layers], kv_cache_dtype) # pyright: ignore[reportAttributeAccessIssue]
+
+def _evict(cache: DynamicCache, layers: List[AutoDecoderLayer], job_data: JobData):
+    """Drop the tokens a bounded cache no longer keeps before the pass
+    writes to it. The pass starts at the index it keeps them up to."""
+    if job_data.kv_window_tokens > 0 and isinstance(cache, PagedCache):
+        kept = int(job_data.cache_position[0])
+        cache.evict([lyr.cls.layer_idx for lyr in layers], job_data.kv_sink_tokens, kept) # pyright: ignore[reportArgumentType]
+
+def _rewind(cache: DynamicCache, layers: List[AutoDecoderLayer], job_data: JobData):
+    """Drop the tokens a layer holds from the start of the pass on. Only a
+    pass that was given up on and sent again leaves them there (see
+    JobReceiver.fail_over and JobProcessor._restart_prefill). Linear
+    attention layers cannot go back."""
+    if job_data.kv_window_tokens > 0 or not isinstance(cache, PagedCache):
+        return
+    start = int(job_data.cache_position[0])
+    for lyr in layers:
+        layer = cache.layers[lyr.cls.layer_idx] # pyright: ignore[reportArgumentType, reportAttributeAccessIssue]
+        if not isinstance(layer, PagedLayer) or layer.get_seq_length() <= start:
+            continue
+        if start == 0:
+            layer.release()
+        else:
+            layer.crop(start)
+
+def reuse_prefix(job: Job, layers: List[PrefixLayer]):
+    """Start the job's cache with the start of the prompt the origin found
+    on every node, on its first prefill pass here: the cache of the session
+    it goes on from, or the blocks of the PrefixKVCache."""
+    data = job.data
+    if data is None or (data.prefix_tokens == 0 and len(data.prefix_hashes) == 0):
+        return
+    session_cache = SESSION_KV_CACHE.resume(job.job_id, data.prefix_tokens)
+    if session_cache is not None:
+        job.cache.release()
+        job.cache = session_cache
+    for layer_idx, kv_cache_dtype in layers:
+        job.cache.set_kv_dtype([layer_idx], kv_cache_dtype)
+    if session_cache is None:
+        PREFIX_KV_CACHE.restore(job.job_id, job.cache, data.prefix_tokens)
+    for layer_idx, _ in layers:
+        layer = job.cache.layers[layer_idx]
+        if isinstance(layer, PagedLayer) and layer.get_seq_length() < data.prefix_tokens:
+            raise Exception(f"KV cache of the first {data.prefix_tokens} prompt tokens is not on this node")
+
+def keep_prefix(job: Job, layers: List[PrefixLayer]):
+    """Keep the prompt's blocks a prefill pass just computed for the next jobs."""
+    data = job.data
+    if data is None or len(data.prefix_hashes) == 0 or not isinstance(job.cache, PagedCache):
+        return
+    PREFIX_KV_CACHE.store(job.pipe_id, job.cache, layers, data.prefix_hashes)
+
+def compute_layers(
+        start_layer: int,
+        job_data: JobData,
+        device: torch.device,
+        config: PretrainedConfig,
+        layers: List[AutoDecoderLayer],
+        cache: DynamicCache,
+        kv_cache_dtype: str = KV_AUTO
+):
     local_dtype = next((p.dtype for p in layers[0].cls.parameters() if p.is_floating_point()), None)
     comp_state = jobDataToComputationState(job_data, device, local_dtype)
     comp_state = detachCompState(comp_state)
 
     first_layer_idx: int = layers[0].cls.layer_idx # pyright: ignore[reportAssignmentType, reportAttributeAccessIssue]
     start_layer -= first_layer_idx
+    _set_kv_dtype(cache, layers[start_layer:], kv_cache_dtype)
+    _evict(cache, layers[start_layer:], job_data)
+    _rewind(cache, layers[start_layer:], job_data)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", FutureWarning)
         with torch.inference_mode():
@@ -24,3 +95,35 @@ def compute_layers(start_layer: int, job_data: JobData, device: torch.device, co
                 comp_state.state = StaticAutoModel.compute_layer(lyr, config, comp_state, cache).detach()
 
     return comp_state.state.detach(), comp_state.shared_kv_states
+
+def compute_layers_batch(
+        start_layer: int,
+        job_datas: List[JobData],
+        device: torch.device,
+        config: PretrainedConfig,
+        layers: List[AutoDecoderLayer],
+        caches: List[DynamicCache],
+        kv_cache_dtype: str = KV_AUTO
+) -> List[Tuple[torch.Tensor, Dict[str, Tuple[torch.Tensor, torch.Tensor]]]]:
+    """compute_layers for several jobs as one forward per layer. Their hidden
+    states can cover different numbers of tokens."""
+    local_dtype = next((p.dtype for p in layers[0].cls.parameters() if p.is_floating_point()), None)
+    batch = BatchedComputationState([
+        detachCompState(jobDataToComputationState(job_data, device, local_dtype))
+        for job_data in job_datas
+    ])
+
+    first_layer_idx: int = layers[0].cls.layer_idx # pyright: ignore[reportAssignmentType, reportAttributeAccessIssue]
+    start_layer -= first_layer_idx
+    for cache, job_data in zip(caches, job_datas, strict=True):
+        _set_kv_dtype(cache, layers[start_layer:], kv_cache_dtype)
+        _evict(cache, layers[start_layer:], job_data)
+        _rewind(cache, layers[start_layer:], job_data)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        with torch.inference_mode():
+            for lyr in layers[start_layer:]:
+                batch.state.state = StaticAutoModel.compute_layer_batch(lyr, config, batch, caches).detach()
+
+    states = batch.split(batch.state.state.detach())
+    return list(zip(states, batch.split_shared_kv_states(), strict=True))
@@ -15,8 +15,11 @@ from language_pipes.jobs.job import ComputeStep, Job
 from language_pipes.jobs.job_data import computationStateToJobData
 
 from language_pipes.modeling.llm_meta_data import LlmMetadata
-from language_pipes.modeling.compute import compute_layers
-from language_pipes.util.utils import CHUNK_SIZE
+from language_pipes.modeling.prompt_cache import PromptCache
+from language_pipes.modeling.compute import compute_layers, compute_layers_batch, keep_prefix, reuse_prefix
+from language_pipes.modeling.kv_pool import KV_AUTO, check_kv_dtype, whole_blocks
+from language_pipes.modeling.kv_prefix import PrefixLayer, prefix_reusable
+from llm_layer_collector.state_obj import LLmComputationState
 
 class EndModel:
     model_id: str
@@ -30,9 +33,27 @@ class EndModel:
     per_layer_embedder: Optional[torch.nn.Module]
     collector: LlmLayerCollector
     layers: List[AutoDecoderLayer]
+    # See KV_CACHE_DTYPES
+    kv_cache_dtype: str
+    # Bounded KV cache of the model's jobs, whole blocks (see window_kept)
+    kv_sink_tokens: int
+    kv_window_tokens: int
 
-    def __init__(self, num_local_layers: int, model_dir: Path, model_id: str, device: str):
+    def __init__(
+            self,
+            num_local_layers: int,
+            model_dir: Path,
+            model_id: str,
+            device: str,
+            kv_cache_dtype: str = KV_AUTO,
+            kv_sink_tokens: int = 0,
+            kv_window_tokens: int = 0
+        ):
+        check_kv_dtype(kv_cache_dtype)
         self.model_id = model_id
+        self.kv_cache_dtype = kv_cache_dtype
+        self.kv_sink_tokens = whole_blocks(kv_sink_tokens) if kv_window_tokens > 0 else 0
+        self.kv_window_tokens = whole_blocks(kv_window_tokens)
         self.loaded = False
         self.num_local_layers = num_local_layers
         self.process_id = str(uuid4())
@@ -47,14 +68,23 @@ class EndModel:
         )
         self.layers = []
         self.tokenizer = AutoTokenizer.from_pretrained(os.path.join(model_path, 'data'), fix_mistral_regex="mistralai" in model_id)
+        self.prompt_cache = PromptCache(self.tokenizer)
+        if self.kv_window_tokens > 0 and not prefix_reusable(self.collector.config):
+            raise Exception(f"A bounded KV cache needs a model with only full attention layers, {model_id} has others")
 
     def load_layers(self, num_local_layers: int):
         self.layers = self.collector.load_layer_set(0, num_local_layers - 1, self.device)
 
+    def prefix_layers(self) -> List[PrefixLayer]:
+        """The local layers, which keep prompt blocks in the PrefixKVCache."""
+        return [(layer, self.kv_cache_dtype) for layer in range(len(self.layers))]
+
     def compute_layers(self, job: Job):
         if job.data is None:
             raise Exception("Job did not have data")
-        state, shared_kv_states = compute_layers(0, job.data, self.device, self.collector.config, self.layers, job.cache)
+        reuse_prefix(job, self.prefix_layers())
+        state, shared_kv_states = compute_layers(0, job.data, self.device, self.collector.config, self.layers, job.layer_cache(), self.kv_cache_dtype)
+        keep_prefix(job, self.prefix_layers())
         job.set_layer(
             state=state,
             layer=len(self.layers),
@@ -62,6 +92,25 @@ class EndModel:
             shared_kv_states=shared_kv_states
         )
         
+    def compute_layers_batch(self, jobs: List[Job]):
+        """compute_layers for several jobs as one batched forward."""
+        for job in jobs:
+            if job.data is None:
+                raise Exception("Job did not have data")
+            reuse_prefix(job, self.prefix_layers())
+        results = compute_layers_batch(
+            0, [job.data for job in jobs], self.device, self.collector.config, self.layers, [job.layer_cache() for job in jobs], self.kv_cache_dtype # type: ignore
+        )
+        for job in jobs:
+            keep_prefix(job, self.prefix_layers())
+        for job, (state, shared_kv_states) in zip(jobs, results, strict=True):
+            job.set_layer(
+                state=state,
+                layer=len(self.layers),
+                num_hidden_layers=self.collector.config.num_hidden_layers,
+                shared_kv_states=shared_kv_states
+            )
+
     def size(self):
         return self.meta_data.embed_size + self.meta_data.head_size + (self.meta_data.avg_layer_size * self.num_local_layers)
 
@@ -74,11 +123,16 @@ class EndModel:
             self.load_layers(self.num_local_layers)
         self.loaded = True
 
-    def tokenize(self, job: Job):
-        prompt = self.tokenizer.apply_chat_template([m.to_json() for m in job.messages], tokenize=False, chat_template=self.tokenizer.chat_template, add_generation_prompt=True)
-        input_tokens = [int(t) for t in self.tokenizer.encode(prompt, return_tensors='pt')[0].numpy()]
+    def tokenize_prompt(self, job: Job):
+        """Render and tokenize the job's conversation. Does not touch the
+        model, so it runs on the thread that takes the request."""
+        input_tokens = self.prompt_cache.encode([m.to_json() for m in job.messages])
         job.input_ids = input_tokens
         job.prompt_tokens = len(input_tokens)
+
+    def tokenize(self, job: Job):
+        if job.prompt_tokens == 0:
+            self.tokenize_prompt(job)
         job.next_step()
 
     def compute_embed(self, job: Job):
@@ -88,17 +142,52 @@ class EndModel:
             raise RuntimeError("Input Embedding must be loaded before computation")
         
         comp_state = StaticAutoModel.compute_embedding(
-            prompt_tokens=job.prompt_tokens,
-            chunk_size=CHUNK_SIZE,
+            prompt_tokens=job.embed_tokens(),
+            chunk_size=job.chunking.get_chunk_length(),
             input_embedder=self.input_embedding,
             input_ids=torch.tensor([job.input_ids]),
             config=self.collector.config,
             cache=job.cache,
             per_layer_embedder=self.per_layer_embedder,
-            past_seen_tokens=job.past_seen_tokens()
+            past_seen_tokens=job.past_seen_tokens(),
+            kept_tokens=job.cached_tokens()
         )
         
+        self._set_embedding(job, comp_state)
+
+    def compute_embed_batch(self, jobs: List[Job]):
+        """compute_embed for several jobs with one embedding lookup. Each job embeds
+        its own next slice: a prefill chunk or its newest token."""
+        for job in jobs:
+            if job.compute_step != ComputeStep.EMBED:
+                raise ValueError('Invalid step for embedding')
+        if self.input_embedding is None:
+            raise RuntimeError("Input Embedding must be loaded before computation")
+
+        comp_states = StaticAutoModel.compute_embedding_batch(
+            prompt_tokens=[job.embed_tokens() for job in jobs],
+            chunk_size=[job.chunking.get_chunk_length() for job in jobs],
+            input_embedder=self.input_embedding,
+            input_ids=[torch.tensor([job.input_ids]) for job in jobs],
+            config=self.collector.config,
+            caches=[job.cache for job in jobs],
+            past_seen_tokens=[job.past_seen_tokens() for job in jobs],
+            per_layer_embedder=self.per_layer_embedder,
+            kept_tokens=[job.cached_tokens() for job in jobs]
+        )
+
+        for job, comp_state in zip(jobs, comp_states, strict=True):
+            self._set_embedding(job, comp_state)
+
+    @staticmethod
+    def _set_embedding(job: Job, comp_state: LLmComputationState):
         job.data = computationStateToJobData(comp_state)
+        if job.current_token == 0:
+            # Prefill passes tell every node which blocks of the prompt they carry
+            job.data.prefix_hashes = job.prefix_hashes
+            job.data.prefix_tokens = job.prefix_tokens
+        job.data.kv_sink_tokens = job.kv_sink_tokens
+        job.data.kv_window_tokens = job.kv_window_tokens
         job.next_step()
 
     def compute_norm(self, job: Job):
@@ -108,6 +197,20 @@ class EndModel:
         norm = self.norm(job.data.state.to(self.device, self.collector.dtype))
         job.set_norm(norm)
 
+    def compute_norm_batch(self, jobs: List[Job]):
+        """compute_norm over the last position of several jobs at once.
+
+        Only the last position feeds the head, so that is all that is normed.
+        """
+        assert self.norm is not None
+        for job in jobs:
+            if job.data is None or job.data.state is None:
+                raise RuntimeError("Cannot compute norm without job data")
+        states = torch.cat([job.data.state[:, -1:, :] for job in jobs], dim=0) # type: ignore
+        norm = self.norm(states.to(self.device, self.collector.dtype))
+        for i, job in enumerate(jobs):
+            job.set_norm(norm[i:i + 1])
+
     @staticmethod
     def _add_stop_tokens(stop_tokens: Set[int], token_value: Optional[int]):
         if token_value is None:
@@ -138,13 +241,37 @@ class EndModel:
             temperature=job.temperature
         )
 
+        self._set_output(job, head)
+
+    def compute_head_batch(self, jobs: List[Job]):
+        """compute_head for several jobs with one lm_head matmul, sampling each
+        job's token with its own temperature/top_k/top_p/min_p."""
+        if self.head is None:
+            raise RuntimeError("Head must be loaded before computation")
+        for job in jobs:
+            if job.data is None or job.data.state is None:
+                raise RuntimeError("Cannot compute head without job data")
+
+        tokens = StaticAutoModel.compute_head_batch(
+            head=self.head,
+            states=[job.data.state.to(self.collector.dtype) for job in jobs], # type: ignore
+            device=str(self.device),
+            top_k=[job.top_k for job in jobs],
+            top_p=[job.top_p for job in jobs],
+            min_p=[job.min_p for job in jobs],
+            temperature=[job.temperature for job in jobs]
+        )
+        for job, token in zip(jobs, tokens, strict=True):
+            self._set_output(job, token)
+
+    def _set_output(self, job: Job, token: int):
         stop_tokens: Set[int] = set()
 
         EndModel._add_stop_tokens(stop_tokens, self.collector.config.eos_token_id)
         EndModel._add_stop_tokens(stop_tokens, self.tokenizer.eos_token_id)
         EndModel._add_stop_tokens(stop_tokens, self.tokenizer.convert_tokens_to_ids("<|eot_id|>"))
 
-        job.set_output(head, stop_tokens)
+        job.set_output(token, stop_tokens)
         job.delta = self.tokenizer.decode([job.input_ids[-1]], skip_special_tokens=True, clean_up_tokenization_spaces=False)
 
     def set_result(self, job: Job):
@@ -0,0 +1,231 @@
+from time import time
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import torch
+
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, PagedCache, PagedLayer
+from language_pipes.util.byte_helper import ByteHelper
+from language_pipes.util.utils import bytes_to_tensor, tensor_to_bytes
+
+# Bytes of keys and values in one part of a move, so no one message holds
+# the connection up for long
+MIGRATE_PART_BYTES = 4 * 1024**2
+
+PART_BLOCKS = 1
+PART_STATE = 2
+
+# Kinds of value a layer's state is made of (see state_parts)
+_NONE = "none"
+_BOOL = "bool"
+_INT = "int"
+_FLOAT = "float"
+_TENSOR = "tensor"
+_DTYPE = "dtype"
+_DEVICE = "device"
+_DICT = "dict"
+
+def _dtype(name: str) -> torch.dtype:
+    dtype = getattr(torch, name.removeprefix("torch."), None)
+    if not isinstance(dtype, torch.dtype):
+        raise Exception(f"Unknown dtype {name}")
+    return dtype
+
+def _write_value(bts: ByteHelper, value):
+    if value is None:
+        bts.write_string(_NONE)
+    elif isinstance(value, bool):
+        bts.write_string(_BOOL)
+        bts.write_int(int(value))
+    elif isinstance(value, int):
+        bts.write_string(_INT)
+        bts.write_string(str(value))
+    elif isinstance(value, float):
+        bts.write_string(_FLOAT)
+        bts.write_float(value)
+    elif isinstance(value, torch.Tensor):
+        bts.write_string(_TENSOR)
+        bts.write_bytes(tensor_to_bytes(value))
+    elif isinstance(value, torch.dtype):
+        bts.write_string(_DTYPE)
+        bts.write_string(str(value))
+    elif isinstance(value, torch.device):
+        bts.write_string(_DEVICE)
+    elif isinstance(value, dict):
+        bts.write_string(_DICT)
+        bts.write_int(len(value))
+        for key, item in value.items():
+            _write_value(bts, key)
+            _write_value(bts, item)
+    else:
+        raise Exception(f"Cannot move KV cache state of type {type(value).__name__}")
+
+def _read_value(bts: ByteHelper, device: torch.device):
+    kind = bts.read_string()
+    if kind == _NONE:
+        return None
+    if kind == _BOOL:
+        return bts.read_int() == 1
+    if kind == _INT:
+        return int(bts.read_string())
+    if kind == _FLOAT:
+        return bts.read_float()
+    if kind == _TENSOR:
+        return bytes_to_tensor(bts.read_bytes()).to(device)
+    if kind == _DTYPE:
+        return _dtype(bts.read_string())
+    if kind == _DEVICE:
+        # The state lives on whichever device the receiving segment is on
+        return device
+    if kind == _DICT:
+        d = { }
+        for _ in range(bts.read_int()):
+            key = _read_value(bts, device)
+            d[key] = _read_value(bts, device)
+        return d
+    raise Exception(f"Unknown KV cache state value {kind}")
+
+def _paged(cache: PagedCache, layer_idx: int) -> PagedLayer | None:
+    if layer_idx >= len(cache.layers):
+        return None
+    layer = cache.layers[layer_idx]
+    if not isinstance(layer, PagedLayer) or not layer.is_initialized:
+        return None
+    return layer
+
+def full_blocks(cache: PagedCache, layer_ids: Iterable[int]) -> Dict[int, int]:
+    """Blocks of each paged layer of `layer_ids` that are full. Tokens are
+    only added after them, so they can be sent while the job goes on."""
+    full: Dict[int, int] = { }
+    for layer_idx in layer_ids:
+        layer = _paged(cache, layer_idx)
+        if layer is not None:
+            full[layer_idx] = layer.get_seq_length() // BLOCK_TOKENS
+    return full
+
+def cache_lengths(cache: PagedCache, layer_ids: Iterable[int]) -> Dict[int, int]:
+    """Tokens each paged layer of `layer_ids` holds."""
+    lengths: Dict[int, int] = { }
+    for layer_idx in layer_ids:
+        layer = _paged(cache, layer_idx)
+        if layer is not None:
+            lengths[layer_idx] = layer.get_seq_length()
+    return lengths
+
+def block_parts(
+        cache: PagedCache,
+        layer_ids: Iterable[int],
+        start: Dict[int, int],
+        stop: Dict[int, int] | None = None
+) -> Iterator[bytes]:
+    """Parts holding the blocks of the paged layers of `layer_ids`, from
+    block `start` up to block `stop` of each layer (every block it has
+    without `stop`), at most MIGRATE_PART_BYTES each."""
+    for layer_idx in layer_ids:
+        layer = _paged(cache, layer_idx)
+        if layer is None:
+            continue
+        assert layer.block_class is not None
+        last = stop.get(layer_idx, 0) if stop is not None else layer.block_count()
+        step = max(1, MIGRATE_PART_BYTES // layer.block_class.block_bytes)
+        for first in range(start.get(layer_idx, 0), last, step):
+            tensors = layer.copy_blocks(first, min(first + step, last))
+            bts = ByteHelper()
+            bts.write_int(PART_BLOCKS)
+            bts.write_int(layer_idx)
+            bts.write_string(layer.kv_dtype)
+            bts.write_string(str(layer.dtype))
+            bts.write_int(first)
+            bts.write_int(len(tensors))
+            for t in tensors:
+                bts.write_bytes(tensor_to_bytes(t))
+            yield bts.get_bytes()
+
+def state_parts(cache: PagedCache, layer_ids: Iterable[int]) -> Iterator[bytes]:
+    """One part for each layer of `layer_ids` that is not paged (linear
+    attention, sliding window), with every attribute of its state."""
+    for layer_idx in layer_ids:
+        if layer_idx >= len(cache.layers):
+            continue
+        layer = cache.layers[layer_idx]
+        if isinstance(layer, PagedLayer):
+            continue
+        state = vars(layer)
+        bts = ByteHelper()
+        bts.write_int(PART_STATE)
+        bts.write_int(layer_idx)
+        bts.write_string(type(layer).__name__)
+        bts.write_int(len(state))
+        for name, value in state.items():
+            bts.write_string(name)
+            _write_value(bts, value)
+        yield bts.get_bytes()
+
+class MigrationStaging:
+    """The parts of a move that reached this node, kept until the sender
+    commits the move and they go into the job's cache (see install)."""
+    # Runs of each paged layer's blocks: first block and the tensors
+    blocks: Dict[int, List[Tuple[int, List[torch.Tensor]]]]
+    # KV cache dtype and the dtype each paged layer computes in
+    formats: Dict[int, Tuple[str, torch.dtype]]
+    # Class name and state of every other layer
+    states: Dict[int, Tuple[str, ByteHelper]]
+
+    def __init__(self):
+        self.blocks = { }
+        self.formats = { }
+        self.states = { }
+        self.created = time()
+
+    def add(self, part: bytes):
+        bts = ByteHelper(part)
+        kind = bts.read_int()
+        layer_idx = bts.read_int()
+        if kind == PART_BLOCKS:
+            self.formats[layer_idx] = (bts.read_string(), _dtype(bts.read_string()))
+            first = bts.read_int()
+            tensors = [bytes_to_tensor(bts.read_bytes()) for _ in range(bts.read_int())]
+            self.blocks.setdefault(layer_idx, []).append((first, tensors))
+        elif kind == PART_STATE:
+            # Read once the receiving device is known
+            self.states[layer_idx] = (bts.read_string(), bts)
+        else:
+            raise Exception(f"Unknown KV cache part {kind}")
+
+    def install(self, cache: PagedCache, lengths: Dict[int, int], device: torch.device):
+        """Load the staged layers into `cache` on `device`. `lengths` is the
+        tokens each paged layer held on the sending node."""
+        for layer_idx, tokens in lengths.items():
+            layer = _paged_or_empty(cache, layer_idx)
+            runs = sorted(self.blocks.get(layer_idx, []), key=lambda run: run[0])
+            count = (tokens + BLOCK_TOKENS - 1) // BLOCK_TOKENS
+            expected = 0
+            for first, tensors in runs:
+                if first != expected:
+                    raise Exception(f"KV cache blocks of layer {layer_idx} are missing from {expected}")
+                expected += tensors[0].shape[0]
+            if expected < count:
+                raise Exception(f"KV cache of layer {layer_idx} has {expected} of {count} blocks")
+            if count == 0:
+                continue
+            kv_dtype, dtype = self.formats[layer_idx]
+            raw = [
+                torch.cat([tensors[i] for _, tensors in runs], dim=0).to(device)
+                for i in range(len(runs[0][1]))
+            ]
+            cache.set_kv_dtype([layer_idx], kv_dtype)
+            layer.load(raw, tokens, dtype)
+
+        for layer_idx, (name, bts) in self.states.items():
+            if layer_idx >= len(cache.layers) or type(cache.layers[layer_idx]).__name__ != name:
+                raise Exception(f"Layer {layer_idx} of the KV cache is not a {name}")
+            layer = cache.layers[layer_idx]
+            for _ in range(bts.read_int()):
+                attribute = bts.read_string()
+                setattr(layer, attribute, _read_value(bts, device))
+
+def _paged_or_empty(cache: PagedCache, layer_idx: int) -> PagedLayer:
+    if layer_idx >= len(cache.layers) or not isinstance(cache.layers[layer_idx], PagedLayer):
+        raise Exception(f"Layer {layer_idx} of the KV cache is not paged")
+    layer = cache.layers[layer_idx]
+    assert isinstance(layer, PagedLayer)
+    return layer
@@ -0,0 +1,528 @@
+import weakref
+from time import time
+from threading import Lock, RLock
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import torch
+from transformers import PretrainedConfig
+from transformers.cache_utils import DynamicCache, DynamicLayer
+
+# Tokens of one layer's keys and values in a block
+BLOCK_TOKENS = 16
+# Blocks allocated together. Slabs are never resized, so a block stays
+# where it is while it is in use.
+SLAB_BLOCKS = 256
+
+# Keys and values in the dtype the layers compute in
+KV_AUTO = "auto"
+# Keys and values in 8 bits, each token of each head scaled on its own
+KV_INT8 = "int8"
+KV_FP8 = "fp8"
+KV_CACHE_DTYPES = [KV_AUTO, KV_INT8, KV_FP8]
+# Bytes of the scale kept per token and head of a quantized cache
+SCALE_BYTES = 4
+
+# (slab id, block index in the slab)
+Block = Tuple[int, int]
+
+def token_bytes(heads: int, head_dim: int, kv_dtype: str, dtype_bytes: int = 2) -> int:
+    """Bytes one token takes in one layer's keys and values."""
+    if kv_dtype == KV_AUTO:
+        return 2 * heads * head_dim * dtype_bytes
+    return 2 * heads * (head_dim + SCALE_BYTES)
+
+def whole_blocks(tokens: int) -> int:
+    """Tokens rounded up to a multiple of BLOCK_TOKENS."""
+    return (max(tokens, 0) + BLOCK_TOKENS - 1) // BLOCK_TOKENS * BLOCK_TOKENS
+
+def window_kept(past_seen_tokens: int, sink_tokens: int, window_tokens: int) -> int:
+    """Tokens a cache bounded to `sink_tokens` plus a window of
+    `window_tokens` holds when `past_seen_tokens` came before the next pass.
+    Both are whole blocks; the tokens between them go a block at a time, so
+    the window holds up to a block more. A window of 0 keeps every token."""
+    if window_tokens <= 0 or past_seen_tokens <= sink_tokens + window_tokens:
+        return past_seen_tokens
+    return past_seen_tokens - (past_seen_tokens - sink_tokens - window_tokens) // BLOCK_TOKENS * BLOCK_TOKENS
+
+def check_kv_dtype(kv_dtype: str):
+    if kv_dtype not in KV_CACHE_DTYPES:
+        raise Exception(f"Unknown KV cache dtype {kv_dtype}, expected one of {', '.join(KV_CACHE_DTYPES)}")
+
+def quantize(x: torch.Tensor, kv_dtype: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    """`x` in 8 bits and the scale of each of its rows (the last dimension)."""
+    amax = x.abs().amax(-1, keepdim=True).float().clamp(min=1e-8)
+    if kv_dtype == KV_INT8:
+        scale = amax / 127
+        return (x.float() / scale).round().clamp(-127, 127).to(torch.int8), scale
+    scale = amax / torch.finfo(torch.float8_e4m3fn).max
+    return (x.float() / scale).to(torch.float8_e4m3fn), scale
+
+def dequantize(q: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    return (q.float() * scale).to(dtype)
+
+def _storage_dtype(dtype: torch.dtype, kv_dtype: str) -> torch.dtype:
+    if kv_dtype == KV_INT8:
+        return torch.int8
+    if kv_dtype == KV_FP8:
+        return torch.float8_e4m3fn
+    return dtype
+
+def _take(t: torch.Tensor, indices: List[int]) -> torch.Tensor:
+    """Rows `indices` of `t`; a view when they are in a row."""
+    if indices[-1] - indices[0] == len(indices) - 1:
+        return t[indices[0]:indices[-1] + 1]
+    return t.index_select(0, torch.tensor(indices, device=t.device))
+
+@dataclass
+class Slab:
+    keys: torch.Tensor
+    values: torch.Tensor
+    # Scales of each token and head; None when the cache is not quantized
+    key_scales: Optional[torch.Tensor]
+    value_scales: Optional[torch.Tensor]
+
+def _slab_tensors(slab: Slab) -> List[Optional[torch.Tensor]]:
+    return [slab.keys, slab.values, slab.key_scales, slab.value_scales]
+
+@dataclass
+class PoolStats:
+    blocks: int = 0
+    used_blocks: int = 0
+    # Bytes of keys and values the pool holds, in use or not
+    bytes: int = 0
+    used_bytes: int = 0
+    # Bytes of keys and values of idle jobs moved to disk (see KVSpill)
+    spilled_bytes: int = 0
+
+    def utilization(self) -> float:
+        if self.blocks == 0:
+            return 0.0
+        return self.used_blocks / self.blocks
+
+class BlockClass:
+    """The slabs for layers whose keys have one shape, dtype, device and KV cache dtype."""
+    slabs: Dict[int, Slab]
+    free: Dict[int, List[int]]
+
+    def __init__(self, heads: int, head_dim: int, dtype: torch.dtype, device: torch.device, kv_dtype: str = KV_AUTO):
+        self.heads = heads
+        self.head_dim = head_dim
+        self.dtype = dtype
+        self.device = device
+        self.kv_dtype = kv_dtype
+        self.slabs = { }
+        self.free = { }
+        self.next_slab = 0
+        dtype_bytes = torch.empty(0, dtype=dtype).element_size()
+        self.block_bytes = BLOCK_TOKENS * token_bytes(heads, head_dim, kv_dtype, dtype_bytes)
+
+    def allocate(self) -> Block:
+        # Fill the oldest slabs first, so the newest empty out
+        for slab_id in sorted(self.free):
+            if len(self.free[slab_id]) > 0:
+                return slab_id, self.free[slab_id].pop()
+        slab_id = self.next_slab
+        self.next_slab += 1
+        shape = (SLAB_BLOCKS, self.heads, BLOCK_TOKENS, self.head_dim)
+        storage = _storage_dtype(self.dtype, self.kv_dtype)
+        scales = None
+        if self.kv_dtype != KV_AUTO:
+            scales = (SLAB_BLOCKS, self.heads, BLOCK_TOKENS, 1)
+        self.slabs[slab_id] = Slab(
+            torch.empty(shape, dtype=storage, device=self.device),
+            torch.empty(shape, dtype=storage, device=self.device),
+            torch.empty(scales, dtype=torch.float32, device=self.device) if scales is not None else None,
+            torch.empty(scales, dtype=torch.float32, device=self.device) if scales is not None else None
+        )
+        self.free[slab_id] = list(range(SLAB_BLOCKS - 1, 0, -1))
+        return slab_id, 0
+
+    def release(self, block: Block):
+        slab_id, index = block
+        self.free[slab_id].append(index)
+        if len(self.free[slab_id]) < SLAB_BLOCKS:
+            return
+        # Keep one empty slab for the next job, hand the rest back
+        empty = [s for s, free in self.free.items() if len(free) == SLAB_BLOCKS]
+        for s in empty[:-1]:
+            del self.slabs[s]
+            del self.free[s]
+
+    def stats(self) -> PoolStats:
+        blocks = len(self.slabs) * SLAB_BLOCKS
+        used = blocks - sum(len(free) for free in self.free.values())
+        return PoolStats(blocks, used, blocks * self.block_bytes, used * self.block_bytes)
+
+class KVBlockPool:
+    """Fixed-size blocks of KV cache shared by every job on the node."""
+    classes: Dict[Hashable, BlockClass]
+    caches: "weakref.WeakSet[PagedCache]"
+    high_water: int
+    on_high_water: Optional[Callable[[], None]]
+
+    def __init__(self):
+        self.classes = { }
+        self.caches = weakref.WeakSet()
+        self.high_water = 0
+        self.on_high_water = None
+        self.lock = Lock()
+
+    def track(self, cache: "PagedCache"):
+        with self.lock:
+            self.caches.add(cache)
+
+    def tracked_caches(self) -> List["PagedCache"]:
+        """The caches that take blocks from this pool and still exist."""
+        with self.lock:
+            return list(self.caches)
+
+    def used_bytes(self, device: str = "cpu") -> int:
+        with self.lock:
+            return sum(
+                c.stats().used_bytes for c in self.classes.values()
+                if torch.device(c.device).type == device
+            )
+
+    def block_class(
+            self,
+            heads: int,
+            head_dim: int,
+            dtype: torch.dtype,
+            device: torch.device,
+            kv_dtype: str = KV_AUTO
+    ) -> BlockClass:
+        key = (heads, head_dim, dtype, str(device), kv_dtype)
+        with self.lock:
+            block_class = self.classes.get(key)
+            if block_class is None:
+                block_class = BlockClass(heads, head_dim, dtype, device, kv_dtype)
+                self.classes[key] = block_class
+            return block_class
+
+    def allocate(self, block_class: BlockClass, count: int) -> List[Block]:
+        with self.lock:
+            blocks = [block_class.allocate() for _ in range(count)]
+        if self.high_water > 0 and self.on_high_water is not None and self.used_bytes() > self.high_water:
+            self.on_high_water()
+        return blocks
+
+    def release(self, block_class: BlockClass, blocks: List[Block]):
+        with self.lock:
+            for block in blocks:
+                block_class.release(block)
+
+    def stats(self) -> PoolStats:
+        with self.lock:
+            total = PoolStats()
+            for block_class in self.classes.values():
+                s = block_class.stats()
+                total.blocks += s.blocks
+                total.used_blocks += s.used_blocks
+                total.bytes += s.bytes
+                total.used_bytes += s.used_bytes
+            caches = list(self.caches)
+        total.spilled_bytes = sum(cache.spilled_bytes() for cache in caches)
+        return total
+
+# One pool per process: a node's jobs, or a segment process's
+KV_POOL = KVBlockPool()
+
+def _release(pool: KVBlockPool, block_class: BlockClass, blocks: List[Block]):
+    pool.release(block_class, list(blocks))
+    blocks.clear()
+
+class PagedLayer(DynamicLayer):
+    """A full attention layer of a PagedCache, kept in blocks of a KVBlockPool."""
+    is_sliding = False
+    blocks: List[Block]
+    block_class: Optional[BlockClass]
+    # keys, values and, when quantized, their scales: [blocks, heads, BLOCK_TOKENS, ...]
+    spilled: Optional[List[torch.Tensor]]
+
+    def __init__(self, pool: KVBlockPool, lock: RLock, kv_dtype: str = KV_AUTO):
+        super().__init__()
+        self.pool = pool
+        self.lock = lock
+        self.kv_dtype = kv_dtype
+        self.blocks = []
+        self.block_class = None
+        self.spilled = None
+        self.length = 0
+
+    def lazy_initialization(self, key_states: torch.Tensor, value_states: torch.Tensor) -> None:
+        self.dtype, self.device = key_states.dtype, key_states.device
+        self.block_class = self.pool.block_class(
+            key_states.shape[1], key_states.shape[3], self.dtype, self.device, self.kv_dtype
+        )
+        # Blocks of a layer that is never released go back once it is collected
+        weakref.finalize(self, _release, self.pool, self.block_class, self.blocks)
+        self.is_initialized = True
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, *args, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
+        if key_states.shape[0] != 1:
+            raise Exception("Paged KV cache holds one sequence per cache")
+        with self.lock:
+            if not self.is_initialized:
+                self.lazy_initialization(key_states, value_states)
+            assert self.block_class is not None
+            self._restore()
+            self._write(key_states, value_states)
+            return self._gather()
+
+    def raw_blocks(self) -> List[torch.Tensor]:
+        """The contents of the layer's blocks as stored: keys, values and,
+        when quantized, their scales."""
+        parts = [self.block_contents(i) for i in range(len(self.blocks))]
+        return [torch.stack(part) for part in zip(*parts, strict=True)]
+
+    def block_contents(self, i: int) -> List[torch.Tensor]:
+        """Views of the keys, values and, when quantized, scales of the
+        layer's `i`th block."""
+        assert self.block_class is not None
+        slab_id, index = self.blocks[i]
+        return [t[index] for t in _slab_tensors(self.block_class.slabs[slab_id]) if t is not None]
+
+    def block_count(self) -> int:
+        """Blocks the layer's tokens take, in the pool or spilled."""
+        if self.spilled is not None:
+            return self.spilled[0].shape[0]
+        return len(self.blocks)
+
+    def copy_blocks(self, first: int, last: int) -> List[torch.Tensor]:
+        """Copies of blocks `first` up to `last` in the form `raw_blocks`
+        gives them, read from the pool or from the spill file."""
+        with self.lock:
+            if self.spilled is not None:
+                return [t[first:last].clone() for t in self.spilled]
+            parts = [self.block_contents(i) for i in range(first, last)]
+            return [torch.stack(part) for part in zip(*parts, strict=True)]
+
+    def load(self, raw: List[torch.Tensor], tokens: int, dtype: torch.dtype):
+        """Start an empty layer off with the first `tokens` tokens of `raw`,
+        blocks of another layer in the form `raw_blocks` gives them. `dtype`
+        is the dtype the layer computes in."""
+        with self.lock:
+            if self.length > 0:
+                raise Exception("Only an empty layer can be loaded")
+            count = (tokens + BLOCK_TOKENS - 1) // BLOCK_TOKENS
+            if not self.is_initialized:
+                keys = raw[0]
+                empty = torch.empty(1, keys.shape[1], 0, keys.shape[3], dtype=dtype, device=keys.device)
+                self.lazy_initialization(empty, empty)
+            self.spilled = [t[:count] for t in raw]
+            self._restore()
+            self.length = tokens
+
+    def spill(self, tensors: List[torch.Tensor]):
+        """Keep the layer's contents in `tensors`, copies of `raw_blocks()`,
+        and hand its blocks back to the pool."""
+        with self.lock:
+            assert self.block_class is not None
+            self.pool.release(self.block_class, self.blocks[:])
+            self.blocks.clear()
+            self.spilled = tensors
+
+    def spilled_bytes(self) -> int:
+        if self.spilled is None:
+            return 0
+        return sum(t.numel() * t.element_size() for t in self.spilled)
+
+    def _restore(self):
+        """Copy a spilled layer back into blocks of the pool."""
+        if self.spilled is None:
+            return
+        assert self.block_class is not None
+        spilled, self.spilled = self.spilled, None
+        self.blocks.extend(self.pool.allocate(self.block_class, spilled[0].shape[0]))
+        slabs = self.block_class.slabs
+        for i, (slab_id, index) in enumerate(self.blocks):
+            targets = [t for t in _slab_tensors(slabs[slab_id]) if t is not None]
+            for target, source in zip(targets, spilled, strict=True):
+                target[index] = source[i]
+
+    def _write(self, key_states: torch.Tensor, value_states: torch.Tensor):
+        assert self.block_class is not None
+        tokens = key_states.shape[2]
+        needed = (self.length + tokens + BLOCK_TOKENS - 1) // BLOCK_TOKENS - len(self.blocks)
+        if needed > 0:
+            self.blocks.extend(self.pool.allocate(self.block_class, needed))
+
+        keys, values = key_states[0], value_states[0]
+        key_scales = value_scales = None
+        if self.kv_dtype != KV_AUTO:
+            keys, key_scales = quantize(keys, self.kv_dtype)
+            values, value_scales = quantize(values, self.kv_dtype)
+
+        slabs = self.block_class.slabs
+        written = 0
+        while written < tokens:
+            position = self.length + written
+            slab_id, index = self.blocks[position // BLOCK_TOKENS]
+            offset = position % BLOCK_TOKENS
+            count = min(BLOCK_TOKENS - offset, tokens - written)
+            slab = slabs[slab_id]
+            slab.keys[index, :, offset:offset + count] = keys[:, written:written + count]
+            slab.values[index, :, offset:offset + count] = values[:, written:written + count]
+            if slab.key_scales is not None and slab.value_scales is not None:
+                assert key_scales is not None and value_scales is not None
+                slab.key_scales[index, :, offset:offset + count] = key_scales[:, written:written + count]
+                slab.value_scales[index, :, offset:offset + count] = value_scales[:, written:written + count]
+            written += count
+        self.length += tokens
+
+    def _gather(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The layer's keys and values as `[1, heads, length, head_dim]` tensors,
+        copied out of the blocks for this forward only."""
+        assert self.block_class is not None
+        slabs = self.block_class.slabs
+        heads, head_dim = self.block_class.heads, self.block_class.head_dim
+        shape = (heads, len(self.blocks), BLOCK_TOKENS, head_dim)
+        keys = torch.empty(shape, dtype=self.dtype, device=self.device)
+        values = torch.empty(shape, dtype=self.dtype, device=self.device)
+        # One copy per run of blocks in the same slab
+        start = 0
+        while start < len(self.blocks):
+            slab_id = self.blocks[start][0]
+            end = start
+            while end < len(self.blocks) and self.blocks[end][0] == slab_id:
+                end += 1
+            indices = [b[1] for b in self.blocks[start:end]]
+            slab = slabs[slab_id]
+            for target, source, scales in [
+                (keys, slab.keys, slab.key_scales),
+                (values, slab.values, slab.value_scales)
+            ]:
+                part = _take(source, indices)
+                if scales is not None:
+                    part = dequantize(part, _take(scales, indices), self.dtype)
+                # [blocks, heads, BLOCK_TOKENS, dim] -> [heads, blocks, BLOCK_TOKENS, dim]
+                target[:, start:end] = part.transpose(0, 1)
+            start = end
+        tokens = len(self.blocks) * BLOCK_TOKENS
+        keys = keys.view(heads, tokens, head_dim)[:, :self.length].unsqueeze(0)
+        values = values.view(heads, tokens, head_dim)[:, :self.length].unsqueeze(0)
+        return keys, values
+
+    def get_seq_length(self) -> int:
+        return self.length
+
+    def held_bytes(self) -> int:
+        if self.block_class is None:
+            return 0
+        return len(self.blocks) * self.block_class.block_bytes
+
+    def crop(self, max_length: int) -> None:
+        if max_length <= 0:
+            max_length = self.length - abs(max_length)
+        if self.length <= max_length:
+            return
+        with self.lock:
+            self._restore()
+            self.length = max_length
+            keep = (max_length + BLOCK_TOKENS - 1) // BLOCK_TOKENS
+            if self.block_class is not None and keep < len(self.blocks):
+                self.pool.release(self.block_class, self.blocks[keep:])
+                del self.blocks[keep:]
+
+    def evict(self, sink_tokens: int, kept_tokens: int):
+        """Drop the blocks right after the first `sink_tokens` tokens until
+        the layer holds `kept_tokens` (see window_kept)."""
+        if self.length <= kept_tokens:
+            return
+        dropped = self.length - kept_tokens
+        if sink_tokens % BLOCK_TOKENS != 0 or dropped % BLOCK_TOKENS != 0:
+            raise Exception(f"KV cache can only drop whole blocks, not {dropped} tokens after {sink_tokens}")
+        with self.lock:
+            self._restore()
+            assert self.block_class is not None
+            first = sink_tokens // BLOCK_TOKENS
+            last = first + dropped // BLOCK_TOKENS
+            self.pool.release(self.block_class, self.blocks[first:last])
+            del self.blocks[first:last]
+            self.length = kept_tokens
+
+    def release(self):
+        """Hand the layer's blocks back to the pool."""
+        with self.lock:
+            if self.block_class is not None and len(self.blocks) > 0:
+                self.pool.release(self.block_class, self.blocks[:])
+                self.blocks.clear()
+            self.spilled = None
+            self.length = 0
+
+    def reset(self) -> None:
+        self.release()
+
+    def batch_repeat_interleave(self, repeats: int) -> None:
+        raise Exception("Paged KV cache holds one sequence per cache")
+
+    def batch_select_indices(self, indices: torch.Tensor) -> None:
+        raise Exception("Paged KV cache holds one sequence per cache")
+
+class PagedCache(DynamicCache):
+    """A DynamicCache whose full attention layers keep their keys and values
+    in a KVBlockPool."""
+    def __init__(self, config: PretrainedConfig, pool: KVBlockPool = KV_POOL, kv_dtype: str = KV_AUTO):
+        super().__init__(config=config)
+        # Held while a layer is written, spilled or released, so blocks are
+        # never handed to another job halfway through a forward
+        self.lock = RLock()
+        self.last_used = time()
+        self.layers = [
+            PagedLayer(pool, self.lock, kv_dtype) if type(layer) is DynamicLayer else layer
+            for layer in self.layers
+        ]
+        pool.track(self)
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int, *args, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
+        self.last_used = time()
+        return super().update(key_states, value_states, layer_idx, *args, **kwargs)
+
+    def paged_layers(self) -> List[PagedLayer]:
+        return [layer for layer in self.layers if isinstance(layer, PagedLayer)]
+
+    def spilled_bytes(self) -> int:
+        return sum(layer.spilled_bytes() for layer in self.paged_layers())
+
+    def set_kv_dtype(self, layer_ids: Iterable[int], kv_dtype: str):
+        """Keep the keys and values of `layer_ids` in `kv_dtype`. Layers that
+        already hold tokens keep the dtype they have."""
+        with self.lock:
+            for layer_idx in layer_ids:
+                if layer_idx >= len(self.layers):
+                    continue
+                layer = self.layers[layer_idx]
+                if isinstance(layer, PagedLayer) and not layer.is_initialized:
+                    layer.kv_dtype = kv_dtype
+
+    def evict(self, layer_ids: Iterable[int], sink_tokens: int, kept_tokens: int):
+        """Bound the paged layers of `layer_ids` to `kept_tokens` tokens,
+        keeping the first `sink_tokens` (see PagedLayer.evict)."""
+        with self.lock:
+            for layer_idx in layer_ids:
+                if layer_idx >= len(self.layers):
+                    continue
+                layer = self.layers[layer_idx]
+                if isinstance(layer, PagedLayer):
+                    layer.evict(sink_tokens, kept_tokens)
+
+    def held_bytes(self) -> int:
+        return sum(layer.held_bytes() for layer in self.paged_layers())
+
+    def release_layers(self, layer_ids: Iterable[int]):
+        """Hand the blocks of the paged layers of `layer_ids` back to the
+        pool, once another node holds them (see kv_migrate)."""
+        with self.lock:
+            for layer_idx in layer_ids:
+                if layer_idx >= len(self.layers):
+                    continue
+                layer = self.layers[layer_idx]
+                if isinstance(layer, PagedLayer):
+                    layer.release()
+
+    def release(self):
+        """Hand every block back to the pool. The cache is empty afterwards."""
+        with self.lock:
+            for layer in self.paged_layers():
+                layer.release()
@@ -0,0 +1,170 @@
+import hashlib
+from time import time
+from threading import Lock
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import torch
+from transformers import PretrainedConfig
+from transformers.cache_utils import DynamicCache, DynamicLayer
+
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, PagedCache, PagedLayer
+
+# Bytes of each block hash
+PREFIX_HASH_BYTES = 16
+# Seconds the blocks a node set aside for a job wait for its first pass
+PREFIX_RESERVE_TIME = 60
+
+# A layer of a pipe and the KV cache dtype it keeps its blocks in
+PrefixLayer = Tuple[int, str]
+
+def block_hashes(ids: Sequence[int], tokens: int) -> List[bytes]:
+    """A hash for each full block of BLOCK_TOKENS in the first `tokens` of
+    `ids`. Each hash covers its block and every block before it, so equal
+    hashes mean equal prompts up to the end of the block."""
+    hashes: List[bytes] = []
+    previous = b""
+    for start in range(0, tokens - BLOCK_TOKENS + 1, BLOCK_TOKENS):
+        digest = hashlib.blake2b(previous, digest_size=PREFIX_HASH_BYTES)
+        digest.update(b"".join(int(t).to_bytes(4, "little") for t in ids[start:start + BLOCK_TOKENS]))
+        previous = digest.digest()
+        hashes.append(previous)
+    return hashes
+
+def prefix_reusable(config: PretrainedConfig) -> bool:
+    """Whether every layer of the model keeps its keys and values in a
+    PagedCache. Sliding window and linear attention layers keep a state that
+    cannot be put together from blocks."""
+    return all(type(layer) is DynamicLayer for layer in DynamicCache(config=config).layers)
+
+@dataclass
+class PrefixBlock:
+    # Keys, values and, when quantized, their scales: [heads, BLOCK_TOKENS, ...]
+    tensors: List[torch.Tensor]
+    # Dtype the layer computes in
+    dtype: torch.dtype
+
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.tensors)
+
+@dataclass
+class PrefixStats:
+    blocks: int = 0
+    bytes: int = 0
+    # Blocks asked for by the jobs that started since the node did, and the
+    # blocks of those that were found
+    lookup_blocks: int = 0
+    hit_blocks: int = 0
+
+    def hit_rate(self) -> float:
+        if self.lookup_blocks == 0:
+            return 0
+        return self.hit_blocks / self.lookup_blocks
+
+class PrefixKVCache:
+    """KV cache blocks of the prompts the node computed before, for its own
+    layers, so jobs whose prompts start the same way do not compute them again."""
+    entries: "OrderedDict[Tuple[str, int, str, bytes], PrefixBlock]"
+    reservations: Dict[str, Tuple[float, Dict[int, List[PrefixBlock]]]]
+    get_max_bytes: Callable[[], int]
+
+    def __init__(self, get_max_bytes: Callable[[], int] = lambda: 0):
+        self.get_max_bytes = get_max_bytes
+        self.entries = OrderedDict()
+        self.reservations = { }
+        self.bytes = 0
+        self.lookup_blocks = 0
+        self.hit_blocks = 0
+        self.lock = Lock()
+
+    def enabled(self) -> bool:
+        return self.get_max_bytes() > 0
+
+    def reserve(self, job_id: str, pipe_id: str, layers: List[PrefixLayer], hashes: List[bytes], now: float | None = None) -> int:
+        """Set aside the longest run of the prompt's blocks the node has for
+        every one of `layers`. Returns the number of blocks."""
+        now = time() if now is None else now
+        with self.lock:
+            self._prune_reservations(now)
+            count = len(hashes) if len(layers) > 0 and self.enabled() else 0
+            for layer_idx, kv_dtype in layers:
+                for i in range(count):
+                    if (pipe_id, layer_idx, kv_dtype, hashes[i]) not in self.entries:
+                        count = i
+                        break
+            self.lookup_blocks += len(hashes)
+            self.hit_blocks += count
+            if count == 0:
+                return 0
+
+            reserved: Dict[int, List[PrefixBlock]] = { }
+            for layer_idx, kv_dtype in layers:
+                keys = [(pipe_id, layer_idx, kv_dtype, hashes[i]) for i in range(count)]
+                for key in reversed(keys):
+                    self.entries.move_to_end(key)
+                reserved[layer_idx] = [self.entries[key] for key in keys]
+            self.reservations[job_id] = (now, reserved)
+            return count
+
+    def restore(self, job_id: str, cache: PagedCache, tokens: int) -> bool:
+        """Load the first `tokens` tokens of the blocks set aside for the job
+        into its cache. False when none were set aside."""
+        with self.lock:
+            reservation = self.reservations.pop(job_id, None)
+        if reservation is None or tokens == 0:
+            return False
+        count = tokens // BLOCK_TOKENS
+        for layer_idx, blocks in reservation[1].items():
+            layer = cache.layers[layer_idx]
+            if not isinstance(layer, PagedLayer) or len(blocks) < count:
+                raise Exception(f"No KV cache blocks set aside for the first {tokens} tokens of layer {layer_idx}")
+            raw = [torch.stack(part) for part in zip(*[b.tensors for b in blocks[:count]], strict=True)]
+            layer.load(raw, tokens, blocks[0].dtype)
+        return True
+
+    def store(self, pipe_id: str, cache: PagedCache, layers: List[PrefixLayer], hashes: List[bytes]):
+        """Keep the full blocks of `layers` the hashes cover."""
+        max_bytes = self.get_max_bytes()
+        if max_bytes <= 0:
+            return
+        for layer_idx, kv_dtype in layers:
+            layer = cache.layers[layer_idx] if layer_idx < len(cache.layers) else None
+            if not isinstance(layer, PagedLayer) or not layer.is_initialized:
+                continue
+            new: Dict[int, PrefixBlock] = { }
+            with cache.lock:
+                if layer.spilled is not None:
+                    continue
+                full = min(len(hashes), layer.length // BLOCK_TOKENS)
+                with self.lock:
+                    missing = [i for i in range(full) if (pipe_id, layer_idx, kv_dtype, hashes[i]) not in self.entries]
+                for i in missing:
+                    new[i] = PrefixBlock([t.clone() for t in layer.block_contents(i)], layer.dtype)
+            with self.lock:
+                # Last block first, so the end of a prompt is evicted before its start
+                for i in reversed(range(full)):
+                    key = (pipe_id, layer_idx, kv_dtype, hashes[i])
+                    if key in self.entries:
+                        self.entries.move_to_end(key)
+                    elif i in new:
+                        self.entries[key] = new[i]
+                        self.bytes += new[i].nbytes()
+                self._evict(max_bytes)
+
+    def stats(self) -> PrefixStats:
+        with self.lock:
+            return PrefixStats(len(self.entries), self.bytes, self.lookup_blocks, self.hit_blocks)
+
+    def _evict(self, max_bytes: int):
+        while self.bytes > max_bytes and len(self.entries) > 0:
+            _, block = self.entries.popitem(last=False)
+            self.bytes -= block.nbytes()
+
+    def _prune_reservations(self, now: float):
+        for job_id, (reserved_at, _) in list(self.reservations.items()):
+            if now - reserved_at > PREFIX_RESERVE_TIME:
+                del self.reservations[job_id]
+
+# One cache per process, like KV_POOL
+PREFIX_KV_CACHE = PrefixKVCache()
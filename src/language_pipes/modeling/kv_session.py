@@ -0,0 +1,158 @@
+import hashlib
+from time import time
+from threading import Lock
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from language_pipes.modeling.kv_pool import PagedCache, PagedLayer
+
+# Seconds the session a node set aside for a job waits for its first pass
+SESSION_RESERVE_TIME = 60
+
+def session_key(api_key: str, name: str) -> str:
+    """The id a session is kept under on every node: the caller's name for
+    it, scoped to its API key so callers cannot continue each other's
+    sessions. The API key itself does not leave the origin."""
+    return hashlib.blake2b(f"{api_key}\n{name}".encode(), digest_size=16).hexdigest()
+
+def common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    """Number of tokens `a` and `b` start with in common."""
+    for i, (x, y) in enumerate(zip(a, b, strict=False)):
+        if x != y:
+            return i
+    return min(len(a), len(b))
+
+@dataclass
+class KVSession:
+    pipe_id: str
+    cache: PagedCache
+    # Tokens the cache holds
+    tokens: int
+    # Their ids, on the origin only: it compares them with the next prompt
+    ids: List[int]
+    kept_at: float
+
+@dataclass
+class SessionStats:
+    sessions: int = 0
+    bytes: int = 0
+    # Jobs that continued a session and the prompt tokens they did not compute
+    resumed_jobs: int = 0
+    resumed_tokens: int = 0
+
+class SessionKVCache:
+    """The KV caches of finished jobs whose conversation may go on, so the
+    next turn only computes its new tokens."""
+    sessions: "OrderedDict[str, KVSession]"
+    reservations: Dict[str, Tuple[float, KVSession]]
+    get_max_bytes: Callable[[], int]
+    get_ttl: Callable[[], float]
+
+    def __init__(self, get_max_bytes: Callable[[], int] = lambda: 0, get_ttl: Callable[[], float] = lambda: 0):
+        self.get_max_bytes = get_max_bytes
+        self.get_ttl = get_ttl
+        self.sessions = OrderedDict()
+        self.reservations = { }
+        self.resumed_jobs = 0
+        self.resumed_tokens = 0
+        self.lock = Lock()
+
+    def enabled(self) -> bool:
+        return self.get_max_bytes() > 0
+
+    def keep(self, session_id: str, pipe_id: str, cache: PagedCache, tokens: int, ids: Optional[List[int]] = None, now: Optional[float] = None) -> bool:
+        """Take over `cache`, which holds the first `tokens` tokens of the
+        session. False, and the cache is left alone, when sessions are off."""
+        now = time() if now is None else now
+        if not self.enabled() or tokens <= 0:
+            return False
+        with self.lock:
+            replaced = self.sessions.pop(session_id, None)
+            self.sessions[session_id] = KVSession(pipe_id, cache, tokens, ids or [], now)
+        if replaced is not None:
+            replaced.cache.release()
+        self.prune(now)
+        return True
+
+    def ids(self, session_id: str) -> Optional[List[int]]:
+        """Token ids of a session this node started, None if it has none."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            return None if session is None else session.ids
+
+    def reserve(self, job_id: str, session_id: str, pipe_id: str, tokens: int, now: Optional[float] = None) -> int:
+        """Set the session aside for the job that continues it with the first
+        `tokens` tokens. Returns how many of them the node has, 0 if none."""
+        now = time() if now is None else now
+        self.prune(now)
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None or session.pipe_id != pipe_id or tokens <= 0:
+                return 0
+            tokens = min(tokens, session.tokens)
+            if tokens < session.tokens and not all(isinstance(layer, PagedLayer) for layer in session.cache.layers):
+                return 0
+            del self.sessions[session_id]
+            self.reservations[job_id] = (now, session)
+            return tokens
+
+    def resume(self, job_id: str, tokens: int) -> Optional[PagedCache]:
+        """The cache set aside for the job, holding its first `tokens`
+        tokens. None when no session was set aside for it, or another node
+        had none of it (0 tokens)."""
+        with self.lock:
+            reservation = self.reservations.pop(job_id, None)
+            if reservation is None:
+                return None
+            session = reservation[1]
+            if 0 < tokens <= session.tokens:
+                self.resumed_jobs += 1
+                self.resumed_tokens += tokens
+        if tokens > session.tokens:
+            session.cache.release()
+            raise Exception(f"Session holds {session.tokens} tokens, job needs {tokens}")
+        if tokens == 0:
+            session.cache.release()
+            return None
+        if tokens < session.tokens:
+            session.cache.crop(tokens)
+        return session.cache
+
+    def prune(self, now: Optional[float] = None):
+        """Release the sessions past their time and, oldest first, the ones
+        over the memory limit."""
+        now = time() if now is None else now
+        ttl = self.get_ttl()
+        max_bytes = self.get_max_bytes()
+        dropped: List[KVSession] = []
+        with self.lock:
+            for job_id, (reserved_at, session) in list(self.reservations.items()):
+                if now - reserved_at > SESSION_RESERVE_TIME:
+                    dropped.append(session)
+                    del self.reservations[job_id]
+            for session_id, session in list(self.sessions.items()):
+                if max_bytes <= 0 or now - session.kept_at > ttl:
+                    dropped.append(session)
+                    del self.sessions[session_id]
+            held = sum(session.cache.held_bytes() for session in self.sessions.values())
+            while held > max_bytes and len(self.sessions) > 0:
+                _, session = self.sessions.popitem(last=False)
+                held -= session.cache.held_bytes()
+                dropped.append(session)
+        # Outside the lock: releasing waits for a forward on the cache to end
+        for session in dropped:
+            session.cache.release()
+
+    def stats(self) -> SessionStats:
+        self.prune()
+        with self.lock:
+            return SessionStats(
+                len(self.sessions),
+                sum(session.cache.held_bytes() for session in self.sessions.values()),
+                self.resumed_jobs,
+                self.resumed_tokens
+            )
+
+# One cache per process, like KV_POOL
+SESSION_KV_CACHE = SessionKVCache()
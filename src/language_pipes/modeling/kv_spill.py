@@ -0,0 +1,161 @@
+import os
+import logging
+from time import time
+from uuid import uuid4
+from pathlib import Path
+from contextlib import suppress
+from threading import Event, Thread
+from typing import Callable, List, Optional
+
+import numpy as np
+import torch
+
+from language_pipes.modeling.kv_pool import KVBlockPool, PagedCache
+
+SPILL_LRU = "lru"
+SPILL_LARGEST = "largest"
+SPILL_POLICIES = [SPILL_LRU, SPILL_LARGEST]
+# Seconds a cache has to go unused before it may be spilled, so the jobs in
+# the middle of a round keep their blocks
+MIN_SPILL_IDLE = 1.0
+# Seconds between checks when no allocation crosses the high-water mark
+SPILL_CHECK_INTERVAL = 5.0
+# A spill goes on until the blocks in use are under this share of the mark,
+# so one more token does not start the next one
+SPILL_LOW_WATER = 0.9
+# Offsets of the tensors in a spill file, so each can be viewed in its dtype
+SPILL_ALIGN = 8
+SPILL_SUFFIX = ".kv"
+
+GB = 1024**3
+
+logger = logging.getLogger(__name__)
+
+def check_spill_policy(policy: str):
+    if policy not in SPILL_POLICIES:
+        raise Exception(f"Unknown KV spill policy {policy}, expected one of {', '.join(SPILL_POLICIES)}")
+
+def spill_cache(cache: PagedCache, directory: Path) -> int:
+    """Move the CPU blocks of `cache` to a memory-mapped file in `directory`.
+    Returns the bytes of blocks handed back."""
+    if not cache.lock.acquire(blocking=False):
+        return 0
+    path = directory / f"{uuid4().hex}{SPILL_SUFFIX}"
+    try:
+        layers = [
+            layer for layer in cache.paged_layers()
+            if layer.spilled is None and len(layer.blocks) > 0 and layer.device.type == "cpu"
+        ]
+        if len(layers) == 0:
+            return 0
+        raw = [layer.raw_blocks() for layer in layers]
+
+        offsets: List[List[int]] = []
+        size = 0
+        for tensors in raw:
+            offsets.append([])
+            for t in tensors:
+                offsets[-1].append(size)
+                size += (t.numel() * t.element_size() + SPILL_ALIGN - 1) // SPILL_ALIGN * SPILL_ALIGN
+
+        mm = np.memmap(path, dtype=np.uint8, mode="w+", shape=(size,))
+        buffer = torch.from_numpy(mm)
+        freed = 0
+        for layer, tensors, starts in zip(layers, raw, offsets, strict=True):
+            views = []
+            for t, start in zip(tensors, starts, strict=True):
+                view = buffer[start:start + t.numel() * t.element_size()].view(t.dtype).view(t.shape)
+                view.copy_(t)
+                views.append(view)
+            freed += layer.held_bytes()
+            layer.spill(views)
+        mm.flush()
+        return freed
+    finally:
+        cache.lock.release()
+        with suppress(OSError):
+            os.unlink(path)
+
+class KVSpill:
+    """Keeps the KV blocks in use on the CPU under `max_kv_memory` by moving
+    the caches of idle jobs to memory-mapped files in `directory`."""
+    pool: KVBlockPool
+    directory: Path
+    get_max_kv_memory: Callable[[], float]
+    get_policy: Callable[[], str]
+
+    def __init__(
+            self,
+            pool: KVBlockPool,
+            directory: Path,
+            get_max_kv_memory: Callable[[], float],
+            get_policy: Callable[[], str],
+            start: bool = True
+    ):
+        check_spill_policy(get_policy())
+        self.pool = pool
+        self.directory = directory
+        self.get_max_kv_memory = get_max_kv_memory
+        self.get_policy = get_policy
+        self.stopped = False
+        self.wake = Event()
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Files a node that did not shut down cleanly left behind
+        for stale in self.directory.glob(f"*{SPILL_SUFFIX}"):
+            with suppress(OSError):
+                stale.unlink()
+
+        self.pool.on_high_water = self.wake.set
+        if start:
+            Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self.stopped = True
+        self.pool.high_water = 0
+        self.pool.on_high_water = None
+        self.wake.set()
+
+    def _run(self):
+        while not self.stopped:
+            self.wake.wait(SPILL_CHECK_INTERVAL)
+            self.wake.clear()
+            if self.stopped:
+                return
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception(f"KV spill failed: {e}")
+
+    def candidates(self, now: Optional[float] = None) -> List[PagedCache]:
+        """The caches that may be spilled, in the order they are spilled."""
+        now = time() if now is None else now
+        caches = [
+            cache for cache in self.pool.tracked_caches()
+            if now - cache.last_used >= MIN_SPILL_IDLE and cache.held_bytes() > 0
+        ]
+        if self.get_policy() == SPILL_LARGEST:
+            caches.sort(key=lambda cache: cache.held_bytes(), reverse=True)
+        else:
+            caches.sort(key=lambda cache: cache.last_used)
+        return caches
+
+    def check(self, now: Optional[float] = None) -> int:
+        """Spill idle caches if the blocks in use are over the mark. Returns
+        the bytes of blocks handed back."""
+        limit = int(self.get_max_kv_memory() * GB)
+        self.pool.high_water = limit
+        if limit <= 0:
+            return 0
+        used = self.pool.used_bytes()
+        if used <= limit:
+            return 0
+
+        spilled = 0
+        for cache in self.candidates(now):
+            if used <= limit * SPILL_LOW_WATER:
+                break
+            freed = spill_cache(cache, self.directory)
+            used -= freed
+            spilled += freed
+        return spilled
@@ -10,9 +10,12 @@ from llm_layer_collector.auto.auto_layer import AutoDecoderLayer
 
 from language_pipes.util.utils import clone_model
 
-from language_pipes.modeling.meta_model import MetaModel
+from language_pipes.modeling.meta_model import MetaModel, ROLE_BOTH, check_pipe_role
 from language_pipes.modeling.llm_meta_data import LlmMetadata
-from language_pipes.modeling.compute import compute_layers
+from language_pipes.modeling.compute import compute_layers, compute_layers_batch, keep_prefix, reuse_prefix
+from language_pipes.modeling.kv_prefix import PrefixLayer
+from language_pipes.modeling.kv_pool import KV_AUTO, check_kv_dtype
+from language_pipes.modeling.segment_process import SegmentProcess, SegmentSpec
 
 from language_pipes.jobs.job import Job
 
@@ -30,6 +33,8 @@ class LlmModel:
 
     layers: List[AutoDecoderLayer]
     tokenizer: Callable
+    # Set when the layers run in their own process (see SegmentProcess)
+    segment_process: Optional[SegmentProcess]
 
     start_layer: int
     end_layer: int
@@ -37,6 +42,10 @@ class LlmModel:
     num_hidden_layers: int
     ram_used: int
     data_type: int
+    # See KV_CACHE_DTYPES
+    kv_cache_dtype: str
+    # See PIPE_ROLES
+    role: str
 
     def __init__(
             self,
@@ -49,8 +58,12 @@ class LlmModel:
             virtual: bool = False,
             huggingface_token: Optional[str] = None,
             num_hidden_layers: Optional[int] = None,
-            data_type: int = 16
+            data_type: int = 16,
+            kv_cache_dtype: str = KV_AUTO,
+            role: str = ROLE_BOTH
     ):
+        check_kv_dtype(kv_cache_dtype)
+        check_pipe_role(role)
         self.node_id = node_id
         self.ram_used = 0
         self.model_id = model_id
@@ -58,11 +71,14 @@ class LlmModel:
         self.loaded = False
         self.virtual = virtual
         self.layers = []
+        self.segment_process = None
         self.start_layer = -1
         self.end_layer = -1
         self.device = device
         self.model_dir = model_dir
         self.data_type = data_type
+        self.kv_cache_dtype = kv_cache_dtype
+        self.role = role
 
         if virtual and num_hidden_layers is not None:
             self.num_hidden_layers = num_hidden_layers
@@ -86,12 +102,24 @@ class LlmModel:
         else:
             self.process_id = process_id
             
-    def load(self):
+    def load(self, own_process: bool = False):
         if self.end_layer > self.num_hidden_layers:
             self.end_layer = self.num_hidden_layers - 1
 
         if self.start_layer == -1 or self.end_layer == -1:
             self.layers = []
+        elif own_process:
+            self.layers = []
+            model_path = self.model_dir / self.model_id
+            self.segment_process = SegmentProcess(SegmentSpec(
+                data_dir=model_path / "data",
+                cache_file=model_path / "cache.json",
+                device=str(self.device),
+                data_type=self.data_type,
+                kv_cache_dtype=self.kv_cache_dtype,
+                start_layer=self.start_layer,
+                end_layer=self.end_layer
+            ))
         else:
             self.layers = self.collector.load_layer_set(self.start_layer, self.end_layer, self.device)
         self.loaded = True
@@ -100,6 +128,13 @@ class LlmModel:
     def process_job(self, job: Job):
         self.compute_layers(job)
 
+    def prefix_layers(self) -> List[PrefixLayer]:
+        """The layers this segment keeps prompt blocks of in the PrefixKVCache:
+        none when they run in their own process."""
+        if self.segment_process is not None:
+            return []
+        return [(layer, self.kv_cache_dtype) for layer in range(self.start_layer, self.end_layer + 1)]
+
     def compute_layers(
         self, 
         job: Job
@@ -107,14 +142,21 @@ class LlmModel:
         if job.data is None:
             raise Exception("cannot compute layers without job data")
 
-        state, shared_kv_states = compute_layers(
-            job.current_layer,
-            job.data,
-            self.device,
-            self.collector.config,
-            self.layers,
-            job.cache,
-        )
+        if self.segment_process is not None:
+            self._check_own_cache([job])
+            state, shared_kv_states = self.segment_process.compute(job.current_layer, [job])[0]
+        else:
+            reuse_prefix(job, self.prefix_layers())
+            state, shared_kv_states = compute_layers(
+                job.current_layer,
+                job.data,
+                self.device,
+                self.collector.config,
+                self.layers,
+                job.layer_cache(),
+                self.kv_cache_dtype
+            )
+            keep_prefix(job, self.prefix_layers())
         job.set_layer(
             state=state,
             layer=self.end_layer + 1,
@@ -122,6 +164,49 @@ class LlmModel:
             shared_kv_states=shared_kv_states
         )
     
+    def process_jobs(self, jobs: List[Job]):
+        """Run several jobs that are at the same layer through this segment as one batch."""
+        if len(jobs) == 1:
+            self.compute_layers(jobs[0])
+            return
+
+        for job in jobs:
+            if job.data is None:
+                raise Exception("cannot compute layers without job data")
+
+        if self.segment_process is not None:
+            self._check_own_cache(jobs)
+            results = self.segment_process.compute(jobs[0].current_layer, jobs)
+        else:
+            for job in jobs:
+                reuse_prefix(job, self.prefix_layers())
+            results = compute_layers_batch(
+                jobs[0].current_layer,
+                [job.data for job in jobs], # type: ignore
+                self.device,
+                self.collector.config,
+                self.layers,
+                [job.layer_cache() for job in jobs],
+                self.kv_cache_dtype
+            )
+            for job in jobs:
+                keep_prefix(job, self.prefix_layers())
+        for job, (state, shared_kv_states) in zip(jobs, results, strict=True):
+            job.set_layer(
+                state=state,
+                layer=self.end_layer + 1,
+                num_hidden_layers=self.num_hidden_layers,
+                shared_kv_states=shared_kv_states
+            )
+
+    @staticmethod
+    def _check_own_cache(jobs: List[Job]):
+        """A segment process keeps one cache for each job, so it cannot run
+        a replay on a cache of its own (see Job.layer_cache)."""
+        for job in jobs:
+            if job.layer_cache() is not job.cache:
+                raise Exception(f"Job {job.job_id[:4]} cannot replay its tokens through a segment in its own process")
+
     def to_meta(self) -> MetaModel:
         return MetaModel(
             process_id=self.process_id,
@@ -132,10 +217,14 @@ class LlmModel:
             model_id=self.model_id,
             loaded=self.loaded,
             num_layers=self.num_hidden_layers,
-            meta_data=self.meta_data
+            meta_data=self.meta_data,
+            role=self.role
         )
 
     def cleanup_tensors(self):
+        if self.segment_process is not None:
+            self.segment_process.stop()
+            self.segment_process = None
         torch.cuda.empty_cache()
         self.layers = []
         torch.cuda.empty_cache()
@@ -150,7 +239,8 @@ class LlmModel:
             model_dir=model_dir,
             process_id=meta.process_id,
             num_hidden_layers=meta.num_layers,
-            virtual=True
+            virtual=True,
+            role=meta.role
         )
         model.loaded = meta.loaded
         model.start_layer = meta.start_layer
@@ -168,7 +258,9 @@ class LlmModel:
         pipe_id: str, 
         device: torch.device, 
         data_type: int,
-        huggingface_token: Optional[str] = None
+        huggingface_token: Optional[str] = None,
+        kv_cache_dtype: str = KV_AUTO,
+        role: str = ROLE_BOTH
     ) -> 'LlmModel':
         model = LlmModel(
             model_id=model_id,
@@ -177,7 +269,9 @@ class LlmModel:
             device=device, 
             model_dir=model_dir,
             huggingface_token=huggingface_token,
-            data_type=data_type
+            data_type=data_type,
+            kv_cache_dtype=kv_cache_dtype,
+            role=role
         )
 
         model_path = model_dir / model_id
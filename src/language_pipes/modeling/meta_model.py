@@ -1,6 +1,18 @@
 from dataclasses import dataclass
 from language_pipes.modeling.llm_meta_data import LlmMetadata
 
+# What the pipe of a segment serves. A prefill segment only computes the
+# prompt of a job, which then decodes on a pipe with decode segments for the
+# same layers (see RouterPipes.handoff_targets).
+ROLE_BOTH = "both"
+ROLE_PREFILL = "prefill"
+ROLE_DECODE = "decode"
+PIPE_ROLES = [ROLE_BOTH, ROLE_PREFILL, ROLE_DECODE]
+
+def check_pipe_role(role: str):
+    if role not in PIPE_ROLES:
+        raise Exception(f"Unknown pipe role {role}, expected one of {', '.join(PIPE_ROLES)}")
+
 @dataclass
 class MetaModel:
     process_id: str
@@ -13,6 +25,8 @@ class MetaModel:
     model_id: str
     num_layers: int
     meta_data: LlmMetadata
+    # See PIPE_ROLES
+    role: str = ROLE_BOTH
 
     def to_json(self):
         return {
@@ -24,7 +38,8 @@ class MetaModel:
             "model_id": self.model_id,
             "num_layers": self.num_layers,
             "loaded": self.loaded,
-            "meta_data": self.meta_data.to_json()
+            "meta_data": self.meta_data.to_json(),
+            "role": self.role
         }
 
     @staticmethod
@@ -38,5 +53,6 @@ class MetaModel:
             pipe_id=data["pipe_id"],
             model_id=data["model_id"],
             num_layers=data["num_layers"],
-            meta_data=LlmMetadata.from_dict(data["meta_data"])
+            meta_data=LlmMetadata.from_dict(data["meta_data"]),
+            role=data.get("role", ROLE_BOTH)
         )
\ No newline at end of file
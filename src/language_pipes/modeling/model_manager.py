@@ -12,9 +12,20 @@ from language_pipes.pipes.router_pipes import RouterPipes
 
 from language_pipes.modeling.llm_model import LlmModel
 from language_pipes.modeling.end_model import EndModel
+from language_pipes.modeling.kv_pool import KV_AUTO
+from language_pipes.modeling.meta_model import ROLE_BOTH
+from language_pipes.jobs.memory_governor import device_key
 
 from language_pipes.util.config import get_model_dir, is_8_bit_mode
 
+def _data_type_divisor(data_type: int) -> float:
+    """How much smaller quantized weights are than the 16 bit ones on disk."""
+    if data_type == 8:
+        return 2.0
+    if data_type == 4:
+        return 4.0
+    return 1
+
 class ModelManager:
     layer_models: List[LlmModel]
     end_models: List[EndModel]
@@ -24,6 +35,9 @@ class ModelManager:
     # unloading a model can stop the jobs that were relying on it.
     cancel_pipe_jobs: Callable[[List[str], str], None]
     cancel_model_jobs: Callable[[str, str], None]
+    # Moves the KV cache of the jobs on segments about to be unloaded to
+    # nodes hosting the same layers, so they go on there
+    move_segment_jobs: Callable[[List[LlmModel]], None]
 
     def __init__(self):
         self.layer_models = []
@@ -35,14 +49,17 @@ class ModelManager:
     def set_job_hooks(
         self,
         cancel_pipe_jobs: Callable[[List[str], str], None],
-        cancel_model_jobs: Callable[[str, str], None]
+        cancel_model_jobs: Callable[[str, str], None],
+        move_segment_jobs: Callable[[List[LlmModel]], None] = lambda segments: None
     ):
         self.cancel_pipe_jobs = cancel_pipe_jobs
         self.cancel_model_jobs = cancel_model_jobs
+        self.move_segment_jobs = move_segment_jobs
 
     def clear_job_hooks(self):
         self.cancel_pipe_jobs = lambda pipe_ids, reason: None
         self.cancel_model_jobs = lambda model_id, reason: None
+        self.move_segment_jobs = lambda segments: None
 
     def stop(self):
         self.logger.info("Stopping models")
@@ -59,6 +76,18 @@ class ModelManager:
                 return m
         return None
 
+    def weights_per_device(self) -> Dict[str, int]:
+        """Bytes of model weights held on each device, loaded or being loaded."""
+        weights: Dict[str, int] = { }
+        for m in self.layer_models:
+            if m.start_layer == -1:
+                continue
+            size = m.meta_data.avg_layer_size * (m.end_layer - m.start_layer + 1) / _data_type_divisor(m.data_type)
+            weights[device_key(m.device)] = weights.get(device_key(m.device), 0) + int(size)
+        for e in self.end_models:
+            weights[device_key(e.device)] = weights.get(device_key(e.device), 0) + e.size()
+        return weights
+
     def get_config(self, model_id: str) -> PretrainedConfig:
         collector = LlmLayerCollector(
             model_dir=get_model_dir() / model_id / "data",
@@ -76,7 +105,9 @@ class ModelManager:
         device: torch.device, 
         available_memory: int | float, 
         first_layer: int,
-        data_type: int
+        data_type: int,
+        kv_cache_dtype: str = KV_AUTO,
+        role: str = ROLE_BOTH
     ) -> Tuple[int | float, Optional[LlmModel]]:
         new_model: Optional[LlmModel] = LlmModel.from_id(
             node_id=node_id,
@@ -84,18 +115,15 @@ class ModelManager:
             model_id=model_id,
             pipe_id=pipe.pipe_id,
             device=device,
-            data_type=data_type
+            data_type=data_type,
+            kv_cache_dtype=kv_cache_dtype,
+            role=role
         )
         if new_model is None:
             return None
         meta_data = new_model.meta_data
         
-        data_type_divisor = 1
-        if data_type == 8:
-            data_type_divisor = 2.0
-
-        if data_type == 4:
-            data_type_divisor = 4.0
+        data_type_divisor = _data_type_divisor(data_type)
 
         num_layers_to_load = int(available_memory / (meta_data.avg_layer_size / data_type_divisor)) - 1
         total_layers = new_model.collector.config.num_hidden_layers
@@ -115,8 +143,16 @@ class ModelManager:
             new_model = None
         return available_memory, new_model
 
-    def load_end_model(self, model_id: str, device: str, num_local_layers: int):
-        model = EndModel(num_local_layers, get_model_dir(), model_id, device)
+    def load_end_model(
+            self,
+            model_id: str,
+            device: str,
+            num_local_layers: int,
+            kv_cache_dtype: str = KV_AUTO,
+            kv_sink_tokens: int = 0,
+            kv_window_tokens: int = 0
+        ):
+        model = EndModel(num_local_layers, get_model_dir(), model_id, device, kv_cache_dtype, kv_sink_tokens, kv_window_tokens)
         self.end_models.append(model)
         self.logger.info(f"Loading End Model for {model_id}")
         model.load()
@@ -131,7 +167,10 @@ class ModelManager:
         device: torch.device, 
         first_layer: int, 
         data_type: int,
-        max_pipes: int = 1
+        max_pipes: int = 1,
+        own_process: bool = False,
+        kv_cache_dtype: str = KV_AUTO,
+        role: str = ROLE_BOTH
     ):
         available_memory = max_memory * 1024**3
         models_to_load: List[LlmModel] = []
@@ -145,9 +184,9 @@ class ModelManager:
             loaded = True
             while loaded:
                 pipe = router_pipes.get_pipe_by_pipe_id(pipe_id)
-                if pipe is None: 
+                if pipe is None or not pipe.accepts(role):
                     break
-                available_memory, model = self._get_model_for_pipe(node_id, model_id, pipe, device, available_memory, first_layer, data_type)
+                available_memory, model = self._get_model_for_pipe(node_id, model_id, pipe, device, available_memory, first_layer, data_type, kv_cache_dtype, role)
                 loaded = model is not None
                 if model is not None:
                     self.pipes_hosted[model_id].append(model.pipe_id)
@@ -158,7 +197,7 @@ class ModelManager:
         if len(self.pipes_hosted[model_id]) < max_pipes:
             new_pipe = MetaPipe(str(uuid4()), model_id, [])
             self.pipes_hosted[model_id].append(new_pipe.pipe_id)
-            _, model = self._get_model_for_pipe(node_id, model_id, new_pipe, device, available_memory, first_layer, data_type)
+            _, model = self._get_model_for_pipe(node_id, model_id, new_pipe, device, available_memory, first_layer, data_type, kv_cache_dtype, role)
             if model is not None:
                 router_pipes.add_model_to_network(model.to_meta())
                 models_to_load.append(model)
@@ -166,7 +205,7 @@ class ModelManager:
 
         for m in models_to_load:
             self.logger.info(f"Loading model {m.model_id} on {m.device}, Layers {m.start_layer}-{m.end_layer}")
-            m.load()
+            m.load(own_process)
             self.logger.info(f"Layers {m.start_layer}-{m.end_layer} for {m.model_id} successfully loaded on {m.device}")
             router_pipes.update_model(m.to_meta())
 
@@ -180,13 +219,13 @@ class ModelManager:
 
     def shutdown_layer_models(self, router_pipes: RouterPipes, model_id: str, device: torch.device):
         to_remove = []
-        pipe_ids = [
-            m.pipe_id for m in self.layer_models
-            if m.model_id == model_id and m.device == device
-        ]
-        # Cancel first: the pipes lose layers here, so any job still running on
-        # them is dead either way, and stopping it now keeps the job from
-        # computing against tensors that are about to be freed.
+        segments = [m for m in self.layer_models if m.model_id == model_id and m.device == device]
+        pipe_ids = [m.pipe_id for m in segments]
+        # Jobs another node hosting the same layers can take go on there.
+        self.move_segment_jobs(segments)
+        # Cancel the rest first: the pipes lose layers here, so any job still
+        # running on them is dead either way, and stopping it now keeps the
+        # job from computing against tensors that are about to be freed.
         self.cancel_pipe_jobs(pipe_ids, f"layers for {model_id} unloaded")
 
         for model in self.layer_models:
@@ -0,0 +1,143 @@
+import json
+import hashlib
+from threading import Lock
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set
+
+# Most prompt tokens kept for conversations seen before, across all of them
+MAX_CACHED_TOKENS = 1_000_000
+
+@dataclass
+class PromptPrefix:
+    # The conversation rendered without a generation prompt
+    text: str
+    ids: List[int]
+
+def prefix_keys(messages: List[Dict[str, Any]]) -> List[str]:
+    """A key for each prefix of the conversation: the first message, the
+    first two, and so on. Equal keys mean equal messages."""
+    keys = []
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+        keys.append(digest.copy().hexdigest())
+    return keys
+
+class PromptCache:
+    """Renders conversations with a tokenizer's chat template and tokenizes
+    them, reusing the tokens of the conversations it tokenized before."""
+    entries: "OrderedDict[str, PromptPrefix]"
+    # Added tokens a prompt can be cut right before, or right after
+    markers: Optional[List[str]]
+    cut_before: Set[str]
+    cut_after: Set[str]
+
+    def __init__(self, tokenizer: Any, max_tokens: int = MAX_CACHED_TOKENS):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.entries = OrderedDict()
+        self.cached_tokens = 0
+        self.lock = Lock()
+        self.markers = None
+        self.cut_before = set()
+        self.cut_after = set()
+
+    def encode(self, messages: List[Dict[str, Any]]) -> List[int]:
+        """Token ids of the prompt for `messages`, with the generation prompt."""
+        prompt = self._render(messages, True)
+        if len(messages) == 0 or len(self._markers()) == 0:
+            return self._encode(prompt)
+        try:
+            history = self._render(messages, False)
+        except Exception:
+            # Some templates only render conversations that end a certain way
+            return self._encode(prompt)
+        if not prompt.startswith(history) or not self._splits_cleanly(prompt, len(history)):
+            return self._encode(prompt)
+
+        keys = prefix_keys(messages)
+        ids = self._encode_history(keys, history)
+        self._store(keys[-1], PromptPrefix(history, ids))
+        return ids + self._encode(prompt[len(history):], special_tokens=False)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def _render(self, messages: List[Dict[str, Any]], generation_prompt: bool) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            chat_template=self.tokenizer.chat_template,
+            add_generation_prompt=generation_prompt
+        )
+
+    def _encode(self, text: str, special_tokens: bool = True) -> List[int]:
+        if text == "":
+            return []
+        return [int(t) for t in self.tokenizer.encode(text, add_special_tokens=special_tokens)]
+
+    def _markers(self) -> List[str]:
+        """The added tokens a prompt can be cut at; none when the cache cannot be used."""
+        if self.markers is None:
+            before: Set[str] = set()
+            after: Set[str] = set()
+            try:
+                full = self._encode("a")
+                bare = self._encode("a", special_tokens=False)
+                # Tokens added at the end would land in the middle of a prompt
+                if full[len(full) - len(bare):] == bare:
+                    for marker in self.tokenizer.get_added_vocab():
+                        if marker == "":
+                            continue
+                        text = "a" + marker + "a a"
+                        if self._cuts_exactly(text, 1):
+                            before.add(marker)
+                        if self._cuts_exactly(text, 1 + len(marker)):
+                            after.add(marker)
+            except Exception:
+                before, after = set(), set()
+            self.cut_before = before
+            self.cut_after = after
+            self.markers = sorted(before | after)
+        return self.markers
+
+    def _cuts_exactly(self, text: str, at: int) -> bool:
+        """Whether `text` cut at `at` encodes to the same tokens as in one piece."""
+        return self._encode(text[:at]) + self._encode(text[at:], special_tokens=False) == self._encode(text)
+
+    def _splits_cleanly(self, text: str, at: int) -> bool:
+        """Whether `text` encodes to the tokens of text[:at] followed by those of text[at:]."""
+        if at <= 0 or len(self._markers()) == 0:
+            return False
+        if at == len(text):
+            return True
+        head = text[:at]
+        return any(text.startswith(m, at) for m in self.cut_before) or any(head.endswith(m) for m in self.cut_after)
+
+    def _encode_history(self, keys: List[str], history: str) -> List[int]:
+        prefix = None
+        with self.lock:
+            for key in reversed(keys):
+                entry = self.entries.get(key)
+                if entry is not None and history.startswith(entry.text) and self._splits_cleanly(history, len(entry.text)):
+                    self.entries.move_to_end(key)
+                    prefix = entry
+                    break
+        if prefix is None:
+            return self._encode(history)
+        return prefix.ids + self._encode(history[len(prefix.text):], special_tokens=False)
+
+    def _store(self, key: str, prefix: PromptPrefix):
+        if len(prefix.ids) > self.max_tokens:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.cached_tokens -= len(old.ids)
+            self.entries[key] = prefix
+            self.cached_tokens += len(prefix.ids)
+            while self.cached_tokens > self.max_tokens:
+                _, evicted = self.entries.popitem(last=False)
+                self.cached_tokens -= len(evicted.ids)
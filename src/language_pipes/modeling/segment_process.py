@@ -0,0 +1,170 @@
+import queue
+import weakref
+from pathlib import Path
+from threading import RLock
+from time import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Set, Tuple
+
+import torch
+import torch.multiprocessing as mp
+
+from llm_layer_collector import LlmLayerCollector
+
+from language_pipes.jobs.job import Job
+from language_pipes.jobs.job_data import JobData
+from language_pipes.modeling.compute import compute_layers, compute_layers_batch
+from language_pipes.modeling.kv_pool import KV_AUTO, PagedCache
+
+# Seconds between liveness checks while waiting on the child
+POLL_INTERVAL = 1
+# Seconds without a pass before a job's cache is dropped in the child, in case
+# the drop message never came (same limit the JobTracker uses for stale jobs)
+CACHE_EXPIRY = 60
+
+LayerResult = Tuple[torch.Tensor, Dict[str, Tuple[torch.Tensor, torch.Tensor]]]
+
+@dataclass
+class SegmentSpec:
+    """What the child process needs to load a segment."""
+    data_dir: Path
+    cache_file: Path
+    device: str
+    data_type: int
+    start_layer: int
+    end_layer: int
+    kv_cache_dtype: str = KV_AUTO
+
+class SegmentProcess:
+    """Runs one layer segment in a child process."""
+    spec: SegmentSpec
+
+    def __init__(self, spec: SegmentSpec):
+        self.spec = spec
+        # Reentrant: a finalizer calling drop can fire while compute holds it
+        self.lock = RLock()
+        self.job_ids: Set[str] = set()
+        self.stopped = False
+
+        ctx = mp.get_context("spawn")
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_segment_main, args=(spec, self.requests, self.results), daemon=True)
+        self.process.start()
+
+        kind, payload = self._receive()
+        if kind == "error":
+            self.stop()
+            raise Exception(f"Segment process could not load layers {spec.start_layer}-{spec.end_layer}: {payload}")
+
+    def compute(self, start_layer: int, jobs: List[Job]) -> List[LayerResult]:
+        """Run `jobs`, all at `start_layer`, through the segment as one batch."""
+        with self.lock:
+            if self.stopped:
+                raise Exception("Segment process is stopped")
+            for job in jobs:
+                if job.job_id not in self.job_ids:
+                    self.job_ids.add(job.job_id)
+                    weakref.finalize(job, self.drop, job.job_id).atexit = False
+
+            self.requests.put(("compute", start_layer, [job.job_id for job in jobs], [job.data for job in jobs]))
+            kind, payload = self._receive()
+
+        if kind == "error":
+            raise Exception(f"Segment process failed: {payload}")
+        return payload
+
+    def drop(self, job_id: str):
+        """Free the cache the child holds for a job."""
+        with self.lock:
+            self.job_ids.discard(job_id)
+            if self.stopped:
+                return
+            self.requests.put(("drop", job_id))
+
+    def stop(self):
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.job_ids = set()
+            if self.process.is_alive():
+                self.requests.put(("stop",))
+                self.process.join(10)
+            if self.process.is_alive():
+                self.process.kill()
+
+    def _receive(self) -> Tuple[str, Any]:
+        while True:
+            try:
+                return self.results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    return ("error", f"process exited with code {self.process.exitcode}")
+
+def _segment_main(spec: SegmentSpec, requests, results):
+    try:
+        device = torch.device(spec.device)
+        collector = LlmLayerCollector(
+            model_dir=spec.data_dir,
+            cache_file=spec.cache_file,
+            device=device,
+            dtype=torch.bfloat16,
+            load_in_8bit=spec.data_type == 8,
+            load_in_4bit=spec.data_type == 4
+        )
+        layers = collector.load_layer_set(spec.start_layer, spec.end_layer, device)
+    except Exception as e:
+        results.put(("error", f"{type(e).__name__}: {e}"))
+        return
+    results.put(("ready", None))
+
+    caches: Dict[str, PagedCache] = { }
+    last_used: Dict[str, float] = { }
+    while True:
+        try:
+            request = requests.get(timeout=CACHE_EXPIRY)
+        except queue.Empty:
+            request = None
+
+        if request is not None:
+            if request[0] == "stop":
+                return
+            if request[0] == "drop":
+                cache = caches.pop(request[1], None)
+                if cache is not None:
+                    cache.release()
+                last_used.pop(request[1], None)
+            elif request[0] == "compute":
+                _, start_layer, job_ids, job_datas = request
+                results.put(_compute(collector, layers, device, spec.kv_cache_dtype, caches, last_used, start_layer, job_ids, job_datas))
+
+        now = time()
+        for job_id in [j for j, t in last_used.items() if now - t > CACHE_EXPIRY]:
+            caches.pop(job_id).release()
+            del last_used[job_id]
+
+def _compute(
+        collector: LlmLayerCollector,
+        layers,
+        device: torch.device,
+        kv_cache_dtype: str,
+        caches: Dict[str, PagedCache],
+        last_used: Dict[str, float],
+        start_layer: int,
+        job_ids: List[str],
+        job_datas: List[JobData]
+) -> Tuple[str, Any]:
+    try:
+        job_caches = []
+        for job_id in job_ids:
+            if job_id not in caches:
+                caches[job_id] = PagedCache(collector.config)
+            last_used[job_id] = time()
+            job_caches.append(caches[job_id])
+
+        if len(job_ids) == 1:
+            return ("ok", [compute_layers(start_layer, job_datas[0], device, collector.config, layers, job_caches[0], kv_cache_dtype)])
+        return ("ok", compute_layers_batch(start_layer, job_datas, device, collector.config, layers, job_caches, kv_cache_dtype))
+    except Exception as e:
+        return ("error", f"{type(e).__name__}: {e}")
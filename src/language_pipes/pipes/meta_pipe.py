@@ -1,7 +1,7 @@
 from typing import List
 from logging import Logger
 from dataclasses import dataclass
-from language_pipes.modeling.meta_model import MetaModel
+from language_pipes.modeling.meta_model import MetaModel, ROLE_BOTH, ROLE_DECODE, ROLE_PREFILL
 from language_pipes.modeling.llm_meta_data import LlmMetadata
 
 @dataclass
@@ -20,6 +20,21 @@ class MetaPipe:
     def is_loading(self) -> bool:
         return len([s for s in self.segments if not s.loaded]) > 0
 
+    def can_prefill(self) -> bool:
+        return len([s for s in self.segments if s.role == ROLE_DECODE]) == 0
+
+    def can_decode(self) -> bool:
+        return len([s for s in self.segments if s.role == ROLE_PREFILL]) == 0
+
+    def accepts(self, role: str) -> bool:
+        """Whether a segment of `role` can join the pipe: a pipe never holds
+        both prefill and decode segments."""
+        if role == ROLE_PREFILL:
+            return self.can_prefill()
+        if role == ROLE_DECODE:
+            return self.can_decode()
+        return role == ROLE_BOTH
+
     def get_computed(self) -> LlmMetadata:
         return self.segments[0].meta_data
 
@@ -7,7 +7,7 @@ from distributed_state_network import StateNetworkNode
 
 from language_pipes.pipes.meta_pipe import MetaPipe
 from language_pipes.modeling.llm_model import LlmModel
-from language_pipes.jobs.network_job import NetworkJob
+from language_pipes.jobs.network_job import HopReply, NetworkJob
 from language_pipes.util.byte_helper import ByteHelper
 from language_pipes.util.chat import ChatMessage
 
@@ -36,16 +36,23 @@ class Pipe:
 
         self.segments = []
 
-    def send_job(self, job: NetworkJob, node_id: str):
+    def send_job(self, job: NetworkJob, node_id: str, timeout: Optional[float] = None) -> HopReply:
+        """Send a pass to `node_id` and return its answer.
+
+        With a `timeout` the request is tried once and fails after that many
+        seconds; the caller sends it again if it wants to."""
         data = job.to_bytes()
         bts = ByteHelper()
         bts.write_int(0) # Job Protocol
         bts.write_bytes(data)
         data = bts.get_bytes()
         if node_id == self.router.node_id():
-            self.router.receive_data(data)
+            reply = self.router.receive_data(data)
+        elif timeout is None:
+            reply = self.router.send_to_node(node_id, data)
         else:
-            self.router.send_to_node(node_id, data)
+            reply = self.router.send_to_node(node_id, data, timeout=timeout, retries=0)
+        return HopReply.from_reply(reply)
 
     def get_layer(self, layer: int, need_physical: bool = False) -> Optional[LlmModel]:
         for segment in self.segments:
@@ -1,9 +1,10 @@
-from typing import Optional
+from typing import Dict, Optional
 
 from language_pipes.pipes.pipe import Pipe
 from language_pipes.pipes.meta_pipe import MetaPipe
 from language_pipes.pipes.router_pipes import RouterPipes
 
+from language_pipes.modeling.llm_model import LlmModel
 from language_pipes.modeling.model_manager import ModelManager
 from language_pipes.util.config import get_model_dir
 
@@ -33,6 +34,36 @@ class PipeManager:
             return None
         return self._get_pipe_from_meta(meta_pipe)
 
+    def get_job_pipe(self, pipe_id: str, segment_moves: Dict[int, str]) -> Optional[Pipe]:
+        """The pipe a job runs on: `pipe_id`, with the segments its KV cache
+        moved or failed over to in place of the ones that held those layers.
+        A segment that is gone leaves a hole in the pipe, which fails the job
+        over when it gets there."""
+        pipe = self.get_pipe_by_pipe_id(pipe_id)
+        if pipe is None or len(segment_moves) == 0:
+            return pipe
+        for start_layer, process_id in segment_moves.items():
+            segment = self._get_segment(process_id)
+            if segment is None:
+                pipe.segments = [s for s in pipe.segments if s.start_layer != start_layer]
+                continue
+            pipe.segments = [
+                s for s in pipe.segments
+                if s.end_layer < segment.start_layer or s.start_layer > segment.end_layer
+            ]
+            pipe.segments.append(segment)
+        pipe.sort_segments()
+        return pipe
+
+    def _get_segment(self, process_id: str) -> Optional[LlmModel]:
+        for model in self.model_manager.layer_models:
+            if model.process_id == process_id:
+                return model
+        meta = self.router_pipes.get_model(process_id)
+        if meta is None:
+            return None
+        return LlmModel.from_meta(meta, get_model_dir())
+
     def get_pipe_by_model_id(self, model_id: str, start_layer: int = 0) -> Optional[Pipe]:
         meta_pipe = self.router_pipes.get_pipe_by_model_id(model_id, start_layer=start_layer)
         if meta_pipe is None:
@@ -6,7 +6,7 @@ from distributed_state_network.handler import DSNodeServer
 from distributed_state_network import StateNetworkNode
 
 from language_pipes.pipes.meta_pipe import MetaPipe
-from language_pipes.modeling.meta_model import MetaModel
+from language_pipes.modeling.meta_model import MetaModel, ROLE_PREFILL
 
 def aggregate_models(models: List[MetaModel]) -> List[MetaPipe]:
     pipes: List[MetaPipe] = []
@@ -73,6 +73,45 @@ class RouterPipes:
         
         return aggregate_models(models)[0]
 
+    def get_model(self, process_id: str) -> Optional[MetaModel]:
+        for model in self._all_models():
+            if model.process_id == process_id:
+                return model
+        return None
+
+    def replicas(self, model: MetaModel) -> List[MetaModel]:
+        """Loaded segments of other pipes that hold the same layers of the
+        same model as `model`."""
+        return [
+            m for m in self._all_models()
+            if m.model_id == model.model_id and m.pipe_id != model.pipe_id and m.loaded
+            and m.start_layer == model.start_layer and m.end_layer == model.end_layer
+        ]
+
+    def cover(self, model_id: str, pipe_id: str, start_layer: int, end_layer: int, exclude_node_id: Optional[str] = None) -> List[MetaModel]:
+        """Loaded segments of pipes other than `pipe_id`, none of them on
+        `exclude_node_id`, that hold layers `start_layer` to `end_layer` of
+        `model_id` between them, each going on where the last one ends.
+        Empty when the network has no such segments."""
+        candidates = [
+            m for m in self._all_models()
+            if m.model_id == model_id and m.pipe_id != pipe_id and m.loaded and m.node_id != exclude_node_id
+            and m.start_layer >= start_layer and m.end_layer <= end_layer
+        ]
+
+        def chain(layer: int) -> Optional[List[MetaModel]]:
+            if layer == end_layer + 1:
+                return []
+            for m in candidates:
+                if m.start_layer != layer:
+                    continue
+                rest = chain(m.end_layer + 1)
+                if rest is not None:
+                    return [m] + rest
+            return None
+
+        return chain(start_layer) or []
+
     def get_pipe_by_model_id(self, model_id: str, start_layer: int = 0) -> Optional[MetaPipe]:
         available_pipes: List[MetaPipe] = []
         for p in self.pipes_for_model(model_id, find_completed=True, start_layer=start_layer):
@@ -81,8 +120,48 @@ class RouterPipes:
         if len(available_pipes) == 0:
             return None
 
+        # Jobs start on a pipe that can compute their prompt and only go to
+        # a decode pipe when there is no other
+        prefill_pipes = [p for p in available_pipes if p.can_prefill()]
+        if len(prefill_pipes) > 0:
+            return random.choice(prefill_pipes)
         return random.choice(available_pipes)
 
+    def handoff_targets(self, pipe: MetaPipe, start_layer: int = 0) -> Dict[int, MetaModel]:
+        """Segments to hand the KV cache of `pipe`'s prefill segments to
+        once a job's prompt is computed, by the start layer of each prefill
+        segment. The targets hold the same layers in complete pipes that can
+        decode, all in one pipe when there is one. Prefill segments with no
+        target are left out."""
+        prefill = [s for s in pipe.segments if s.role == ROLE_PREFILL and s.loaded and s.start_layer >= start_layer]
+        if len(prefill) == 0:
+            return { }
+        decode_pipes = [
+            p for p in self.pipes_for_model(pipe.model_id, find_completed=True, start_layer=start_layer)
+            if p.pipe_id != pipe.pipe_id and not p.is_loading() and p.can_decode()
+        ]
+        random.shuffle(decode_pipes)
+
+        def target(p: MetaPipe, segment: MetaModel) -> Optional[MetaModel]:
+            for s in p.segments:
+                if s.loaded and s.start_layer == segment.start_layer and s.end_layer == segment.end_layer:
+                    return s
+            return None
+
+        for p in decode_pipes:
+            targets = [target(p, s) for s in prefill]
+            if None not in targets:
+                return { s.start_layer: t for s, t in zip(prefill, targets, strict=True) if t is not None }
+
+        targets: Dict[int, MetaModel] = { }
+        for s in prefill:
+            for p in decode_pipes:
+                t = target(p, s)
+                if t is not None:
+                    targets[s.start_layer] = t
+                    break
+        return targets
+
     def print_pipes(self, num_local_layers: int, logger: logging.Logger):
         for p in self._network_pipes():
             p.print(num_local_layers, logger)
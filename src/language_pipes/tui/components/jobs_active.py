@@ -38,7 +38,38 @@ class JobsActive:
     def get_view(self) -> List[str]:
         lines = ["Active Jobs:", ""]
 
-        jobs = self.provider.job_provider.get_active_jobs()
+        stats = self.provider.job_provider.get_queue_stats()
+        if stats is not None:
+            lines.extend([
+                f"Queued: {stats.depth} ({stats.prefill} prefill, {stats.decode} decode) from {len(stats.flows)} flow(s) on {stats.queues} worker(s), oldest {stats.oldest_wait * 1000:.0f} ms",
+                f"Queue wait: avg {stats.avg_wait * 1000:.0f} ms, p99 {stats.p99_wait * 1000:.0f} ms, max {stats.max_wait * 1000:.0f} ms",
+                ""
+            ])
+
+        pool = self.provider.job_provider.get_kv_pool_stats()
+        if pool.blocks > 0:
+            lines.extend([
+                f"KV pool: {pool.used_blocks} of {pool.blocks} blocks in use ({pool.utilization() * 100:.0f}%), {pool.used_bytes / 1024**2:.0f} of {pool.bytes / 1024**2:.0f} MB",
+            ])
+            if pool.spilled_bytes > 0:
+                lines.append(f"KV spilled to disk: {pool.spilled_bytes / 1024**2:.0f} MB")
+            lines.append("")
+
+        prefix = self.provider.job_provider.get_prefix_cache_stats()
+        if prefix.blocks > 0 or prefix.lookup_blocks > 0:
+            lines.extend([
+                f"Prefix cache: {prefix.blocks} blocks, {prefix.bytes / 1024**2:.0f} MB, hit rate {prefix.hit_rate() * 100:.0f}%",
+                ""
+            ])
+
+        sessions = self.provider.job_provider.get_session_kv_stats()
+        if sessions.sessions > 0 or sessions.resumed_jobs > 0:
+            lines.extend([
+                f"KV sessions: {sessions.sessions} kept, {sessions.bytes / 1024**2:.0f} MB, {sessions.resumed_jobs} jobs went on from one ({sessions.resumed_tokens} tokens)",
+                ""
+            ])
+
+        jobs =self.provider.job_provider.get_active_jobs()
         self.num_jobs = len(jobs)
         entries = []
         for job in jobs:
@@ -54,6 +85,8 @@ class JobsActive:
             prefill_speed = job.timing_stats.prefill_times.get_tokens_per_second()
             if prefill_speed > 0:
                 entry.extend(["", f"Prefill speed: {prefill_speed:.2f} Tok/s", ""])
+            if job.progress.prefilling and job.timing_stats.prefill_chunk_size > 0:
+                entry.append(f"Prefill chunk: {job.timing_stats.prefill_chunk_size} tokens")
 
             decode_speed = job.timing_stats.output_times.get_tokens_per_second()
             if not job.progress.prefilling and decode_speed > 0:
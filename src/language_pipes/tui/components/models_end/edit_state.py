@@ -191,6 +191,11 @@ class EditPageState(PageState):
             num_local_layers=int(self.local_layers),
             device=self.device_name,
         )
+        if self.editing_model is not None:
+            # Options this page does not edit stay as they were
+            model.kv_cache_dtype = self.editing_model.kv_cache_dtype
+            model.kv_sink_tokens = self.editing_model.kv_sink_tokens
+            model.kv_window_tokens = self.editing_model.kv_window_tokens
 
         was_running = (
             self.editing_model is not None
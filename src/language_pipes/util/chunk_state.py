@@ -1,60 +1,147 @@
+from typing import List, Optional, Set
+
 from language_pipes.util.utils import CHUNK_SIZE
 
 class ChunkState:
+    """Prefill chunking of a prompt on the origin node."""
     job_id: str
     current_chunk: int  # Current chunk index being processed (0-based)
     total_chunks: int  # Total chunks for prefill (0 = no chunking needed)
-    chunk_size: int  # Size of each chunk
+    chunk_size: int  # Size of each remaining chunk
+    chunk_start: int  # Prompt position the current chunk starts at
     prompt_length: int  # Total prompt length
+    prompt_start: int  # Prompt position prefill starts at
+    chunk_ends: List[int]  # Prompt position each chunk sent so far ends at
+    sent_alone: List[bool]  # Whether each chunk went out with no other chunk in the pipe
+    chunks_done: int  # Chunks that have come back from the pipe
+    chunk_passes: List[int]  # Pass each chunk sent so far went out as
+    stale_passes: Set[int]  # Passes of chunks that were sent again since
 
     def __init__(self, job_id: str):
         self.job_id = job_id
-        self.current_chunk = 0
-        self.total_chunks = 0
-        self.chunk_size = 0
         self.prompt_length = 0
+        self.disable()
 
-    def init(self, prompt_length: int):
-        """Initialize chunking if the prompt exceeds chunk_size."""
+    def init(self, prompt_length: int, chunk_size: Optional[int] = None, start: int = 0):
+        """Initialize chunking if the prompt from `start` on exceeds chunk_size
+        (CHUNK_SIZE if not given)."""
+        if chunk_size is None:
+            chunk_size = CHUNK_SIZE
+        self.disable()
         self.prompt_length = prompt_length
-        if prompt_length > CHUNK_SIZE:
-            self.total_chunks = (prompt_length + CHUNK_SIZE - 1) // CHUNK_SIZE
-            self.current_chunk = 0
-            self.chunk_size = CHUNK_SIZE
-        else:
-            self.total_chunks = 0
-            self.current_chunk = 0
-            self.chunk_size = 0
+        self.prompt_start = start
+        self.chunk_start = start
+        remaining = prompt_length - start
+        if remaining > chunk_size:
+            self.total_chunks = (remaining + chunk_size - 1) // chunk_size
+            self.chunk_size = chunk_size
+            self._sent()
 
     def is_active(self) -> bool:
         return self.total_chunks > 1
 
     def has_more(self) -> bool:
+        """Whether chunks remain to be sent."""
         return self.is_active() and self.current_chunk < self.total_chunks - 1
 
     def is_final(self) -> bool:
         return not self.is_active() or self.current_chunk == self.total_chunks - 1
 
+    def next_return_is_final(self) -> bool:
+        """Whether the next chunk to come back is the last one of the prompt."""
+        return not self.is_active() or self.chunks_done >= self.total_chunks - 1
+
+    def in_flight(self) -> int:
+        """Chunks sent into the pipe that have not come back yet."""
+        return len(self.chunk_ends) - self.chunks_done
+
     def get_range(self) -> tuple[int, int]:
         if not self.is_active():
-            return (0, self.prompt_length)
-        start = self.current_chunk * self.chunk_size
+            return (self.prompt_start, self.prompt_length)
+        start = min(self.chunk_start, self.prompt_length)
         end = min(start + self.chunk_size, self.prompt_length)
         return (start, end)
 
     def get_tokens_processed(self) -> int:
-        """Number of prompt tokens covered by chunks that have already finished."""
+        """Number of prompt tokens in the KV cache before the current chunk."""
         return self.get_range()[0]
 
+    def get_tokens_done(self) -> int:
+        """Number of prompt tokens the pipe holds the KV cache of: the prefix and the chunks that have come back."""
+        if self.chunks_done == 0:
+            return self.prompt_start
+        return self.chunk_ends[self.chunks_done - 1]
+
     def get_chunk_length(self) -> int:
         """Number of prompt tokens covered by the chunk currently being processed."""
         start, end = self.get_range()
         return end - start
 
-    def advance(self):
+    def advance(self, chunk_size: Optional[int] = None):
+        """Move on to the next chunk. A new `chunk_size` re-plans the rest of the
+        prompt in chunks of that size; the chunks already sent stay as they were."""
+        self.chunk_start = self.get_range()[1]
         self.current_chunk += 1
+        if not self.is_active():
+            return
+        if chunk_size is not None:
+            remaining = self.prompt_length - self.chunk_start
+            self.chunk_size = chunk_size
+            self.total_chunks = self.current_chunk + max(1, (remaining + chunk_size - 1) // chunk_size)
+        if self.current_chunk < self.total_chunks:
+            self._sent()
+
+    def finish_chunk(self) -> int:
+        """Mark the oldest chunk still in the pipe as back. Returns its length."""
+        if self.in_flight() <= 0:
+            return 0
+        start = self.get_tokens_done()
+        self.chunks_done += 1
+        return self.chunk_ends[self.chunks_done - 1] - start
+
+    def number(self, pass_id: int):
+        """Record the pass the chunk sent last goes out as."""
+        if len(self.chunk_passes) > 0:
+            self.chunk_passes[-1] = pass_id
+
+    def chunk_of(self, pass_id: int) -> Optional[int]:
+        """The chunk still in the pipe that went out as `pass_id`, if any."""
+        for chunk in range(self.chunks_done, len(self.chunk_passes)):
+            if self.chunk_passes[chunk] == pass_id:
+                return chunk
+        return None
+
+    def restart(self, chunk: int):
+        """Send the prompt again from `chunk` on, which was lost in the pipe.
+        The chunks sent after it ran without its KV, so they are sent again
+        too and their passes are stale."""
+        self.stale_passes.update(self.chunk_passes[chunk:])
+        self.chunk_start = self.prompt_start if chunk == 0 else self.chunk_ends[chunk - 1]
+        del self.chunk_ends[chunk:]
+        del self.sent_alone[chunk:]
+        del self.chunk_passes[chunk:]
+        self.current_chunk = chunk
+        remaining = self.prompt_length - self.chunk_start
+        self.total_chunks = chunk + max(1, (remaining + self.chunk_size - 1) // self.chunk_size)
+        self._sent()
+
+    def finished_alone(self) -> bool:
+        """Whether the chunk that came back last had the pipe to itself."""
+        return self.chunks_done > 0 and self.sent_alone[self.chunks_done - 1]
 
     def disable(self):
         self.current_chunk = 0
         self.total_chunks = 0
         self.chunk_size = 0
+        self.chunk_start = 0
+        self.prompt_start = 0
+        self.chunk_ends = []
+        self.sent_alone = []
+        self.chunks_done = 0
+        self.chunk_passes = []
+        self.stale_passes = set()
+
+    def _sent(self):
+        self.sent_alone.append(self.in_flight() == 0)
+        self.chunk_ends.append(self.get_range()[1])
+        self.chunk_passes.append(0)
@@ -1,12 +1,14 @@
 import json
 import time
 import threading
-from typing import Any, Callable, List, Optional
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
 
 from promise import Promise
 from http.server import BaseHTTPRequestHandler
 
 from language_pipes.jobs.job import Job
+from language_pipes.modeling.kv_session import session_key
 from language_pipes.util.chat import ChatMessage, ChatRole
 from language_pipes.util.http import _connection_alive, _respond_json, _send_code, _send_sse_headers
 from language_pipes.util.oai_chunks import send_complete, send_error, send_initial_chunk, send_keepalive, send_update_chunk
@@ -20,6 +22,9 @@ SSE_KEEPALIVE_INTERVAL = 10.0
 # (prefill) can run for a long time between update() calls, so this has to be
 # independent of per-token/per-chunk writes to catch a drop while it's happening.
 DISCONNECT_CHECK_INTERVAL = 1.0
+
+# Responses kept for `previous_response_id`, the least recently used go first
+MAX_STORED_RESPONSES = 1000
 from language_pipes.util.oai_tool_calls import (
     ReasoningStreamSplitter,
     ResponsesTool,
@@ -42,6 +47,7 @@ class ChatCompletionRequest:
     top_p: float
     min_p: float
     presence_penalty: float
+    session_id: Optional[str]
 
     def __init__(
             self, 
@@ -53,7 +59,8 @@ class ChatCompletionRequest:
             top_k: int = 0,
             top_p: float = 1.0,
             min_p: float = 0.0,
-            presence_penalty: float = 0.0
+            presence_penalty: float = 0.0,
+            session_id: Optional[str] = None
         ):
         self.model = model
         self.stream = stream
@@ -64,6 +71,7 @@ class ChatCompletionRequest:
         self.top_p = top_p
         self.min_p = min_p
         self.presence_penalty = presence_penalty
+        self.session_id = session_id
 
     def to_json(self):
         return {
@@ -75,7 +83,8 @@ class ChatCompletionRequest:
             'top_k': self.top_k,
             'top_p': self.top_p,
             'min_p': self.min_p,
-            'presence_penalty': self.presence_penalty
+            'presence_penalty': self.presence_penalty,
+            'session_id': self.session_id
         }
     
     @staticmethod
@@ -92,7 +101,10 @@ class ChatCompletionRequest:
         top_p = data['top_p'] if 'top_p' in data else 1.0
         min_p = data['min_p'] if 'min_p' in data else 0.0
         presence_penalty = data['presence_penalty'] if 'presence_penalty' in data else 0.0
-        return ChatCompletionRequest(data['model'], stream, max_completion_tokens, [ChatMessage.from_dict(m) for m in data['messages']], temperature, top_k, top_p, min_p, presence_penalty)
+        # Not an OpenAI field: the turns of a chat sent with the same
+        # session id go on from the KV cache of the turn before
+        session_id = str(data['session_id']) if data.get('session_id') is not None else None
+        return ChatCompletionRequest(data['model'], stream, max_completion_tokens, [ChatMessage.from_dict(m) for m in data['messages']], temperature, top_k, top_p, min_p, presence_penalty, session_id)
 
 def _content_to_text(content: Any) -> str:
     if isinstance(content, str):
@@ -155,11 +167,42 @@ def _response_input_to_messages(response_input: Any) -> List[ChatMessage]:
 
     return messages
 
+class ResponseHistory:
+    """The conversation of each stored response up to and including its
+    output, so a request with `previous_response_id` does not have to send
+    it again. Responses are kept by API key; only the last
+    MAX_STORED_RESPONSES are."""
+    responses: "OrderedDict[Tuple[str, str], List[ChatMessage]]"
+
+    def __init__(self, max_responses: int = MAX_STORED_RESPONSES):
+        self.max_responses = max_responses
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, api_key: str, response_id: str) -> Optional[List[ChatMessage]]:
+        with self.lock:
+            key = (api_key, response_id)
+            if key not in self.responses:
+                return None
+            self.responses.move_to_end(key)
+            return list(self.responses[key])
+
+    def store(self, api_key: str, response_id: str, messages: List[ChatMessage]):
+        with self.lock:
+            self.responses[(api_key, response_id)] = messages
+            self.responses.move_to_end((api_key, response_id))
+            while len(self.responses) > self.max_responses:
+                self.responses.popitem(last=False)
+
+RESPONSE_HISTORY = ResponseHistory()
+
 class ResponsesRequest:
     model: str
     stream: bool
     input: Any
     instructions: Optional[str]
+    # The turns of the conversation, without the system messages
+    conversation: List[ChatMessage]
     messages: List[ChatMessage]
     max_output_tokens: int
     temperature: float
@@ -170,6 +213,8 @@ class ResponsesRequest:
     tools: List[ResponsesTool]
     tool_choice: Any
     parallel_tool_calls: bool
+    previous_response_id: Optional[str]
+    store: bool
 
     def __init__(
             self,
@@ -186,7 +231,10 @@ class ResponsesRequest:
             presence_penalty: float = 0.0,
             tools: Optional[List[ResponsesTool]] = None,
             tool_choice: Any = None,
-            parallel_tool_calls: bool = False
+            parallel_tool_calls: bool = False,
+            conversation: Optional[List[ChatMessage]] = None,
+            previous_response_id: Optional[str] = None,
+            store: bool = True
         ):
         self.model = model
         self.stream = stream
@@ -202,9 +250,14 @@ class ResponsesRequest:
         self.tools = tools if tools is not None else []
         self.tool_choice = tool_choice
         self.parallel_tool_calls = parallel_tool_calls
+        self.conversation = conversation if conversation is not None else []
+        self.previous_response_id = previous_response_id
+        self.store = store
 
     @staticmethod
-    def from_dict(data):
+    def from_dict(data, history: Optional[List[ChatMessage]] = None):
+        """`history` is the conversation of `previous_response_id`; the
+        instructions and tools of the request go before it."""
         max_output_tokens = 1000
         if "max_tokens" in data:
             max_output_tokens = data['max_tokens']
@@ -228,7 +281,8 @@ class ResponsesRequest:
             tools = parse_tool_definitions(data['tools'])
             validate_tool_choice(tool_choice, tools)
 
-        messages = _response_input_to_messages(data['input'])
+        conversation = (history or []) + _response_input_to_messages(data['input'])
+        messages = list(conversation)
         if instructions is not None:
             messages.insert(0, ChatMessage(ChatRole.SYSTEM, str(instructions)))
         if len(tools) > 0:
@@ -240,7 +294,9 @@ class ResponsesRequest:
         if len(messages) == 0:
             raise ValueError("input must contain at least one text message")
 
-        return ResponsesRequest(data['model'], stream, data['input'], instructions, max_output_tokens, messages, temperature, top_k, top_p, min_p, presence_penalty, tools, tool_choice, parallel_tool_calls)
+        previous_response_id = data.get('previous_response_id')
+        store = data.get('store') is not False
+        return ResponsesRequest(data['model'], stream, data['input'], instructions, max_output_tokens, messages, temperature, top_k, top_p, min_p, presence_penalty, tools, tool_choice, parallel_tool_calls, conversation, previous_response_id, store)
 
 def _reasoning_item(job: Any, reasoning_text: str) -> dict:
     return {
@@ -292,6 +348,8 @@ def _response_json(job: Any, req: ResponsesRequest, created_at: float):
         "instructions": req.instructions,
         "max_output_tokens": req.max_output_tokens,
         "model": job.model_id,
+        "previous_response_id": req.previous_response_id,
+        "store": req.store,
         "output": response_output,
         "output_text": response_output_text,
         "usage": {
@@ -414,13 +472,23 @@ def oai_chat_complete(handler: BaseHTTPRequestHandler, complete_cb: Callable, da
                 })
 
     def promise_fn(resolve: Callable, _: Callable):
-        complete_cb(api_key, req.model, req.messages, req.max_completion_tokens, req.temperature, req.top_k, req.top_p, req.min_p, req.presence_penalty, start, update, resolve)
+        # Each turn keeps the session the next one goes on from
+        session = { } if req.session_id is None else { "session_id": req.session_id, "resume_session_id": req.session_id }
+        complete_cb(api_key, req.model, req.messages, req.max_completion_tokens, req.temperature, req.top_k, req.top_p, req.min_p, req.presence_penalty, start, update, resolve, **session)
     job = Promise(promise_fn).get()
     complete(job)
 
 def oai_responses_create(handler: BaseHTTPRequestHandler, complete_cb: Callable, data: dict, api_key: str):
+    history = None
+    previous_response_id = data.get('previous_response_id')
+    if previous_response_id is not None:
+        history = RESPONSE_HISTORY.get(api_key, str(previous_response_id))
+        if history is None:
+            _send_code(400, handler, f"previous response {previous_response_id} not found")
+            return
+
     try:
-        req = ResponsesRequest.from_dict(data)
+        req = ResponsesRequest.from_dict(data, history)
     except ValueError as e:
         _send_code(400, handler, str(e))
         return
@@ -522,6 +590,9 @@ def oai_responses_create(handler: BaseHTTPRequestHandler, complete_cb: Callable,
         stop_watchdog = _start_disconnect_watchdog(handler, job, req.stream, write_lock, last_write)
         sstate["reasoning_id"] = f"rs-{job.job_id}"
         sstate["message_id"] = f"msg-{job.job_id}"
+        if req.store:
+            # The nodes keep the KV cache for a request that continues this response
+            job.session_id = session_key(api_key, f"resp-{job.job_id}")
         if not req.stream:
             return
         with write_lock:
@@ -536,6 +607,8 @@ def oai_responses_create(handler: BaseHTTPRequestHandler, complete_cb: Callable,
                 "instructions": req.instructions,
                 "max_output_tokens": req.max_output_tokens,
                 "model": job.model_id,
+                "previous_response_id": req.previous_response_id,
+                "store": req.store,
                 "output": [],
                 "output_text": ""
             }
@@ -696,13 +769,16 @@ def oai_responses_create(handler: BaseHTTPRequestHandler, complete_cb: Callable,
                 _respond_json(handler, { "error": job.cancel_reason })
         else:
             response = _response_json(job, req, created_at)
+            if req.store:
+                RESPONSE_HISTORY.store(api_key, response["id"], req.conversation + [ChatMessage(ChatRole.ASSISTANT, job.result)])
             if req.stream:
                 complete_stream(job, response)
             else:
                 _respond_json(handler, response)
 
     def promise_fn(resolve: Callable, _: Callable):
-        complete_cb(api_key, req.model, req.messages, req.max_output_tokens, req.temperature, req.top_k, req.top_p, req.min_p, req.presence_penalty, start, update, resolve)
+        session = { } if req.previous_response_id is None else { "resume_session_id": req.previous_response_id }
+        complete_cb(api_key, req.model, req.messages, req.max_output_tokens, req.temperature, req.top_k, req.top_p, req.min_p, req.presence_penalty, start, update, resolve, **session)
     job = Promise(promise_fn).get()
     complete(job)
 
@@ -0,0 +1,161 @@
+import os
+import sys
+import unittest
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'tests', 'language_pipes', 'unit'))
+
+from language_pipes.jobs.job_processor import JobState, run_batch
+from language_pipes.util.enums import ComputeStep
+
+from util import make_processor, make_job, make_job_data, BatchingModel, FakeModel, FakeEndModel, FakeEndModelContinue, PipeWrapper
+
+
+def make_layer_job(job_id: str, tokens: int = 1, current_layer: int = 1):
+    """A job that has arrived from upstream for `current_layer`."""
+    job = make_job(origin_node_id="node-origin")
+    job.job_id = job_id
+    job.compute_step = ComputeStep.LAYER
+    job.current_layer = current_layer
+    job.data = make_job_data()
+    job.data.state = torch.zeros((1, tokens, 4))
+    return job
+
+
+def make_head_job(job_id: str, complete=None):
+    """A decode step that has come back to its origin for the next token."""
+    job = make_job(origin_node_id="node-1", complete=complete)
+    job.job_id = job_id
+    job.compute_step = ComputeStep.HEAD
+    job.input_ids = [0, 1]
+    job.prompt_tokens = 1
+    job.current_token = 1
+    job.data = make_job_data()
+    return job
+
+
+class TestRunBatch(unittest.TestCase):
+    def setUp(self):
+        self.first = FakeModel("node-origin", 0, 0, virtual=True, num_hidden_layers=3)
+        self.model = BatchingModel("node-1", 1, 1, num_hidden_layers=3)
+        self.last = FakeModel("node-2", 2, 2, virtual=True, num_hidden_layers=3)
+        self.pipe = PipeWrapper("node-1", "model-a", [self.first, self.model, self.last])
+
+    def test_decode_steps_for_the_same_segment_share_one_forward(self):
+        jobs = [make_layer_job("job-1"), make_layer_job("job-2"), make_layer_job("job-3")]
+        processors = [make_processor(job=j, pipe=self.pipe, end_model=None) for j in jobs]
+
+        run_batch(processors)
+
+        self.assertEqual(self.model.batches, [["job-1", "job-2", "job-3"]])
+        self.assertEqual(self.model.singles, [])
+        for p in processors:
+            self.assertEqual(p.state, JobState.DONE)
+            self.assertEqual(p.ctx.job.current_layer, 2)
+        self.assertEqual(len(self.pipe.sent_jobs), 3)
+
+    def test_prefill_and_decode_batch_separately(self):
+        jobs = [
+            make_layer_job("job-1"), make_layer_job("prefill-1", tokens=4),
+            make_layer_job("job-2"), make_layer_job("prefill-2", tokens=2),
+        ]
+        processors = [make_processor(job=j, pipe=self.pipe, end_model=None) for j in jobs]
+
+        run_batch(processors)
+
+        self.assertEqual(sorted(self.model.batches), [["job-1", "job-2"], ["prefill-1", "prefill-2"]])
+        self.assertEqual(self.model.singles, [])
+
+    def test_batched_jobs_follow_the_same_transitions_as_run(self):
+        jobs = [make_layer_job("job-1"), make_layer_job("job-2")]
+        processors = [make_processor(job=j, pipe=self.pipe, end_model=None) for j in jobs]
+
+        run_batch(processors)
+
+        for p in processors:
+            self.assertEqual(p.states, [JobState.VALIDATING, JobState.SEND])
+
+    def test_canceled_job_leaves_the_batch(self):
+        jobs = [make_layer_job("job-1"), make_layer_job("job-2"), make_layer_job("job-3")]
+        jobs[1].cancel_reason = "client went away"
+        processors = [make_processor(job=j, pipe=self.pipe, end_model=None) for j in jobs]
+
+        run_batch(processors)
+
+        self.assertEqual(self.model.batches, [["job-1", "job-3"]])
+        self.assertEqual(len(self.pipe.sent_jobs), 2)
+
+    def test_failed_batch_stops_only_its_jobs(self):
+        def fail(jobs):
+            raise RuntimeError("boom")
+        self.model.process_jobs = fail
+        other_model = BatchingModel("node-1", 2, 2, num_hidden_layers=3)
+        pipe = PipeWrapper("node-1", "model-a", [self.first, self.model, other_model])
+
+        jobs = [make_layer_job("job-1"), make_layer_job("job-2"), make_layer_job("job-3", current_layer=2)]
+        processors = [make_processor(job=j, pipe=pipe, end_model=None) for j in jobs]
+
+        run_batch(processors)
+
+        for p in processors:
+            self.assertEqual(p.state, JobState.DONE)
+        self.assertEqual(other_model.singles, ["job-3"])
+        self.assertEqual(len(pipe.sent_jobs), 1)
+
+
+class TestRunBatchOrigin(unittest.TestCase):
+    def setUp(self):
+        self.remote = FakeModel("node-2", 0, 0, virtual=True, num_hidden_layers=1)
+        self.pipe = PipeWrapper("node-1", "model-a", [self.remote])
+
+    def batch_calls(self, end_model):
+        return [c for c in end_model.calls if isinstance(c, tuple)]
+
+    def test_head_and_next_embed_run_as_one_batch(self):
+        end_model = FakeEndModelContinue()
+        jobs = [make_head_job("job-1"), make_head_job("job-2")]
+        processors = [make_processor(job=j, pipe=self.pipe, end_model=end_model) for j in jobs]
+
+        run_batch(processors)
+
+        self.assertEqual(self.batch_calls(end_model), [
+            ("compute_norm_batch", ["job-1", "job-2"]),
+            ("compute_head_batch", ["job-1", "job-2"]),
+            ("compute_embed_batch", ["job-1", "job-2"]),
+        ])
+        for p in processors:
+            self.assertEqual(p.state, JobState.DONE)
+            self.assertEqual(p.ctx.job.compute_step, ComputeStep.LAYER)
+        self.assertEqual(len(self.pipe.sent_jobs), 2)
+
+    def test_completed_jobs_leave_before_embed(self):
+        completed = []
+        end_model = FakeEndModel()
+        jobs = [make_head_job("job-1", complete=lambda j: completed.append(j.job_id)),
+                make_head_job("job-2", complete=lambda j: completed.append(j.job_id))]
+        processors = [make_processor(job=j, pipe=self.pipe, end_model=end_model) for j in jobs]
+
+        run_batch(processors)
+
+        self.assertEqual(completed, ["job-1", "job-2"])
+        self.assertNotIn("compute_embed_batch", [c[0] for c in self.batch_calls(end_model)])
+        self.assertEqual(self.pipe.sent_jobs, [])
+
+    def test_prompt_embed_does_not_join_decode_embeds(self):
+        end_model = FakeEndModelContinue()
+        prefill = make_job(origin_node_id="node-1")
+        prefill.job_id = "prefill"
+        jobs = [prefill, make_head_job("job-1"), make_head_job("job-2")]
+        processors = [make_processor(job=j, pipe=self.pipe, end_model=end_model) for j in jobs]
+
+        run_batch(processors)
+
+        self.assertIn(("compute_embed_batch", ["job-1", "job-2"]), end_model.calls)
+        self.assertIn("tokenize", end_model.calls)
+        self.assertEqual(len(self.pipe.sent_jobs), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,10 +6,13 @@ from unittest.mock import patch
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'src'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'tests', 'language_pipes', 'unit'))
 
-from language_pipes.jobs.job_processor import JobState
+import torch
+from transformers import PretrainedConfig
+
+from language_pipes.jobs.job_processor import JobState, get_next_state
 from language_pipes.util.enums import ComputeStep
 
-from util import make_processor, make_job, FakeEndModel, FakeModel, PipeWrapper
+from util import make_processor, make_job, make_job_data, FakeEndModel, FakeModel, PipeWrapper
 
 class TestEmbedState(unittest.TestCase):
     """Tests for the _state_embed method."""
@@ -24,7 +27,8 @@ class TestEmbedState(unittest.TestCase):
 
         job = make_job(update=fail_update)
         job.origin_node_id = "node-1"
-        job.compute_step = ComputeStep.EMBED
+        # The first of two prefill chunks came back through the pipe
+        job.compute_step = ComputeStep.HEAD
         job.prompt_tokens = 2
         job.current_token = 0
         job.init_chunking()
@@ -73,6 +77,20 @@ class TestEmbedState(unittest.TestCase):
 
         self.assertEqual(next_state, JobState.SEND)
 
+    def test_each_embedded_pass_gets_a_new_number(self):
+        job = make_job()
+        job.origin_node_id = "node-1"
+        job.compute_step = ComputeStep.EMBED
+        job.prompt_tokens = 1
+        virtual_model = FakeModel("node-b", 0, 0, virtual=True, num_hidden_layers=1)
+        pipe = PipeWrapper("node-a", "model-a", [virtual_model])
+
+        make_processor(job=job, pipe=pipe, end_model=FakeEndModel())._state_embed()
+        job.compute_step = ComputeStep.EMBED
+        make_processor(job=job, pipe=pipe, end_model=FakeEndModel())._state_embed()
+
+        self.assertEqual(job.pass_id, 2)
+
     def test_transitions_to_process_layers_for_local_layer(self):
         job = make_job()
         job.origin_node_id = "node-1"
@@ -174,6 +192,251 @@ class TestEmbedState(unittest.TestCase):
         )
         self.assertEqual(job.current_layer, 1)
 
+class FakeChunkSizer:
+    def __init__(self, size: int):
+        self.size = size
+        self.recorded = []
+
+    def chunk_size(self):
+        return self.size
+
+    def record(self, completed):
+        self.recorded.append(completed)
+
+class LongPromptEndModel(FakeEndModel):
+    def tokenize(self, job):
+        self.calls.append("tokenize")
+        job.input_ids = list(range(10))
+        job.prompt_tokens = len(job.input_ids)
+        job.next_step()
+
+class TestEmbedChunkSizing(unittest.TestCase):
+    """The pipe's chunk sizer picks the chunk size when the prompt is
+    tokenized and again after every chunk."""
+
+    def make(self, sizer: FakeChunkSizer):
+        job = make_job()
+        job.origin_node_id = "node-1"
+        job.compute_step = ComputeStep.TOKENIZE
+        pipe = PipeWrapper("node-a", "model-a", [FakeModel("node-b", 0, 0, virtual=True, num_hidden_layers=1)])
+        processor = make_processor(job=job, pipe=pipe, end_model=LongPromptEndModel())
+        processor.ctx.chunk_sizer = sizer  # pyright: ignore[reportAttributeAccessIssue]
+        return job, processor
+
+    def test_first_chunk_uses_the_sizers_size(self):
+        job, processor = self.make(FakeChunkSizer(4))
+
+        processor._state_embed()
+
+        self.assertEqual(job.chunking.get_range(), (0, 4))
+        self.assertEqual(job.chunking.total_chunks, 3)
+        self.assertEqual(job.timing_stats.prefill_chunk_size, 4)
+
+    def test_prompt_tokenized_by_the_job_factory_is_chunked_too(self):
+        job, processor = self.make(FakeChunkSizer(4))
+        job.input_ids = list(range(10))
+        job.prompt_tokens = 10
+
+        processor._state_embed()
+
+        self.assertEqual(job.chunking.get_range(), (0, 4))
+        self.assertEqual(job.chunking.total_chunks, 3)
+
+    def test_finished_chunk_is_recorded_and_the_rest_resized(self):
+        sizer = FakeChunkSizer(4)
+        job, processor = self.make(sizer)
+        processor._state_embed()
+
+        sizer.size = 6
+        job.compute_step = ComputeStep.HEAD
+        processor._state_embed()
+
+        self.assertEqual([p.token_count for p in sizer.recorded], [4])
+        self.assertEqual(job.chunking.get_range(), (4, 10))
+        self.assertFalse(job.chunking.has_more())
+        self.assertEqual(job.timing_stats.prefill_chunk_size, 6)
+
+class TestEmbedAdmission(unittest.TestCase):
+    """A new job is checked against the node's memory once its prompt is tokenized."""
+
+    def make(self, admit: bool):
+        job = make_job()
+        job.origin_node_id = "node-1"
+        job.compute_step = ComputeStep.TOKENIZE
+        pipe = PipeWrapper("node-a", "model-a", [FakeModel("node-b", 0, 0, virtual=True, num_hidden_layers=1)])
+        end_model = FakeEndModel()
+        processor = make_processor(job=job, pipe=pipe, end_model=end_model)
+        admitted = []
+
+        def admit_job(j):
+            admitted.append(j.prompt_tokens)
+            return admit
+
+        processor.ctx.admit_job = admit_job  # pyright: ignore[reportAttributeAccessIssue]
+        return job, processor, end_model, admitted
+
+    def test_admitted_job_is_embedded(self):
+        _, processor, end_model, admitted = self.make(True)
+
+        self.assertEqual(processor._state_embed(), JobState.SEND)
+        self.assertEqual(admitted, [2])
+        self.assertIn("compute_embed", end_model.calls)
+
+    def test_job_that_is_not_let_in_stops_before_embedding(self):
+        _, processor, end_model, _ = self.make(False)
+
+        self.assertEqual(processor._state_embed(), JobState.DONE)
+        self.assertNotIn("compute_embed", end_model.calls)
+
+    def test_resumed_job_is_not_checked_again(self):
+        job, processor, end_model, admitted = self.make(False)
+        processor._state_embed()
+
+        # The job comes back once memory is free, still at its first step
+        processor.ctx.admit_job = None  # pyright: ignore[reportAttributeAccessIssue]
+        self.assertEqual(processor._state_embed(), JobState.SEND)
+        self.assertEqual(admitted, [2])
+        self.assertEqual(end_model.calls.count("tokenize"), 1)
+
+class TestEmbedPark(unittest.TestCase):
+    """A decoding job can be held at the origin between two passes while its KV cache moves."""
+
+    def make(self, park: bool):
+        job = make_job()
+        job.origin_node_id = "node-1"
+        job.compute_step = ComputeStep.EMBED
+        job.current_token = 1
+        job.input_ids = [1, 2, 3]
+        pipe = PipeWrapper("node-a", "model-a", [FakeModel("node-b", 0, 0, virtual=True, num_hidden_layers=1)])
+        end_model = FakeEndModel()
+        processor = make_processor(job=job, pipe=pipe, end_model=end_model)
+        processor.ctx.park_job = lambda j: park  # pyright: ignore[reportAttributeAccessIssue]
+        return job, processor, end_model
+
+    def test_held_job_stops_before_its_next_pass(self):
+        job, processor, end_model = self.make(True)
+
+        self.assertEqual(processor._state_embed(), JobState.DONE)
+        self.assertNotIn("compute_embed", end_model.calls)
+        self.assertEqual(job.passes_sent, 0)
+
+    def test_job_that_is_not_held_goes_on(self):
+        job, processor, end_model = self.make(False)
+
+        self.assertEqual(processor._state_embed(), JobState.SEND)
+        self.assertIn("compute_embed", end_model.calls)
+        self.assertEqual(job.passes_sent, 1)
+
+class TestEmbedReplay(unittest.TestCase):
+    """A job that failed over layers 2-3 replays its 10 tokens in chunks of 4."""
+
+    def make(self):
+        job = make_job(config=PretrainedConfig(num_hidden_layers=6))
+        job.origin_node_id = "node-1"
+        job.input_ids = list(range(10))
+        job.prompt_tokens = 7
+        job.current_token = 3
+        job.start_replay(2, 4, 4)
+        pipe = PipeWrapper("node-a", "model-a", [
+            FakeModel("node-b", 0, 1, virtual=True, num_hidden_layers=6),
+            FakeModel("node-c", 2, 3, virtual=True, num_hidden_layers=6),
+            FakeModel("node-d", 4, 5, virtual=True, num_hidden_layers=6)
+        ])
+        end_model = FakeEndModel()
+        processor = make_processor(job=job, pipe=pipe, end_model=end_model)
+        processor.ctx.chunk_sizer = FakeChunkSizer(4)  # pyright: ignore[reportAttributeAccessIssue]
+        return job, processor, end_model
+
+    def come_back(self, job):
+        job.compute_step = ComputeStep.HEAD
+        job.current_layer = 0
+        job.data = make_job_data()
+        job.data.state = torch.arange(8.0).reshape(1, 2, 4)
+
+    def test_first_chunk_is_sent_from_the_start_of_the_pipe(self):
+        job, processor, end_model = self.make()
+
+        self.assertEqual(processor._state_embed(), JobState.SEND)
+        self.assertEqual(job.chunking.get_range(), (0, 4))
+        self.assertEqual(job.passes_sent, 1)
+        self.assertIn("compute_embed", end_model.calls)
+
+    def test_chunk_that_comes_back_is_followed_by_the_next(self):
+        job, processor, _ = self.make()
+        processor._state_embed()
+        self.come_back(job)
+
+        self.assertEqual(get_next_state(processor.ctx), JobState.EMBED)
+        self.assertEqual(processor._state_embed(), JobState.SEND)
+        self.assertEqual(job.chunking.get_range(), (4, 8))
+        self.assertTrue(job.replaying())
+
+    def test_last_chunk_goes_on_from_the_rebuilt_layers_as_a_decode_pass(self):
+        job, processor, _ = self.make()
+        processor._state_embed()
+        for _ in range(3):
+            self.come_back(job)
+            processor._state_embed()
+
+        self.assertFalse(job.replaying())
+        self.assertEqual(job.current_layer, 4)
+        self.assertEqual(job.compute_step, ComputeStep.LAYER)
+        assert job.data is not None
+        self.assertTrue(torch.equal(job.data.state, torch.tensor([[[4.0, 5.0, 6.0, 7.0]]])))
+        self.assertEqual(job.past_seen_tokens(), 9)
+        self.assertEqual(job.passes_sent, 4)
+
+class TestEmbedLostChunk(unittest.TestCase):
+    """A 10-token prompt in chunks of 4 on a pipe of three nodes, with every
+    chunk in flight when the second one is sent back to be redone."""
+
+    def make(self):
+        failed = []
+        job = make_job()
+        job.origin_node_id = "node-1"
+        job.compute_step = ComputeStep.TOKENIZE
+        pipe = PipeWrapper("node-a", "model-a", [
+            FakeModel("node-b", 0, 0, virtual=True, num_hidden_layers=3),
+            FakeModel("node-c", 1, 1, virtual=True, num_hidden_layers=3),
+            FakeModel("node-d", 2, 2, virtual=True, num_hidden_layers=3)
+        ])
+        processor = make_processor(job=job, pipe=pipe, end_model=LongPromptEndModel(), on_fail=lambda j, reason: failed.append(reason))
+        processor.ctx.chunk_sizer = FakeChunkSizer(4)  # pyright: ignore[reportAttributeAccessIssue]
+        processor._state_embed()
+        for _ in range(2):
+            # The last chunk left and the next one follows it
+            job.compute_step = ComputeStep.LAYER
+            processor._state_embed()
+        self.assertEqual(job.chunking.in_flight(), 3)
+        return job, processor, failed
+
+    def send_back(self, job, pass_id: int):
+        job.compute_step = ComputeStep.EMBED
+        job.current_layer = 0
+        job.pass_id = pass_id
+
+    def test_prompt_is_sent_again_from_the_lost_chunk(self):
+        job, processor, failed = self.make()
+        self.send_back(job, 2)
+
+        self.assertEqual(processor._state_embed(), JobState.SEND)
+
+        self.assertEqual(failed, [])
+        self.assertEqual(job.chunking.get_range(), (4, 8))
+        self.assertEqual(job.chunking.in_flight(), 2)
+        self.assertTrue(job.chunking.has_more())
+        self.assertEqual(job.passes_sent, 4)
+        self.assertEqual(job.chunking.chunk_of(4), 1)
+        # The chunk sent after it ran without its KV
+        self.assertEqual(job.chunking.stale_passes, {2, 3})
+
+    def test_unknown_pass_still_fails_the_job(self):
+        job, processor, failed = self.make()
+        self.send_back(job, 9)
+
+        self.assertEqual(processor._state_embed(), JobState.DONE)
+        self.assertEqual(failed, ["prefill chunk lost in the pipe"])
+
 class TestEmbedPrefillIntegration(unittest.TestCase):
     """Integration tests for embed state during prefill operations."""
 
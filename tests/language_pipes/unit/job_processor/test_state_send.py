@@ -1,14 +1,15 @@
 import os
 import sys
 import unittest
+from unittest.mock import patch
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'src'))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', 'tests', 'language_pipes', 'unit'))
 
-from language_pipes.jobs.job_processor import JobState
-from language_pipes.util.enums import ComputeStep
+from language_pipes.jobs.job_processor import JobContext, JobProcessor, JobState
+from language_pipes.util.enums import ComputeStep, JobStatus
 
-from util import make_processor, make_job, make_job_data, FakeModel, PipeWrapper
+from util import make_processor, make_job, make_job_data, mock_complete, FakeEndModel, FakeModel, PipeWrapper
 
 class TestSendState(unittest.TestCase):
     """Tests for the _state_send method."""
@@ -29,6 +30,31 @@ class TestSendState(unittest.TestCase):
         self.assertEqual(next_state, JobState.DONE)
         self.assertEqual(pipe.calls, ["send job"])
 
+    def test_hands_off_to_the_send_stage(self):
+        job = make_job()
+        job.compute_step = ComputeStep.LAYER
+        job.current_layer = 1
+        job.data = make_job_data()
+
+        local_model = FakeModel("node-a", 0, 0, virtual=False, num_hidden_layers=2)
+        remote_model = FakeModel("node-b", 1, 1, virtual=True, num_hidden_layers=2)
+        pipe = PipeWrapper("node-a", "model-a", [local_model, remote_model])
+        handed_off = []
+        processor = JobProcessor(JobContext(
+            node_id="node-a",
+            job=job,
+            pipe=pipe,
+            end_model=None,
+            send_job=lambda p, j, node_id: handed_off.append((p, j, node_id))
+        ))
+
+        next_state = processor._state_send()
+
+        self.assertEqual(next_state, JobState.DONE)
+        self.assertEqual(handed_off, [(pipe, job, "node-b")])
+        # Encoding and sending are left to the send stage
+        self.assertEqual(pipe.calls, [])
+
     def test_routes_tokenize_job_to_next_node_when_origin_mismatch(self):
         job = make_job(origin_node_id="node-b")
         job.compute_step = ComputeStep.TOKENIZE
@@ -48,3 +74,89 @@ class TestSendState(unittest.TestCase):
         self.assertEqual(processor.states, [JobState.VALIDATING, JobState.SEND])
         self.assertEqual(processor.state, JobState.DONE)
         self.assertEqual(pipe.calls, ["send job"])
+
+class LongPromptEndModel(FakeEndModel):
+    def tokenize(self, job):
+        self.calls.append("tokenize")
+        job.input_ids = list(range(100))
+        job.prompt_tokens = len(job.input_ids)
+        job.next_step()
+
+@patch("language_pipes.util.chunk_state.CHUNK_SIZE", 32)
+class TestPipelinedPrefill(unittest.TestCase):
+    """The origin sends the next prefill chunk as soon as the last one has
+    left, keeping up to one chunk per node on the pipe in flight."""
+
+    def make(self, node_ids):
+        job = make_job(origin_node_id="node-1", complete=mock_complete)
+        job.compute_step = ComputeStep.TOKENIZE
+        num_layers = len(node_ids)
+        segments = [FakeModel(node_id, i, i, virtual=True, num_hidden_layers=num_layers) for i, node_id in enumerate(node_ids)]
+        pipe = PipeWrapper("node-1", "model-a", segments)
+        return job, pipe
+
+    def come_back(self, job, pipe):
+        """The oldest chunk in flight returns from the last node."""
+        job.compute_step = ComputeStep.HEAD
+        job.current_layer = 0
+        processor = make_processor(job=job, pipe=pipe, end_model=LongPromptEndModel())
+        processor.run()
+        return processor.states
+
+    def test_sends_one_chunk_per_node_without_waiting(self):
+        job, pipe = self.make(["node-b", "node-c"])
+        processor = make_processor(job=job, pipe=pipe, end_model=LongPromptEndModel())
+
+        processor.run()
+
+        self.assertEqual(processor.states, [JobState.VALIDATING, JobState.EMBED, JobState.SEND, JobState.EMBED, JobState.SEND])
+        self.assertEqual(processor.state, JobState.DONE)
+        self.assertEqual(len(pipe.sent_jobs), 2)
+        self.assertEqual(job.chunking.in_flight(), 2)
+        self.assertEqual(job.chunking.get_range(), (32, 64))
+
+    def test_single_node_pipe_sends_chunks_one_at_a_time(self):
+        job, pipe = self.make(["node-b"])
+        processor = make_processor(job=job, pipe=pipe, end_model=LongPromptEndModel())
+
+        processor.run()
+
+        self.assertEqual(processor.states, [JobState.VALIDATING, JobState.EMBED, JobState.SEND])
+        self.assertEqual(job.chunking.in_flight(), 1)
+
+    def test_each_returning_chunk_makes_room_for_the_next(self):
+        job, pipe = self.make(["node-b", "node-c"])
+        make_processor(job=job, pipe=pipe, end_model=LongPromptEndModel()).run()
+
+        self.assertEqual(self.come_back(job, pipe), [JobState.VALIDATING, JobState.EMBED, JobState.SEND])
+        self.assertEqual(job.chunking.get_range(), (64, 96))
+        self.assertEqual(self.come_back(job, pipe), [JobState.VALIDATING, JobState.EMBED, JobState.SEND])
+        self.assertEqual(job.chunking.get_range(), (96, 100))
+        self.assertEqual(len(pipe.sent_jobs), 4)
+
+        # Nothing left to send: the chunk is retired and the job waits for the last one
+        self.assertEqual(self.come_back(job, pipe), [JobState.VALIDATING, JobState.EMBED])
+        self.assertEqual(job.chunking.get_tokens_done(), 96)
+        self.assertEqual(job.status, JobStatus.IN_PROGRESS)
+
+        self.assertEqual(self.come_back(job, pipe), [JobState.VALIDATING, JobState.HEAD])
+        self.assertEqual(job.status, JobStatus.COMPLETED)
+        self.assertEqual(len(pipe.sent_jobs), 4)
+
+    def test_chunk_sent_back_to_be_redone_is_sent_again_with_the_chunks_after_it(self):
+        job, pipe = self.make(["node-b", "node-c"])
+        make_processor(job=job, pipe=pipe, end_model=LongPromptEndModel()).run()
+        failures = []
+
+        # A node got a corrupt copy of the first chunk and asks for it again
+        job.compute_step = ComputeStep.EMBED
+        job.current_layer = 0
+        job.pass_id = 1
+        processor = make_processor(job=job, pipe=pipe, end_model=LongPromptEndModel(), on_fail=lambda j, reason: failures.append(reason))
+        processor.run()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(processor.states, [JobState.VALIDATING, JobState.EMBED, JobState.SEND, JobState.EMBED, JobState.SEND])
+        self.assertEqual([j.pass_id for j in pipe.sent_jobs], [1, 2, 3, 4])
+        self.assertEqual(job.chunking.stale_passes, {1, 2})
+        self.assertEqual(job.chunking.in_flight(), 2)
@@ -0,0 +1,91 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+from language_pipes.config import DEFAULT_MAX_PREFILL_CHUNK, DEFAULT_MIN_PREFILL_CHUNK
+from language_pipes.jobs.chunk_sizer import ChunkSizer, PassSample
+from language_pipes.jobs.completed_pass import CompletedPass
+from language_pipes.jobs.job_time import JobTime
+
+START = 1000.0
+
+
+def make_time(node_id: str, receive_ms: float, compute_ms: float) -> JobTime:
+    time = JobTime(node_id=node_id)
+    time.receive_time = START + receive_ms / 1000.0
+    time.send_time = time.receive_time + compute_ms / 1000.0
+    return time
+
+
+def record(sizer: ChunkSizer, tokens: int, compute_ms: float, overhead_ms: float):
+    """A pass that spent `compute_ms` on one node and `overhead_ms` everywhere else."""
+    completed = CompletedPass(0, tokens, tokens > 1, [make_time("node-a", 0, compute_ms)])
+    sizer.record(completed, START + (compute_ms + overhead_ms) / 1000.0)
+
+
+class PassSampleTests(unittest.TestCase):
+    def test_splits_compute_from_the_rest_of_the_round_trip(self):
+        completed = CompletedPass(0, 32, True, [
+            make_time("node-a", 0, 5),
+            make_time("node-b", 40, 20),
+            make_time("node-c", 100, 15),
+        ])
+
+        sample = PassSample.from_pass(completed, START + 0.150)
+
+        assert sample is not None
+        self.assertEqual(sample.tokens, 32)
+        self.assertAlmostEqual(sample.compute_ms, 40, places=3)
+        self.assertAlmostEqual(sample.overhead_ms, 110, places=3)
+
+    def test_pass_without_timings_is_skipped(self):
+        self.assertIsNone(PassSample.from_pass(CompletedPass(0, 1, False, []), START))
+
+
+class ChunkSizerTests(unittest.TestCase):
+    def test_starts_at_the_minimum(self):
+        self.assertEqual(ChunkSizer().chunk_size(), DEFAULT_MIN_PREFILL_CHUNK)
+
+    def test_high_latency_pipe_gets_large_chunks(self):
+        sizer = ChunkSizer()
+        # 200 ms of round trips per pass against 1 ms of compute per token
+        record(sizer, 32, 32, 200)
+
+        self.assertEqual(sizer.chunk_size(), DEFAULT_MAX_PREFILL_CHUNK)
+
+    def test_fast_pipe_keeps_small_chunks(self):
+        sizer = ChunkSizer()
+        record(sizer, 32, 32, 2)
+
+        self.assertEqual(sizer.chunk_size(), DEFAULT_MIN_PREFILL_CHUNK)
+
+    def test_fits_fixed_and_per_token_cost_across_pass_sizes(self):
+        sizer = ChunkSizer(lambda: 1, lambda: 1000)
+        # compute 9 ms + 1 ms/token, overhead 49.5 ms + 0.5 ms/token
+        for _ in range(4):
+            record(sizer, 1, 10, 50)
+        record(sizer, 33, 42, 66)
+
+        estimate = sizer.estimate()
+
+        assert estimate is not None
+        self.assertAlmostEqual(estimate[0], 58.5, places=3)
+        self.assertAlmostEqual(estimate[1], 1.5, places=3)
+        # 58.5 ms is a fifth of a pass once a chunk takes 234 ms of tokens
+        self.assertEqual(sizer.chunk_size(), 156)
+
+    def test_bounds_are_read_each_time(self):
+        bounds = [64, 128]
+        sizer = ChunkSizer(lambda: bounds[0], lambda: bounds[1])
+        record(sizer, 32, 32, 200)
+        self.assertEqual(sizer.chunk_size(), 128)
+
+        bounds[1] = 16
+        # A maximum below the minimum gives way to the minimum
+        self.assertEqual(sizer.chunk_size(), 64)
+
+
+if __name__ == "__main__":
+    unittest.main()
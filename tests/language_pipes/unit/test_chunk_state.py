@@ -56,5 +56,90 @@ class TestChunkState(unittest.TestCase):
         self.assertTrue(state.is_final())
         self.assertEqual(state.get_range(), (0, 70))
 
+    def test_explicit_chunk_size(self):
+        state = ChunkState("job-1")
+        state.init(70, 50)
+
+        self.assertEqual(state.total_chunks, 2)
+        self.assertEqual(state.get_range(), (0, 50))
+
+    def test_resizing_replans_only_the_rest_of_the_prompt(self):
+        state = self.make(100)
+        state.advance(16)
+
+        self.assertEqual(state.get_range(), (32, 48))
+        self.assertEqual(state.total_chunks, 1 + 5)
+
+        ranges = [state.get_range()]
+        while state.has_more():
+            state.advance(48)
+            ranges.append(state.get_range())
+
+        self.assertEqual(ranges, [(32, 48), (48, 96), (96, 100)])
+
+    def test_chunks_come_back_in_the_order_they_were_sent(self):
+        state = self.make(70)
+        state.advance()
+        state.advance()
+        self.assertEqual(state.in_flight(), 3)
+        self.assertFalse(state.has_more())
+
+        self.assertEqual(state.finish_chunk(), 32)
+        self.assertEqual(state.get_tokens_done(), 32)
+        self.assertFalse(state.next_return_is_final())
+        self.assertEqual(state.finish_chunk(), 32)
+        self.assertTrue(state.next_return_is_final())
+        self.assertEqual(state.finish_chunk(), 6)
+        self.assertEqual(state.in_flight(), 0)
+        self.assertEqual(state.get_tokens_done(), 70)
+
+    def test_only_a_chunk_sent_into_an_empty_pipe_went_alone(self):
+        state = self.make(100)
+        state.advance()
+        state.finish_chunk()
+        state.finish_chunk()
+        state.advance()
+        state.advance()
+
+        alone = []
+        while state.in_flight() > 0:
+            state.finish_chunk()
+            alone.append(state.finished_alone())
+
+        self.assertEqual(alone, [True, False])
+
+    def test_lost_chunk_is_sent_again_with_the_chunks_after_it(self):
+        state = self.make(100)
+        for pass_id in range(1, 4):
+            state.number(pass_id)
+            if pass_id < 3:
+                state.advance()
+        state.finish_chunk()
+
+        self.assertIsNone(state.chunk_of(1))
+        self.assertEqual(state.chunk_of(2), 1)
+        state.restart(1)
+
+        self.assertEqual(state.get_range(), (32, 64))
+        self.assertEqual(state.in_flight(), 1)
+        self.assertEqual(state.total_chunks, 4)
+        self.assertEqual(state.stale_passes, {2, 3})
+        self.assertIsNone(state.chunk_of(3))
+
+    def test_prefill_starts_after_a_cached_prefix(self):
+        state = ChunkState("job-1")
+        state.init(70, start=16)
+
+        self.assertEqual(state.total_chunks, 2)
+        self.assertEqual(state.get_tokens_done(), 16)
+        self.assertEqual(state.get_range(), (16, 48))
+        state.advance()
+        self.assertEqual(state.get_range(), (48, 70))
+
+        state.init(40, start=16)
+        self.assertFalse(state.is_active())
+        self.assertEqual(state.get_range(), (16, 40))
+        self.assertEqual(state.get_tokens_processed(), 16)
+
 if __name__ == "__main__":
     unittest.main()
@@ -14,9 +14,26 @@ from language_pipes.util.config import (
 from language_pipes.config import (
     LpConfig,
     EndModelConfig,
+    ModelToLoad,
     DEFAULT_NUM_LOCAL_LAYERS,
     DEFAULT_MAX_NODE_JOBS,
     DEFAULT_MAX_API_JOBS,
+    DEFAULT_MAX_BATCH_SIZE,
+    DEFAULT_SEGMENT_PROCESSES,
+    DEFAULT_MIN_PREFILL_CHUNK,
+    DEFAULT_MAX_PREFILL_CHUNK,
+    DEFAULT_MAX_DEVICE_MEMORY,
+    DEFAULT_ROUND_TOKEN_BUDGET,
+    DEFAULT_MAX_PREFILL_SHARE,
+    DEFAULT_KV_CACHE_DTYPE,
+    DEFAULT_PIPE_ROLE,
+    DEFAULT_KV_SINK_TOKENS,
+    DEFAULT_KV_WINDOW_TOKENS,
+    DEFAULT_MAX_KV_MEMORY,
+    DEFAULT_KV_SPILL_POLICY,
+    DEFAULT_PREFIX_CACHE_MEMORY,
+    DEFAULT_SESSION_KV_MEMORY,
+    DEFAULT_SESSION_KV_TTL,
 )
 
 
@@ -76,6 +93,201 @@ class MaxApiJobsTests(unittest.TestCase):
             self.assertEqual(reloaded.max_api_jobs, 2)
 
 
+class MaxBatchSizeTests(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(LpConfig().max_batch_size, DEFAULT_MAX_BATCH_SIZE)
+
+    def test_config_field_overrides_default(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.max_batch_size = 1
+            cfg.save()
+
+            reloaded = LpConfig.from_file(path)
+            self.assertEqual(reloaded.max_batch_size, 1)
+
+
+class SchedulingRoundTests(unittest.TestCase):
+    def test_defaults(self):
+        cfg = LpConfig()
+        self.assertEqual(cfg.round_token_budget, DEFAULT_ROUND_TOKEN_BUDGET)
+        self.assertEqual(cfg.max_prefill_share, DEFAULT_MAX_PREFILL_SHARE)
+
+    def test_config_fields_override_defaults(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.round_token_budget = 64
+            cfg.max_prefill_share = 0.25
+            cfg.save()
+
+            reloaded = LpConfig.from_file(path)
+            self.assertEqual(reloaded.round_token_budget, 64)
+            self.assertEqual(reloaded.max_prefill_share, 0.25)
+
+
+class SegmentProcessesTests(unittest.TestCase):
+    def test_defaults_to_off(self):
+        self.assertEqual(LpConfig().segment_processes, DEFAULT_SEGMENT_PROCESSES)
+        self.assertFalse(DEFAULT_SEGMENT_PROCESSES)
+
+    def test_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.segment_processes = True
+            cfg.save()
+
+            self.assertTrue(LpConfig.from_file(path).segment_processes)
+
+
+class PrefillChunkTests(unittest.TestCase):
+    def test_defaults(self):
+        cfg = LpConfig()
+        self.assertEqual(cfg.min_prefill_chunk, DEFAULT_MIN_PREFILL_CHUNK)
+        self.assertEqual(cfg.max_prefill_chunk, DEFAULT_MAX_PREFILL_CHUNK)
+
+    def test_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.min_prefill_chunk = 16
+            cfg.max_prefill_chunk = 1024
+            cfg.save()
+
+            reloaded = LpConfig.from_file(path)
+            self.assertEqual(reloaded.min_prefill_chunk, 16)
+            self.assertEqual(reloaded.max_prefill_chunk, 1024)
+
+
+class MaxDeviceMemoryTests(unittest.TestCase):
+    def test_default(self):
+        self.assertEqual(LpConfig().max_device_memory, DEFAULT_MAX_DEVICE_MEMORY)
+
+    def test_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.max_device_memory = 12.5
+            cfg.save()
+
+            self.assertEqual(LpConfig.from_file(path).max_device_memory, 12.5)
+
+class KvSpillTests(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(LpConfig().max_kv_memory, DEFAULT_MAX_KV_MEMORY)
+        self.assertEqual(LpConfig().kv_spill_policy, DEFAULT_KV_SPILL_POLICY)
+
+    def test_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.max_kv_memory = 4
+            cfg.kv_spill_policy = "largest"
+            cfg.save()
+
+            reloaded = LpConfig.from_file(path)
+            self.assertEqual(reloaded.max_kv_memory, 4)
+            self.assertEqual(reloaded.kv_spill_policy, "largest")
+
+class PrefixCacheMemoryTests(unittest.TestCase):
+    def test_default_is_off(self):
+        self.assertEqual(LpConfig().prefix_cache_memory, DEFAULT_PREFIX_CACHE_MEMORY)
+        self.assertEqual(DEFAULT_PREFIX_CACHE_MEMORY, 0)
+
+    def test_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.prefix_cache_memory = 2
+            cfg.save()
+
+            self.assertEqual(LpConfig.from_file(path).prefix_cache_memory, 2)
+
+class SessionKvTests(unittest.TestCase):
+    def test_defaults_keep_no_sessions(self):
+        cfg = LpConfig()
+        self.assertEqual(cfg.session_kv_memory, DEFAULT_SESSION_KV_MEMORY)
+        self.assertEqual(DEFAULT_SESSION_KV_MEMORY, 0)
+        self.assertEqual(cfg.session_kv_ttl, DEFAULT_SESSION_KV_TTL)
+
+    def test_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.session_kv_memory = 1.5
+            cfg.session_kv_ttl = 120
+            cfg.save()
+
+            reloaded = LpConfig.from_file(path)
+            self.assertEqual(reloaded.session_kv_memory, 1.5)
+            self.assertEqual(reloaded.session_kv_ttl, 120)
+
+class KvCacheDtypeTests(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(EndModelConfig(model_id="org/model").kv_cache_dtype, DEFAULT_KV_CACHE_DTYPE)
+        self.assertEqual(ModelToLoad.from_dict({"model_id": "org/model"}).kv_cache_dtype, DEFAULT_KV_CACHE_DTYPE)
+
+    @mock.patch.dict(os.environ, {}, clear=True)
+    def test_round_trips_for_layer_and_end_models(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.layer_models = [ModelToLoad.from_dict({"model_id": "org/model", "kv_cache_dtype": "int8"})]
+            cfg.end_models = [EndModelConfig(model_id="org/model", kv_cache_dtype="fp8")]
+            cfg.save()
+
+            reloaded = LpConfig.from_file(path)
+            self.assertEqual(reloaded.layer_models[0].kv_cache_dtype, "int8")
+            self.assertEqual(reloaded.end_models[0].kv_cache_dtype, "fp8")
+
+class PipeRoleTests(unittest.TestCase):
+    def test_layer_models_join_any_pipe_by_default(self):
+        self.assertEqual(ModelToLoad.from_dict({"model_id": "org/model"}).role, DEFAULT_PIPE_ROLE)
+
+    @mock.patch.dict(os.environ, {}, clear=True)
+    def test_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.layer_models = [ModelToLoad.from_dict({"model_id": "org/model", "role": "prefill"})]
+            cfg.save()
+
+            reloaded = LpConfig.from_file(path)
+            self.assertEqual(reloaded.layer_models[0].role, "prefill")
+
+class KvWindowTests(unittest.TestCase):
+    def test_defaults_keep_every_token(self):
+        model = EndModelConfig(model_id="org/model")
+        self.assertEqual(model.kv_sink_tokens, DEFAULT_KV_SINK_TOKENS)
+        self.assertEqual(model.kv_window_tokens, DEFAULT_KV_WINDOW_TOKENS)
+        self.assertEqual(model.to_config(), "org/model")
+
+    @mock.patch.dict(os.environ, {}, clear=True)
+    def test_round_trips(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "config.toml"
+            cfg = LpConfig()
+            cfg._file_path = path
+            cfg.end_models = [EndModelConfig(model_id="org/model", kv_sink_tokens=32, kv_window_tokens=4096)]
+            cfg.save()
+
+            reloaded = LpConfig.from_file(path)
+            self.assertEqual(reloaded.end_models[0].kv_sink_tokens, 32)
+            self.assertEqual(reloaded.end_models[0].kv_window_tokens, 4096)
+            self.assertIn("32 sink + 4096 window tokens", reloaded.to_string())
+
 class EightBitModeTests(unittest.TestCase):
     @mock.patch.dict(os.environ, {}, clear=True)
     def test_defaults_to_false(self):
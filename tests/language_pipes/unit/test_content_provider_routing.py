@@ -8,17 +8,56 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'sr
 
 from language_pipes.content_provider.content_provider import ContentProvider
 from language_pipes.jobs.job_cancel import JobCancel
+from language_pipes.jobs.job_credit import CREDIT_PROTOCOL
+from language_pipes.jobs.job_migration import MIGRATE_PROTOCOL
 from language_pipes.jobs.job_receiver import CANCEL_PROTOCOL
+from language_pipes.jobs.prefix_match import PREFIX_PROTOCOL, SESSION_PROTOCOL
 from language_pipes.util.byte_helper import ByteHelper
 
 
+class FakeCreditExchange:
+    def __init__(self):
+        self.credits = []
+
+    def receive_credit(self, node_id, data):
+        self.credits.append((node_id, data))
+        return b"OK 3"
+
+
+class FakePrefixMatcher:
+    def __init__(self):
+        self.queries = []
+        self.sessions = []
+
+    def receive_prefix(self, node_id, data):
+        self.queries.append((node_id, data))
+        return b"2"
+
+    def receive_session(self, node_id, data):
+        self.sessions.append((node_id, data))
+        return b"40"
+
+
+class FakeJobMigration:
+    def __init__(self):
+        self.messages = []
+
+    def receive_migrate(self, node_id, data):
+        self.messages.append((node_id, data))
+        return b"OK"
+
+
 class FakeJobReceiver:
     def __init__(self):
         self.jobs = []
         self.cancels = []
+        self.credit = FakeCreditExchange()
+        self.prefixes = FakePrefixMatcher()
+        self.migration = FakeJobMigration()
 
     def receive_data(self, node_id, data):
         self.jobs.append((node_id, data))
+        return b"BUSY"
 
     def receive_cancel(self, node_id, data):
         self.cancels.append((node_id, data))
@@ -55,11 +94,45 @@ class ReceiveDataRoutingTests(unittest.TestCase):
     def test_routes_job_protocol_to_the_receiver(self):
         provider, receiver = make_provider()
 
-        provider._receive_data("node-b", framed(0, b"job-payload"))
+        reply = provider._receive_data("node-b", framed(0, b"job-payload"))
 
         self.assertEqual(receiver.jobs, [("node-b", b"job-payload")])
+        # The receiver's answer goes back to the sender
+        self.assertEqual(reply, b"BUSY")
         self.assertEqual(receiver.cancels, [])
 
+    def test_routes_credit_protocol_to_the_receiver(self):
+        provider, receiver = make_provider()
+
+        reply = provider._receive_data("node-b", framed(CREDIT_PROTOCOL, b"credit"))
+
+        self.assertEqual(receiver.credit.credits, [("node-b", b"credit")])
+        self.assertEqual(reply, b"OK 3")
+
+    def test_routes_prefix_protocol_to_the_receiver(self):
+        provider, receiver = make_provider()
+
+        reply = provider._receive_data("node-b", framed(PREFIX_PROTOCOL, b"hashes"))
+
+        self.assertEqual(receiver.prefixes.queries, [("node-b", b"hashes")])
+        self.assertEqual(reply, b"2")
+
+    def test_routes_session_protocol_to_the_receiver(self):
+        provider, receiver = make_provider()
+
+        reply = provider._receive_data("node-b", framed(SESSION_PROTOCOL, b"session"))
+
+        self.assertEqual(receiver.prefixes.sessions, [("node-b", b"session")])
+        self.assertEqual(reply, b"40")
+
+    def test_routes_migrate_protocol_to_the_receiver(self):
+        provider, receiver = make_provider()
+
+        reply = provider._receive_data("node-b", framed(MIGRATE_PROTOCOL, b"part"))
+
+        self.assertEqual(receiver.migration.messages, [("node-b", b"part")])
+        self.assertEqual(reply, b"OK")
+
 
 if __name__ == "__main__":
     unittest.main()
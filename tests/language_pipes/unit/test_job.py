@@ -4,9 +4,15 @@ import unittest
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
 
+from unittest.mock import patch
+
 from transformers import PretrainedConfig
 
 from language_pipes.jobs.job import Job
+from language_pipes.jobs.job_progress import JobProgress
+from language_pipes.jobs.network_job import NetworkJob
+from language_pipes.modeling.kv_session import SessionKVCache
+from language_pipes.util.byte_helper import ByteHelper
 from language_pipes.util.enums import ComputeStep, JobStatus
 from language_pipes.util.utils import CHUNK_SIZE
 
@@ -102,6 +108,36 @@ class JobCompletedPassTests(unittest.TestCase):
         self.assertEqual(len(relay.timing_stats.output_times.token_ms), 1)
 
 
+class JobPassNumberTests(unittest.TestCase):
+    def test_origin_numbers_each_pass(self):
+        job = make_job()
+
+        job.number_pass()
+        job.number_pass()
+
+        self.assertEqual(job.to_network_job().pass_id, 2)
+
+    def test_relay_sends_on_the_number_it_got(self):
+        origin = make_job()
+        origin.number_pass()
+        relay = make_relay(origin)
+
+        relay.receive_network_job(origin.to_network_job(), "node-b")
+
+        self.assertEqual(relay.to_network_job().pass_id, 1)
+
+    def test_origin_keeps_numbering_after_an_older_pass_comes_back(self):
+        job = make_job()
+        job.number_pass()
+        first = job.to_network_job()
+        job.number_pass()
+
+        job.receive_network_job(first, "node-a")
+        job.number_pass()
+
+        self.assertEqual(job.pass_id, 3)
+
+
 class JobProgressTests(unittest.TestCase):
     """A node hosting only layers never runs the tokenizer or the head, so its own
     `current_token` and `chunking` stay at zero for the life of the job."""
@@ -123,6 +159,9 @@ class JobProgressTests(unittest.TestCase):
         origin.prompt_tokens = CHUNK_SIZE * 4
         origin.init_chunking()
         origin.chunking.advance()
+        origin.chunking.advance()
+        # The first chunk is back, the second and third are still in the pipe
+        origin.chunking.finish_chunk()
         relay = make_relay(origin)
 
         relay.receive_network_job(origin.to_network_job(), "node-b")
@@ -133,8 +172,8 @@ class JobProgressTests(unittest.TestCase):
         self.assertEqual(progress.prompt_tokens, CHUNK_SIZE * 4)
 
     def test_relay_routing_state_is_left_untouched(self):
-        # `set_layer` asks `chunking.has_more()` whether a finished layer pass goes
-        # back to the origin, so a mirrored chunk state would misroute it
+        # The processor asks the chunk state whether a pass that came back is a
+        # finished prefill chunk, so a mirrored chunk state would misroute it
         origin = make_job()
         origin.prompt_tokens = CHUNK_SIZE * 4
         origin.init_chunking()
@@ -171,6 +210,26 @@ class JobProgressTests(unittest.TestCase):
         self.assertEqual(relay.display_progress().current_token, 2)
 
 
+    def test_relay_learns_how_long_the_job_may_run(self):
+        origin = make_job()
+        origin.prompt_tokens = 40
+        origin.max_completion_tokens = 256
+        relay = make_relay(origin)
+
+        relay.receive_network_job(NetworkJob.from_bytes(origin.to_network_job().to_bytes())[0], "node-b")
+
+        self.assertEqual(relay.display_progress().max_completion_tokens, 256)
+
+    def test_report_from_an_older_peer_has_no_completion_limit(self):
+        bts = ByteHelper()
+        for value in (3, 40, 0, 0):
+            bts.write_int(value)
+
+        progress = JobProgress.from_bytes(bts.get_bytes())
+
+        self.assertEqual(progress.prompt_tokens, 40)
+        self.assertEqual(progress.max_completion_tokens, 0)
+
 class JobPastSeenTokensTests(unittest.TestCase):
     """`past_seen_tokens` has to be derived from job state, not from `job.cache`:
     a node only populates the cache layers it hosts, and a hybrid
@@ -226,6 +285,33 @@ class JobPastSeenTokensTests(unittest.TestCase):
 
         self.assertEqual(job.past_seen_tokens(), CHUNK_SIZE * 2)
 
+class JobSessionTests(unittest.TestCase):
+    def test_session_keeps_every_token_but_the_last(self):
+        job = make_job()
+        job.session_id = "session-1"
+        job.input_ids = list(range(12))
+        job.current_token = 2
+        sessions = SessionKVCache(lambda: 1024**3, lambda: 600)
+
+        with patch("language_pipes.jobs.job.SESSION_KV_CACHE", sessions), patch.object(job.cache, "release") as release:
+            job.keep_session()
+            job.release_cache()
+
+        self.assertTrue(job.session_kept)
+        self.assertEqual(sessions.ids("session-1"), list(range(11)))
+        release.assert_not_called()
+
+    def test_job_without_generated_tokens_keeps_nothing(self):
+        job = make_job()
+        job.session_id = "session-1"
+        job.input_ids = list(range(12))
+        sessions = SessionKVCache(lambda: 1024**3, lambda: 600)
+
+        with patch("language_pipes.jobs.job.SESSION_KV_CACHE", sessions):
+            job.keep_session()
+
+        self.assertFalse(job.session_kept)
+
 
 if __name__ == "__main__":
     unittest.main()
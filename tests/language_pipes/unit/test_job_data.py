@@ -40,6 +40,23 @@ class JobDataTests(unittest.TestCase):
             self.assertTrue(torch.equal(restored.position_ids, job_data.position_ids))
             self.assertTrue(torch.equal(restored.cache_position, job_data.cache_position))
 
+    def test_prefix_round_trips(self):
+        job_data = JobData(
+            state=torch.ones((1, 2)),
+            position_ids=torch.tensor([0, 1]),
+            cache_position=torch.tensor([32, 33]),
+            causal_mask={},
+            position_embeddings={},
+            prefix_hashes=[b"a" * 16, b"b" * 16],
+            prefix_tokens=32
+        )
+
+        restored = JobData.from_bytes(job_data.to_bytes())
+
+        assert restored is not None
+        self.assertEqual(restored.prefix_hashes, [b"a" * 16, b"b" * 16])
+        self.assertEqual(restored.prefix_tokens, 32)
+
 
 if __name__ == "__main__":
     unittest.main()
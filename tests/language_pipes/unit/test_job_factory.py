@@ -6,8 +6,11 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'sr
 
 from transformers import PretrainedConfig
 
+from language_pipes.jobs.job import Job
 from language_pipes.jobs.job_factory import JobFactory
 from language_pipes.jobs.job_tracker import JobTracker
+from language_pipes.modeling.kv_session import session_key
+from language_pipes.util.enums import ComputeStep
 
 
 class FakeCollector:
@@ -18,6 +21,17 @@ class FakeEndModel:
     def __init__(self):
         self.layers = []
         self.collector = FakeCollector()
+        self.kv_sink_tokens = 0
+        self.kv_window_tokens = 0
+
+    def tokenize_prompt(self, job):
+        job.input_ids = [1, 2, 3]
+        job.prompt_tokens = len(job.input_ids)
+
+
+class BrokenTokenizerEndModel(FakeEndModel):
+    def tokenize_prompt(self, job):
+        raise Exception("template error")
 
 
 class FakePipe:
@@ -39,14 +53,20 @@ class RecordingPipe(FakePipe):
     def __init__(self, tracker):
         self.tracker = tracker
         self.tracked_on_send = None
+        self.prompt_tokens_on_send = None
 
     def send_job(self, network_job, node_id):
         self.tracked_on_send = self.tracker.get_job(network_job.job_id)
+        if self.tracked_on_send is not None:
+            self.prompt_tokens_on_send = self.tracked_on_send.prompt_tokens
 
 
 class FakeModelManager:
+    def __init__(self, end_model=None):
+        self.end_model = end_model
+
     def get_end_model(self, model_id):
-        return FakeEndModel()
+        return self.end_model or FakeEndModel()
 
 
 class FakeRouter:
@@ -59,8 +79,8 @@ class FakeRouterPipes:
 
 
 class FakePipeManager:
-    def __init__(self, pipe=None):
-        self.model_manager = FakeModelManager()
+    def __init__(self, pipe=None, end_model=None):
+        self.model_manager = FakeModelManager(end_model)
         self.router_pipes = FakeRouterPipes()
         self.pipe = pipe or FakePipe()
 
@@ -74,11 +94,22 @@ def make_factory(max_api_jobs: int = 5, pipe=None):
     return JobFactory(tracker, FakePipeManager(pipe), lambda: max_api_jobs)  # pyright: ignore[reportArgumentType]
 
 
+def fill_key(tracker: JobTracker, api_key: str, count: int):
+    for _ in range(count):
+        tracker.track_job(api_key, Job(
+            origin_node_id="node-a",
+            messages=[],
+            pipe_id="pipe-1",
+            model_id="model-1",
+            config=PretrainedConfig(num_hidden_layers=1)
+        ))
+
+
 class MaxApiJobsTests(unittest.TestCase):
     def test_rejects_when_key_over_limit(self):
         factory = make_factory(max_api_jobs=2)
         # Pre-fill the key past the limit (limit is 2, guard trips at > 2).
-        factory.job_tracker.jobs_pending["key-1"] = ["j0", "j1", "j2"] # pyright: ignore[reportArgumentType]
+        fill_key(factory.job_tracker, "key-1", 3)
 
         resolved = []
         factory.start_job(
@@ -99,11 +130,11 @@ class MaxApiJobsTests(unittest.TestCase):
 
         self.assertIsNotNone(job)
         self.assertNotIn("MAX_JOBS", resolved)
-        self.assertEqual(len(factory.job_tracker.jobs_pending["key-1"]), 1)
+        self.assertEqual(factory.job_tracker.count_jobs("key-1"), 1)
 
     def test_limit_is_per_api_key(self):
         factory = make_factory(max_api_jobs=2)
-        factory.job_tracker.jobs_pending["key-1"] = ["j0", "j1", "j2"] # pyright: ignore[reportArgumentType]
+        fill_key(factory.job_tracker, "key-1", 3)
 
         resolved = []
         # A different key is unaffected by key-1 being over the limit.
@@ -113,7 +144,7 @@ class MaxApiJobsTests(unittest.TestCase):
         )
 
         self.assertIsNotNone(job)
-        self.assertEqual(len(factory.job_tracker.jobs_pending["key-2"]), 1)
+        self.assertEqual(factory.job_tracker.count_jobs("key-2"), 1)
 
 
 class DispatchOrderTests(unittest.TestCase):
@@ -153,7 +184,56 @@ class DispatchOrderTests(unittest.TestCase):
         self.assertIsNone(job)
         self.assertEqual(len(resolved), 1)
         self.assertEqual(resolved[0].cancel_reason, "could not send job to pipe")
-        self.assertEqual(factory.job_tracker.jobs_pending["key-1"], [])
+        self.assertEqual(factory.job_tracker.jobs_for_key("key-1"), [])
+
+    def test_session_ids_are_scoped_to_the_api_key(self):
+        factory = make_factory()
+
+        job = factory.start_job("key-1", "model-1", [], max_completion_tokens=8, session_id="chat", resume_session_id="chat")
+
+        assert job is not None
+        self.assertEqual(job.session_id, session_key("key-1", "chat"))
+        self.assertEqual(job.resume_session_id, job.session_id)
+
+    def test_jobs_take_the_kv_window_of_their_end_model(self):
+        end_model = FakeEndModel()
+        end_model.kv_sink_tokens = 16
+        end_model.kv_window_tokens = 64
+        tracker = JobTracker()
+        tracker.shutdown = True
+        factory = JobFactory(tracker, FakePipeManager(end_model=end_model), lambda: 5)  # pyright: ignore[reportArgumentType]
+
+        job = factory.start_job("key-1", "model-1", [], max_completion_tokens=8)
+
+        assert job is not None
+        self.assertEqual(job.kv_bound_tokens(), 80)
+        self.assertEqual(job.get_progress().kv_bound_tokens, 80)
+
+
+class TokenizeTests(unittest.TestCase):
+    def test_prompt_is_tokenized_before_the_job_is_sent(self):
+        tracker = JobTracker()
+        tracker.shutdown = True
+        pipe = RecordingPipe(tracker)
+        factory = JobFactory(tracker, FakePipeManager(pipe), lambda: 5)  # pyright: ignore[reportArgumentType]
+
+        job = factory.start_job("key-1", "model-1", [], max_completion_tokens=8)
+
+        assert job is not None
+        self.assertEqual(pipe.prompt_tokens_on_send, 3)
+        self.assertEqual(job.compute_step, ComputeStep.TOKENIZE)
+
+    def test_prompt_that_fails_to_tokenize_is_left_to_the_worker(self):
+        tracker = JobTracker()
+        tracker.shutdown = True
+        pipe_manager = FakePipeManager(end_model=BrokenTokenizerEndModel())
+        factory = JobFactory(tracker, pipe_manager, lambda: 5)  # pyright: ignore[reportArgumentType]
+
+        job = factory.start_job("key-1", "model-1", [], max_completion_tokens=8)
+
+        assert job is not None
+        self.assertEqual(job.prompt_tokens, 0)
+        self.assertIsNone(job.cancel_reason)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,305 @@
+import os
+import sys
+import threading
+import unittest
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+from language_pipes.jobs.job_data import JobData
+from language_pipes.jobs.job_queue import QUANTUM_TOKENS, JobQueue, api_key_flow
+from language_pipes.jobs.network_job import NetworkJob
+from language_pipes.util.enums import ComputeStep
+
+
+def make_packet(job_id: str, origin: str = "node-a", tokens: int = 1, data_hash: bytes = b"") -> NetworkJob:
+    return NetworkJob(
+        job_id=job_id,
+        pipe_id="pipe-1",
+        origin_node_id=origin,
+        current_layer=0,
+        data=JobData(
+            state=torch.zeros((1, tokens, 4)),
+            cache_position=torch.arange(tokens),
+            position_ids=torch.arange(tokens).unsqueeze(0),
+            causal_mask={},
+            position_embeddings={}
+        ),
+        data_hash=data_hash,
+        compute_step=ComputeStep.LAYER,
+        times=[],
+    )
+
+
+def by_tokens(network_job: NetworkJob):
+    assert network_job.data is not None
+    return network_job.data.state.shape[1]
+
+
+def drain(queue: JobQueue):
+    ids = []
+    while len(queue) > 0:
+        packet = queue.get(0)
+        assert packet is not None
+        ids.append(packet.job_id)
+    return ids
+
+
+class JobQueueTests(unittest.TestCase):
+    def test_keeps_arrival_order_within_an_origin(self):
+        queue = JobQueue(lambda j: None)
+        for i in range(3):
+            queue.put("node-b", make_packet(f"job-{i}"), 10)
+
+        self.assertEqual(drain(queue), ["job-0", "job-1", "job-2"])
+
+    def test_origins_take_turns(self):
+        queue = JobQueue(lambda j: None)
+        for i in range(QUANTUM_TOKENS * 2):
+            queue.put("node-b", make_packet(f"a-{i}", origin="node-a"), 100)
+        queue.put("node-b", make_packet("c-0", origin="node-c"), 100)
+
+        order = drain(queue)
+
+        # node-a spends one quantum and then node-c is served, however long
+        # node-a's backlog is.
+        self.assertEqual(order.index("c-0"), QUANTUM_TOKENS)
+        self.assertEqual([i for i in order if i.startswith("a")], [f"a-{i}" for i in range(QUANTUM_TOKENS * 2)])
+
+    def test_origins_share_in_proportion_to_their_weights(self):
+        queue = JobQueue(lambda j: None, get_flow_weights=lambda: {"node-a": 3})
+        for i in range(QUANTUM_TOKENS * 8):
+            queue.put("node-b", make_packet(f"a-{i}", origin="node-a"), 1000)
+            queue.put("node-b", make_packet(f"c-{i}", origin="node-c"), 1000)
+
+        order = drain(queue)[:QUANTUM_TOKENS * 8]
+
+        # node-a gets three decode steps for each one of node-c
+        self.assertEqual(len([i for i in order if i.startswith("a")]), QUANTUM_TOKENS * 6)
+
+    def test_flows_of_one_origin_take_turns(self):
+        queue = JobQueue(lambda j: None)
+        flow_a = api_key_flow("node-a", "key-a")
+        flow_b = api_key_flow("node-a", "key-b")
+        for i in range(QUANTUM_TOKENS * 2):
+            queue.put("node-a", make_packet(f"a-{i}"), 100, flow_a)
+        queue.put("node-a", make_packet("b-0"), 100, flow_b)
+
+        self.assertNotEqual(flow_a, flow_b)
+        self.assertEqual(drain(queue).index("b-0"), QUANTUM_TOKENS)
+
+    def test_api_key_flow_takes_its_node_weight(self):
+        queue = JobQueue(lambda j: None, get_flow_weights=lambda: {"node-a": 3})
+        for i in range(QUANTUM_TOKENS * 8):
+            queue.put("node-a", make_packet(f"a-{i}"), 1000, api_key_flow("node-a", "key-a"))
+            queue.put("node-b", make_packet(f"c-{i}", origin="node-c"), 1000)
+
+        order = drain(queue)[:QUANTUM_TOKENS * 8]
+
+        self.assertEqual(len([i for i in order if i.startswith("a")]), QUANTUM_TOKENS * 6)
+
+    def test_long_prefill_does_not_starve_decode_steps(self):
+        queue = JobQueue(lambda j: None)
+        for i in range(4):
+            queue.put("node-b", make_packet(f"chunk-{i}", origin="node-a", tokens=QUANTUM_TOKENS), 10)
+        for i in range(4):
+            queue.put("node-b", make_packet(f"decode-{i}", origin="node-c"), 10)
+
+        order = drain(queue)
+
+        # All of the decode steps cost less than one chunk, so they are served
+        # before the prompt's second chunk.
+        self.assertLess(order.index("decode-3"), order.index("chunk-1"))
+
+    def test_rejects_duplicate_packets(self):
+        queue = JobQueue(lambda j: None)
+
+        self.assertTrue(queue.put("node-b", make_packet("job-1"), 10))
+        self.assertFalse(queue.put("node-c", make_packet("job-1"), 10))
+        self.assertEqual(len(queue), 1)
+
+    def test_passes_of_one_job_run_in_arrival_order(self):
+        queue = JobQueue(lambda j: None, lambda: 64, lambda: 0.1)
+        queue.put("node-b", make_packet("job-0", tokens=32), 10)
+        # A prompt's last chunk can be a single token, which waits in the
+        # decode lane while the chunk before it is still in the prefill lane
+        queue.put("node-b", make_packet("job-1", tokens=32, data_hash=b"chunk-0"), 10)
+        queue.put("node-b", make_packet("job-1", tokens=1, data_hash=b"chunk-1"), 10)
+
+        order = []
+        while len(queue) > 0:
+            packet = queue.get(0)
+            assert packet is not None
+            order.append((packet.job_id, packet.data_hash))
+
+        self.assertEqual(order, [("job-0", b""), ("job-1", b"chunk-0"), ("job-1", b"chunk-1")])
+        self.assertEqual(queue.job_ids(), [])
+
+    def test_take_leaves_later_passes_of_a_job_behind(self):
+        queue = JobQueue(by_tokens)
+        queue.put("node-b", make_packet("job-1", tokens=2, data_hash=b"pass-0"), 10)
+        queue.put("node-b", make_packet("job-1", data_hash=b"pass-1"), 10)
+        queue.put("node-b", make_packet("job-2"), 10)
+        queue.put("node-b", make_packet("job-3"), 10)
+
+        taken = queue.take(1, 8, exclude=("job-3",))
+
+        self.assertEqual([j.job_id for j in taken], ["job-2"])
+        self.assertEqual(sorted(queue.job_ids()), ["job-1", "job-3"])
+
+    def test_limit_is_per_sender(self):
+        queue = JobQueue(lambda j: None)
+        for i in range(3):
+            queue.put("node-b", make_packet(f"b-{i}"), 2)
+
+        with self.assertRaisesRegex(Exception, "Maximum number of jobs for node reached"):
+            queue.put("node-b", make_packet("b-3"), 2)
+        self.assertTrue(queue.put("node-c", make_packet("c-0"), 2))
+
+    def test_take_pulls_only_the_batch_class(self):
+        queue = JobQueue(by_tokens)
+        queue.put("node-b", make_packet("decode-1"), 10)
+        queue.put("node-b", make_packet("chunk", tokens=4), 10)
+        queue.put("node-c", make_packet("decode-2", origin="node-c"), 10)
+
+        taken = queue.take(1, 8)
+
+        self.assertEqual([j.job_id for j in taken], ["decode-1", "decode-2"])
+        self.assertEqual(queue.job_ids(), ["chunk"])
+
+    def test_remove_drops_the_packet_everywhere(self):
+        queue = JobQueue(by_tokens)
+        queue.put("node-b", make_packet("job-1"), 10)
+        queue.put("node-b", make_packet("job-2"), 10)
+
+        self.assertTrue(queue.remove("job-1"))
+        self.assertFalse(queue.remove("job-1"))
+
+        self.assertEqual(queue.depth("node-b"), 1)
+        self.assertEqual([j.job_id for j in queue.take(1, 8)], ["job-2"])
+        self.assertEqual(len(queue), 0)
+
+    def test_get_times_out_when_empty(self):
+        queue = JobQueue(lambda j: None)
+
+        self.assertIsNone(queue.get(0.01))
+
+    def test_get_wakes_when_a_packet_arrives(self):
+        queue = JobQueue(lambda j: None)
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(queue.get(5)))
+        waiter.start()
+
+        queue.put("node-b", make_packet("job-1"), 10)
+        waiter.join(5)
+
+        self.assertEqual([j.job_id for j in got], ["job-1"])
+
+    def test_close_wakes_waiters(self):
+        queue = JobQueue(lambda j: None)
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(queue.get(5)))
+        waiter.start()
+
+        queue.close()
+        waiter.join(5)
+
+        self.assertEqual(got, [None])
+
+    def test_stats_report_depth_and_waits(self):
+        queue = JobQueue(lambda j: None)
+        queue.put("node-b", make_packet("job-1", origin="node-a"), 10)
+        queue.put("node-b", make_packet("job-2", origin="node-c"), 10)
+        queue.get(0)
+
+        stats = queue.stats()
+
+        self.assertEqual(stats.depth, 1)
+        self.assertEqual(sum(stats.flows.values()), 1)
+        self.assertGreaterEqual(stats.max_wait, stats.avg_wait)
+        self.assertGreaterEqual(stats.oldest_wait, 0)
+
+
+    def test_counts_the_bytes_of_waiting_packets(self):
+        queue = JobQueue(lambda j: None)
+        queue.put("node-b", make_packet("job-1", tokens=8), 10)
+        queue.put("node-b", make_packet("job-2", tokens=1), 10)
+        # Hidden state, cache positions and position ids of each packet
+        first = 8 * 4 * 4 + 8 * 8 * 2
+
+        self.assertEqual(queue.buffered_bytes(), first + 1 * 4 * 4 + 1 * 8 * 2)
+
+        queue.get(0)
+        queue.remove("job-2")
+
+        self.assertEqual(queue.buffered_bytes(), 0)
+
+def drain_tokens(queue: JobQueue, count: int):
+    """Take `count` packets and report the token cost of each, signed: prefill
+    chunks positive, decode steps negative."""
+    costs = []
+    for _ in range(count):
+        packet = queue.get(0)
+        assert packet is not None and packet.data is not None
+        tokens = packet.data.state.shape[1]
+        costs.append(tokens if tokens > 1 else -1)
+    return costs
+
+
+class PrefillDecodeInterleavingTests(unittest.TestCase):
+    def fill(self, queue: JobQueue, chunks: int, decodes: int, chunk_tokens: int = 32):
+        for i in range(chunks):
+            queue.put("node-b", make_packet(f"chunk-{i}", origin="node-a", tokens=chunk_tokens), 1000)
+        for i in range(decodes):
+            queue.put("node-b", make_packet(f"decode-{i}", origin="node-c"), 1000)
+
+    def test_prefill_and_decode_interleave_at_the_prefill_share(self):
+        queue = JobQueue(lambda j: None, lambda: 128, lambda: 0.5)
+        self.fill(queue, chunks=8, decodes=200)
+
+        costs = drain_tokens(queue, 66)
+
+        # Each 32-token chunk is followed by 32 decode steps
+        self.assertEqual(costs[0], 32)
+        self.assertEqual(costs[1:33], [-1] * 32)
+        self.assertEqual(costs[33], 32)
+        self.assertEqual(costs[34:66], [-1] * 32)
+
+    def test_prefill_share_is_capped_per_round(self):
+        queue = JobQueue(lambda j: None, lambda: 128, lambda: 0.25)
+        self.fill(queue, chunks=8, decodes=400)
+
+        costs = drain_tokens(queue, 97 * 3)
+        prefill = sum(c for c in costs if c > 0)
+        decode = -sum(c for c in costs if c < 0)
+
+        self.assertEqual(prefill * 3, decode)
+
+    def test_prefill_takes_the_whole_round_without_decode_steps(self):
+        queue = JobQueue(lambda j: None, lambda: 64, lambda: 0.1)
+        self.fill(queue, chunks=4, decodes=0)
+
+        self.assertEqual(drain_tokens(queue, 4), [32, 32, 32, 32])
+
+    def test_decode_steps_run_when_no_prefill_waits(self):
+        queue = JobQueue(lambda j: None, lambda: 64, lambda: 0.9)
+        self.fill(queue, chunks=0, decodes=3)
+
+        self.assertEqual(drain_tokens(queue, 3), [-1, -1, -1])
+
+    def test_batch_mates_stop_at_the_prefill_allowance(self):
+        queue = JobQueue(by_tokens, lambda: 128, lambda: 0.5)
+        self.fill(queue, chunks=4, decodes=1)
+
+        first = queue.get(0)
+        assert first is not None
+        mates = queue.take(32, 8)
+
+        # 64 of the 128 tokens may go to prefill while a decode step waits
+        self.assertEqual(first.job_id, "chunk-0")
+        self.assertEqual([j.job_id for j in mates], ["chunk-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,21 +1,40 @@
 import os
 import sys
+import threading
 import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import torch
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'tests', 'language_pipes', 'unit'))
 
-from transformers import PretrainedConfig
+from transformers import LlamaConfig, PretrainedConfig
 
 from language_pipes.jobs.job import Job
+from language_pipes.jobs.job_data import JobData
 from language_pipes.jobs.job_cancel import JobCancel
-from language_pipes.jobs.job_receiver import CANCEL_PROTOCOL, JobReceiver
+from language_pipes.jobs.job_progress import JobProgress
+from language_pipes.jobs.job_queue import JobQueue, api_key_flow
+from language_pipes.jobs.job_credit import CREDIT_PROTOCOL
+from language_pipes.jobs.job_receiver import CANCEL_PROTOCOL, FORWARD_WORKER, JobReceiver, JobWorker
+from language_pipes.jobs.prefix_match import PREFIX_PROTOCOL, SESSION_PROTOCOL
 from language_pipes.jobs.job_tracker import JobTracker
-from language_pipes.jobs.network_job import NetworkJob
+from language_pipes.jobs.memory_governor import MemoryGovernor
+from language_pipes.jobs.network_job import HopReply, NetworkJob
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, KVBlockPool, PagedCache
+from language_pipes.modeling.kv_prefix import PrefixKVCache, block_hashes
+from language_pipes.modeling.kv_session import SessionKVCache
 from language_pipes.util.byte_helper import ByteHelper
+from language_pipes.pipes.pipe import Pipe
 from language_pipes.util.enums import ComputeStep
 
+from util import FakeEndModel, FakeModel, FakeStateNetworkNode
+
 
-def make_network_job(job_id: str) -> bytes:
+def make_network_job(job_id: str, pass_id: int = 0) -> bytes:
     return NetworkJob(
         job_id=job_id,
         pipe_id="pipe-1",
@@ -25,31 +44,65 @@ def make_network_job(job_id: str) -> bytes:
         data_hash=b"",
         compute_step=ComputeStep.LAYER,
         times=[],
+        pass_id=pass_id
     ).to_bytes()
 
 
-def make_receiver(max_node_jobs: int = 10) -> JobReceiver:
-    # is_shutdown returns True so the background runner loop exits immediately
-    # and never touches the (unused) managers.
+def make_step(job_id: str, tokens: int = 1, pipe_id: str = "pipe-1", current_layer: int = 3, compute_step: ComputeStep = ComputeStep.LAYER) -> NetworkJob:
+    """A queued layer step whose hidden state covers `tokens` tokens."""
+    return NetworkJob(
+        job_id=job_id,
+        pipe_id=pipe_id,
+        origin_node_id="node-a",
+        current_layer=current_layer,
+        data=JobData(
+            state=torch.zeros((1, tokens, 4)),
+            cache_position=torch.arange(tokens),
+            position_ids=torch.arange(tokens).unsqueeze(0),
+            causal_mask={},
+            position_embeddings={}
+        ),
+        data_hash=b"",
+        compute_step=compute_step,
+        times=[],
+    )
+
+
+def stopped_tracker() -> JobTracker:
+    tracker = JobTracker()
+    tracker.shutdown = True
+    return tracker
+
+
+def make_receiver(max_node_jobs: int = 10, max_batch_size: int = 8) -> JobReceiver:
+    # is_shutdown returns True so the worker threads exit immediately and
+    # never touch the (unused) managers. No pipes are known, so every packet
+    # goes to the forwarding worker.
     return JobReceiver(
         job_factory=None,   # pyright: ignore[reportArgumentType]
-        job_tracker=None,   # pyright: ignore[reportArgumentType]
-        pipe_manager=None,  # pyright: ignore[reportArgumentType]
+        job_tracker=stopped_tracker(),
+        pipe_manager=FakePipeManager(FakeRouter("node-a")),  # pyright: ignore[reportArgumentType]
         model_manager=None, # pyright: ignore[reportArgumentType]
         is_shutdown=lambda: True,
         get_max_node_jobs=lambda: max_node_jobs,
+        get_max_batch_size=lambda: max_batch_size,
+        get_round_token_budget=lambda: 256,
+        get_max_prefill_share=lambda: 0.5,
     )
 
 
+def queued(receiver: JobReceiver, node_id: str) -> int:
+    return sum(w.queue.depth(node_id) for w in receiver.workers.values())
+
+
 class ReceiveDataTests(unittest.TestCase):
     def test_queues_job_under_node_id(self):
         receiver = make_receiver()
 
         receiver.receive_data("node-b", make_network_job("job-1"))
 
-        self.assertIn("node-b", receiver.job_queue)
-        self.assertEqual(len(receiver.job_queue["node-b"]), 1)
-        self.assertEqual(receiver.job_queue["node-b"][0].job_id, "job-1")
+        self.assertEqual(queued(receiver, "node-b"), 1)
+        self.assertEqual(receiver.queued_job_ids(), ["job-1"])
 
     def test_separate_nodes_get_separate_queues(self):
         receiver = make_receiver()
@@ -57,28 +110,47 @@ class ReceiveDataTests(unittest.TestCase):
         receiver.receive_data("node-b", make_network_job("job-1"))
         receiver.receive_data("node-c", make_network_job("job-2"))
 
-        self.assertEqual(len(receiver.job_queue["node-b"]), 1)
-        self.assertEqual(len(receiver.job_queue["node-c"]), 1)
+        self.assertEqual(queued(receiver, "node-b"), 1)
+        self.assertEqual(queued(receiver, "node-c"), 1)
 
-    def test_ignores_duplicate_job_ids_from_same_node(self):
+    def test_jobs_started_here_are_queued_by_api_key(self):
+        receiver = make_receiver()
+        receiver.get_flow_weights = lambda: {"node-a": 2}
+        receiver.get_api_key_weights = lambda: {"key-a": 3}
+        make_pending_job(receiver.job_tracker, "job-1", key="key-a")
+        make_pending_job(receiver.job_tracker, "job-2", key="key-b")
+
+        receiver.receive_data("node-a", make_network_job("job-1"))
+        receiver.receive_data("node-a", make_network_job("job-2"))
+        receiver.receive_data("node-b", make_network_job("job-3"))
+
+        flows = [flow for w in receiver.workers.values() for flow in w.queue.stats().flows]
+        self.assertCountEqual(flows, [api_key_flow("node-a", "key-a"), api_key_flow("node-a", "key-b"), "node-a"])
+        weights = receiver._flow_weights()
+        self.assertEqual(weights[api_key_flow("node-a", "key-a")], 6)
+        self.assertNotIn(api_key_flow("node-a", "key-b"), weights)
+
+    def test_ignores_duplicate_job_ids(self):
         receiver = make_receiver()
 
         receiver.receive_data("node-b", make_network_job("job-1"))
         receiver.receive_data("node-b", make_network_job("job-1"))
+        receiver.receive_data("node-c", make_network_job("job-1"))
 
-        self.assertEqual(len(receiver.job_queue["node-b"]), 1)
+        self.assertEqual(receiver.queued_job_ids(), ["job-1"])
+        self.assertEqual(queued(receiver, "node-b"), 1)
 
     def test_rejects_jobs_beyond_node_limit(self):
         receiver = make_receiver(max_node_jobs=2)
 
         # Limit is 2; the guard rejects once the queue already holds more than
-        # the limit, so jobs 0..2 are accepted and the next one raises.
-        receiver.receive_data("node-b", make_network_job("job-0"))
-        receiver.receive_data("node-b", make_network_job("job-1"))
-        receiver.receive_data("node-b", make_network_job("job-2"))
+        # the limit, so jobs 0..2 are accepted and the next one is turned away.
+        # Each answer says how many more fit.
+        for i in range(3):
+            self.assertEqual(receiver.receive_data("node-b", make_network_job(f"job-{i}")), HopReply(True, 2 - i).to_bytes())
 
-        with self.assertRaises(Exception):
-            receiver.receive_data("node-b", make_network_job("job-3"))
+        self.assertEqual(receiver.receive_data("node-b", make_network_job("job-3")), HopReply(False, 0).to_bytes())
+        self.assertNotIn("job-3", receiver.queued_job_ids())
 
     def test_limit_is_per_node(self):
         receiver = make_receiver(max_node_jobs=2)
@@ -89,12 +161,115 @@ class ReceiveDataTests(unittest.TestCase):
         receiver.receive_data("node-b", make_network_job("b-2"))
 
         receiver.receive_data("node-c", make_network_job("c-0"))
-        self.assertEqual(len(receiver.job_queue["node-c"]), 1)
+        self.assertEqual(queued(receiver, "node-c"), 1)
+
+
+class HopTests(unittest.TestCase):
+    def test_copy_of_a_pass_that_already_ran_is_dropped(self):
+        receiver = make_receiver()
+        receiver.receive_data("node-b", make_network_job("job-1", pass_id=3))
+        receiver._drop_queued("job-1")  # the pass ran and left
+
+        reply = receiver.receive_data("node-b", make_network_job("job-1", pass_id=3))
+
+        self.assertTrue(HopReply.from_reply(reply).accepted)
+        self.assertEqual(receiver.queued_job_ids(), [])
+
+    def test_next_pass_of_the_job_is_taken(self):
+        receiver = make_receiver()
+        receiver.receive_data("node-b", make_network_job("job-1", pass_id=3))
+        receiver._drop_queued("job-1")
+
+        receiver.receive_data("node-b", make_network_job("job-1", pass_id=4))
+
+        self.assertEqual(receiver.queued_job_ids(), ["job-1"])
+
+    def test_pass_turned_away_is_taken_when_sent_again(self):
+        receiver = make_receiver(max_node_jobs=0)
+        receiver.receive_data("node-b", make_network_job("job-0"))
+        self.assertEqual(receiver.receive_data("node-b", make_network_job("job-1", pass_id=1)), HopReply(False, 0).to_bytes())
+
+        receiver._drop_queued("job-0")
+        receiver.receive_data("node-b", make_network_job("job-1", pass_id=1))
+
+        self.assertEqual(receiver.queued_job_ids(), ["job-1"])
+
+
+def make_worker(receiver: JobReceiver) -> JobWorker:
+    return JobWorker(FORWARD_WORKER, JobQueue(receiver._batch_class))
+
+
+def enqueue(worker: JobWorker, node_id: str, *steps: NetworkJob):
+    for step in steps:
+        worker.queue.put(node_id, step, 10)
+
+
+class TakeBatchTests(unittest.TestCase):
+    def test_takes_decode_steps_for_the_same_layer_from_every_node(self):
+        receiver = make_receiver()
+        worker = make_worker(receiver)
+        enqueue(worker, "node-b", make_step("job-2"))
+        enqueue(worker, "node-c", make_step("job-3"))
+
+        batch = receiver._take_batch(worker, make_step("job-1"))
+
+        self.assertEqual([j.job_id for j in batch], ["job-1", "job-2", "job-3"])
+        self.assertEqual(len(worker.queue), 0)
+
+    def test_leaves_steps_that_cannot_share_the_forward(self):
+        receiver = make_receiver()
+        worker = make_worker(receiver)
+        enqueue(worker, "node-b",
+            make_step("other-layer", current_layer=5),
+            make_step("other-pipe", pipe_id="pipe-2"),
+            make_step("prefill", tokens=4),
+            make_step("head", compute_step=ComputeStep.HEAD),
+        )
+
+        batch = receiver._take_batch(worker, make_step("job-1"))
+
+        self.assertEqual([j.job_id for j in batch], ["job-1"])
+        self.assertEqual(worker.queue.depth("node-b"), 4)
+
+    def test_prefill_chunks_batch_with_prefill_chunks(self):
+        receiver = make_receiver()
+        worker = make_worker(receiver)
+        enqueue(worker, "node-b", make_step("decode"), make_step("job-2", tokens=2))
+
+        batch = receiver._take_batch(worker, make_step("job-1", tokens=4))
+
+        self.assertEqual([j.job_id for j in batch], ["job-1", "job-2"])
+        self.assertEqual(worker.queue.job_ids(), ["decode"])
+
+    def test_takes_head_steps_together(self):
+        receiver = make_receiver()
+        worker = make_worker(receiver)
+        enqueue(worker, "node-b",
+            make_step("head-2", tokens=4, compute_step=ComputeStep.HEAD),
+            make_step("layer"),
+            make_step("head-3", pipe_id="pipe-2", compute_step=ComputeStep.HEAD),
+        )
+
+        batch = receiver._take_batch(worker, make_step("head-1", compute_step=ComputeStep.HEAD))
+
+        self.assertEqual([j.job_id for j in batch], ["head-1", "head-2", "head-3"])
+        self.assertEqual(worker.queue.job_ids(), ["layer"])
+
+    def test_respects_max_batch_size(self):
+        receiver = make_receiver(max_batch_size=2)
+        worker = make_worker(receiver)
+        enqueue(worker, "node-b", make_step("job-2"), make_step("job-3"))
+
+        batch = receiver._take_batch(worker, make_step("job-1"))
+
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(worker.queue.depth("node-b"), 1)
 
 
 class FakeRouter:
-    def __init__(self, node_id: str):
+    def __init__(self, node_id: str, reply=None):
         self._node_id = node_id
+        self.reply = reply
         self.sent = []
 
     def node_id(self) -> str:
@@ -102,14 +277,22 @@ class FakeRouter:
 
     def send_to_node(self, node_id: str, data: bytes):
         self.sent.append((node_id, data))
+        return self.reply
 
     def receive_data(self, data: bytes):
         self.sent.append((self._node_id, data))
 
 
 class FakePipeManager:
-    def __init__(self, router: FakeRouter):
+    def __init__(self, router: FakeRouter, pipes=None):
         self.router_pipes = type("FakeRouterPipes", (), {"router": router})()
+        self.pipes = pipes or []
+
+    def get_pipe_by_pipe_id(self, pipe_id: str):
+        return next((p for p in self.pipes if p.pipe_id == pipe_id), None)
+
+    def get_job_pipe(self, pipe_id: str, segment_moves):
+        return self.get_pipe_by_pipe_id(pipe_id)
 
 
 def make_cancel_receiver(node_id: str = "node-a"):
@@ -124,6 +307,9 @@ def make_cancel_receiver(node_id: str = "node-a"):
         model_manager=None, # pyright: ignore[reportArgumentType]
         is_shutdown=lambda: True,
         get_max_node_jobs=lambda: 10,
+        get_max_batch_size=lambda: 8,
+        get_round_token_budget=lambda: 256,
+        get_max_prefill_share=lambda: 0.5,
     )
     return receiver, tracker, router
 
@@ -144,7 +330,7 @@ def make_pending_job(
         config=PretrainedConfig(num_hidden_layers=1),
     )
     job.job_id = job_id
-    tracker.jobs_pending.setdefault(key, []).append(job)
+    tracker.track_job(key, job)
     return job
 
 
@@ -203,8 +389,7 @@ class CancelPipeJobsTests(unittest.TestCase):
 
         receiver.cancel_pipe_jobs(["pipe-1"], "layers for model-1 unloaded")
 
-        queued = [j.job_id for j in receiver.job_queue.get("node-b", [])]
-        self.assertEqual(queued, ["job-2"])
+        self.assertEqual(receiver.queued_job_ids(), ["job-2"])
 
 
 class CancelModelJobsTests(unittest.TestCase):
@@ -259,6 +444,125 @@ class ReceiveCancelTests(unittest.TestCase):
         self.assertEqual([node_id for node_id, _ in router.sent], ["node-c"])
 
 
+class ImmediateSender:
+    """Sends control messages as soon as they are handed over."""
+    def __init__(self):
+        self.notified = []
+
+    def send_notice(self, node_id: str, send):
+        self.notified.append(node_id)
+        send()
+
+
+def make_finish_receiver(node_id: str = "node-a"):
+    receiver, tracker, router = make_cancel_receiver(node_id)
+    receiver.pipe_manager.pipes.append(make_pipe(  # pyright: ignore[reportAttributeAccessIssue]
+        "pipe-1",
+        "model-1",
+        FakeModel("node-a", 0, 3),
+        FakeModel("node-b", 4, 7),
+        FakeModel("node-c", 8, 11),
+        FakeModel("node-a", 12, 15)
+    ))
+    receiver.sender = ImmediateSender()  # pyright: ignore[reportAttributeAccessIssue]
+    return receiver, tracker, router
+
+
+class FinishJobTests(unittest.TestCase):
+    def test_origin_tells_every_other_node_on_the_pipe(self):
+        receiver, tracker, router = make_finish_receiver("node-a")
+        job = make_pending_job(tracker, origin_node_id="node-a")
+
+        receiver.finish_job(job)
+
+        self.assertEqual([node_id for node_id, _ in router.sent], ["node-b", "node-c"])
+        cancel = read_cancel(router.sent[0][1])
+        self.assertEqual(cancel.job_id, "job-1")
+        self.assertTrue(cancel.finished)
+
+    def test_canceled_job_carries_its_reason(self):
+        receiver, tracker, router = make_finish_receiver("node-a")
+        job = make_pending_job(tracker, origin_node_id="node-a")
+
+        tracker.cancel_job(job, "layers unloaded")
+        receiver.finish_job(job)
+
+        cancel = read_cancel(router.sent[0][1])
+        self.assertFalse(cancel.finished)
+        self.assertEqual(cancel.reason, "layers unloaded")
+
+    def test_only_the_origin_tells_the_pipe(self):
+        receiver, tracker, router = make_finish_receiver("node-b")
+        job = make_pending_job(tracker, origin_node_id="node-a")
+
+        receiver.finish_job(job)
+
+        self.assertEqual(router.sent, [])
+
+    def test_node_frees_the_job_when_the_origin_finishes_it(self):
+        receiver, tracker, router = make_finish_receiver("node-b")
+        make_pending_job(tracker, origin_node_id="node-a")
+        receiver.receive_data("node-a", make_packet("job-1", current_layer=4))
+        self.assertEqual(receiver.queued_job_ids(), ["job-1"])
+
+        receiver.receive_cancel("node-a", JobCancel("job-1", "pipe-1", "completed", finished=True).to_bytes())
+
+        self.assertIsNone(tracker.get_job("job-1"))
+        self.assertEqual(receiver.queued_job_ids(), [])
+        # Nothing goes back to the origin
+        self.assertEqual(router.sent, [])
+
+    def test_node_cancels_the_job_when_the_origin_cancels_it(self):
+        receiver, tracker, router = make_finish_receiver("node-b")
+        job = make_pending_job(tracker, origin_node_id="node-a")
+
+        receiver.receive_cancel("node-a", JobCancel("job-1", "pipe-1", "client went away").to_bytes())
+
+        self.assertEqual(job.cancel_reason, "client went away")
+        self.assertEqual(router.sent, [])
+
+    def test_pass_that_cannot_be_sent_on_is_handed_to_the_origin(self):
+        receiver, tracker, router = make_finish_receiver("node-b")
+        job = make_pending_job(tracker, origin_node_id="node-a")
+        job.current_layer = 8
+
+        receiver._hop_lost(job, "node-c", "connection refused")
+
+        # The origin fails the job over, or cancels it everywhere
+        self.assertIsNone(job.cancel_reason)
+        self.assertEqual([node_id for node_id, _ in router.sent], ["node-a"])
+        lost = read_cancel(router.sent[0][1])
+        self.assertEqual(lost.reason, "could not reach node node-c: connection refused")
+        self.assertEqual(lost.lost_layer, 8)
+
+    def test_answer_that_cannot_reach_the_origin_cancels_the_job(self):
+        receiver, tracker, _ = make_finish_receiver("node-b")
+        job = make_pending_job(tracker, origin_node_id="node-a")
+        job.compute_step = ComputeStep.HEAD
+
+        receiver._hop_lost(job, "node-a", "connection refused")
+
+        self.assertEqual(job.cancel_reason, "could not reach node node-a: connection refused")
+
+    def test_node_keeps_the_session_the_origin_kept(self):
+        receiver, tracker, _ = make_finish_receiver("node-b")
+        job = make_pending_job(tracker, origin_node_id="node-a")
+
+        with patch.object(Job, "keep_session") as keep_session:
+            receiver.receive_cancel("node-a", JobCancel("job-1", "pipe-1", "completed", finished=True, session_id="session-1", session_tokens=40).to_bytes())
+
+        keep_session.assert_called_once()
+        self.assertEqual(job.session_id, "session-1")
+        self.assertEqual(job.session_tokens, 40)
+
+    def test_late_packets_of_a_finished_job_are_dropped(self):
+        receiver, tracker, _ = make_finish_receiver("node-b")
+
+        receiver.receive_cancel("node-a", JobCancel("job-1", "pipe-1", "completed", finished=True).to_bytes())
+
+        self.assertTrue(tracker.is_completed("job-1"))
+
+
 class JobCancelPacketTests(unittest.TestCase):
     def test_round_trips(self):
         cancel = JobCancel("job-1", "pipe-1", "layers for model-1 unloaded")
@@ -268,6 +572,553 @@ class JobCancelPacketTests(unittest.TestCase):
         self.assertEqual(parsed.job_id, "job-1")
         self.assertEqual(parsed.pipe_id, "pipe-1")
         self.assertEqual(parsed.reason, "layers for model-1 unloaded")
+        self.assertFalse(parsed.finished)
+
+    def test_finished_flag_round_trips(self):
+        parsed = JobCancel.from_bytes(JobCancel("job-1", "pipe-1", "completed", finished=True).to_bytes())
+
+        self.assertTrue(parsed.finished)
+
+    def test_session_round_trips(self):
+        cancel = JobCancel("job-1", "pipe-1", "completed", finished=True, session_id="session-1", session_tokens=40)
+
+        parsed = JobCancel.from_bytes(cancel.to_bytes())
+
+        self.assertEqual(parsed.session_id, "session-1")
+        self.assertEqual(parsed.session_tokens, 40)
+
+    def test_lost_layer_round_trips(self):
+        parsed = JobCancel.from_bytes(JobCancel("job-1", "pipe-1", "lost", lost_layer=0, pass_id=7).to_bytes())
+
+        self.assertEqual(parsed.lost_layer, 0)
+        self.assertEqual(parsed.pass_id, 7)
+        self.assertIsNone(JobCancel.from_bytes(JobCancel("job-1", "pipe-1", "lost").to_bytes()).lost_layer)
+
+    def test_reads_packets_without_the_finished_flag(self):
+        bts = ByteHelper()
+        bts.write_string("job-1")
+        bts.write_string("pipe-1")
+        bts.write_string("layers unloaded")
+
+        parsed = JobCancel.from_bytes(bts.get_bytes())
+
+        self.assertEqual(parsed.reason, "layers unloaded")
+        self.assertFalse(parsed.finished)
+
+
+class FakeModelManager:
+    def __init__(self, end_models):
+        self.end_models = end_models
+
+    def get_end_model(self, model_id: str):
+        return self.end_models.get(model_id)
+
+
+def make_pipe(pipe_id: str, model_id: str, *segments) -> Pipe:
+    pipe = Pipe(FakeStateNetworkNode("node-a"), pipe_id, model_id, Path("."))  # pyright: ignore[reportArgumentType]
+    pipe.segments = list(segments)
+    return pipe
+
+
+def make_packet(job_id: str, pipe_id: str = "pipe-1", current_layer: int = 0, compute_step: ComputeStep = ComputeStep.LAYER) -> bytes:
+    return NetworkJob(
+        job_id=job_id,
+        pipe_id=pipe_id,
+        origin_node_id="node-b",
+        current_layer=current_layer,
+        data=None,
+        data_hash=b"",
+        compute_step=compute_step,
+        times=[],
+    ).to_bytes()
+
+
+def make_routing_receiver(max_node_jobs: int = 10, is_shutdown=lambda: True, receiver_type=JobReceiver) -> JobReceiver:
+    """pipe-1 runs layers 0-3 here and 4-7 on node-b, pipe-2 runs all of model-2
+    here, and pipe-3's end model holds the first two layers of model-3."""
+    pipes = [
+        make_pipe("pipe-1", "model-1", FakeModel("node-a", 0, 3), FakeModel("node-b", 4, 7, virtual=True)),
+        make_pipe("pipe-2", "model-2", FakeModel("node-a", 0, 7)),
+        make_pipe("pipe-3", "model-3", FakeModel("node-a", 2, 7)),
+    ]
+    end_models = {"model-1": FakeEndModel(), "model-3": FakeEndModel(num_local_layers=2)}
+    return receiver_type(
+        job_factory=None,   # pyright: ignore[reportArgumentType]
+        job_tracker=stopped_tracker(),
+        pipe_manager=FakePipeManager(FakeRouter("node-a"), pipes),  # pyright: ignore[reportArgumentType]
+        model_manager=FakeModelManager(end_models),  # pyright: ignore[reportArgumentType]
+        is_shutdown=is_shutdown,
+        get_max_node_jobs=lambda: max_node_jobs,
+        get_max_batch_size=lambda: 8,
+        get_round_token_budget=lambda: 256,
+        get_max_prefill_share=lambda: 0.5,
+    )
+
+
+class WorkerRoutingTests(unittest.TestCase):
+    def key(self, receiver: JobReceiver, data: bytes):
+        network_job, _ = NetworkJob.from_bytes(data)
+        return receiver._worker_key(network_job)
+
+    def test_routes_packets_to_the_segment_they_need(self):
+        receiver = make_routing_receiver()
+
+        self.assertEqual(self.key(receiver, make_packet("j", "pipe-1", 0, ComputeStep.HEAD)), ("end", "model-1"))
+        self.assertEqual(self.key(receiver, make_packet("j", "pipe-1", 0, ComputeStep.EMBED)), ("end", "model-1"))
+        self.assertEqual(self.key(receiver, make_packet("j", "pipe-1", 3)), ("layers", "pipe-1", 0))
+        self.assertEqual(self.key(receiver, make_packet("j", "pipe-2", 3)), ("layers", "pipe-2", 0))
+        # The end model holds layers 0-1, so layer 0 runs on its worker
+        self.assertEqual(self.key(receiver, make_packet("j", "pipe-3", 0)), ("end", "model-3"))
+        self.assertEqual(self.key(receiver, make_packet("j", "pipe-3", 2)), ("layers", "pipe-3", 2))
+
+    def test_packets_for_remote_layers_or_unknown_pipes_are_forwarded(self):
+        receiver = make_routing_receiver()
+
+        self.assertEqual(self.key(receiver, make_packet("j", "pipe-1", 5)), FORWARD_WORKER)
+        self.assertEqual(self.key(receiver, make_packet("j", "pipe-9", 0)), FORWARD_WORKER)
+
+    def test_each_segment_gets_its_own_queue(self):
+        receiver = make_routing_receiver()
+
+        receiver.receive_data("node-b", make_packet("job-1", "pipe-1", 3))
+        receiver.receive_data("node-b", make_packet("job-2", "pipe-2", 3))
+        receiver.receive_data("node-b", make_packet("job-3", "pipe-1", 0, ComputeStep.HEAD))
+
+        self.assertEqual(
+            {key: w.queue.job_ids() for key, w in receiver.workers.items()},
+            {
+                ("layers", "pipe-1", 0): ["job-1"],
+                ("layers", "pipe-2", 0): ["job-2"],
+                ("end", "model-1"): ["job-3"],
+            }
+        )
+
+    def test_node_limit_covers_every_worker(self):
+        receiver = make_routing_receiver(max_node_jobs=1)
+
+        receiver.receive_data("node-b", make_packet("job-1", "pipe-1", 3))
+        receiver.receive_data("node-b", make_packet("job-2", "pipe-2", 3))
+
+        reply = receiver.receive_data("node-b", make_packet("job-3", "pipe-1", 0, ComputeStep.HEAD))
+
+        self.assertEqual(reply, HopReply(False, 0).to_bytes())
+
+    def test_ignores_duplicates_on_other_workers(self):
+        receiver = make_routing_receiver()
+
+        receiver.receive_data("node-b", make_packet("job-1", "pipe-1", 3))
+        receiver.receive_data("node-b", make_packet("job-1", "pipe-2", 3))
+
+        self.assertEqual(receiver.queued_job_ids(), ["job-1"])
+
+    def test_stats_cover_every_worker(self):
+        receiver = make_routing_receiver()
+
+        receiver.receive_data("node-b", make_packet("job-1", "pipe-1", 3))
+        receiver.receive_data("node-b", make_packet("job-2", "pipe-2", 3))
+        stats = receiver.queue_stats()
+
+        self.assertEqual(stats.depth, 2)
+        self.assertEqual(stats.queues, 2)
+        self.assertEqual(stats.flows, {"node-b": 2})
+
+    def test_idle_worker_retires_only_when_empty(self):
+        receiver = make_routing_receiver()
+        receiver.receive_data("node-b", make_packet("job-1", "pipe-1", 3))
+        worker = receiver.workers[("layers", "pipe-1", 0)]
+
+        self.assertFalse(receiver._retire_worker(worker))
+        worker.queue.get(0)
+        self.assertTrue(receiver._retire_worker(worker))
+        self.assertEqual(receiver.workers, {})
+
+    def test_segments_run_in_parallel(self):
+        # Both packets have to be inside run() at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        ran = []
+
+        class BlockingProcessor:
+            def __init__(self, job_id: str):
+                self.job_id = job_id
+
+            def run(self):
+                barrier.wait()
+                ran.append(self.job_id)
+
+        class Receiver(JobReceiver):
+            def _make_processor(self, network_job):
+                return BlockingProcessor(network_job.job_id)
+
+        receiver = make_routing_receiver(is_shutdown=lambda: False, receiver_type=Receiver)
+        receiver.receive_data("node-b", make_packet("job-1", "pipe-1", 3))
+        receiver.receive_data("node-b", make_packet("job-2", "pipe-2", 3))
+        threads = [w.thread for w in receiver.workers.values()]
+
+        barrier_passed = False
+        try:
+            for _ in range(500):
+                if len(ran) == 2:
+                    barrier_passed = True
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            receiver.stop()
+            for thread in threads:
+                assert thread is not None
+                thread.join(5)
+
+        self.assertTrue(barrier_passed)
+        self.assertEqual(sorted(ran), ["job-1", "job-2"])
+
+
+class ControlSender:
+    """Records the control messages handed over instead of sending them."""
+    def __init__(self):
+        self.controls = []
+
+    def send_control(self, node_id: str, send):
+        self.controls.append(node_id)
+
+
+def credit_payload(credit: int) -> bytes:
+    bts = ByteHelper()
+    bts.write_int(credit)
+    return bts.get_bytes()
+
+
+class CreditTests(unittest.TestCase):
+    def test_node_out_of_credit_is_told_when_room_comes_free(self):
+        receiver = make_receiver(max_node_jobs=0)
+        sender = ControlSender()
+        receiver.credit.sender = sender  # pyright: ignore[reportAttributeAccessIssue]
+        receiver.receive_data("node-b", make_network_job("job-0"))
+        self.assertEqual(receiver.credit.starved, {"node-b"})
+
+        receiver._drop_queued("job-0")
+
+        self.assertEqual(sender.controls, ["node-b"])
+        self.assertEqual(receiver.credit.starved, set())
+
+    def test_node_with_credit_left_is_not_told(self):
+        receiver = make_receiver(max_node_jobs=2)
+        sender = ControlSender()
+        receiver.credit.sender = sender  # pyright: ignore[reportAttributeAccessIssue]
+        receiver.receive_data("node-b", make_network_job("job-0"))
+
+        receiver._drop_queued("job-0")
+
+        self.assertEqual(sender.controls, [])
+
+    def test_takes_the_credit_given_and_answers_with_its_own(self):
+        receiver = make_receiver(max_node_jobs=2)
+        receiver.receive_data("node-b", make_network_job("job-0"))
+
+        reply = receiver.credit.receive_credit("node-b", credit_payload(0))
+
+        self.assertEqual(receiver.sender.credit("node-b"), 0)
+        self.assertEqual(reply, HopReply(True, 2).to_bytes())
+
+    def test_exchange_sends_the_credit_and_records_the_answer(self):
+        receiver, _, router = make_cancel_receiver("node-a")
+        router.reply = HopReply(True, 4).to_bytes()
+
+        self.assertEqual(receiver.credit.exchange("node-b"), 4)
+
+        node_id, data = router.sent[0]
+        bts = ByteHelper(data)
+        self.assertEqual(node_id, "node-b")
+        self.assertEqual(bts.read_int(), CREDIT_PROTOCOL)
+        self.assertEqual(ByteHelper(bts.read_bytes()).read_int(), 11)
+        self.assertEqual(receiver.sender.credit("node-b"), 4)
+
+    def test_older_node_without_credit_is_not_waited_on(self):
+        receiver, _, router = make_cancel_receiver("node-a")
+
+        self.assertIsNone(receiver.credit.exchange("node-b"))
+        self.assertIsNone(receiver.sender.credit("node-b"))
+
+
+def make_held_receiver():
+    """node-a starts jobs on pipe-1, which runs on to node-b."""
+    receiver, tracker, router = make_cancel_receiver("node-a")
+    receiver.pipe_manager.pipes.append(make_pipe(  # pyright: ignore[reportAttributeAccessIssue]
+        "pipe-1",
+        "model-1",
+        FakeModel("node-a", 0, 3),
+        FakeModel("node-b", 4, 7)
+    ))
+    # Credit coming back is handed to _credit_returned by the tests
+    receiver.sender.on_credit = lambda node_id: None
+    return receiver, tracker
+
+
+class HeldJobTests(unittest.TestCase):
+    def test_job_starts_when_its_pipe_has_room(self):
+        receiver, tracker = make_held_receiver()
+        job = make_pending_job(tracker)
+
+        self.assertTrue(receiver._admit_job(job))
+
+    def test_job_waits_while_a_node_on_its_pipe_has_no_credit(self):
+        receiver, tracker = make_held_receiver()
+        receiver.sender.set_credit("node-b", 0)
+        job = make_pending_job(tracker)
+
+        self.assertFalse(receiver._admit_job(job))
+        self.assertEqual(receiver.held_jobs, [job])
+        self.assertEqual(receiver.queued_job_ids(), [])
+
+    def test_held_jobs_start_in_order_once_credit_comes_back(self):
+        receiver, tracker = make_held_receiver()
+        receiver.sender.set_credit("node-b", 0)
+        first = make_pending_job(tracker, job_id="job-1", key="key-1")
+        second = make_pending_job(tracker, job_id="job-2", key="key-2")
+        receiver._admit_job(first)
+        receiver._admit_job(second)
+
+        receiver.sender.set_credit("node-b", 2)
+        receiver._credit_returned("node-b")
+
+        self.assertEqual(receiver.held_jobs, [])
+        self.assertEqual(receiver.queued_job_ids(), ["job-1", "job-2"])
+
+    def test_canceled_held_job_is_dropped(self):
+        receiver, tracker = make_held_receiver()
+        receiver.sender.set_credit("node-b", 0)
+        job = make_pending_job(tracker)
+        receiver._admit_job(job)
+        tracker.cancel_job(job, "client went away")
+
+        receiver.sender.set_credit("node-b", 2)
+        receiver._credit_returned("node-b")
+
+        self.assertEqual(receiver.held_jobs, [])
+        self.assertEqual(receiver.queued_job_ids(), [])
+
+
+# 4 KB of KV per token on each layer
+KV_CONFIG = PretrainedConfig(num_hidden_layers=2, num_attention_heads=1, head_dim=1024)
+
+
+class MemoryModel(FakeModel):
+    def __init__(self, node_id, start_layer, end_layer, virtual=False):
+        super().__init__(node_id, start_layer, end_layer, virtual=virtual, num_hidden_layers=2)
+        self.device = "cpu"
+        self.collector = SimpleNamespace(config=KV_CONFIG)
+        self.kv_cache_dtype = "auto"
+
+
+class ConfigModelManager(FakeModelManager):
+    def get_config(self, model_id: str):
+        return KV_CONFIG
+
+
+def make_admission_receiver():
+    """node-a runs both layers of pipe-1 and has about 1 MB for them."""
+    receiver, tracker, router = make_cancel_receiver("node-a")
+    pipe = make_pipe("pipe-1", "model-1", MemoryModel("node-a", 0, 1))
+    pipe.router = router  # pyright: ignore[reportAttributeAccessIssue]
+    receiver.pipe_manager.pipes = [pipe]  # pyright: ignore[reportAttributeAccessIssue]
+    receiver.model_manager = ConfigModelManager({ })  # pyright: ignore[reportAttributeAccessIssue]
+    governor = MemoryGovernor(lambda: { }, get_max_device_memory=lambda: 0.001)
+    receiver.memory_governor = governor
+    tracker.on_remove = governor.release
+    return receiver, tracker, router, governor
+
+
+def make_first_packet(prompt_tokens: int, max_completion_tokens: int) -> NetworkJob:
+    network_job = make_step("job-1", tokens=prompt_tokens, current_layer=0)
+    network_job.origin_node_id = "node-b"
+    network_job.progress = JobProgress(0, prompt_tokens, True, 0, max_completion_tokens)
+    return network_job
+
+
+class AdmissionTests(unittest.TestCase):
+    def test_job_from_another_node_that_fits_is_reserved(self):
+        receiver, _, router, governor = make_admission_receiver()
+
+        processor = receiver._make_processor(make_first_packet(10, 10))
+
+        self.assertIsNotNone(processor)
+        # Two blocks of 16 tokens on each of 2 layers, and the copy of one layer's forward
+        self.assertEqual(governor.reserved["job-1"], {"cpu": 32 * 4096 * 3})
+        self.assertEqual(router.sent, [])
+
+    def test_job_from_another_node_that_does_not_fit_is_canceled_at_its_origin(self):
+        receiver, tracker, router, governor = make_admission_receiver()
+
+        processor = receiver._make_processor(make_first_packet(100, 100))
+
+        self.assertIsNone(processor)
+        self.assertTrue(tracker.is_completed("job-1"))
+        self.assertEqual(governor.reserved, { })
+        node_id, data = router.sent[0]
+        self.assertEqual(node_id, "node-b")
+        self.assertIn("not enough memory", read_cancel(data).reason)
+        self.assertIn("node-a", read_cancel(data).reason)
+
+    @patch("language_pipes.jobs.memory_governor.Timer")
+    def test_job_starting_here_waits_for_memory_and_is_sent_once_it_is_free(self, _):
+        receiver, tracker, router, governor = make_admission_receiver()
+        governor.admit("job-0", {"cpu": 1_000_000})
+        job = make_pending_job(tracker, origin_node_id="node-a", key="key-1")
+        job.prompt_tokens = 10
+        job.max_completion_tokens = 10
+
+        self.assertFalse(receiver._admit_job(job))
+        self.assertEqual(router.sent, [])
+
+        governor.release("job-0")
+
+        self.assertIn("job-1", governor.reserved)
+        self.assertIsNone(job.cancel_reason)
+        # Back into its pipe through this node's own queue
+        self.assertEqual(receiver.queued_job_ids(), ["job-1"])
+
+    def test_reservation_is_freed_when_the_job_leaves(self):
+        receiver, tracker, _, governor = make_admission_receiver()
+        receiver._make_processor(make_first_packet(10, 10))
+
+        tracker.remove_job("job-1")
+
+        self.assertEqual(governor.reserved, { })
+
+
+
+class PrefixRouter(FakeRouter):
+    """A router whose peers answer prefix queries with a block count."""
+    def __init__(self, node_id: str, blocks: dict):
+        super().__init__(node_id)
+        self.blocks = blocks
+
+    def send_to_node(self, node_id: str, data: bytes, timeout=None, retries=None):
+        self.sent.append((node_id, data))
+        if node_id not in self.blocks:
+            raise Exception("timed out")
+        bts = ByteHelper()
+        bts.write_int(self.blocks[node_id])
+        return bts.get_bytes()
+
+
+class MatchPrefixTests(unittest.TestCase):
+    def make(self, blocks: dict, tokens: int = BLOCK_TOKENS * 3 + 1):
+        prefix = PrefixKVCache(lambda: 1024**3)
+        patcher = patch("language_pipes.jobs.prefix_match.PREFIX_KV_CACHE", prefix)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        config = LlamaConfig(num_hidden_layers=2, hidden_size=8, num_attention_heads=2, num_key_value_heads=2)
+        local = SimpleNamespace(node_id="node-a", virtual=False, segment_process=None, prefix_layers=lambda: [(1, "auto")])
+        remote = SimpleNamespace(node_id="node-b", virtual=True)
+        pipe = SimpleNamespace(pipe_id="pipe-1", model_id="model-1", segments=[local, remote])
+        end_model = SimpleNamespace(collector=SimpleNamespace(config=config), prefix_layers=lambda: [(0, "auto")])
+        router = PrefixRouter("node-a", blocks)
+        receiver = JobReceiver(
+            job_factory=None,   # pyright: ignore[reportArgumentType]
+            job_tracker=stopped_tracker(),
+            pipe_manager=FakePipeManager(router, [pipe]),  # pyright: ignore[reportArgumentType]
+            model_manager=SimpleNamespace(get_end_model=lambda model_id: end_model),  # pyright: ignore[reportArgumentType]
+            is_shutdown=lambda: True,
+            get_max_node_jobs=lambda: 10,
+            get_max_batch_size=lambda: 8,
+            get_round_token_budget=lambda: 256,
+            get_max_prefill_share=lambda: 0.5,
+        )
+
+        ids = list(range(tokens))
+        cache = PagedCache(config, KVBlockPool())
+        for layer_idx in range(2):
+            cache.update(torch.randn(1, 2, tokens, 4), torch.randn(1, 2, tokens, 4), layer_idx)
+        prefix.store("pipe-1", cache, [(0, "auto"), (1, "auto")], block_hashes(ids, tokens))
+        job = SimpleNamespace(
+            job_id="job-1", pipe_id="pipe-1", model_id="model-1",
+            input_ids=ids, prompt_tokens=tokens, prefix_hashes=[], prefix_tokens=0,
+            resume_session_id=None,
+            kv_window_tokens=0
+        )
+        return receiver, router, job
+
+    def test_job_skips_the_blocks_every_node_has(self):
+        receiver, router, job = self.make({"node-b": 2})
+
+        receiver.prefixes.match_prefix(job)
+
+        self.assertEqual(len(job.prefix_hashes), 3)
+        self.assertEqual(job.prefix_tokens, BLOCK_TOKENS * 2)
+        self.assertEqual([node_id for node_id, _ in router.sent], ["node-b"])
+
+    def test_last_prompt_token_is_always_computed(self):
+        receiver, _, job = self.make({"node-b": 3}, tokens=BLOCK_TOKENS * 3)
+
+        receiver.prefixes.match_prefix(job)
+
+        self.assertEqual(job.prefix_tokens, BLOCK_TOKENS * 2)
+
+    def test_node_that_does_not_answer_has_nothing(self):
+        receiver, _, job = self.make({})
+
+        receiver.prefixes.match_prefix(job)
+
+        self.assertEqual(job.prefix_tokens, 0)
+
+    def test_query_is_answered_with_the_blocks_set_aside(self):
+        receiver, router, job = self.make({"node-b": 2})
+        receiver.prefixes.match_prefix(job)
+        _, data = router.sent[0]
+        bts = ByteHelper(data)
+        self.assertEqual(bts.read_int(), PREFIX_PROTOCOL)
+
+        # node-a hosts layer 1 of the pipe for the query's job
+        reply = receiver.prefixes.receive_prefix("node-c", bts.read_bytes())
+
+        self.assertEqual(ByteHelper(reply).read_int(), 3)
+
+    def keep_session(self, job, tokens: int):
+        sessions = SessionKVCache(lambda: 1024**3, lambda: 600)
+        patcher = patch("language_pipes.jobs.prefix_match.SESSION_KV_CACHE", sessions)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache = PagedCache(LlamaConfig(num_hidden_layers=2, hidden_size=8, num_attention_heads=2, num_key_value_heads=2), KVBlockPool())
+        for layer_idx in range(2):
+            cache.update(torch.randn(1, 2, tokens, 4), torch.randn(1, 2, tokens, 4), layer_idx)
+        sessions.keep("session-1", "pipe-1", cache, tokens, job.input_ids[:tokens])
+        job.resume_session_id = "session-1"
+        return sessions
+
+    def test_job_goes_on_from_its_session(self):
+        receiver, router, job = self.make({"node-b": 40})
+        self.keep_session(job, 40)
+
+        receiver.prefixes.match_prefix(job)
+
+        self.assertEqual(job.prefix_tokens, 40)
+        _, data = router.sent[0]
+        bts = ByteHelper(data)
+        self.assertEqual(bts.read_int(), SESSION_PROTOCOL)
+        # Blocks are not looked up when the session covers the prompt
+        self.assertEqual(len(router.sent), 1)
+
+    def test_session_query_is_answered_with_the_tokens_set_aside(self):
+        receiver, router, job = self.make({"node-b": 40})
+        sessions = self.keep_session(job, 40)
+        receiver.prefixes.match_prefix(job)
+        sessions.keep("session-1", "pipe-1", sessions.resume("job-1", 40), 40)  # pyright: ignore[reportArgumentType]
+        bts = ByteHelper(router.sent[0][1])
+        bts.read_int()
+
+        reply = receiver.prefixes.receive_session("node-c", bts.read_bytes())
+
+        self.assertEqual(ByteHelper(reply).read_int(), 40)
+
+    def test_prompt_blocks_are_used_when_a_node_lost_the_session(self):
+        receiver, router, job = self.make({"node-b": 0})
+        self.keep_session(job, 40)
+
+        receiver.prefixes.match_prefix(job)
+
+        # node-b answers the block query with no blocks too
+        self.assertEqual(job.prefix_tokens, 0)
+        self.assertEqual(len(router.sent), 2)
 
 
 if __name__ == "__main__":
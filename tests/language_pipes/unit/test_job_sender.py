@@ -0,0 +1,318 @@
+import os
+import sys
+import threading
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'tests', 'language_pipes', 'unit'))
+
+from language_pipes.jobs.job_sender import HOP_ATTEMPTS, MIN_HOP_DEADLINE, MIN_TIMED_BYTES, SEND_QUEUE_SIZE, HopTimer, JobSender
+from language_pipes.jobs.network_job import HopReply
+
+from util import make_job, make_job_data
+
+
+class RecordingPipe:
+    """Records what was sent. Sends to `blocked` nodes wait until `release` is
+    set, and the first `busy` sends are turned away. Answers carry `credit`."""
+    def __init__(self, blocked=(), busy: int = 0, credit=None):
+        self.blocked = blocked
+        self.busy = busy
+        self.credit = credit
+        self.release = threading.Event()
+        self.sent = []
+        self.attempts = 0
+        self.timeouts = []
+        self.done = threading.Condition()
+
+    def send_job(self, network_job, node_id: str, timeout=None) -> HopReply:
+        self.attempts += 1
+        self.timeouts.append(timeout)
+        if node_id in self.blocked:
+            self.release.wait(5)
+        if network_job.job_id == "broken":
+            raise Exception("connection refused")
+        if self.busy > 0:
+            self.busy -= 1
+            return HopReply(False, self.credit)
+        with self.done:
+            self.sent.append((network_job.job_id, node_id))
+            self.done.notify_all()
+        return HopReply(True, self.credit)
+
+    def wait_for(self, count: int) -> bool:
+        with self.done:
+            return self.done.wait_for(lambda: len(self.sent) >= count, 5)
+
+
+def make_pass(job_id: str):
+    job = make_job()
+    job.job_id = job_id
+    job.data = make_job_data()
+    return job
+
+
+class JobSenderTests(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("language_pipes.jobs.job_sender.RETRY_WAIT", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lost = []
+        self.lost_event = threading.Event()
+        def on_lost(job, node_id, reason):
+            self.lost.append((job.job_id, node_id))
+            self.lost_event.set()
+        self.asked = []
+        self.returned = threading.Event()
+        def ask_credit(node_id):
+            self.asked.append(node_id)
+            return None
+        self.sender = JobSender(lambda: False, on_lost, ask_credit, lambda node_id: self.returned.set())
+
+    def tearDown(self):
+        self.sender.stop()
+
+    def test_sends_passes_in_order_per_node(self):
+        pipe = RecordingPipe()
+
+        for i in range(3):
+            self.sender.send(pipe, make_pass(f"job-{i}"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.assertTrue(pipe.wait_for(3))
+        self.assertEqual(pipe.sent, [("job-0", "node-b"), ("job-1", "node-b"), ("job-2", "node-b")])
+
+    def test_slow_node_does_not_hold_up_other_nodes(self):
+        pipe = RecordingPipe(blocked=("node-b",))
+
+        self.sender.send(pipe, make_pass("to-b"), "node-b")  # pyright: ignore[reportArgumentType]
+        self.sender.send(pipe, make_pass("to-c"), "node-c")  # pyright: ignore[reportArgumentType]
+
+        self.assertTrue(pipe.wait_for(1))
+        self.assertEqual(pipe.sent, [("to-c", "node-c")])
+        pipe.release.set()
+        self.assertTrue(pipe.wait_for(2))
+
+    def test_blocks_once_a_node_is_too_far_behind(self):
+        pipe = RecordingPipe(blocked=("node-b",))
+        # One pass is being sent, SEND_QUEUE_SIZE wait behind it
+        for i in range(SEND_QUEUE_SIZE + 1):
+            self.sender.send(pipe, make_pass(f"job-{i}"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        handed_over = threading.Event()
+        def send_one_more():
+            self.sender.send(pipe, make_pass("one-more"), "node-b")  # pyright: ignore[reportArgumentType]
+            handed_over.set()
+        threading.Thread(target=send_one_more).start()
+
+        self.assertFalse(handed_over.wait(0.3))
+        pipe.release.set()
+        self.assertTrue(handed_over.wait(5))
+        self.assertTrue(pipe.wait_for(SEND_QUEUE_SIZE + 2))
+
+    def test_sends_the_pass_as_it_was_handed_over(self):
+        pipe = RecordingPipe(blocked=("node-b",))
+        packets = []
+        send_job = pipe.send_job
+        def record_packet(network_job, node_id, timeout=None):
+            packets.append(network_job)
+            return send_job(network_job, node_id, timeout)
+        pipe.send_job = record_packet  # pyright: ignore[reportAttributeAccessIssue]
+        job = make_pass("job-1")
+        sent_data = job.data
+
+        self.sender.send(pipe, job, "node-b")  # pyright: ignore[reportArgumentType]
+        # The origin moves on to the next prefill chunk before the send goes out
+        job.data = make_job_data()
+        job.current_layer = 3
+        pipe.release.set()
+
+        self.assertTrue(pipe.wait_for(1))
+        self.assertIs(packets[0].data, sent_data)
+        self.assertEqual(packets[0].current_layer, 0)
+        self.assertNotEqual(packets[0].data_hash, b"")
+
+    def test_skips_passes_of_canceled_jobs(self):
+        pipe = RecordingPipe()
+        canceled = make_pass("canceled")
+        canceled.cancel_reason = "layers unloaded"
+
+        self.sender.send(pipe, canceled, "node-b")  # pyright: ignore[reportArgumentType]
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.assertTrue(pipe.wait_for(1))
+        self.assertEqual(pipe.sent, [("job-1", "node-b")])
+
+    def test_failed_send_does_not_stop_the_lane(self):
+        pipe = RecordingPipe()
+
+        self.sender.send(pipe, make_pass("broken"), "node-b")  # pyright: ignore[reportArgumentType]
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.assertTrue(pipe.wait_for(1))
+        self.assertEqual(pipe.sent, [("job-1", "node-b")])
+
+    def test_pass_turned_away_is_sent_again(self):
+        pipe = RecordingPipe(busy=2)
+
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.assertTrue(pipe.wait_for(1))
+        self.assertEqual(pipe.attempts, 3)
+        self.assertEqual(self.lost, [])
+
+    def test_pass_that_never_gets_through_is_reported_lost(self):
+        pipe = RecordingPipe()
+
+        self.sender.send(pipe, make_pass("broken"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.assertTrue(self.lost_event.wait(5))
+        self.assertEqual(self.lost, [("broken", "node-b")])
+        self.assertEqual(pipe.attempts, HOP_ATTEMPTS)
+
+    def test_hops_have_a_deadline(self):
+        pipe = RecordingPipe()
+
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.assertTrue(pipe.wait_for(1))
+        self.assertEqual(pipe.timeouts, [MIN_HOP_DEADLINE])
+
+    def test_notice_goes_out_behind_earlier_passes(self):
+        pipe = RecordingPipe()
+
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+        self.sender.send_notice("node-b", lambda: pipe.send_job(make_pass("notice"), "node-b"))
+
+        self.assertTrue(pipe.wait_for(2))
+        self.assertEqual(pipe.sent, [("job-1", "node-b"), ("notice", "node-b")])
+
+    def test_holds_passes_for_a_node_without_credit(self):
+        pipe = RecordingPipe(credit=0)
+        self.sender.ask_credit = lambda node_id: 0
+        self.sender.set_credit("node-b", 0)
+
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.assertFalse(pipe.wait_for(1))
+        self.assertEqual(pipe.attempts, 0)
+
+    def test_credit_coming_back_lets_the_pass_go(self):
+        pipe = RecordingPipe(credit=3)
+        self.sender.set_credit("node-b", 0)
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.sender.set_credit("node-b", 2)
+
+        self.assertTrue(pipe.wait_for(1))
+        self.assertTrue(self.returned.wait(5))
+        self.assertEqual(self.sender.credit("node-b"), 3)
+
+    @patch("language_pipes.jobs.job_sender.CREDIT_WAIT", 0.01)
+    def test_asks_for_credit_it_has_not_heard_back_about(self):
+        pipe = RecordingPipe()
+        self.sender.set_credit("node-b", 0)
+
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        # The node does not say, so the pass goes out
+        self.assertTrue(pipe.wait_for(1))
+        self.assertEqual(self.asked, ["node-b"])
+
+    def test_busy_answer_with_credit_is_not_a_failed_attempt(self):
+        pipe = RecordingPipe(busy=HOP_ATTEMPTS, credit=0)
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+        self.assertFalse(self.lost_event.wait(0.3))
+
+        pipe.credit = 1
+        self.sender.set_credit("node-b", 1)
+
+        self.assertTrue(pipe.wait_for(1))
+        self.assertEqual(self.lost, [])
+
+    @patch("language_pipes.jobs.job_sender.MAX_CREDIT_WAIT", 0.0)
+    def test_node_that_never_has_room_costs_the_job(self):
+        pipe = RecordingPipe(busy=HOP_ATTEMPTS, credit=0)
+
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.assertTrue(self.lost_event.wait(5))
+        self.assertEqual(pipe.attempts, HOP_ATTEMPTS)
+
+    def test_send_returns_after_stop(self):
+        pipe = RecordingPipe(blocked=("node-b",))
+        for i in range(SEND_QUEUE_SIZE + 1):
+            self.sender.send(pipe, make_pass(f"job-{i}"), "node-b")  # pyright: ignore[reportArgumentType]
+
+        self.sender.stop()
+        self.sender.send(pipe, make_pass("late"), "node-b")  # pyright: ignore[reportArgumentType]
+        pipe.release.set()
+
+    def lane_thread(self, node_id: str) -> threading.Thread:
+        thread = self.sender.lanes[node_id].thread
+        assert thread is not None
+        return thread
+
+    def test_lane_thread_is_a_daemon_that_ends_on_stop(self):
+        pipe = RecordingPipe()
+        self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+        thread = self.lane_thread("node-b")
+
+        self.assertTrue(thread.daemon)
+        self.sender.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_lane_of_a_node_that_left_ends_after_its_passes(self):
+        pipe = RecordingPipe(blocked=("node-b",))
+        for i in range(2):
+            self.sender.send(pipe, make_pass(f"job-{i}"), "node-b")  # pyright: ignore[reportArgumentType]
+        thread = self.lane_thread("node-b")
+
+        self.sender.retire_lanes(["node-a", "node-c"])
+        pipe.release.set()
+
+        self.assertTrue(pipe.wait_for(2))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.sender.lanes, { })
+        # A node that comes back gets a new lane
+        self.sender.send(pipe, make_pass("job-2"), "node-b")  # pyright: ignore[reportArgumentType]
+        self.assertTrue(pipe.wait_for(3))
+
+    def test_idle_lane_ends(self):
+        pipe = RecordingPipe()
+        with patch("language_pipes.jobs.job_sender.LANE_IDLE_TIMEOUT", 0), patch("language_pipes.jobs.job_sender.IDLE_WAIT", 0.01):
+            self.sender.send(pipe, make_pass("job-1"), "node-b")  # pyright: ignore[reportArgumentType]
+            self.assertTrue(pipe.wait_for(1))
+            self.lane_thread("node-b").join(5)
+
+        self.assertEqual(self.sender.lanes, { })
+
+
+class HopTimerTests(unittest.TestCase):
+    def test_deadline_follows_the_measured_rate(self):
+        timer = HopTimer()
+        size = 100 * MIN_TIMED_BYTES
+
+        timer.record(size, 2.0)
+
+        self.assertAlmostEqual(timer.deadline(size), 8.0)
+        self.assertAlmostEqual(timer.deadline(size // 2), 4.0)
+
+    def test_small_passes_get_the_shortest_deadline(self):
+        timer = HopTimer()
+        timer.record(100 * MIN_TIMED_BYTES, 2.0)
+
+        self.assertEqual(timer.deadline(100), MIN_HOP_DEADLINE)
+
+    def test_small_passes_do_not_change_the_rate(self):
+        timer = HopTimer()
+
+        timer.record(100, 1.0)
+
+        self.assertIsNone(timer.seconds_per_byte)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -11,7 +11,7 @@ from transformers import PretrainedConfig
 from language_pipes.jobs.job import Job
 from language_pipes.jobs.job_data import JobData
 from language_pipes.jobs.job_progress import JobProgress
-from language_pipes.jobs.job_tracker import JobTracker
+from language_pipes.jobs.job_tracker import EXPIRED_JOB_TIME, CompletedJobs, JobTracker
 from language_pipes.jobs.network_job import NetworkJob
 from language_pipes.util.enums import ComputeStep, JobStatus
 
@@ -61,7 +61,7 @@ class CancelJobTests(unittest.TestCase):
         tracker = make_tracker()
         resolved = []
         job = make_job(resolve=lambda j: resolved.append(j))
-        tracker.jobs_pending["key-1"] = [job]
+        tracker.track_job("key-1", job)
 
         tracker.cancel_job(job, "layers for model-1 unloaded")
 
@@ -70,7 +70,7 @@ class CancelJobTests(unittest.TestCase):
     def test_cancel_records_reason_and_status(self):
         tracker = make_tracker()
         job = make_job()
-        tracker.jobs_pending["key-1"] = [job]
+        tracker.track_job("key-1", job)
 
         tracker.cancel_job(job, "end model for model-1 unloaded")
 
@@ -81,18 +81,18 @@ class CancelJobTests(unittest.TestCase):
     def test_cancel_removes_job_from_pending(self):
         tracker = make_tracker()
         job = make_job()
-        tracker.jobs_pending["key-1"] = [job]
+        tracker.track_job("key-1", job)
 
         tracker.cancel_job(job, "unloaded")
 
-        self.assertEqual(tracker.jobs_pending["key-1"], [])
+        self.assertEqual(tracker.jobs_for_key("key-1"), [])
         self.assertIsNone(tracker.get_job("job-1"))
 
     def test_cancel_is_a_no_op_once_completed(self):
         tracker = make_tracker()
         resolved = []
         job = make_job(resolve=lambda j: resolved.append(j))
-        tracker.jobs_pending["key-1"] = [job]
+        tracker.track_job("key-1", job)
         tracker.complete_job(job)
 
         tracker.cancel_job(job, "unloaded")
@@ -105,11 +105,11 @@ class CancelJobTests(unittest.TestCase):
         # still have to leave the pending list rather than wait for the timeout.
         tracker = make_tracker()
         job = make_job()
-        tracker.jobs_pending["network"] = [job]
+        tracker.track_job("network", job)
 
         tracker.complete_job(job)
 
-        self.assertEqual(tracker.jobs_pending["network"], [])
+        self.assertEqual(tracker.jobs_for_key("network"), [])
 
 
 class JobLookupTests(unittest.TestCase):
@@ -117,7 +117,8 @@ class JobLookupTests(unittest.TestCase):
         tracker = make_tracker()
         on_pipe = make_job("job-1", pipe_id="pipe-1")
         off_pipe = make_job("job-2", pipe_id="pipe-2")
-        tracker.jobs_pending["network"] = [on_pipe, off_pipe]
+        tracker.track_job("network", on_pipe)
+        tracker.track_job("network", off_pipe)
 
         self.assertEqual(tracker.jobs_for_pipes(["pipe-1"]), [on_pipe])
 
@@ -125,7 +126,8 @@ class JobLookupTests(unittest.TestCase):
         tracker = make_tracker()
         ours = make_job("job-1", origin_node_id="node-a")
         theirs = make_job("job-2", origin_node_id="node-b")
-        tracker.jobs_pending["network"] = [ours, theirs]
+        tracker.track_job("network", ours)
+        tracker.track_job("network", theirs)
 
         self.assertEqual(tracker.jobs_for_model("model-1", "node-a"), [ours])
         self.assertEqual(len(tracker.jobs_for_model("model-1")), 2)
@@ -133,11 +135,144 @@ class JobLookupTests(unittest.TestCase):
     def test_jobs_for_model_ignores_other_models(self):
         tracker = make_tracker()
         job = make_job("job-1", model_id="model-2")
-        tracker.jobs_pending["network"] = [job]
+        tracker.track_job("network", job)
 
         self.assertEqual(tracker.jobs_for_model("model-1"), [])
 
 
+class JobIndexTests(unittest.TestCase):
+    def test_removed_job_leaves_every_index(self):
+        tracker = make_tracker()
+        job = make_job("job-1")
+        tracker.track_job("key-1", job)
+
+        tracker.remove_job("job-1")
+
+        self.assertIsNone(tracker.get_job("job-1"))
+        self.assertEqual(tracker.count_jobs("key-1"), 0)
+        self.assertEqual(tracker.jobs_for_pipes(["pipe-1"]), [])
+        self.assertEqual(tracker.jobs_for_model("model-1"), [])
+        self.assertEqual(tracker.jobs_by_key, { })
+
+    def test_a_job_is_tracked_once(self):
+        tracker = make_tracker()
+
+        self.assertTrue(tracker.track_job("key-1", make_job("job-1")))
+        self.assertFalse(tracker.track_job("key-2", make_job("job-1")))
+        self.assertEqual(tracker.count_jobs("key-2"), 0)
+
+
+class RemoveHookTests(unittest.TestCase):
+    def test_hook_hears_of_every_job_that_leaves(self):
+        removed = []
+        with patch("language_pipes.jobs.job_tracker.Thread"):
+            tracker = JobTracker(on_remove=removed.append)
+        finished = make_job("job-1")
+        expired = make_job("job-2")
+        expired.last_update = 1000.0
+        tracker.track_job("key-1", finished)
+        tracker.track_job("key-1", expired)
+
+        tracker.complete_job(finished)
+        tracker.expire_jobs(1000.0 + EXPIRED_JOB_TIME)
+        tracker.remove_job("job-1")
+
+        self.assertEqual(removed, ["job-1", "job-2"])
+
+    def test_leaving_job_hands_back_its_kv_blocks(self):
+        tracker = make_tracker()
+        finished = make_job("job-1")
+        expired = make_job("job-2")
+        expired.last_update = 1000.0
+        for job in [finished, expired]:
+            job.cache.update(torch.zeros(1, 1, 3, 4), torch.zeros(1, 1, 3, 4), 0)
+            tracker.track_job("key-1", job)
+
+        tracker.complete_job(finished)
+        tracker.expire_jobs(1000.0 + EXPIRED_JOB_TIME)
+
+        self.assertEqual(finished.cache.held_bytes(), 0)
+        self.assertEqual(expired.cache.held_bytes(), 0)
+
+    def test_complete_hook_hears_of_finished_and_canceled_jobs_once(self):
+        completed = []
+        with patch("language_pipes.jobs.job_tracker.Thread"):
+            tracker = JobTracker(on_complete=lambda job: completed.append(job.job_id))
+        finished = make_job("job-1")
+        canceled = make_job("job-2")
+        tracker.track_job("key-1", finished)
+        tracker.track_job("key-1", canceled)
+
+        tracker.complete_job(finished)
+        tracker.complete_job(finished)
+        tracker.cancel_job(canceled, "layers unloaded")
+
+        self.assertEqual(completed, ["job-1", "job-2"])
+
+
+class ExpiryTests(unittest.TestCase):
+    def test_job_expires_after_its_last_update(self):
+        tracker = make_tracker()
+        job = make_job()
+        job.last_update = 1000.0
+        tracker.track_job("key-1", job)
+
+        self.assertEqual(tracker.expire_jobs(1000.0 + EXPIRED_JOB_TIME - 1), [])
+        self.assertEqual(tracker.expire_jobs(1000.0 + EXPIRED_JOB_TIME), ["job-1"])
+        self.assertIsNone(tracker.get_job("job-1"))
+
+    def test_updated_job_gets_a_new_deadline(self):
+        tracker = make_tracker()
+        job = make_job()
+        job.last_update = 1000.0
+        tracker.track_job("key-1", job)
+        job.last_update = 1030.0
+
+        self.assertEqual(tracker.expire_jobs(1000.0 + EXPIRED_JOB_TIME), [])
+        self.assertEqual(tracker.next_deadline(), 1030.0 + EXPIRED_JOB_TIME)
+        self.assertEqual(tracker.expire_jobs(1030.0 + EXPIRED_JOB_TIME), ["job-1"])
+
+    def test_stale_job_is_dropped_when_its_deadline_comes_up(self):
+        tracker = make_tracker()
+        job = make_job()
+        job.last_update = 1000.0
+        tracker.track_job("key-1", job)
+        job.last_update = 1050.0
+        job.stale = True
+
+        self.assertEqual(tracker.expire_jobs(1000.0 + EXPIRED_JOB_TIME), ["job-1"])
+
+
+class CompletedJobsTests(unittest.TestCase):
+    def test_ids_are_forgotten_after_their_time(self):
+        completed = CompletedJobs(ttl=10, max_size=100)
+        completed.add("job-1", 1000.0)
+
+        completed.prune(1005.0)
+        self.assertEqual(len(completed), 1)
+        completed.prune(1011.0)
+        self.assertEqual(len(completed), 0)
+
+    def test_oldest_ids_make_room_for_new_ones(self):
+        completed = CompletedJobs(ttl=10, max_size=2)
+        for i in range(3):
+            completed.add(f"job-{i}")
+
+        self.assertNotIn("job-0", completed)
+        self.assertIn("job-1", completed)
+        self.assertIn("job-2", completed)
+
+    def test_completed_job_is_remembered_after_it_leaves(self):
+        tracker = make_tracker()
+        job = make_job()
+        tracker.track_job("network", job)
+
+        tracker.complete_job(job)
+
+        self.assertIsNone(tracker.get_job("job-1"))
+        self.assertTrue(tracker.is_completed("job-1"))
+
+
 class AddJobTests(unittest.TestCase):
     """`add_job` builds the local record for a job this node only hosts layers
     for, so anything the origin owns has to stay unset here."""
@@ -0,0 +1,452 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'tests', 'language_pipes', 'unit'))
+
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig
+
+from llm_layer_collector import LlmLayerCollector
+from llm_layer_collector.auto.static_auto_model import StaticAutoModel
+
+from language_pipes.jobs.job import Job
+from language_pipes.jobs.job_cancel import JobCancel
+from language_pipes.jobs.job_data import computationStateToJobData
+from language_pipes.jobs.job_receiver import JobReceiver
+from language_pipes.jobs.job_tracker import JobTracker
+from language_pipes.jobs.network_job import NetworkJob
+from language_pipes.modeling.compute import _rewind, compute_layers
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, KVBlockPool, PagedCache
+from language_pipes.pipes.pipe import Pipe
+from language_pipes.pipes.pipe_manager import PipeManager
+from language_pipes.util.enums import ComputeStep
+
+from util import FakeEndModel, FakeModel, FakeStateNetworkNode, make_job_data
+
+HEADS = 2
+HEAD_DIM = 4
+NUM_LAYERS = 8
+
+
+def make_config() -> LlamaConfig:
+    return LlamaConfig(
+        num_hidden_layers=NUM_LAYERS,
+        hidden_size=HEADS * HEAD_DIM,
+        num_attention_heads=HEADS,
+        num_key_value_heads=HEADS
+    )
+
+
+def make_decoding_job(origin_node_id: str = "node-a", tokens: int = 10) -> Job:
+    """A job that has decoded a few tokens and sent as many passes."""
+    job = Job(origin_node_id=origin_node_id, messages=[], pipe_id="pipe-1", model_id="model-1", config=make_config())
+    job.job_id = "job-1"
+    job.input_ids = list(range(tokens))
+    job.prompt_tokens = tokens - 3
+    job.current_token = 3
+    job.passes_sent = 4
+    job.pass_id = 4
+    job.compute_step = ComputeStep.LAYER
+    job.current_layer = 4
+    return job
+
+
+def keys(cache: PagedCache, layer_idx: int) -> torch.Tensor:
+    k, _ = cache.layers[layer_idx]._gather()  # pyright: ignore[reportAttributeAccessIssue]
+    return k
+
+
+def segment(process_id: str, node_id: str, start_layer: int, end_layer: int):
+    return SimpleNamespace(process_id=process_id, node_id=node_id, start_layer=start_layer, end_layer=end_layer)
+
+
+class ReplayTests(unittest.TestCase):
+    def test_replay_prefills_every_token_in_chunks(self):
+        job = make_decoding_job()
+
+        job.start_replay(4, 8, chunk_size=4)
+
+        self.assertTrue(job.replaying())
+        self.assertEqual(job.replay_id, 5)
+        self.assertEqual(job.compute_step, ComputeStep.EMBED)
+        self.assertEqual(job.current_layer, 0)
+        self.assertEqual(job.embed_tokens(), 10)
+        self.assertEqual(job.chunking.total_chunks, 3)
+        self.assertEqual(job.past_seen_tokens(), 0)
+
+    def test_layers_before_the_rebuilt_ones_run_on_a_cache_of_their_own(self):
+        job = make_decoding_job()
+        job.start_replay(4, 8)
+
+        scratch = job.layer_cache()
+
+        self.assertIsNot(scratch, job.cache)
+        self.assertIs(job.layer_cache(), scratch)
+        job.current_layer = 4
+        self.assertIs(job.layer_cache(), job.cache)
+
+    def test_next_replay_starts_on_a_new_cache(self):
+        job = make_decoding_job()
+        job.start_replay(4, 8)
+        scratch = job.layer_cache()
+        job.end_replay()
+        job.passes_sent = 9
+
+        job.start_replay(4, 8)
+
+        self.assertIsNot(job.layer_cache(), scratch)
+
+    def test_replay_pass_goes_back_once_the_rebuilt_layers_are_done(self):
+        job = make_decoding_job()
+        job.start_replay(2, 4)
+        job.compute_step = ComputeStep.LAYER
+        job.data = make_job_data()
+
+        job.set_layer(torch.zeros((1, 1)), 4, NUM_LAYERS)
+
+        self.assertEqual(job.compute_step, ComputeStep.HEAD)
+        self.assertEqual(job.current_layer, 0)
+
+    def test_end_of_the_replay_goes_back_to_decoding(self):
+        job = make_decoding_job()
+        job.start_replay(4, 8)
+
+        job.end_replay()
+
+        self.assertFalse(job.replaying())
+        self.assertEqual(job.embed_tokens(), job.prompt_tokens)
+        self.assertEqual(job.past_seen_tokens(), 9)
+        self.assertIs(job.layer_cache(), job.cache)
+
+    def test_nodes_off_the_origin_follow_the_replay(self):
+        origin = make_decoding_job()
+        origin.start_replay(4, 8)
+        node = make_decoding_job()
+
+        packet, _ = NetworkJob.from_bytes(origin.to_network_job().to_bytes())
+        node.receive_network_job(packet, "node-b")
+        self.assertEqual((node.replay_id, node.replay_start, node.replay_end), (5, 4, 8))
+        self.assertIsNot(node.layer_cache(), node.cache)
+
+        origin.end_replay()
+        packet, _ = NetworkJob.from_bytes(origin.to_network_job().to_bytes())
+        node.receive_network_job(packet, "node-b")
+        self.assertFalse(node.replaying())
+        self.assertIsNone(node.replay_cache)
+
+
+class RewindTests(unittest.TestCase):
+    def make(self, start: int):
+        cache = PagedCache(make_config(), KVBlockPool())
+        for layer_idx in range(2):
+            kv = torch.randn(1, HEADS, BLOCK_TOKENS + 4, HEAD_DIM)
+            cache.update(kv, kv, layer_idx)
+        layers = [SimpleNamespace(cls=SimpleNamespace(layer_idx=i)) for i in range(2)]
+        job_data = make_job_data()
+        job_data.cache_position = torch.arange(start, start + 1)
+        return cache, layers, job_data
+
+    def test_tokens_from_the_start_of_the_pass_on_are_dropped(self):
+        cache, layers, job_data = self.make(BLOCK_TOKENS + 1)
+
+        _rewind(cache, layers, job_data)  # pyright: ignore[reportArgumentType]
+
+        self.assertEqual([cache.layers[i].get_seq_length() for i in range(2)], [BLOCK_TOKENS + 1] * 2)
+
+    def test_pass_from_the_first_token_starts_over(self):
+        cache, layers, job_data = self.make(0)
+
+        _rewind(cache, layers[1:], job_data)  # pyright: ignore[reportArgumentType]
+
+        self.assertEqual(cache.layers[0].get_seq_length(), BLOCK_TOKENS + 4)
+        self.assertEqual(cache.layers[1].get_seq_length(), 0)
+
+    def test_cache_that_holds_no_more_is_left_alone(self):
+        cache, layers, job_data = self.make(BLOCK_TOKENS + 4)
+
+        _rewind(cache, layers, job_data)  # pyright: ignore[reportArgumentType]
+
+        self.assertEqual(cache.layers[1].get_seq_length(), BLOCK_TOKENS + 4)
+
+
+class JobPipeTests(unittest.TestCase):
+    def test_failed_over_segments_take_the_place_of_every_segment_they_cover(self):
+        pipe = Pipe(FakeStateNetworkNode("node-a"), "pipe-1", "model-1", Path("."))  # pyright: ignore[reportArgumentType]
+        pipe.segments = [FakeModel("node-a", 0, 3), FakeModel("node-b", 4, 5), FakeModel("node-c", 6, 7)]  # pyright: ignore[reportAttributeAccessIssue]
+        replica = FakeModel("node-d", 4, 7)
+        manager = PipeManager(SimpleNamespace(layer_models=[]), SimpleNamespace(get_model=lambda p: None))  # pyright: ignore[reportArgumentType]
+        manager.get_pipe_by_pipe_id = lambda pipe_id: pipe  # pyright: ignore[reportAttributeAccessIssue]
+        manager._get_segment = lambda process_id: replica if process_id == "p9" else None  # pyright: ignore[reportAttributeAccessIssue]
+
+        job_pipe = manager.get_job_pipe("pipe-1", {4: "p9"})
+
+        assert job_pipe is not None
+        self.assertEqual([s.node_id for s in job_pipe.segments], ["node-a", "node-d"])
+
+
+class FailOverPipeManager:
+    """pipe-1 runs layers 0-3 on node-a and 4-7 on node-b. Another pipe's
+    segments are what `cover` finds."""
+    def __init__(self, router, segments):
+        self.segments = segments
+        self.covered = []
+        self.router_pipes = SimpleNamespace(router=router, cover=self.cover)
+        self.pipe = Pipe(FakeStateNetworkNode("node-a"), "pipe-1", "model-1", Path("."))  # pyright: ignore[reportArgumentType]
+        self.pipe.segments = [FakeModel("node-a", 0, 3), FakeModel("node-b", 4, 7, virtual=True)]  # pyright: ignore[reportAttributeAccessIssue]
+
+    def cover(self, model_id, pipe_id, start_layer, end_layer, exclude_node_id=None):
+        self.covered.append((model_id, pipe_id, start_layer, end_layer, exclude_node_id))
+        return [s for s in self.segments if s.start_layer >= start_layer and s.end_layer <= end_layer]
+
+    def get_pipe_by_pipe_id(self, pipe_id: str):
+        return self.pipe
+
+    def get_job_pipe(self, pipe_id: str, segment_moves):
+        return self.pipe
+
+
+class Router:
+    def __init__(self, node_id: str):
+        self._node_id = node_id
+        self.sent = []
+
+    def node_id(self):
+        return self._node_id
+
+    def send_to_node(self, node_id: str, data: bytes):
+        self.sent.append((node_id, data))
+
+
+def make_receiver(node_id: str = "node-a", segments=()):
+    tracker = JobTracker()
+    tracker.shutdown = True
+    receiver = JobReceiver(
+        job_factory=None,   # pyright: ignore[reportArgumentType]
+        job_tracker=tracker,
+        pipe_manager=FailOverPipeManager(Router(node_id), list(segments)),  # pyright: ignore[reportArgumentType]
+        model_manager=SimpleNamespace(get_end_model=lambda model_id: FakeEndModel(num_local_layers=0)),  # pyright: ignore[reportArgumentType]
+        is_shutdown=lambda: True,
+        get_max_node_jobs=lambda: 10,
+        get_max_batch_size=lambda: 8,
+        get_round_token_budget=lambda: 256,
+        get_max_prefill_share=lambda: 0.5,
+    )
+    return receiver, tracker
+
+
+def track(tracker: JobTracker, origin_node_id: str = "node-a") -> Job:
+    job = make_decoding_job(origin_node_id)
+    tracker.track_job("network", job)
+    return job
+
+
+class FailOverTests(unittest.TestCase):
+    def test_job_goes_on_through_another_pipes_segment(self):
+        receiver, tracker = make_receiver(segments=[segment("p9", "node-c", 4, 7)])
+        job = track(tracker)
+
+        self.assertTrue(receiver.fail_over(job, 4))
+
+        self.assertEqual(receiver.pipe_manager.covered, [("model-1", "pipe-1", 4, 7, "node-b")])  # pyright: ignore[reportAttributeAccessIssue]
+        self.assertEqual(job.segment_moves, {4: "p9"})
+        self.assertEqual((job.replay_start, job.replay_end), (4, 8))
+        self.assertEqual(job.compute_step, ComputeStep.EMBED)
+        self.assertEqual(receiver.queued_job_ids(), ["job-1"])
+
+    def test_layers_no_node_hosts_fail_over_together(self):
+        receiver, tracker = make_receiver(segments=[segment("p9", "node-c", 4, 5), segment("p10", "node-d", 6, 7)])
+        receiver.pipe_manager.pipe.segments = receiver.pipe_manager.pipe.segments[:1]  # pyright: ignore[reportAttributeAccessIssue]
+        job = track(tracker)
+        job.segment_moves = {0: "p0", 6: "p5"}
+
+        self.assertTrue(receiver.fail_over(job, 4))
+
+        self.assertEqual(receiver.pipe_manager.covered, [("model-1", "pipe-1", 4, 7, None)])  # pyright: ignore[reportAttributeAccessIssue]
+        self.assertEqual(job.segment_moves, {0: "p0", 4: "p9", 6: "p10"})
+
+    def test_job_without_replica_segments_is_canceled(self):
+        receiver, tracker = make_receiver()
+        job = track(tracker)
+
+        receiver._lose_layer(job, 4, "no node hosts layer 4")
+
+        self.assertEqual(job.cancel_reason, "no node hosts layer 4")
+        self.assertFalse(job.replaying())
+
+    def test_prefilling_and_bounded_jobs_do_not_fail_over(self):
+        receiver, tracker = make_receiver(segments=[segment("p9", "node-c", 4, 7)])
+        job = track(tracker)
+        job.current_token = 0
+        self.assertFalse(receiver.fail_over(job, 4))
+
+        job.current_token = 3
+        job.kv_window_tokens = 64
+        self.assertFalse(receiver.fail_over(job, 4))
+
+    def test_node_asks_the_origin_to_fail_the_job_over(self):
+        receiver, tracker = make_receiver("node-b")
+        job = track(tracker)
+
+        receiver._lose_layer(job, 4, "no node hosts layer 4")
+
+        self.assertIsNone(job.cancel_reason)
+        node_id, _ = receiver.pipe_manager.router_pipes.router.sent[0]  # pyright: ignore[reportAttributeAccessIssue]
+        self.assertEqual(node_id, "node-a")
+
+    def test_origin_fails_over_the_pass_a_node_lost(self):
+        receiver, tracker = make_receiver(segments=[segment("p9", "node-c", 4, 7)])
+        job = track(tracker)
+
+        receiver.receive_cancel("node-b", JobCancel("job-1", "pipe-1", "lost", lost_layer=4, pass_id=4).to_bytes())
+
+        self.assertTrue(job.replaying())
+        self.assertIsNone(job.cancel_reason)
+
+    def test_report_about_a_pass_the_job_gave_up_on_is_ignored(self):
+        receiver, tracker = make_receiver(segments=[segment("p9", "node-c", 4, 7)])
+        job = track(tracker)
+
+        receiver.receive_cancel("node-b", JobCancel("job-1", "pipe-1", "lost", lost_layer=4, pass_id=3).to_bytes())
+
+        self.assertFalse(job.replaying())
+        self.assertIsNone(job.cancel_reason)
+
+    def test_pass_given_up_on_is_dropped_when_it_comes_back(self):
+        job = make_decoding_job()
+        packet = job.to_network_job()
+        packet.compute_step = ComputeStep.HEAD
+
+        self.assertFalse(JobReceiver._gave_up_on(job, packet, "node-a"))
+        job.number_pass()
+        self.assertTrue(JobReceiver._gave_up_on(job, packet, "node-a"))
+        self.assertFalse(JobReceiver._gave_up_on(job, packet, "node-b"))
+
+    def test_chunk_sent_before_a_lost_chunk_was_sent_again_is_dropped(self):
+        job = make_decoding_job()
+        job.current_token = 0
+        job.chunking.init(100, 32)
+        job.number_pass()
+        job.advance_chunk()
+        job.number_pass()
+        packet = job.to_network_job()
+        packet.compute_step = ComputeStep.HEAD
+
+        self.assertFalse(JobReceiver._gave_up_on(job, packet, "node-a"))
+        job.chunking.restart(0)
+        self.assertTrue(JobReceiver._gave_up_on(job, packet, "node-a"))
+
+    def test_stalled_pass_fails_over_once_a_layer_has_no_host(self):
+        receiver, tracker = make_receiver(segments=[segment("p9", "node-c", 4, 7)])
+        receiver.pipe_manager.pipe.segments = receiver.pipe_manager.pipe.segments[:1]  # pyright: ignore[reportAttributeAccessIssue]
+        job = track(tracker)
+
+        receiver._fail_over_stalled({"job-1": 4})
+
+        self.assertTrue(job.replaying())
+        self.assertEqual(job.replay_start, 4)
+
+    def test_pass_that_came_back_is_not_failed_over(self):
+        receiver, tracker = make_receiver(segments=[segment("p9", "node-c", 4, 7)])
+        receiver.pipe_manager.pipe.segments = receiver.pipe_manager.pipe.segments[:1]  # pyright: ignore[reportAttributeAccessIssue]
+        job = track(tracker)
+
+        receiver._fail_over_stalled({"job-1": 3})
+
+        self.assertFalse(job.replaying())
+
+
+class ReplayGenerationTests(unittest.TestCase):
+    """A tiny random two layer Llama decodes a few tokens until the node with
+    its second layer is lost, mid-pass. The job replays on a new cache for
+    that layer, and goes on as if the layer had never been lost."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        model_dir = Path(cls.tmp.name)
+        torch.manual_seed(0)
+        config = LlamaConfig(
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            vocab_size=64,
+            max_position_embeddings=256
+        )
+        AutoModelForCausalLM.from_config(config).save_pretrained(model_dir / "data", safe_serialization=True)
+        cls.collector = LlmLayerCollector(model_dir / "data", model_dir / "cache.json", dtype=torch.float32)
+        cls.embedding = cls.collector.load_input_embedding(torch.device("cpu"))
+        cls.layers = cls.collector.load_layer_set(0, 1, torch.device("cpu"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def embed(self, ids, prompt_tokens: int, chunk_size: int, past: int):
+        comp_state = StaticAutoModel.compute_embedding(
+            prompt_tokens=prompt_tokens,
+            chunk_size=chunk_size,
+            input_embedder=self.embedding,
+            input_ids=torch.tensor([ids]),
+            config=self.collector.config,
+            cache=PagedCache(self.collector.config, KVBlockPool()),
+            past_seen_tokens=past
+        )
+        return computationStateToJobData(comp_state)
+
+    def layer(self, layer_idx: int, job_data, cache):
+        state, _ = compute_layers(layer_idx, job_data, torch.device("cpu"), self.collector.config, self.layers[layer_idx:layer_idx + 1], cache)
+        job_data.state = state
+        return state
+
+    def test_replay_rebuilds_the_lost_layer(self):
+        torch.manual_seed(1)
+        ids = torch.randint(0, 64, (13,)).tolist()
+        config = self.collector.config
+        reference = PagedCache(config, KVBlockPool())
+        job = Job(origin_node_id="node-a", messages=[], pipe_id="pipe-1", model_id="model-1", config=config)
+        lost = PagedCache(config, KVBlockPool())
+        with torch.no_grad():
+            for past in [0, 10, 11, 12]:
+                step = 10 if past == 0 else 1
+                job_data = self.embed(ids[:past + step], 10, 10, past)
+                self.layer(0, job_data, reference)
+                expected = self.layer(1, job_data, reference)
+
+                # The pass of the last token gets through layer 0 only
+                job_data = self.embed(ids[:past + step], 10, 10, past)
+                self.layer(0, job_data, job.cache)
+                if past < 12:
+                    self.layer(1, job_data, lost)
+
+            job.input_ids = ids
+            job.start_replay(1, 2, 4)
+            rebuilt = PagedCache(config, KVBlockPool())
+            while True:
+                start, end = job.chunking.get_range()
+                job_data = self.embed(ids, len(ids), end - start, start)
+                job.current_layer = 0
+                self.layer(0, job_data, job.layer_cache())
+                job.current_layer = 1
+                state = self.layer(1, job_data, rebuilt)
+                job.chunking.finish_chunk()
+                if not job.chunking.has_more():
+                    break
+                job.advance_chunk(4)
+
+        # Layer 0 kept its cache; the replay ran it on a cache of its own
+        self.assertEqual(job.cache.layers[0].get_seq_length(), 13)
+        assert job.replay_cache is not None
+        self.assertEqual(job.replay_cache.layers[0].get_seq_length(), 13)
+        self.assertTrue(torch.allclose(keys(rebuilt, 1), keys(reference, 1), atol=1e-5))
+        self.assertTrue(torch.allclose(state[:, -1], expected[:, -1], atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,380 @@
+import os
+import sys
+import unittest
+from pathlib import Path
+from threading import Thread
+from time import sleep, time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'tests', 'language_pipes', 'unit'))
+
+import torch
+from transformers import LlamaConfig, Qwen3NextConfig
+
+from language_pipes.jobs.job import Job
+from language_pipes.jobs.job_receiver import JobReceiver
+from language_pipes.jobs.job_tracker import JobTracker
+from language_pipes.modeling.kv_migrate import MigrationStaging, block_parts, cache_lengths, full_blocks, state_parts
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, KV_INT8, KVBlockPool, PagedCache
+from language_pipes.pipes.pipe import Pipe
+from language_pipes.pipes.pipe_manager import PipeManager
+from language_pipes.util.byte_helper import ByteHelper
+
+from util import FakeStateNetworkNode
+
+HEADS = 2
+HEAD_DIM = 4
+LAYERS = range(2)
+
+
+def make_config() -> LlamaConfig:
+    return LlamaConfig(
+        num_hidden_layers=2,
+        hidden_size=HEADS * HEAD_DIM,
+        num_attention_heads=HEADS,
+        num_key_value_heads=HEADS
+    )
+
+
+def kv(tokens: int):
+    return torch.randn(1, HEADS, tokens, HEAD_DIM), torch.randn(1, HEADS, tokens, HEAD_DIM)
+
+
+def fill(cache: PagedCache, tokens: int):
+    for layer_idx in LAYERS:
+        cache.update(*kv(tokens), layer_idx)
+
+
+def keys(cache: PagedCache, layer_idx: int) -> torch.Tensor:
+    layer = cache.layers[layer_idx]
+    layer._restore()  # pyright: ignore[reportAttributeAccessIssue]
+    k, _ = layer._gather()  # pyright: ignore[reportAttributeAccessIssue]
+    return k
+
+
+def move(source: PagedCache, target: PagedCache, start=None):
+    staging = MigrationStaging()
+    for part in block_parts(source, LAYERS, start or { }):
+        staging.add(part)
+    for part in state_parts(source, LAYERS):
+        staging.add(part)
+    staging.install(target, cache_lengths(source, LAYERS), torch.device("cpu"))
+
+
+class MigrateCacheTests(unittest.TestCase):
+    def test_blocks_move_to_another_cache(self):
+        source = PagedCache(make_config(), KVBlockPool())
+        fill(source, BLOCK_TOKENS * 2 + 5)
+        target = PagedCache(make_config(), KVBlockPool())
+
+        move(source, target)
+
+        for layer_idx in LAYERS:
+            self.assertEqual(target.layers[layer_idx].get_seq_length(), BLOCK_TOKENS * 2 + 5)
+            self.assertTrue(torch.equal(keys(target, layer_idx), keys(source, layer_idx)))
+
+    def test_full_blocks_go_first_and_the_rest_after(self):
+        source = PagedCache(make_config(), KVBlockPool())
+        fill(source, BLOCK_TOKENS + 5)
+        staging = MigrationStaging()
+        sent = full_blocks(source, LAYERS)
+        for part in block_parts(source, LAYERS, { }, sent):
+            staging.add(part)
+        # The job goes on while the full blocks are sent
+        fill(source, BLOCK_TOKENS)
+        for part in block_parts(source, LAYERS, sent):
+            staging.add(part)
+        target = PagedCache(make_config(), KVBlockPool())
+
+        staging.install(target, cache_lengths(source, LAYERS), torch.device("cpu"))
+
+        self.assertEqual(sent, {0: 1, 1: 1})
+        self.assertTrue(torch.equal(keys(target, 1), keys(source, 1)))
+
+    def test_quantized_and_spilled_layers_keep_their_form(self):
+        source = PagedCache(make_config(), KVBlockPool())
+        source.set_kv_dtype([1], KV_INT8)
+        fill(source, BLOCK_TOKENS * 3)
+        layer = source.paged_layers()[0]
+        layer.spill([t.clone() for t in layer.raw_blocks()])
+        target = PagedCache(make_config(), KVBlockPool())
+
+        move(source, target)
+
+        self.assertEqual(target.paged_layers()[1].kv_dtype, KV_INT8)
+        for layer_idx in LAYERS:
+            self.assertTrue(torch.equal(keys(target, layer_idx), keys(source, layer_idx)))
+
+    def test_missing_blocks_are_refused(self):
+        source = PagedCache(make_config(), KVBlockPool())
+        fill(source, BLOCK_TOKENS * 2)
+        staging = MigrationStaging()
+        for part in block_parts(source, LAYERS, {0: 1, 1: 1}):
+            staging.add(part)
+
+        with self.assertRaisesRegex(Exception, "missing"):
+            staging.install(PagedCache(make_config(), KVBlockPool()), cache_lengths(source, LAYERS), torch.device("cpu"))
+
+    def test_linear_attention_state_moves(self):
+        config = Qwen3NextConfig(
+            num_hidden_layers=4,
+            hidden_size=64,
+            num_attention_heads=2,
+            num_key_value_heads=1,
+            head_dim=32,
+            linear_num_value_heads=2,
+            linear_num_key_heads=1,
+            linear_key_head_dim=16,
+            linear_value_head_dim=16
+        )
+        source = PagedCache(config, KVBlockPool())
+        linear = source.layers[0]
+        linear.conv_states = {0: torch.randn(1, 8, 4)}  # pyright: ignore[reportAttributeAccessIssue]
+        linear.recurrent_states = {0: torch.randn(1, 2, 16, 16)}  # pyright: ignore[reportAttributeAccessIssue]
+        linear.has_previous_state = {0: True}  # pyright: ignore[reportAttributeAccessIssue]
+        linear.dtype = torch.float32  # pyright: ignore[reportAttributeAccessIssue]
+        target = PagedCache(config, KVBlockPool())
+
+        staging = MigrationStaging()
+        for part in state_parts(source, [0]):
+            staging.add(part)
+        staging.install(target, { }, torch.device("cpu"))
+
+        moved = target.layers[0]
+        self.assertTrue(torch.equal(moved.recurrent_states[0], linear.recurrent_states[0]))  # pyright: ignore[reportAttributeAccessIssue]
+        self.assertTrue(torch.equal(moved.conv_states[0], linear.conv_states[0]))  # pyright: ignore[reportAttributeAccessIssue]
+        self.assertEqual(moved.has_previous_state, {0: True})  # pyright: ignore[reportAttributeAccessIssue]
+        self.assertEqual(moved.dtype, torch.float32)  # pyright: ignore[reportAttributeAccessIssue]
+
+
+def segment(process_id: str, node_id: str, pipe_id: str, virtual: bool = False, role: str = "both"):
+    config = make_config()
+    return SimpleNamespace(
+        process_id=process_id,
+        node_id=node_id,
+        pipe_id=pipe_id,
+        model_id="model-1",
+        start_layer=0,
+        end_layer=1,
+        virtual=virtual,
+        loaded=True,
+        segment_process=None,
+        device=torch.device("cpu"),
+        kv_cache_dtype="auto",
+        role=role,
+        collector=SimpleNamespace(config=config),
+        to_meta=lambda: SimpleNamespace(process_id=process_id, model_id="model-1", pipe_id=pipe_id)
+    )
+
+
+class JobPipeTests(unittest.TestCase):
+    def test_moved_segment_takes_the_place_of_the_one_left(self):
+        local = segment("p1", "node-a", "pipe-1")
+        replica = segment("p2", "node-b", "pipe-2", virtual=True)
+        pipe = Pipe(FakeStateNetworkNode("node-a"), "pipe-1", "model-1", Path("."))  # pyright: ignore[reportArgumentType]
+        pipe.segments = [local]  # pyright: ignore[reportAttributeAccessIssue]
+        manager = PipeManager(SimpleNamespace(layer_models=[]), SimpleNamespace(get_model=lambda p: None))  # pyright: ignore[reportArgumentType]
+        manager.get_pipe_by_pipe_id = lambda pipe_id: pipe  # pyright: ignore[reportAttributeAccessIssue]
+        manager._get_segment = lambda process_id: replica if process_id == "p2" else None  # pyright: ignore[reportAttributeAccessIssue]
+
+        self.assertIs(manager.get_job_pipe("pipe-1", { }).get_layer(0), local)  # pyright: ignore[reportOptionalMemberAccess]
+        self.assertIs(manager.get_job_pipe("pipe-1", {0: "p2"}).get_layer(0), replica)  # pyright: ignore[reportOptionalMemberAccess]
+        self.assertIsNone(manager.get_job_pipe("pipe-1", {0: "p9"}).get_layer(0))  # pyright: ignore[reportOptionalMemberAccess]
+
+
+class Network:
+    """Routers of several receivers that hand messages to each other."""
+    def __init__(self):
+        self.receivers = { }
+
+    def router(self, node_id: str):
+        network = self
+
+        class Router:
+            def node_id(self):
+                return node_id
+
+            def send_to_node(self, to: str, data: bytes, timeout=None, retries=None):
+                return network.deliver(node_id, to, data)
+
+            def receive_data(self, data: bytes):
+                return network.deliver(node_id, node_id, data)
+
+        return Router()
+
+    def deliver(self, sender: str, to: str, data: bytes):
+        bts = ByteHelper(data)
+        bts.read_int()
+        return self.receivers[to].migration.receive_migrate(sender, bts.read_bytes())
+
+
+class MovePipeManager:
+    """Pipe-1 runs layers 0-1 on node-a's p1 until they move to node-b's p2."""
+    def __init__(self, router, replicas, role="both"):
+        self.router_pipes = SimpleNamespace(router=router, replicas=lambda meta: replicas)
+        self.role = role
+
+    def get_job_pipe(self, pipe_id: str, segment_moves):
+        if 0 in segment_moves:
+            moved = segment(segment_moves[0], "node-b", "pipe-2", virtual=True)
+            return SimpleNamespace(segments=[moved], get_layer=lambda layer: moved)
+        local = segment("p1", "node-a", "pipe-1", role=self.role)
+        return SimpleNamespace(segments=[local], get_layer=lambda layer: local)
+
+
+def make_node(network: Network, node_id: str, layer_models, replicas=(), role="both"):
+    tracker = JobTracker()
+    tracker.shutdown = True
+    receiver = JobReceiver(
+        job_factory=None,   # pyright: ignore[reportArgumentType]
+        job_tracker=tracker,
+        pipe_manager=MovePipeManager(network.router(node_id), list(replicas), role),  # pyright: ignore[reportArgumentType]
+        model_manager=SimpleNamespace(layer_models=layer_models),  # pyright: ignore[reportArgumentType]
+        is_shutdown=lambda: True,
+        get_max_node_jobs=lambda: 10,
+        get_max_batch_size=lambda: 8,
+        get_round_token_budget=lambda: 256,
+        get_max_prefill_share=lambda: 0.5,
+    )
+    network.receivers[node_id] = receiver
+    return receiver, tracker
+
+
+def track(tracker: JobTracker, origin_node_id: str) -> Job:
+    job = Job(origin_node_id=origin_node_id, messages=[], pipe_id="pipe-1", model_id="model-1", config=make_config())
+    job.job_id = "job-1"
+    tracker.track_job("network", job)
+    return job
+
+
+def wait_for(check):
+    deadline = time() + 5
+    while not check():
+        if time() > deadline:
+            raise Exception("timed out")
+        sleep(0.01)
+
+
+class MoveSegmentJobsTests(unittest.TestCase):
+    """node-a unloads p1; node-b's p2 holds the same layers and takes the job,
+    which node-c started."""
+
+    def setUp(self):
+        self.network = Network()
+        self.leaving = segment("p1", "node-a", "pipe-1")
+        self.target = segment("p2", "node-b", "pipe-2")
+        self.a, self.a_jobs = make_node(self.network, "node-a", [self.leaving], [SimpleNamespace(process_id="p2", node_id="node-b")])
+        self.b, self.b_jobs = make_node(self.network, "node-b", [self.target])
+        self.c, self.c_jobs = make_node(self.network, "node-c", [])
+        self.resumed = []
+        self.c._resume_job = self.resumed.append  # pyright: ignore[reportAttributeAccessIssue]
+
+    def test_job_goes_on_with_its_cache_on_the_other_node(self):
+        job = track(self.a_jobs, "node-c")
+        fill(job.cache, BLOCK_TOKENS * 2 + 3)
+        origin_job = track(self.c_jobs, "node-c")
+        drain = Thread(target=self.a.migration.move_segment_jobs, args=([self.leaving],))
+        drain.start()
+
+        wait_for(lambda: "job-1" in self.c.migration.paused_moves)
+        # A decode pass ran before the job got back to its origin
+        fill(job.cache, 1)
+        expected = [keys(job.cache, layer_idx) for layer_idx in LAYERS]
+        self.assertTrue(self.c.migration.park_job(origin_job))
+        drain.join(5)
+
+        self.assertEqual(self.resumed, [origin_job])
+        self.assertEqual(origin_job.segment_moves, {0: "p2"})
+        moved = self.b_jobs.get_job("job-1")
+        assert moved is not None
+        self.assertEqual(moved.segment_moves, {0: "p2"})
+        for layer_idx in LAYERS:
+            self.assertEqual(moved.cache.layers[layer_idx].get_seq_length(), BLOCK_TOKENS * 2 + 4)
+            self.assertTrue(torch.equal(keys(moved.cache, layer_idx), expected[layer_idx]))
+        # node-a is done with the job, and does not cancel it with its pipe
+        self.assertIsNone(self.a_jobs.get_job("job-1"))
+        self.assertEqual(self.a.migration.moved_jobs, {"job-1"})
+
+    def test_job_the_origin_does_not_hold_stays_and_is_canceled(self):
+        job = track(self.a_jobs, "node-c")
+        fill(job.cache, BLOCK_TOKENS * 2)
+
+        self.a.migration.move_segment_jobs([self.leaving])
+
+        self.assertIs(self.a_jobs.get_job("job-1"), job)
+        self.assertEqual(self.a.migration.moved_jobs, set())
+        self.assertEqual(self.b.migration.moves_in, { })
+        self.assertIsNone(self.b_jobs.get_job("job-1"))
+
+    def test_segment_without_a_replica_moves_nothing(self):
+        self.a.pipe_manager.router_pipes.replicas = lambda meta: []
+        track(self.a_jobs, "node-c")
+
+        self.a.migration.move_segment_jobs([self.leaving])
+
+        self.assertEqual(self.a.migration.moves_out, { })
+        self.assertEqual(self.c.migration.paused_moves, { })
+
+
+class HandOffTests(unittest.TestCase):
+    """node-c started the job on pipe-1, whose prefill segment p1 on node-a
+    computed the prompt; node-b's p2 decodes the same layers."""
+
+    def setUp(self):
+        self.network = Network()
+        self.target = segment("p2", "node-b", "pipe-2", role="decode")
+        self.a, self.a_jobs = make_node(self.network, "node-a", [segment("p1", "node-a", "pipe-1", role="prefill")], role="prefill")
+        self.b, self.b_jobs = make_node(self.network, "node-b", [self.target])
+        self.c, self.c_jobs = make_node(self.network, "node-c", [], role="prefill")
+        self.a.pipe_manager.router_pipes.get_model = lambda process_id: self.target if process_id == "p2" else None
+        self.c.pipe_manager.router_pipes.handoff_targets = lambda pipe, start_layer: {0: self.target}
+        self.c.model_manager.get_end_model = lambda model_id: None
+        self.resumed = []
+        self.c._resume_job = self.resumed.append  # pyright: ignore[reportAttributeAccessIssue]
+
+    def test_job_decodes_on_the_decode_pipe_after_its_prompt(self):
+        job = track(self.a_jobs, "node-a")
+        job.origin_node_id = "node-c"
+        fill(job.cache, BLOCK_TOKENS * 2 + 3)
+        expected = [keys(job.cache, layer_idx) for layer_idx in LAYERS]
+        origin_job = track(self.c_jobs, "node-c")
+
+        self.assertTrue(self.c.migration.park_job(origin_job))
+        wait_for(lambda: len(self.resumed) == 1)
+
+        self.assertEqual(origin_job.segment_moves, {0: "p2"})
+        moved = self.b_jobs.get_job("job-1")
+        assert moved is not None
+        self.assertEqual(moved.segment_moves, {0: "p2"})
+        for layer_idx in LAYERS:
+            self.assertTrue(torch.equal(keys(moved.cache, layer_idx), expected[layer_idx]))
+        # node-a has no layers of the job left
+        self.assertIsNone(self.a_jobs.get_job("job-1"))
+        # It is only looked for once
+        self.assertFalse(self.c.migration.park_job(origin_job))
+
+    def test_job_stays_on_the_prefill_pipe_when_the_hand_off_fails(self):
+        self.b.model_manager.layer_models = []
+        job = track(self.a_jobs, "node-c")
+        fill(job.cache, BLOCK_TOKENS)
+        origin_job = track(self.c_jobs, "node-c")
+
+        self.assertTrue(self.c.migration.park_job(origin_job))
+        wait_for(lambda: len(self.resumed) == 1)
+
+        self.assertEqual(origin_job.segment_moves, { })
+        self.assertIs(self.a_jobs.get_job("job-1"), job)
+        self.assertEqual(job.cache.layers[0].get_seq_length(), BLOCK_TOKENS)
+        self.assertEqual(self.b.migration.moves_in, { })
+
+    def test_pipe_without_prefill_segments_does_not_hold_the_job(self):
+        self.c.pipe_manager.role = "both"
+        origin_job = track(self.c_jobs, "node-c")
+
+        self.assertFalse(self.c.migration.park_job(origin_job))
+        self.assertEqual(self.resumed, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,276 @@
+import os
+import sys
+import gc
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import torch
+from transformers import Gemma3TextConfig, Gemma3TextModel, LlamaConfig, LlamaModel
+from transformers.cache_utils import DynamicCache, DynamicSlidingWindowLayer
+
+from llm_layer_collector.auto.cache_view import PartialCacheMaskView
+
+from language_pipes.modeling.kv_pool import (
+    BLOCK_TOKENS, KV_FP8, KV_INT8, SLAB_BLOCKS, KVBlockPool, PagedCache, PagedLayer, check_kv_dtype, whole_blocks
+)
+
+HEADS = 2
+HEAD_DIM = 4
+# Cosine of the last hidden state with a quantized cache against one without
+INT8_COS_MIN = 0.9999
+FP8_COS_MIN = 0.999
+
+
+def make_config(sliding: bool = False) -> LlamaConfig:
+    config = LlamaConfig(
+        num_hidden_layers=2,
+        hidden_size=HEADS * HEAD_DIM,
+        num_attention_heads=HEADS,
+        num_key_value_heads=HEADS
+    )
+    if sliding:
+        config.sliding_window = 8
+        config.layer_types = ["sliding_attention", "full_attention"]
+    return config
+
+
+def resident_bytes(cache: PagedCache) -> int:
+    """Bytes the paged layers of `cache` keep: their blocks and any tensor left on them."""
+    held = cache.held_bytes()
+    for layer in cache.paged_layers():
+        held += sum(t.numel() * t.element_size() for t in vars(layer).values() if isinstance(t, torch.Tensor))
+    return held
+
+
+def kv(tokens: int):
+    return torch.randn(1, HEADS, tokens, HEAD_DIM), torch.randn(1, HEADS, tokens, HEAD_DIM)
+
+
+class KVBlockPoolTests(unittest.TestCase):
+    def test_blocks_come_back_to_the_free_list(self):
+        pool = KVBlockPool()
+        block_class = pool.block_class(HEADS, HEAD_DIM, torch.float32, torch.device("cpu"))
+
+        blocks = pool.allocate(block_class, 3)
+        self.assertEqual(pool.stats().used_blocks, 3)
+        self.assertEqual(pool.stats().blocks, SLAB_BLOCKS)
+
+        pool.release(block_class, blocks)
+        self.assertEqual(pool.stats().used_blocks, 0)
+        # The next job gets the same blocks back
+        self.assertEqual(sorted(pool.allocate(block_class, 3)), sorted(blocks))
+
+    def test_keeps_one_empty_slab(self):
+        pool = KVBlockPool()
+        block_class = pool.block_class(HEADS, HEAD_DIM, torch.float32, torch.device("cpu"))
+
+        blocks = pool.allocate(block_class, 2 * SLAB_BLOCKS + 1)
+        self.assertEqual(pool.stats().blocks, 3 * SLAB_BLOCKS)
+
+        pool.release(block_class, blocks)
+        self.assertEqual(pool.stats().blocks, SLAB_BLOCKS)
+
+    def test_reports_bytes(self):
+        pool = KVBlockPool()
+        block_class = pool.block_class(HEADS, HEAD_DIM, torch.float32, torch.device("cpu"))
+        pool.allocate(block_class, 2)
+
+        stats = pool.stats()
+        self.assertEqual(stats.used_bytes, 2 * 2 * HEADS * BLOCK_TOKENS * HEAD_DIM * 4)
+        self.assertEqual(stats.bytes, SLAB_BLOCKS * stats.used_bytes // 2)
+        self.assertAlmostEqual(stats.utilization(), 2 / SLAB_BLOCKS)
+
+
+class PagedCacheTests(unittest.TestCase):
+    def test_matches_a_dynamic_cache(self):
+        config = make_config()
+        paged = PagedCache(config, KVBlockPool())
+        dynamic = DynamicCache(config=config)
+
+        # A prefill over several blocks, then decode tokens across a block edge
+        for tokens in [BLOCK_TOKENS * 2 + 3, 1, 1, BLOCK_TOKENS, 1]:
+            for layer_idx in range(2):
+                k, v = kv(tokens)
+                paged_k, paged_v = paged.update(k, v, layer_idx)
+                dynamic_k, dynamic_v = dynamic.update(k, v, layer_idx)
+                self.assertTrue(torch.equal(paged_k, dynamic_k))
+                self.assertTrue(torch.equal(paged_v, dynamic_v))
+
+        self.assertEqual(paged.get_seq_length(), dynamic.get_seq_length())
+        self.assertEqual(paged.get_mask_sizes(1, 0), dynamic.get_mask_sizes(1, 0))
+
+    def test_jobs_share_the_pool(self):
+        pool = KVBlockPool()
+        first = PagedCache(make_config(), pool)
+        second = PagedCache(make_config(), pool)
+        first.update(*kv(BLOCK_TOKENS + 1), 0)
+        second.update(*kv(1), 0)
+
+        self.assertEqual(pool.stats().used_blocks, 3)
+        self.assertEqual(pool.stats().blocks, SLAB_BLOCKS)
+        self.assertEqual(first.held_bytes(), 2 * pool.stats().used_bytes // 3)
+
+    def test_release_frees_every_block(self):
+        pool = KVBlockPool()
+        cache = PagedCache(make_config(), pool)
+        cache.update(*kv(BLOCK_TOKENS * 3), 0)
+        cache.update(*kv(BLOCK_TOKENS * 3), 1)
+
+        cache.release()
+
+        self.assertEqual(pool.stats().used_blocks, 0)
+        self.assertEqual(cache.get_seq_length(), 0)
+        self.assertEqual(cache.held_bytes(), 0)
+
+    def test_collected_cache_frees_its_blocks(self):
+        pool = KVBlockPool()
+        cache = PagedCache(make_config(), pool)
+        cache.update(*kv(BLOCK_TOKENS), 0)
+
+        del cache
+        gc.collect()
+
+        self.assertEqual(pool.stats().used_blocks, 0)
+
+    def test_crop_frees_the_blocks_past_the_end(self):
+        pool = KVBlockPool()
+        cache = PagedCache(make_config(), pool)
+        k, v = kv(BLOCK_TOKENS * 3)
+        cache.update(k, v, 0)
+
+        cache.crop(BLOCK_TOKENS + 1)
+
+        self.assertEqual(pool.stats().used_blocks, 2)
+        k2, v2 = kv(1)
+        keys, _ = cache.update(k2, v2, 0)
+        self.assertTrue(torch.equal(keys, torch.cat([k[:, :, :BLOCK_TOKENS + 1], k2], dim=2)))
+
+    def test_holds_only_its_blocks_between_passes(self):
+        config = make_config()
+        paged = PagedCache(config, KVBlockPool())
+        dynamic = DynamicCache(config=config)
+        for tokens in [BLOCK_TOKENS * 4 + 3] + [1] * BLOCK_TOKENS * 2:
+            k, v = kv(tokens)
+            paged.update(k, v, 0)
+            dynamic.update(k, v, 0)
+
+        tokens = dynamic.get_seq_length()
+        dynamic_bytes = sum(t.numel() * t.element_size() for t in (dynamic.layers[0].keys, dynamic.layers[0].values))
+        self.assertEqual(resident_bytes(paged), paged.held_bytes())
+        self.assertEqual(resident_bytes(paged), dynamic_bytes * whole_blocks(tokens) // tokens)
+
+    def test_keys_follow_crop_and_evict(self):
+        cache = PagedCache(make_config(), KVBlockPool())
+        k, v = kv(BLOCK_TOKENS * 3)
+        cache.update(k, v, 0)
+
+        cache.crop(BLOCK_TOKENS * 2 + 1)
+        cache.evict([0], BLOCK_TOKENS, BLOCK_TOKENS + 1)
+        k2, v2 = kv(1)
+        keys, values = cache.update(k2, v2, 0)
+
+        kept = torch.cat([k[:, :, :BLOCK_TOKENS], k[:, :, BLOCK_TOKENS * 2:BLOCK_TOKENS * 2 + 1], k2], dim=2)
+        self.assertTrue(torch.equal(keys, kept))
+        self.assertEqual(values.shape[2], BLOCK_TOKENS + 2)
+
+        self.assertEqual(resident_bytes(cache), cache.held_bytes())
+
+    def test_sliding_layers_stay_dynamic(self):
+        cache = PagedCache(make_config(sliding=True), KVBlockPool())
+
+        self.assertIsInstance(cache.layers[0], DynamicSlidingWindowLayer)
+        self.assertIsInstance(cache.layers[1], PagedLayer)
+
+    def test_holds_one_sequence(self):
+        cache = PagedCache(make_config(), KVBlockPool())
+        with self.assertRaisesRegex(Exception, "one sequence"):
+            cache.update(torch.randn(2, HEADS, 1, HEAD_DIM), torch.randn(2, HEADS, 1, HEAD_DIM), 0)
+
+
+def tiny_models():
+    torch.manual_seed(0)
+    dims = dict(vocab_size=128, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2)
+    llama = LlamaConfig(**dims)
+    gemma = Gemma3TextConfig(**dims, head_dim=16, sliding_window=4, layer_types=["sliding_attention", "full_attention"])
+    return [LlamaModel(llama).eval(), Gemma3TextModel(gemma).eval()]
+
+
+def decode_state(model, cache) -> torch.Tensor:
+    """Last hidden state of a decode step after a prefill over several blocks."""
+    torch.manual_seed(1)
+    prompt = torch.randint(0, 128, (1, BLOCK_TOKENS * 2 + 5))
+    with torch.no_grad():
+        model(input_ids=prompt, past_key_values=cache, use_cache=True)
+        return model(input_ids=torch.tensor([[7]]), past_key_values=cache, use_cache=True).last_hidden_state[:, -1]
+
+
+class QuantizedCacheTests(unittest.TestCase):
+    def test_quantized_cache_holds_less_than_an_auto_one(self):
+        llama = tiny_models()[0]
+        auto = PagedCache(llama.config, KVBlockPool())
+        decode_state(llama, auto)
+
+        for kv_dtype in [KV_INT8, KV_FP8]:
+            cache = PagedCache(llama.config, KVBlockPool(), kv_dtype)
+            decode_state(llama, cache)
+            self.assertEqual(resident_bytes(cache), cache.held_bytes())
+            self.assertLess(resident_bytes(cache), resident_bytes(auto) // 2)
+
+    def test_quantized_blocks_are_smaller(self):
+        pool = KVBlockPool()
+        cache = PagedCache(make_config(), pool, KV_INT8)
+        keys, values = kv(3)
+
+        out_keys, out_values = cache.update(keys.to(torch.bfloat16), values.to(torch.bfloat16), 0)
+
+        self.assertEqual(out_keys.dtype, torch.bfloat16)
+        # One byte per value and a four byte scale per token and head
+        self.assertEqual(cache.held_bytes(), 2 * HEADS * BLOCK_TOKENS * (HEAD_DIM + 4))
+        self.assertLess((out_keys.float() - keys).abs().max().item(), 0.05)
+        self.assertLess((out_values.float() - values).abs().max().item(), 0.05)
+
+    def test_layers_keep_the_dtype_they_were_written_in(self):
+        cache = PagedCache(make_config(), KVBlockPool())
+        cache.update(*kv(1), 0)
+
+        cache.set_kv_dtype([0, 1], KV_FP8)
+
+        layers = [layer for layer in cache.layers if isinstance(layer, PagedLayer)]
+        self.assertEqual([layer.kv_dtype for layer in layers], ["auto", KV_FP8])
+
+    def test_unknown_dtype_is_refused(self):
+        with self.assertRaisesRegex(Exception, "Unknown KV cache dtype"):
+            check_kv_dtype("int4")
+
+    def test_matches_the_reference_models(self):
+        for model in tiny_models():
+            expected = decode_state(model, DynamicCache(config=model.config))
+            for kv_dtype, cos_min in [(KV_INT8, INT8_COS_MIN), (KV_FP8, FP8_COS_MIN)]:
+                state = decode_state(model, PagedCache(model.config, KVBlockPool(), kv_dtype))
+                cos = torch.nn.functional.cosine_similarity(expected, state).item()
+                self.assertGreaterEqual(cos, cos_min, f"{model.config.model_type} {kv_dtype}")
+
+
+class MaskViewTests(unittest.TestCase):
+    def test_view_reads_sliding_windows_through_the_paged_cache(self):
+        config = make_config(sliding=True)
+        paged = PartialCacheMaskView(PagedCache(config, KVBlockPool()), 20)
+        dynamic = PartialCacheMaskView(DynamicCache(config=config), 20)
+
+        for layer_idx in range(2):
+            self.assertEqual(paged.get_mask_sizes(1, layer_idx), dynamic.get_mask_sizes(1, layer_idx))
+        self.assertEqual(paged.get_mask_sizes(1, 0), (8, 13))
+        self.assertEqual(paged.get_mask_sizes(1, 1), (21, 0))
+
+    def test_view_writes_through_to_the_pool(self):
+        pool = KVBlockPool()
+        view = PartialCacheMaskView(PagedCache(make_config(), pool), 0)
+
+        view.update(*kv(3), 1)
+
+        self.assertEqual(pool.stats().used_blocks, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
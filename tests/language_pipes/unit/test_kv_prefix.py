@@ -0,0 +1,157 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import torch
+from transformers import LlamaConfig, LlamaModel
+
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, KV_AUTO, KV_INT8, KVBlockPool, PagedCache
+from language_pipes.modeling.kv_prefix import (
+    PREFIX_RESERVE_TIME, PrefixKVCache, block_hashes, prefix_reusable
+)
+
+HEADS = 2
+HEAD_DIM = 4
+GB = 1024**3
+
+
+def make_config(sliding: bool = False) -> LlamaConfig:
+    config = LlamaConfig(
+        num_hidden_layers=2,
+        hidden_size=HEADS * HEAD_DIM,
+        num_attention_heads=HEADS,
+        num_key_value_heads=HEADS
+    )
+    if sliding:
+        config.sliding_window = 8
+        config.layer_types = ["sliding_attention", "full_attention"]
+    return config
+
+
+def prompt(first: int, tokens: int) -> list[int]:
+    return [first] + list(range(1, tokens))
+
+
+def stored(prefix: PrefixKVCache, ids: list[int], layers=None, pipe_id: str = "pipe-1") -> list[bytes]:
+    """Store a KV cache of `ids` for `layers` (layer 0) and return its block hashes."""
+    layers = layers or [(0, KV_AUTO)]
+    cache = PagedCache(make_config(), KVBlockPool())
+    for layer_idx, _ in layers:
+        cache.update(torch.randn(1, HEADS, len(ids), HEAD_DIM), torch.randn(1, HEADS, len(ids), HEAD_DIM), layer_idx)
+    hashes = block_hashes(ids, len(ids))
+    prefix.store(pipe_id, cache, layers, hashes)
+    return hashes
+
+
+def block_bytes() -> int:
+    return 2 * HEADS * BLOCK_TOKENS * HEAD_DIM * 4
+
+
+class BlockHashTests(unittest.TestCase):
+    def test_one_hash_per_full_block(self):
+        self.assertEqual(len(block_hashes(prompt(0, 100), BLOCK_TOKENS * 2 + 5)), 2)
+        self.assertEqual(block_hashes(prompt(0, 100), BLOCK_TOKENS - 1), [])
+
+    def test_hashes_cover_every_block_before(self):
+        long = block_hashes(prompt(0, 100), 60)
+        short = block_hashes(prompt(0, 40), 40)
+        other = block_hashes(prompt(5, 60), 60)
+
+        self.assertEqual(short, long[:2])
+        # A different first token changes every hash after it
+        self.assertTrue(all(a != b for a, b in zip(long, other, strict=True)))
+
+    def test_only_full_attention_models_are_reusable(self):
+        self.assertTrue(prefix_reusable(make_config()))
+        self.assertFalse(prefix_reusable(make_config(sliding=True)))
+
+
+class PrefixKVCacheTests(unittest.TestCase):
+    def test_reserves_the_run_every_layer_has(self):
+        prefix = PrefixKVCache(lambda: GB)
+        layers = [(0, KV_AUTO), (1, KV_AUTO)]
+        hashes = stored(prefix, prompt(0, BLOCK_TOKENS * 3), layers)
+        # None of the blocks were kept in int8
+        self.assertEqual(prefix.reserve("job-1", "pipe-1", [(0, KV_AUTO), (1, KV_INT8)], hashes), 0)
+
+        self.assertEqual(prefix.reserve("job-2", "pipe-1", layers, hashes), 3)
+        self.assertEqual(prefix.reserve("job-3", "pipe-2", layers, hashes), 0)
+        self.assertEqual(prefix.stats().lookup_blocks, 9)
+        self.assertEqual(prefix.stats().hit_blocks, 3)
+        self.assertAlmostEqual(prefix.stats().hit_rate(), 1 / 3)
+
+    def test_end_of_a_prompt_is_evicted_before_its_start(self):
+        prefix = PrefixKVCache(lambda: block_bytes() * 3)
+        first = stored(prefix, prompt(0, BLOCK_TOKENS * 3))
+
+        stored(prefix, prompt(5, BLOCK_TOKENS * 2))
+
+        self.assertEqual(prefix.stats().blocks, 3)
+        self.assertEqual(prefix.stats().bytes, block_bytes() * 3)
+        self.assertEqual(prefix.reserve("job-1", "pipe-1", [(0, KV_AUTO)], first), 1)
+
+    def test_reserved_blocks_outlive_eviction(self):
+        prefix = PrefixKVCache(lambda: block_bytes() * 2)
+        hashes = stored(prefix, prompt(0, BLOCK_TOKENS * 2))
+        self.assertEqual(prefix.reserve("job-1", "pipe-1", [(0, KV_AUTO)], hashes), 2)
+
+        stored(prefix, prompt(5, BLOCK_TOKENS * 2))
+        cache = PagedCache(make_config(), KVBlockPool())
+
+        self.assertTrue(prefix.restore("job-1", cache, BLOCK_TOKENS * 2))
+        self.assertEqual(cache.layers[0].get_seq_length(), BLOCK_TOKENS * 2)
+
+    def test_reservations_expire(self):
+        prefix = PrefixKVCache(lambda: GB)
+        hashes = stored(prefix, prompt(0, BLOCK_TOKENS))
+        prefix.reserve("job-1", "pipe-1", [(0, KV_AUTO)], hashes, now=0)
+
+        prefix.reserve("job-2", "pipe-1", [(0, KV_AUTO)], hashes, now=PREFIX_RESERVE_TIME + 1)
+
+        self.assertFalse(prefix.restore("job-1", PagedCache(make_config(), KVBlockPool()), BLOCK_TOKENS))
+
+    def test_off_keeps_nothing(self):
+        prefix = PrefixKVCache()
+        hashes = stored(prefix, prompt(0, BLOCK_TOKENS * 2))
+
+        self.assertEqual(prefix.stats().blocks, 0)
+        self.assertEqual(prefix.reserve("job-1", "pipe-1", [(0, KV_AUTO)], hashes), 0)
+
+
+def tiny_llama() -> LlamaModel:
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=128, hidden_size=64, intermediate_size=128,
+        num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2
+    )
+    return LlamaModel(config).eval()
+
+
+class PrefixReuseTests(unittest.TestCase):
+    def test_restored_prefix_gives_the_same_output(self):
+        model = tiny_llama()
+        torch.manual_seed(1)
+        ids = torch.randint(0, 128, (1, BLOCK_TOKENS * 2 + 5))
+        hashes = block_hashes(ids[0].tolist(), ids.size(1) - 1)
+
+        for kv_dtype in [KV_AUTO, KV_INT8]:
+            prefix = PrefixKVCache(lambda: GB)
+            layers = [(0, kv_dtype), (1, kv_dtype)]
+            with torch.no_grad():
+                full = PagedCache(model.config, KVBlockPool(), kv_dtype)
+                expected = model(input_ids=ids, past_key_values=full, use_cache=True).last_hidden_state[:, -1]
+                prefix.store("pipe-1", full, layers, hashes)
+
+                self.assertEqual(prefix.reserve("job-1", "pipe-1", layers, hashes), 2)
+                restored = PagedCache(model.config, KVBlockPool(), kv_dtype)
+                self.assertTrue(prefix.restore("job-1", restored, BLOCK_TOKENS * 2))
+                out = model(input_ids=ids[:, BLOCK_TOKENS * 2:], past_key_values=restored, use_cache=True)
+
+            self.assertTrue(torch.allclose(out.last_hidden_state[:, -1], expected, atol=1e-5), kv_dtype)
+            self.assertEqual(restored.get_seq_length(), ids.size(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import torch
+from transformers import LlamaConfig, LlamaModel
+
+from language_pipes.modeling.kv_pool import KVBlockPool, PagedCache
+from language_pipes.modeling.kv_session import SESSION_RESERVE_TIME, SessionKVCache, common_prefix, session_key
+
+HEADS = 2
+HEAD_DIM = 4
+GB = 1024**3
+
+
+def make_config(sliding: bool = False) -> LlamaConfig:
+    config = LlamaConfig(
+        num_hidden_layers=2,
+        hidden_size=HEADS * HEAD_DIM,
+        num_attention_heads=HEADS,
+        num_key_value_heads=HEADS
+    )
+    if sliding:
+        config.sliding_window = 8
+        config.layer_types = ["sliding_attention", "full_attention"]
+    return config
+
+
+def filled_cache(pool: KVBlockPool, tokens: int, sliding: bool = False) -> PagedCache:
+    cache = PagedCache(make_config(sliding), pool)
+    for layer_idx in range(2):
+        cache.update(torch.randn(1, HEADS, tokens, HEAD_DIM), torch.randn(1, HEADS, tokens, HEAD_DIM), layer_idx)
+    return cache
+
+
+class SessionKeyTests(unittest.TestCase):
+    def test_sessions_are_scoped_to_their_api_key(self):
+        self.assertEqual(session_key("key-1", "chat"), session_key("key-1", "chat"))
+        self.assertNotEqual(session_key("key-1", "chat"), session_key("key-2", "chat"))
+
+    def test_common_prefix(self):
+        self.assertEqual(common_prefix([1, 2, 3], [1, 2, 4, 5]), 2)
+        self.assertEqual(common_prefix([1, 2], [1, 2, 3]), 2)
+        self.assertEqual(common_prefix([], [1]), 0)
+
+
+class SessionKVCacheTests(unittest.TestCase):
+    def test_next_job_takes_over_the_cache(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+        cache = filled_cache(KVBlockPool(), 20)
+        self.assertTrue(sessions.keep("session-1", "pipe-1", cache, 20, list(range(20)), now=0))
+        self.assertEqual(sessions.ids("session-1"), list(range(20)))
+
+        self.assertEqual(sessions.reserve("job-1", "session-1", "pipe-1", 30, now=1), 20)
+
+        self.assertIs(sessions.resume("job-1", 20), cache)
+        self.assertEqual(cache.get_seq_length(), 20)
+        self.assertEqual(sessions.stats().sessions, 0)
+        self.assertEqual(sessions.stats().resumed_tokens, 20)
+
+    def test_cache_is_cut_back_to_the_shared_tokens(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+        pool = KVBlockPool()
+        cache = filled_cache(pool, 40)
+        sessions.keep("session-1", "pipe-1", cache, 40, now=0)
+
+        self.assertEqual(sessions.reserve("job-1", "session-1", "pipe-1", 10, now=1), 10)
+        sessions.resume("job-1", 10)
+
+        self.assertEqual(cache.get_seq_length(), 10)
+
+    def test_cache_of_unpaged_layers_is_not_cut_back(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+        sessions.keep("session-1", "pipe-1", filled_cache(KVBlockPool(), 20, sliding=True), 20, now=0)
+
+        self.assertEqual(sessions.reserve("job-1", "session-1", "pipe-1", 10, now=1), 0)
+        self.assertEqual(sessions.reserve("job-2", "session-1", "pipe-1", 20, now=1), 20)
+
+    def test_other_pipes_do_not_get_the_session(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+        sessions.keep("session-1", "pipe-1", filled_cache(KVBlockPool(), 20), 20, now=0)
+
+        self.assertEqual(sessions.reserve("job-1", "session-1", "pipe-2", 20, now=1), 0)
+        self.assertEqual(sessions.reserve("job-1", "session-2", "pipe-1", 20, now=1), 0)
+
+    def test_none_of_the_session_releases_it(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+        pool = KVBlockPool()
+        sessions.keep("session-1", "pipe-1", filled_cache(pool, 20), 20, now=0)
+        sessions.reserve("job-1", "session-1", "pipe-1", 20, now=1)
+
+        # Another node of the pipe had none of it
+        self.assertIsNone(sessions.resume("job-1", 0))
+        self.assertEqual(pool.stats().used_blocks, 0)
+
+    def test_sessions_expire(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+        pool = KVBlockPool()
+        sessions.keep("session-1", "pipe-1", filled_cache(pool, 20), 20, now=0)
+
+        self.assertEqual(sessions.reserve("job-1", "session-1", "pipe-1", 20, now=61), 0)
+        self.assertEqual(pool.stats().used_blocks, 0)
+
+    def test_reservations_expire(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 600)
+        pool = KVBlockPool()
+        sessions.keep("session-1", "pipe-1", filled_cache(pool, 20), 20, now=0)
+        sessions.reserve("job-1", "session-1", "pipe-1", 20, now=0)
+
+        sessions.prune(SESSION_RESERVE_TIME + 1)
+
+        self.assertIsNone(sessions.resume("job-1", 20))
+        self.assertEqual(pool.stats().used_blocks, 0)
+
+    def test_least_recently_kept_go_over_the_limit(self):
+        pool = KVBlockPool()
+        first = filled_cache(pool, 20)
+        limit = first.held_bytes() * 2
+        sessions = SessionKVCache(lambda: limit, lambda: 60)
+        sessions.keep("session-1", "pipe-1", first, 20, now=0)
+        sessions.keep("session-2", "pipe-1", filled_cache(pool, 20), 20, now=1)
+
+        sessions.keep("session-3", "pipe-1", filled_cache(pool, 20), 20, now=2)
+
+        self.assertIsNone(sessions.ids("session-1"))
+        self.assertEqual(list(sessions.sessions), ["session-2", "session-3"])
+        self.assertEqual(first.held_bytes(), 0)
+
+    def test_limit_counts_all_a_kept_cache_holds(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+        cache = filled_cache(KVBlockPool(), 20)
+        # A decode step after the prompt, as the job's last pass
+        for layer_idx in range(2):
+            cache.update(torch.randn(1, HEADS, 1, HEAD_DIM), torch.randn(1, HEADS, 1, HEAD_DIM), layer_idx)
+        sessions.keep("session-1", "pipe-1", cache, 21)
+
+        tensors = [t for layer in cache.paged_layers() for t in vars(layer).values() if isinstance(t, torch.Tensor)]
+        self.assertEqual(tensors, [])
+        stats = sessions.stats()
+        self.assertEqual(stats.sessions, 1)
+        self.assertEqual(stats.bytes, cache.held_bytes())
+
+    def test_keeping_a_session_again_releases_the_old_cache(self):
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+        pool = KVBlockPool()
+        old = filled_cache(pool, 20)
+        sessions.keep("session-1", "pipe-1", old, 20, now=0)
+
+        sessions.keep("session-1", "pipe-1", filled_cache(pool, 30), 30, now=1)
+
+        self.assertEqual(old.held_bytes(), 0)
+        self.assertEqual(sessions.reserve("job-1", "session-1", "pipe-1", 30, now=2), 30)
+
+    def test_off_keeps_nothing(self):
+        sessions = SessionKVCache()
+
+        self.assertFalse(sessions.keep("session-1", "pipe-1", filled_cache(KVBlockPool(), 20), 20))
+        self.assertEqual(sessions.stats().sessions, 0)
+
+
+def tiny_llama() -> LlamaModel:
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=128, hidden_size=64, intermediate_size=128,
+        num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2
+    )
+    return LlamaModel(config).eval()
+
+
+class SessionResumeTests(unittest.TestCase):
+    def test_resumed_session_gives_the_same_output(self):
+        model = tiny_llama()
+        torch.manual_seed(1)
+        first_turn = torch.randint(0, 128, (1, 40))
+        # The next turn shares the first 30 tokens with the one before
+        next_turn = torch.cat([first_turn[:, :30], torch.randint(0, 128, (1, 12))], dim=1)
+        sessions = SessionKVCache(lambda: GB, lambda: 60)
+
+        with torch.no_grad():
+            expected = model(input_ids=next_turn, past_key_values=PagedCache(model.config, KVBlockPool()), use_cache=True).last_hidden_state[:, -1]
+            cache = PagedCache(model.config, KVBlockPool())
+            model(input_ids=first_turn, past_key_values=cache, use_cache=True)
+            sessions.keep("session-1", "pipe-1", cache, 40, first_turn[0].tolist())
+
+            tokens = common_prefix(sessions.ids("session-1") or [], next_turn[0].tolist())
+            self.assertEqual(sessions.reserve("job-1", "session-1", "pipe-1", tokens), 30)
+            resumed = sessions.resume("job-1", 30)
+            out = model(input_ids=next_turn[:, 30:], past_key_values=resumed, use_cache=True)
+
+        self.assertTrue(torch.allclose(out.last_hidden_state[:, -1], expected, atol=1e-5))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+import os
+import sys
+import tempfile
+import unittest
+from threading import Event, Thread
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import torch
+from transformers import LlamaConfig
+
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, KV_INT8, KVBlockPool, PagedCache
+from language_pipes.modeling.kv_spill import (
+    GB, MIN_SPILL_IDLE, SPILL_LARGEST, SPILL_LOW_WATER, SPILL_LRU, KVSpill, spill_cache
+)
+
+HEADS = 2
+HEAD_DIM = 4
+
+
+def make_config() -> LlamaConfig:
+    return LlamaConfig(
+        num_hidden_layers=2,
+        hidden_size=HEADS * HEAD_DIM,
+        num_attention_heads=HEADS,
+        num_key_value_heads=HEADS
+    )
+
+
+def kv(tokens: int):
+    return torch.randn(1, HEADS, tokens, HEAD_DIM), torch.randn(1, HEADS, tokens, HEAD_DIM)
+
+
+def filled_cache(pool: KVBlockPool, tokens: int, last_used: float = 0.0) -> PagedCache:
+    cache = PagedCache(make_config(), pool)
+    for layer_idx in range(2):
+        cache.update(*kv(tokens), layer_idx)
+    cache.last_used = last_used
+    return cache
+
+
+class SpillCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_spilled_cache_reads_back_the_same(self):
+        for kv_dtype in ["auto", KV_INT8]:
+            pool = KVBlockPool()
+            config = make_config()
+            paged = PagedCache(config, pool, kv_dtype)
+            reference = PagedCache(config, KVBlockPool(), kv_dtype)
+
+            for tokens in [BLOCK_TOKENS * 2 + 3, 1]:
+                if tokens == 1:
+                    spill_cache(paged, self.directory)
+                for layer_idx in range(2):
+                    k, v = kv(tokens)
+                    paged_k, paged_v = paged.update(k, v, layer_idx)
+                    reference_k, reference_v = reference.update(k, v, layer_idx)
+                    self.assertTrue(torch.equal(paged_k, reference_k), kv_dtype)
+                    self.assertTrue(torch.equal(paged_v, reference_v), kv_dtype)
+
+    def test_spill_hands_the_blocks_back(self):
+        pool = KVBlockPool()
+        cache = filled_cache(pool, BLOCK_TOKENS * 3)
+        held = cache.held_bytes()
+
+        self.assertEqual(spill_cache(cache, self.directory), held)
+
+        self.assertEqual(pool.stats().used_blocks, 0)
+        self.assertEqual(pool.stats().spilled_bytes, held)
+        self.assertEqual(cache.held_bytes(), 0)
+        self.assertEqual(cache.get_seq_length(), BLOCK_TOKENS * 3)
+        # The file only lives as long as its mapping
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_freed_bytes_are_all_the_cache_held_in_ram(self):
+        pool = KVBlockPool()
+        cache = filled_cache(pool, BLOCK_TOKENS * 3)
+        # A decode step, as the job's last pass before it went idle
+        for layer_idx in range(2):
+            cache.update(*kv(1), layer_idx)
+        used = pool.used_bytes()
+        tensors = [t for layer in cache.paged_layers() for t in vars(layer).values() if isinstance(t, torch.Tensor)]
+        self.assertEqual(tensors, [])
+
+        freed = spill_cache(cache, self.directory)
+
+        self.assertEqual(freed, used)
+        self.assertEqual(pool.used_bytes(), 0)
+
+    def test_next_pass_pages_the_cache_back_in(self):
+        pool = KVBlockPool()
+        cache = filled_cache(pool, BLOCK_TOKENS)
+        spill_cache(cache, self.directory)
+
+        cache.update(*kv(1), 0)
+
+        self.assertEqual(pool.stats().used_blocks, 2)
+        self.assertEqual(cache.spilled_bytes(), cache.paged_layers()[1].spilled_bytes())
+
+    def test_release_drops_the_spilled_cache(self):
+        pool = KVBlockPool()
+        cache = filled_cache(pool, BLOCK_TOKENS)
+        spill_cache(cache, self.directory)
+
+        cache.release()
+
+        self.assertEqual(pool.stats().spilled_bytes, 0)
+        self.assertEqual(cache.get_seq_length(), 0)
+
+    def test_busy_cache_is_left_alone(self):
+        pool = KVBlockPool()
+        cache = filled_cache(pool, BLOCK_TOKENS)
+        # A forward on another thread holds the cache's lock
+        locked, done = Event(), Event()
+        def forward():
+            with cache.lock:
+                locked.set()
+                done.wait()
+        thread = Thread(target=forward)
+        thread.start()
+        locked.wait()
+
+        try:
+            self.assertEqual(spill_cache(cache, self.directory), 0)
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(cache.spilled_bytes(), 0)
+
+
+class KVSpillTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_spill(self, pool: KVBlockPool, max_bytes: int, policy: str = SPILL_LRU) -> KVSpill:
+        return KVSpill(pool, self.directory, lambda: max_bytes / GB, lambda: policy, start=False)
+
+    def test_lru_spills_the_caches_used_longest_ago(self):
+        pool = KVBlockPool()
+        old = filled_cache(pool, BLOCK_TOKENS, last_used=100.0)
+        new = filled_cache(pool, BLOCK_TOKENS, last_used=200.0)
+
+        self.assertEqual(self.make_spill(pool, 1).candidates(300.0), [old, new])
+
+    def test_largest_spills_the_biggest_caches(self):
+        pool = KVBlockPool()
+        small = filled_cache(pool, BLOCK_TOKENS, last_used=100.0)
+        large = filled_cache(pool, BLOCK_TOKENS * 3, last_used=200.0)
+
+        self.assertEqual(self.make_spill(pool, 1, SPILL_LARGEST).candidates(300.0), [large, small])
+
+    def test_busy_caches_are_not_candidates(self):
+        pool = KVBlockPool()
+        filled_cache(pool, BLOCK_TOKENS, last_used=300.0 - MIN_SPILL_IDLE / 2)
+
+        self.assertEqual(self.make_spill(pool, 1).candidates(300.0), [])
+
+    def test_spills_until_under_the_low_water_mark(self):
+        pool = KVBlockPool()
+        caches = [filled_cache(pool, BLOCK_TOKENS, last_used=float(i)) for i in range(4)]
+        per_cache = caches[0].held_bytes()
+        # Room for three caches: one spill is not enough to get under 90%
+        limit = int(per_cache * 3)
+        self.assertLess(per_cache * 2, limit * SPILL_LOW_WATER)
+
+        spilled = self.make_spill(pool, limit).check(100.0)
+
+        self.assertEqual(spilled, per_cache * 2)
+        self.assertEqual([cache.spilled_bytes() > 0 for cache in caches], [True, True, False, False])
+
+    def test_nothing_spills_under_the_mark(self):
+        pool = KVBlockPool()
+        filled_cache(pool, BLOCK_TOKENS)
+
+        self.assertEqual(self.make_spill(pool, GB).check(100.0), 0)
+        self.assertEqual(self.make_spill(pool, 0).check(100.0), 0)
+
+    def test_allocation_over_the_mark_wakes_the_spill(self):
+        pool = KVBlockPool()
+        spill = self.make_spill(pool, 1)
+        spill.check()
+
+        filled_cache(pool, 1)
+
+        self.assertTrue(spill.wake.is_set())
+
+    def test_clears_files_left_behind(self):
+        (self.directory / "old.kv").write_bytes(b"0")
+
+        self.make_spill(KVBlockPool(), 0)
+
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_unknown_policy_is_refused(self):
+        with self.assertRaisesRegex(Exception, "Unknown KV spill policy"):
+            self.make_spill(KVBlockPool(), 0, "priority")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig
+
+from llm_layer_collector import LlmLayerCollector
+from llm_layer_collector.auto.static_auto_model import StaticAutoModel
+
+from language_pipes.jobs.job_data import JobData, computationStateToJobData
+from language_pipes.jobs.job_progress import JobProgress, kv_tokens
+from language_pipes.modeling.compute import compute_layers
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, KVBlockPool, PagedCache, whole_blocks, window_kept
+
+HEADS = 2
+HEAD_DIM = 4
+SINK = BLOCK_TOKENS
+WINDOW = BLOCK_TOKENS * 2
+
+
+def make_config() -> LlamaConfig:
+    return LlamaConfig(
+        num_hidden_layers=2,
+        hidden_size=HEADS * HEAD_DIM,
+        num_attention_heads=HEADS,
+        num_key_value_heads=HEADS
+    )
+
+
+def kv(tokens: int):
+    return torch.randn(1, HEADS, tokens, HEAD_DIM), torch.randn(1, HEADS, tokens, HEAD_DIM)
+
+
+class WindowKeptTests(unittest.TestCase):
+    def test_keeps_every_token_until_the_window_is_full(self):
+        self.assertEqual(window_kept(100, SINK, 0), 100)
+        self.assertEqual(window_kept(SINK + WINDOW, SINK, WINDOW), SINK + WINDOW)
+
+    def test_drops_whole_blocks(self):
+        for past in range(SINK + WINDOW, SINK + WINDOW + BLOCK_TOKENS * 4):
+            kept = window_kept(past, SINK, WINDOW)
+            self.assertEqual((past - kept) % BLOCK_TOKENS, 0)
+            self.assertGreaterEqual(kept, SINK + WINDOW)
+            self.assertLess(kept, SINK + WINDOW + BLOCK_TOKENS)
+
+    def test_whole_blocks(self):
+        self.assertEqual(whole_blocks(0), 0)
+        self.assertEqual(whole_blocks(1), BLOCK_TOKENS)
+        self.assertEqual(whole_blocks(BLOCK_TOKENS), BLOCK_TOKENS)
+
+    def test_bounded_jobs_reserve_the_bound(self):
+        self.assertEqual(kv_tokens(10000, 0, 512), 10000)
+        self.assertEqual(kv_tokens(10000, SINK + WINDOW, 512), SINK + WINDOW + BLOCK_TOKENS + 512)
+        self.assertEqual(kv_tokens(100, SINK + WINDOW, 512), 100)
+        progress = JobProgress(0, 5000, True, 0, 5000, SINK + WINDOW)
+        self.assertEqual(JobProgress.from_bytes(progress.to_bytes()).kv_tokens(512), SINK + WINDOW + BLOCK_TOKENS + 512)
+
+
+class EvictTests(unittest.TestCase):
+    def test_drops_the_blocks_after_the_sink(self):
+        pool = KVBlockPool()
+        cache = PagedCache(make_config(), pool)
+        k, v = kv(BLOCK_TOKENS * 4 + 3)
+        cache.update(k, v, 0)
+
+        cache.evict([0, 1], SINK, BLOCK_TOKENS * 2 + 3)
+
+        self.assertEqual(cache.layers[0].get_seq_length(), BLOCK_TOKENS * 2 + 3)
+        self.assertEqual(pool.stats().used_blocks, 3)
+        k2, v2 = kv(1)
+        keys, _ = cache.update(k2, v2, 0)
+        expected = torch.cat([k[:, :, :SINK], k[:, :, BLOCK_TOKENS * 3:], k2], dim=2)
+        self.assertTrue(torch.equal(keys, expected))
+
+    def test_only_whole_blocks_go(self):
+        cache = PagedCache(make_config(), KVBlockPool())
+        cache.update(*kv(BLOCK_TOKENS * 3), 0)
+
+        with self.assertRaisesRegex(Exception, "whole blocks"):
+            cache.evict([0], SINK, BLOCK_TOKENS * 2 + 1)
+
+
+class JobDataWindowTests(unittest.TestCase):
+    def test_window_round_trips(self):
+        data = JobData(
+            cache_position=torch.arange(3),
+            position_ids=torch.arange(3).unsqueeze(0),
+            causal_mask={},
+            position_embeddings={},
+            state=torch.zeros(1, 3, 4),
+            kv_sink_tokens=SINK,
+            kv_window_tokens=WINDOW
+        )
+
+        restored = JobData.from_bytes(data.to_bytes())
+
+        assert restored is not None
+        self.assertEqual(restored.kv_sink_tokens, SINK)
+        self.assertEqual(restored.kv_window_tokens, WINDOW)
+
+
+class BoundedGenerationTests(unittest.TestCase):
+    """A tiny random one layer Llama run one token at a time with a bounded
+    cache, checked against the same model run on only the tokens the cache
+    kept. With one layer the keys of a token do not depend on the tokens
+    before it, so both see the same keys."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        model_dir = Path(cls.tmp.name)
+        torch.manual_seed(0)
+        config = LlamaConfig(
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=1,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            vocab_size=64,
+            max_position_embeddings=256
+        )
+        AutoModelForCausalLM.from_config(config).save_pretrained(model_dir / "data", safe_serialization=True)
+        cls.reference = AutoModelForCausalLM.from_pretrained(model_dir / "data").model.eval()
+        cls.collector = LlmLayerCollector(model_dir / "data", model_dir / "cache.json", dtype=torch.float32)
+        cls.embedding = cls.collector.load_input_embedding(torch.device("cpu"))
+        cls.layers = cls.collector.load_layer_set(0, 0, torch.device("cpu"))
+        cls.norm = cls.collector.load_norm(torch.device("cpu"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_cache_stays_bounded_and_matches_the_kept_tokens(self):
+        torch.manual_seed(1)
+        prompt_tokens = 40
+        ids = torch.randint(0, 64, (prompt_tokens + 40,)).tolist()
+        cache = PagedCache(self.collector.config, KVBlockPool())
+
+        past = 0
+        state = None
+        with torch.no_grad():
+            while past < len(ids):
+                step = prompt_tokens if past == 0 else 1
+                kept = window_kept(past, SINK, WINDOW)
+                comp_state = StaticAutoModel.compute_embedding(
+                    prompt_tokens=prompt_tokens,
+                    chunk_size=prompt_tokens,
+                    input_embedder=self.embedding,
+                    input_ids=torch.tensor([ids[:past + step]]),
+                    config=self.collector.config,
+                    cache=cache,
+                    past_seen_tokens=past,
+                    kept_tokens=kept
+                )
+                job_data = computationStateToJobData(comp_state)
+                job_data.kv_sink_tokens = SINK
+                job_data.kv_window_tokens = WINDOW
+                state, _ = compute_layers(0, job_data, torch.device("cpu"), self.collector.config, self.layers, cache)
+                self.assertEqual(cache.get_seq_length(), kept + step)
+                self.assertLess(cache.get_seq_length(), SINK + WINDOW + BLOCK_TOKENS + 1)
+                past += step
+
+            # The last pass saw the sink and the window behind the newest token
+            last = len(ids) - 1
+            kept = window_kept(last, SINK, WINDOW)
+            positions = list(range(SINK)) + list(range(last - (kept - SINK), last + 1))
+            expected = self.reference(
+                input_ids=torch.tensor([[ids[p] for p in positions]]),
+                position_ids=torch.tensor([positions])
+            ).last_hidden_state[:, -1]
+
+        assert state is not None
+        self.assertTrue(torch.allclose(self.norm(state)[:, -1], expected, atol=1e-4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+import torch
+from transformers import LlamaConfig, PretrainedConfig
+
+from language_pipes.jobs.memory_governor import GB, Admission, MemoryGovernor, device_key, kv_cache_bytes
+from language_pipes.modeling.kv_pool import BLOCK_TOKENS, KV_AUTO, KV_INT8, KVBlockPool, PagedCache
+
+
+def make_governor(weights: int = 0, limit_gb: float = 10, buffered: int = 0) -> MemoryGovernor:
+    return MemoryGovernor(
+        lambda: {"cpu": weights},
+        lambda: buffered,
+        lambda: limit_gb
+    )
+
+
+class KvCacheBytesTests(unittest.TestCase):
+    def test_full_attention_grows_a_block_at_a_time(self):
+        config = PretrainedConfig(num_attention_heads=8, num_key_value_heads=2, hidden_size=64)
+        # keys and values, 2 heads of 8 dims, 2 bytes each
+        per_token = 2 * 2 * 8 * 2
+
+        # A block of tokens on 3 layers, and the copy one layer's forward makes
+        self.assertEqual(kv_cache_bytes(config, range(3), 10), 4 * per_token * BLOCK_TOKENS)
+        self.assertEqual(kv_cache_bytes(config, range(3), BLOCK_TOKENS + 1), 4 * per_token * 2 * BLOCK_TOKENS)
+
+    def test_quantized_cache_takes_a_byte_per_value_and_its_scales(self):
+        config = PretrainedConfig(num_attention_heads=8, num_key_value_heads=2, hidden_size=64)
+
+        # keys and values, 2 heads of 8 one byte dims and a 4 byte scale, and
+        # the copy of the forward in 2 bytes
+        per_token = 2 * 2 * (8 + 4) + 2 * 2 * 8 * 2
+        self.assertEqual(kv_cache_bytes(config, [0], 10, kv_dtype="int8"), per_token * BLOCK_TOKENS)
+
+    def test_matches_what_a_paged_cache_holds(self):
+        config = LlamaConfig(num_hidden_layers=2, hidden_size=16, num_attention_heads=2, num_key_value_heads=2)
+        for kv_dtype in [KV_AUTO, KV_INT8]:
+            cache = PagedCache(config, KVBlockPool(), kv_dtype)
+            for layer_idx in range(2):
+                keys, values = cache.update(*[torch.randn(1, 2, 20, 8, dtype=torch.bfloat16)] * 2, layer_idx)
+            copy = keys.numel() * keys.element_size() + values.numel() * values.element_size()
+
+            self.assertGreaterEqual(kv_cache_bytes(config, range(2), 20, kv_dtype=kv_dtype), cache.held_bytes() + copy)
+
+    def test_sliding_and_linear_layers(self):
+        config = PretrainedConfig(
+            num_attention_heads=4,
+            head_dim=16,
+            sliding_window=4,
+            layer_types=["sliding_attention", "linear_attention", "full_attention"]
+        )
+        per_token = 2 * 4 * 16 * 2
+
+        self.assertEqual(kv_cache_bytes(config, [0], 10), per_token * 4)
+        self.assertEqual(kv_cache_bytes(config, [1], 10), 0)
+        self.assertEqual(kv_cache_bytes(config, [2], 10), 2 * per_token * BLOCK_TOKENS)
+
+
+class AdmissionTests(unittest.TestCase):
+    def test_job_that_fits_is_admitted(self):
+        governor = make_governor(weights=4 * GB)
+
+        result = governor.admit("job-1", {"cpu": 5 * GB})
+
+        self.assertEqual(result.admission, Admission.ADMIT)
+        self.assertEqual(governor.devices()[0].kv, 5 * GB)
+
+    def test_job_that_fits_after_others_finish_waits(self):
+        governor = make_governor(weights=4 * GB)
+        governor.admit("job-1", {"cpu": 5 * GB})
+
+        result = governor.admit("job-2", {"cpu": 2 * GB})
+
+        self.assertEqual(result.admission, Admission.WAIT)
+        self.assertNotIn("job-2", governor.reserved)
+
+    def test_job_that_never_fits_is_rejected_with_a_reason(self):
+        governor = make_governor(weights=4 * GB, buffered=1 * GB)
+
+        result = governor.admit("job-1", {"cpu": 6 * GB})
+
+        self.assertEqual(result.admission, Admission.REJECT)
+        assert result.reason is not None
+        self.assertIn("6.00 GB", result.reason)
+        self.assertIn("cpu", result.reason)
+
+    def test_without_a_limit_most_of_the_device_is_used(self):
+        governor = MemoryGovernor(lambda: { }, get_max_device_memory=lambda: 0, get_device_memory=lambda d: 10 * GB)
+
+        self.assertEqual(governor.admit("job-1", {"cuda:0": 9.5 * GB}).admission, Admission.REJECT)
+        self.assertEqual(governor.admit("job-2", {"cuda:0": 9 * GB}).admission, Admission.ADMIT)
+
+    def test_admitting_a_job_again_reserves_nothing_more(self):
+        governor = make_governor()
+        governor.admit("job-1", {"cpu": 6 * GB})
+
+        self.assertEqual(governor.admit("job-1", {"cpu": 6 * GB}).admission, Admission.ADMIT)
+        self.assertEqual(governor.devices()[0].kv, 6 * GB)
+
+    def test_device_names(self):
+        self.assertEqual(device_key("cuda"), "cuda:0")
+        self.assertEqual(device_key("cuda:1"), "cuda:1")
+        self.assertEqual(device_key("cpu"), "cpu")
+
+
+class WaitingTests(unittest.TestCase):
+    def setUp(self):
+        # The admission timeout is driven by hand
+        patcher = patch("language_pipes.jobs.memory_governor.Timer")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.events = []
+
+    def wait(self, governor: MemoryGovernor, job_id: str, size: int):
+        governor.wait(
+            job_id,
+            {"cpu": size},
+            lambda: self.events.append(("resume", job_id)),
+            lambda reason: self.events.append(("reject", job_id))
+        )
+
+    def test_release_lets_waiting_jobs_in_in_order(self):
+        governor = make_governor()
+        governor.admit("job-1", {"cpu": 8 * GB})
+        self.wait(governor, "job-2", 6 * GB)
+        self.wait(governor, "job-3", 1 * GB)
+
+        # job-3 would fit already, but does not jump the queue
+        self.assertEqual(self.events, [])
+
+        governor.release("job-1")
+
+        self.assertEqual(self.events, [("resume", "job-2"), ("resume", "job-3")])
+        self.assertEqual(governor.devices()[0].kv, 7 * GB)
+
+    def test_new_job_does_not_overtake_waiting_ones(self):
+        governor = make_governor()
+        governor.admit("job-1", {"cpu": 8 * GB})
+        self.wait(governor, "job-2", 6 * GB)
+
+        result = governor.admit("job-3", {"cpu": 1 * GB})
+
+        self.assertEqual(result.admission, Admission.WAIT)
+        self.assertNotIn("job-3", governor.reserved)
+
+    def test_waiting_job_times_out(self):
+        governor = make_governor()
+        governor.admit("job-1", {"cpu": 8 * GB})
+        self.wait(governor, "job-2", 6 * GB)
+
+        governor._timeout("job-2")
+        governor.release("job-1")
+
+        self.assertEqual(self.events, [("reject", "job-2")])
+
+    def test_released_waiting_job_leaves_the_queue(self):
+        governor = make_governor()
+        governor.admit("job-1", {"cpu": 8 * GB})
+        self.wait(governor, "job-2", 6 * GB)
+
+        governor.release("job-2")
+        governor.release("job-1")
+
+        self.assertEqual(self.events, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
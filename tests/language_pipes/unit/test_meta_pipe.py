@@ -17,6 +17,7 @@ def make_computed():
     metadata.embed_hash = "embed"
     metadata.head_hash = "head"
     metadata.layer_hash= "l0"
+    metadata.version = "1.0.0"
     return metadata
 
 
@@ -72,6 +73,27 @@ class MetaPipeTests(unittest.TestCase):
 
         self.assertEqual(pipe.get_filled_slots(), [1, 1, 2, 2])
 
+    def test_prefill_and_decode_segments_do_not_share_a_pipe(self):
+        meta_data = make_computed()
+        pipe = MetaPipe("pipe-1", "model-1", [
+            MetaModel("p1", 0, 1, True, "node-a", "pipe-1", "model-1", 4, meta_data, role="prefill"),
+            MetaModel("p2", 2, 3, True, "node-b", "pipe-1", "model-1", 4, meta_data),
+        ])
+
+        self.assertTrue(pipe.can_prefill())
+        self.assertFalse(pipe.can_decode())
+        self.assertTrue(pipe.accepts("prefill"))
+        self.assertTrue(pipe.accepts("both"))
+        self.assertFalse(pipe.accepts("decode"))
+
+    def test_role_goes_over_the_network(self):
+        model = MetaModel("p1", 0, 1, True, "node-a", "pipe-1", "model-1", 4, make_computed(), role="decode")
+
+        self.assertEqual(MetaModel.from_dict(model.to_json()).role, "decode")
+        old_peer = model.to_json()
+        del old_peer["role"]
+        self.assertEqual(MetaModel.from_dict(old_peer).role, "both")
+
 
 if __name__ == '__main__':
     unittest.main()
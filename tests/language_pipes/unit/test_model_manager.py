@@ -73,6 +73,7 @@ class FakeLlmModel:
         self.start_layer = -1
         self.end_layer = -1
         self.loaded = False
+        self.own_process = False
         self.num_hidden_layers = num_hidden_layers
         self.meta_data = make_metadata()
         self.process_id = f"process-{model_id}-{pipe_id}"
@@ -82,8 +83,9 @@ class FakeLlmModel:
         self.collector.config = MagicMock()
         self.collector.config.num_hidden_layers = num_hidden_layers
 
-    def load(self):
+    def load(self, own_process: bool = False):
         self.loaded = True
+        self.own_process = own_process
 
     def cleanup_tensors(self):
         pass
@@ -108,10 +110,22 @@ class FakeLlmModel:
 class FakeEndModel:
     """Mock EndModel for testing without loading real models."""
     
-    def __init__(self, num_local_layers: int, model_dir: Path, model_id: str, device: str):
+    def __init__(
+            self,
+            num_local_layers: int,
+            model_dir: Path,
+            model_id: str,
+            device: str,
+            kv_cache_dtype: str = "auto",
+            kv_sink_tokens: int = 0,
+            kv_window_tokens: int = 0
+        ):
         self.model_dir = model_dir
         self.model_id = model_id
         self.device = device
+        self.kv_cache_dtype = kv_cache_dtype
+        self.kv_sink_tokens = kv_sink_tokens
+        self.kv_window_tokens = kv_window_tokens
         self.process_id = f"end-{model_id}"
         self.layers = list(range(num_local_layers))
 
@@ -342,6 +356,35 @@ class ModelManagerTests(unittest.TestCase):
 
         self.assertIn("existing-pipe", manager.pipes_hosted["model-1"])
 
+    @patch('language_pipes.modeling.model_manager.EndModel', FakeEndModel)
+    @patch('language_pipes.modeling.model_manager.LlmModel')
+    def test_decode_layers_do_not_join_a_prefill_pipe(self, mock_llm_model_class):
+        """Test host_model starts a new pipe rather than mix prefill and decode segments."""
+        existing_model = MetaModel(
+            process_id="existing-process",
+            start_layer=0,
+            end_layer=1,
+            loaded=True,
+            node_id="node-b",
+            pipe_id="existing-pipe",
+            model_id="model-1",
+            num_layers=4,
+            meta_data=make_metadata(),
+            role="prefill"
+        )
+        mock_llm_model_class.from_id.return_value = FakeLlmModel("model-1", "node-a", "new-pipe", torch.device("cpu"))
+
+        node = FakeStateNetworkNode("node-a")
+        node.add_peer("node-a", [])
+        node.add_peer("node-b", [existing_model])
+        router = RouterPipes(node) # type: ignore
+
+        manager = ModelManager()
+        manager.host_model(router, "node-a", "model-1", 10.0, torch.device("cpu"), first_layer=0, data_type=16, max_pipes=2, role="decode")
+
+        self.assertNotIn("existing-pipe", manager.pipes_hosted["model-1"])
+        self.assertEqual(mock_llm_model_class.from_id.call_args.kwargs["role"], "decode")
+
     @patch('language_pipes.modeling.model_manager.EndModel', FakeEndModel)
     @patch('language_pipes.modeling.model_manager.LlmModel')
     def test_get_model_for_pipe_returns_none_when_no_memory(self, mock_llm_model_class):
@@ -429,6 +472,24 @@ class ModelManagerTests(unittest.TestCase):
         # All models in the manager should be loaded
         for model in manager.layer_models:
             self.assertTrue(model.loaded)
+            self.assertFalse(model.own_process)  # pyright: ignore[reportAttributeAccessIssue]
+
+    @patch('language_pipes.modeling.model_manager.EndModel', FakeEndModel)
+    @patch('language_pipes.modeling.model_manager.LlmModel')
+    def test_models_load_in_their_own_process_when_asked(self, mock_llm_model_class):
+        fake_model = FakeLlmModel("model-1", "node-a", "pipe-1", torch.device("cpu"))
+        mock_llm_model_class.from_id.return_value = fake_model
+
+        node = FakeStateNetworkNode("node-a")
+        node.add_peer("node-a", [])
+        router = RouterPipes(node) # type: ignore
+
+        manager = ModelManager()
+        manager.host_model(router, "node-a", "model-1", 10.0, torch.device("cpu"), first_layer=0, data_type=16, max_pipes=1, own_process=True)
+
+        self.assertGreater(len(manager.layer_models), 0)
+        for model in manager.layer_models:
+            self.assertTrue(model.own_process)  # pyright: ignore[reportAttributeAccessIssue]
 
     @patch('language_pipes.modeling.model_manager.EndModel', FakeEndModel)
     @patch('language_pipes.modeling.model_manager.LlmModel')
@@ -1,10 +1,17 @@
 import os
 import sys
 import unittest
+from unittest import mock
+
+import torch
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
 
-from language_pipes.jobs.network_job import NetworkJob, JobTime
+from transformers import PretrainedConfig
+
+from language_pipes.jobs.job import Job
+from language_pipes.jobs.job_data import JobData
+from language_pipes.jobs.network_job import HopReply, NetworkJob, JobTime
 from language_pipes.util.enums import ComputeStep
 
 
@@ -51,6 +58,76 @@ class NetworkJobTests(unittest.TestCase):
         self.assertEqual(len(restored.times), 1)
         self.assertEqual(restored.times[0].node_id, "node-a")
 
+    def test_pass_number_round_trip(self):
+        job = NetworkJob("job-1", "pipe-1", "node-a", 2, None, b"", ComputeStep.LAYER, [], pass_id=7)
+
+        restored, _ = NetworkJob.from_bytes(job.to_bytes())
+
+        self.assertEqual(restored.pass_id, 7)
+        self.assertEqual(restored.hop_key(), job.hop_key())
+
+    def test_segment_moves_round_trip(self):
+        job = NetworkJob("job-1", "pipe-1", "node-a", 2, None, b"", ComputeStep.LAYER, [], segment_moves={4: "p9"})
+
+        restored, _ = NetworkJob.from_bytes(job.to_bytes())
+
+        self.assertEqual(restored.segment_moves, {4: "p9"})
+
+    def test_replay_round_trip(self):
+        job = NetworkJob("job-1", "pipe-1", "node-a", 0, None, b"", ComputeStep.EMBED, [], replay_id=5, replay_start=4, replay_end=8)
+
+        restored, _ = NetworkJob.from_bytes(job.to_bytes())
+
+        self.assertEqual((restored.replay_id, restored.replay_start, restored.replay_end), (5, 4, 8))
+
+    def test_unnumbered_pass_has_no_hop_key(self):
+        job = NetworkJob("job-1", "pipe-1", "node-a", 2, None, b"", ComputeStep.LAYER, [])
+
+        self.assertIsNone(job.hop_key())
+
+    def test_hops_of_a_pass_have_different_keys(self):
+        first = NetworkJob("job-1", "pipe-1", "node-a", 2, None, b"", ComputeStep.LAYER, [], pass_id=7)
+        second = NetworkJob("job-1", "pipe-1", "node-a", 5, None, b"", ComputeStep.LAYER, [], pass_id=7)
+
+        self.assertNotEqual(first.hop_key(), second.hop_key())
+
+    def test_job_data_is_serialized_once_per_packet(self):
+        job = Job(
+            origin_node_id="node-a",
+            messages=[],
+            pipe_id="pipe-1",
+            model_id="model-1",
+            config=PretrainedConfig(num_hidden_layers=1),
+        )
+        job.data = JobData(
+            state=torch.ones((1, 2, 4)),
+            position_ids=torch.tensor([[0, 1]]),
+            cache_position=torch.tensor([0, 1]),
+            causal_mask={},
+            position_embeddings={}
+        )
+        to_bytes = JobData.to_bytes
+
+        with mock.patch.object(JobData, "to_bytes", autospec=True, side_effect=to_bytes) as serialize:
+            data = job.to_network_job().to_bytes()
+
+        restored, valid = NetworkJob.from_bytes(data)
+        self.assertEqual(serialize.call_count, 1)
+        self.assertTrue(valid)
+        assert restored.data is not None
+        self.assertTrue(torch.equal(restored.data.state, job.data.state))
+
+
+class HopReplyTests(unittest.TestCase):
+    def test_round_trips_with_credit(self):
+        for reply in (HopReply(True, 3), HopReply(False, 0)):
+            self.assertEqual(HopReply.from_reply(reply.to_bytes()), reply)
+
+    def test_reads_answers_of_older_nodes(self):
+        self.assertEqual(HopReply.from_reply(b"OK"), HopReply(True))
+        self.assertEqual(HopReply.from_reply(b"BUSY"), HopReply(False))
+        self.assertEqual(HopReply.from_reply(None), HopReply(True))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -5,13 +5,14 @@ import sys
 import threading
 import time
 import unittest
+from unittest.mock import patch
 import requests
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
 
 from language_pipes.oai_server import OAIHttpServer
-from language_pipes.util.chat import ChatRole
-from language_pipes.util.oai import ResponsesRequest, _response_json
+from language_pipes.util.chat import ChatMessage, ChatRole
+from language_pipes.util.oai import ResponseHistory, ResponsesRequest, _response_json
 from language_pipes.util.oai_tool_calls import (
     ReasoningStreamSplitter,
     parse_tool_call,
@@ -147,6 +148,69 @@ class ResponsesRequestTests(unittest.TestCase):
             thread.join(timeout=1)
 
 
+class PreviousResponseTests(unittest.TestCase):
+    def test_history_goes_after_the_instructions(self):
+        history = [ChatMessage(ChatRole.USER, "Question"), ChatMessage(ChatRole.ASSISTANT, "Answer")]
+
+        req = ResponsesRequest.from_dict({
+            "model": "model-1",
+            "instructions": "Be concise",
+            "input": "Next question",
+            "previous_response_id": "resp-job-1",
+        }, history)
+
+        self.assertEqual([m.content for m in req.messages], ["Be concise", "Question", "Answer", "Next question"])
+        self.assertEqual([m.content for m in req.conversation], ["Question", "Answer", "Next question"])
+
+    def test_history_keeps_the_last_responses(self):
+        history = ResponseHistory(max_responses=2)
+        for i in range(3):
+            history.store("key-1", f"resp-{i}", [ChatMessage(ChatRole.USER, str(i))])
+
+        self.assertIsNone(history.get("key-1", "resp-0"))
+        self.assertEqual(history.get("key-1", "resp-2")[0].content, "2")  # pyright: ignore[reportOptionalSubscript]
+        self.assertIsNone(history.get("key-2", "resp-2"))
+
+    def test_next_request_continues_the_stored_response(self):
+        calls = []
+
+        def complete(api_key, model, messages, max_completion_tokens, temperature, top_k, top_p, min_p, presence_penalty, start, update, resolve, **session):
+            calls.append((messages, session))
+            job = DummyJob()
+            start(job)
+            calls.append(job.session_id)
+            resolve(job)
+
+        server = OAIHttpServer(5000, [], complete, lambda: ["model-1"])
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        try:
+            port = server.server_address[1]
+            with patch("language_pipes.util.oai.RESPONSE_HISTORY", ResponseHistory()):
+                first = requests.post(f"http://127.0.0.1:{port}/v1/responses", json={"model": "model-1", "input": "Hello"})
+                second = requests.post(f"http://127.0.0.1:{port}/v1/responses", json={
+                    "model": "model-1", "input": "And again", "previous_response_id": first.json()["id"]
+                })
+                unknown = requests.post(f"http://127.0.0.1:{port}/v1/responses", json={
+                    "model": "model-1", "input": "Hello", "previous_response_id": "resp-missing"
+                })
+
+            self.assertEqual(second.status_code, 200)
+            self.assertEqual(second.json()["previous_response_id"], "resp-job-1")
+            messages, session = calls[2]
+            self.assertEqual([m.content for m in messages], ["Hello", "Hello from Language Pipes", "And again"])
+            self.assertEqual(session, {"resume_session_id": "resp-job-1"})
+            # Every stored response keeps its KV cache under a session
+            self.assertIsNotNone(calls[1])
+            self.assertEqual(unknown.status_code, 400)
+            self.assertEqual(len(calls), 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join(timeout=1)
+
+
 class ToolDefinitionParsingTests(unittest.TestCase):
     def test_parses_valid_function_tool(self):
         tools = parse_tool_definitions([WEATHER_TOOL])
@@ -0,0 +1,190 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+from transformers import PreTrainedTokenizerFast
+
+from language_pipes.modeling.prompt_cache import PromptCache, prefix_keys
+
+CHATML = (
+    "{% for message in messages %}"
+    "{{ '<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
+)
+
+# Each turn goes on right after the special token that ended the last one
+RUN_ON = (
+    "{% for message in messages %}"
+    "{{ message['role'] + ': ' + message['content'] + '<|im_end|>' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ 'assistant:' }}{% endif %}"
+)
+
+CORPUS = [
+    "the quick brown fox jumps over the lazy dog",
+    "hello there, how are you doing today?",
+    "tell me about pipes and layers and nodes",
+    "user assistant system",
+]
+
+
+def make_tokenizer() -> PreTrainedTokenizerFast:
+    """A small byte level BPE with ChatML special tokens."""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=300,
+        special_tokens=["<|im_start|>", "<|im_end|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(CORPUS, trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tokenizer)
+    fast.add_special_tokens({"additional_special_tokens": ["<|im_start|>", "<|im_end|>"]})
+    fast.chat_template = CHATML
+    return fast
+
+
+def make_metaspace_tokenizer(chat_template: str = CHATML) -> PreTrainedTokenizerFast:
+    """A small SentencePiece style BPE. Only the start of the text gets a
+    leading "▁", so text after a special token encodes differently alone."""
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace(prepend_scheme="first")
+    tokenizer.decoder = decoders.Metaspace(prepend_scheme="first")
+    trainer = trainers.BpeTrainer(vocab_size=300, special_tokens=["<unk>", "<|im_start|>", "<|im_end|>"])
+    tokenizer.train_from_iterator(CORPUS + ["\n"], trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>")
+    fast.add_special_tokens({"additional_special_tokens": ["<|im_start|>", "<|im_end|>"]})
+    fast.chat_template = chat_template
+    return fast
+
+
+class CountingTokenizer:
+    """Wraps a tokenizer and counts the characters it is asked to encode."""
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.chat_template = tokenizer.chat_template
+        self.encoded = 0
+
+    def apply_chat_template(self, *args, **kwargs):
+        return self.tokenizer.apply_chat_template(*args, **kwargs)
+
+    def get_added_vocab(self):
+        return self.tokenizer.get_added_vocab()
+
+    def encode(self, text, **kwargs):
+        self.encoded += len(text)
+        return self.tokenizer.encode(text, **kwargs)
+
+
+def conversation(turns: int):
+    messages = [{"role": "system", "content": "you are a helpful assistant"}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"tell me about pipes {i}, the quick brown fox"})
+        messages.append({"role": "assistant", "content": f"hello there, layers and nodes {i}"})
+    messages.append({"role": "user", "content": "how are you doing today?"})
+    return messages
+
+
+def encode_whole(tokenizer, messages):
+    prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer.encode(prompt)
+
+
+class PromptCacheTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = make_tokenizer()
+
+    def test_first_prompt_matches_encoding_it_whole(self):
+        cache = PromptCache(self.tokenizer)
+        messages = conversation(1)
+
+        self.assertEqual(cache.encode(messages), encode_whole(self.tokenizer, messages))
+
+    def test_next_turn_matches_encoding_it_whole(self):
+        cache = PromptCache(self.tokenizer)
+        for turns in range(4):
+            messages = conversation(turns)
+            self.assertEqual(cache.encode(messages), encode_whole(self.tokenizer, messages))
+
+    def test_next_turn_only_encodes_the_new_text(self):
+        counting = CountingTokenizer(self.tokenizer)
+        cache = PromptCache(counting)
+        first = conversation(3)
+        cache.encode(first)
+        counting.encoded = 0
+
+        second = first + [
+            {"role": "assistant", "content": "the lazy dog"},
+            {"role": "user", "content": "and then?"}
+        ]
+        ids = cache.encode(second)
+
+        prompt = self.tokenizer.apply_chat_template(second, tokenize=False, add_generation_prompt=True)
+        earlier = self.tokenizer.apply_chat_template(first, tokenize=False, add_generation_prompt=False)
+        self.assertEqual(counting.encoded, len(prompt) - len(earlier))
+        self.assertEqual(ids, encode_whole(self.tokenizer, second))
+
+    def test_changed_history_is_encoded_again(self):
+        cache = PromptCache(self.tokenizer)
+        first = conversation(2)
+        cache.encode(first)
+
+        edited = [dict(m) for m in first]
+        edited[1]["content"] = "a different question"
+
+        self.assertEqual(cache.encode(edited), encode_whole(self.tokenizer, edited))
+
+    def test_tokenizer_without_added_tokens_is_not_cached(self):
+        tokenizer = make_tokenizer()
+        cache = PromptCache(tokenizer)
+        cache.markers = []
+
+        cache.encode(conversation(1))
+
+        self.assertEqual(len(cache), 0)
+
+    def test_text_after_a_special_token_is_not_cut_off_when_it_encodes_differently(self):
+        tokenizer = make_metaspace_tokenizer(RUN_ON)
+        cache = PromptCache(tokenizer)
+
+        for turns in range(3):
+            messages = conversation(turns)
+            self.assertEqual(cache.encode(messages), encode_whole(tokenizer, messages))
+        self.assertEqual(len(cache), 0)
+
+    def test_metaspace_tokenizer_is_still_cut_before_special_tokens(self):
+        tokenizer = make_metaspace_tokenizer()
+        cache = PromptCache(tokenizer)
+
+        for turns in range(3):
+            messages = conversation(turns)
+            self.assertEqual(cache.encode(messages), encode_whole(tokenizer, messages))
+        self.assertEqual(len(cache), 3)
+
+    def test_keeps_at_most_max_tokens(self):
+        cache = PromptCache(self.tokenizer, max_tokens=200)
+        for i in range(10):
+            cache.encode([{"role": "user", "content": f"the quick brown fox {i} " * 3}])
+
+        self.assertLessEqual(cache.cached_tokens, 200)
+        self.assertLess(len(cache), 10)
+
+
+class PrefixKeyTests(unittest.TestCase):
+    def test_key_follows_every_message_before_it(self):
+        a = prefix_keys([{"role": "user", "content": "a"}, {"role": "user", "content": "b"}])
+        b = prefix_keys([{"role": "user", "content": "x"}, {"role": "user", "content": "b"}])
+
+        self.assertNotEqual(a[0], b[0])
+        self.assertNotEqual(a[1], b[1])
+        self.assertEqual(len(a), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -123,5 +123,90 @@ class RouterPipesTests(unittest.TestCase):
         self.assertEqual(pipe.pipe_id, "pipe-1")
 
 
+    def test_replicas_hold_the_same_layers_in_other_pipes(self):
+        node = FakeStateNetworkNode("node-a")
+        router = RouterPipes(node) # pyright: ignore[reportArgumentType]
+        meta_data = make_computed()
+        model = MetaModel("p1", 0, 1, True, "node-a", "pipe-1", "model-1", 4, meta_data)
+        node.add_peer(
+            "node-a",
+            [
+                model,
+                MetaModel("p2", 0, 1, True, "node-b", "pipe-2", "model-1", 4, meta_data),
+                MetaModel("p3", 0, 2, True, "node-c", "pipe-3", "model-1", 4, meta_data),
+                MetaModel("p4", 0, 1, False, "node-d", "pipe-4", "model-1", 4, meta_data),
+                MetaModel("p5", 0, 1, True, "node-e", "pipe-5", "model-2", 4, meta_data),
+            ],
+        )
+
+        self.assertEqual([m.process_id for m in router.replicas(model)], ["p2"])
+        found = router.get_model("p3")
+        assert found is not None
+        self.assertEqual(found.node_id, "node-c")
+        self.assertIsNone(router.get_model("p9"))
+
+    def test_cover_chains_segments_of_other_pipes_over_the_layers(self):
+        node = FakeStateNetworkNode("node-a")
+        router = RouterPipes(node) # pyright: ignore[reportArgumentType]
+        meta_data = make_computed()
+        node.add_peer(
+            "node-a",
+            [
+                MetaModel("p1", 4, 7, True, "node-b", "pipe-1", "model-1", 8, meta_data),
+                MetaModel("p2", 4, 5, True, "node-c", "pipe-2", "model-1", 8, meta_data),
+                MetaModel("p3", 6, 6, True, "node-b", "pipe-3", "model-1", 8, meta_data),
+                MetaModel("p4", 6, 7, True, "node-d", "pipe-2", "model-1", 8, meta_data),
+                MetaModel("p5", 3, 7, True, "node-e", "pipe-4", "model-1", 8, meta_data),
+            ],
+        )
+
+        self.assertEqual([m.process_id for m in router.cover("model-1", "pipe-1", 4, 7, "node-b")], ["p2", "p4"])
+        self.assertEqual(router.cover("model-1", "pipe-1", 4, 7, "node-d"), [])
+        self.assertEqual(router.cover("model-2", "pipe-1", 4, 7), [])
+
+    def test_jobs_start_on_pipes_that_can_prefill(self):
+        node = FakeStateNetworkNode("node-a")
+        router = RouterPipes(node) # pyright: ignore[reportArgumentType]
+        meta_data = make_computed()
+        node.add_peer("node-a", [MetaModel("p1", 0, 3, True, "node-a", "pipe-1", "model-1", 4, meta_data, role="decode")])
+
+        self.assertEqual(router.get_pipe_by_model_id("model-1").pipe_id, "pipe-1")  # pyright: ignore[reportOptionalMemberAccess]
+
+        node.add_peer("node-b", [MetaModel("p2", 0, 3, True, "node-b", "pipe-2", "model-1", 4, meta_data, role="prefill")])
+        for _ in range(10):
+            self.assertEqual(router.get_pipe_by_model_id("model-1").pipe_id, "pipe-2")  # pyright: ignore[reportOptionalMemberAccess]
+
+    def test_handoff_targets_hold_the_same_layers_in_a_decode_pipe(self):
+        node = FakeStateNetworkNode("node-a")
+        router = RouterPipes(node) # pyright: ignore[reportArgumentType]
+        meta_data = make_computed()
+        node.add_peer(
+            "node-a",
+            [
+                MetaModel("p1", 0, 1, True, "node-a", "pipe-1", "model-1", 4, meta_data, role="prefill"),
+                MetaModel("p2", 2, 3, True, "node-b", "pipe-1", "model-1", 4, meta_data, role="prefill"),
+                # Holds layers 0-1 alone
+                MetaModel("p3", 0, 1, True, "node-c", "pipe-2", "model-1", 4, meta_data, role="decode"),
+                MetaModel("p4", 2, 2, True, "node-c", "pipe-2", "model-1", 4, meta_data, role="decode"),
+                MetaModel("p5", 3, 3, True, "node-c", "pipe-2", "model-1", 4, meta_data, role="decode"),
+                # Holds both
+                MetaModel("p6", 0, 1, True, "node-d", "pipe-3", "model-1", 4, meta_data, role="decode"),
+                MetaModel("p7", 2, 3, True, "node-d", "pipe-3", "model-1", 4, meta_data),
+                # Cannot decode
+                MetaModel("p8", 0, 3, True, "node-e", "pipe-4", "model-1", 4, meta_data, role="prefill"),
+            ],
+        )
+        prefill = router.get_pipe_by_pipe_id("pipe-1")
+        assert prefill is not None
+
+        for _ in range(10):
+            targets = router.handoff_targets(prefill)
+            self.assertEqual({s: t.process_id for s, t in targets.items()}, {0: "p6", 2: "p7"})
+
+        node.add_peer("node-a", [m for m in router._all_models() if m.pipe_id != "pipe-3"])
+        self.assertEqual({s: t.process_id for s, t in router.handoff_targets(prefill).items()}, {0: "p3"})
+        self.assertEqual(router.handoff_targets(router.get_pipe_by_pipe_id("pipe-2")), { })  # pyright: ignore[reportArgumentType]
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,142 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'src'))
+
+from transformers import AutoModelForCausalLM, LlamaConfig
+from transformers.cache_utils import DynamicCache
+
+from llm_layer_collector import LlmLayerCollector
+from llm_layer_collector.auto.static_auto_model import StaticAutoModel
+
+from language_pipes.jobs.job_data import computationStateToJobData
+from language_pipes.modeling.compute import compute_layers
+from language_pipes.modeling.segment_process import SegmentProcess, SegmentSpec
+
+NUM_LAYERS = 4
+
+
+class FakeJob:
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.data = None
+
+
+def build_checkpoint(model_dir: Path):
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=NUM_LAYERS,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        vocab_size=64,
+        max_position_embeddings=128
+    )
+    AutoModelForCausalLM.from_config(config).save_pretrained(model_dir / "data", safe_serialization=True)
+
+
+class SegmentProcessTests(unittest.TestCase):
+    """One segment process for layers 1-3 of a tiny random Llama, checked against
+    the same layers run in this process."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        model_dir = Path(cls.tmp.name)
+        build_checkpoint(model_dir)
+
+        cls.collector = LlmLayerCollector(model_dir / "data", model_dir / "local-cache.json")
+        cls.embedding = cls.collector.load_input_embedding(torch.device("cpu"))
+        cls.layers = cls.collector.load_layer_set(1, NUM_LAYERS - 1, torch.device("cpu"))
+        cls.process = SegmentProcess(SegmentSpec(
+            data_dir=model_dir / "data",
+            cache_file=model_dir / "cache.json",
+            device="cpu",
+            data_type=16,
+            start_layer=1,
+            end_layer=NUM_LAYERS - 1
+        ))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.stop()
+        cls.tmp.cleanup()
+
+    def embed(self, input_ids, past_seen_tokens: int, prompt_tokens: int):
+        """The next pass of a sequence: the whole prompt, then one token at a time."""
+        state = StaticAutoModel.compute_embedding(
+            prompt_tokens=prompt_tokens,
+            chunk_size=prompt_tokens,
+            input_embedder=self.embedding,
+            input_ids=torch.tensor([input_ids]),
+            config=self.collector.config,
+            cache=DynamicCache(),
+            past_seen_tokens=past_seen_tokens
+        )
+        return computationStateToJobData(state)
+
+    def local(self, job_data, cache: DynamicCache) -> torch.Tensor:
+        return compute_layers(1, job_data, torch.device("cpu"), self.collector.config, self.layers, cache)[0]
+
+    def test_matches_layers_run_in_this_process(self):
+        job = FakeJob("job-1")
+        cache = DynamicCache(config=self.collector.config)
+        prompt = [1, 2, 3, 4, 5]
+
+        # Prefill, then one decode step that has to read the child's cache
+        for input_ids, past in ((prompt, 0), (prompt + [6], len(prompt))):
+            job.data = self.embed(input_ids, past, len(prompt))
+            state, _ = self.process.compute(1, [job])[0]  # pyright: ignore[reportArgumentType]
+            expected = self.local(job.data, cache)
+            self.assertTrue(torch.equal(state, expected))
+
+    def test_batch_keeps_each_jobs_cache(self):
+        jobs = [FakeJob("batch-1"), FakeJob("batch-2")]
+        prompts = [[1, 2, 3], [7, 8, 9, 10]]
+        caches = [DynamicCache(config=self.collector.config) for _ in jobs]
+
+        for job, prompt, cache in zip(jobs, prompts, caches, strict=True):
+            job.data = self.embed(prompt, 0, len(prompt))
+            self.process.compute(1, [job])  # pyright: ignore[reportArgumentType]
+            self.local(job.data, cache)
+
+        for job, prompt in zip(jobs, prompts, strict=True):
+            job.data = self.embed(prompt + [11], len(prompt), len(prompt))
+        results = self.process.compute(1, jobs)  # pyright: ignore[reportArgumentType]
+
+        for job, cache, (state, _) in zip(jobs, caches, results, strict=True):
+            expected = self.local(job.data, cache)
+            self.assertTrue(torch.allclose(state.float(), expected.float(), atol=1e-2))
+
+    def test_errors_in_the_child_are_raised_here(self):
+        job = FakeJob("broken")
+
+        with self.assertRaisesRegex(Exception, "Segment process failed"):
+            self.process.compute(1, [job])  # pyright: ignore[reportArgumentType]
+
+        # The process is still usable afterwards
+        job.data = self.embed([1, 2], 0, 2)
+        self.assertEqual(len(self.process.compute(1, [job])), 1)  # pyright: ignore[reportArgumentType]
+
+
+class SegmentProcessLoadTests(unittest.TestCase):
+    def test_load_failure_raises(self):
+        with tempfile.TemporaryDirectory() as tmp, self.assertRaisesRegex(Exception, "could not load layers 0-1"):
+            SegmentProcess(SegmentSpec(
+                data_dir=Path(tmp) / "missing",
+                cache_file=Path(tmp) / "cache.json",
+                device="cpu",
+                data_type=16,
+                start_layer=0,
+                end_layer=1
+            ))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -54,6 +54,26 @@ class FakeEndModel:
         self.calls.append("set_result")
         job.result = "done"
 
+    def compute_layers_batch(self, jobs):
+        self.calls.append(("compute_layers_batch", [job.job_id for job in jobs]))
+        for job in jobs:
+            self.compute_layers(job)
+
+    def compute_embed_batch(self, jobs):
+        self.calls.append(("compute_embed_batch", [job.job_id for job in jobs]))
+        for job in jobs:
+            self.compute_embed(job)
+
+    def compute_norm_batch(self, jobs):
+        self.calls.append(("compute_norm_batch", [job.job_id for job in jobs]))
+        for job in jobs:
+            self.compute_norm(job)
+
+    def compute_head_batch(self, jobs):
+        self.calls.append(("compute_head_batch", [job.job_id for job in jobs]))
+        for job in jobs:
+            self.compute_head(job)
+
 
 class FakeEndModelContinue(FakeEndModel):
     def compute_head(self, job):
@@ -75,6 +95,26 @@ class FakeModel:
             job.data = make_job_data()
         job.set_layer(torch.zeros((1, 1)), self.end_layer + 1, self.num_hidden_layers)
 
+    def process_jobs(self, jobs):
+        for job in jobs:
+            self.process_job(job)
+
+class BatchingModel(FakeModel):
+    """Records which jobs went through each batched forward."""
+    def __init__(self, node_id, start_layer, end_layer, virtual=False, num_hidden_layers=1):
+        super().__init__(node_id, start_layer, end_layer, virtual=virtual, num_hidden_layers=num_hidden_layers)
+        self.batches = []
+        self.singles = []
+
+    def process_job(self, job):
+        self.singles.append(job.job_id)
+        super().process_job(job)
+
+    def process_jobs(self, jobs):
+        self.batches.append([job.job_id for job in jobs])
+        for job in jobs:
+            super().process_job(job)
+
 class TrackingModel(FakeModel):
     def __init__(self, node_id, start_layer, end_layer, virtual=False, num_hidden_layers=1):
         super().__init__(node_id, start_layer, end_layer, virtual=virtual, num_hidden_layers=num_hidden_layers)